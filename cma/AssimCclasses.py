@@ -30,6 +30,9 @@ from __future__ import print_function, absolute_import
 from typing import Optional, List, Union, Tuple
 import six
 import collections
+import collections.abc
+import json
+import os
 import traceback
 import types
 from sys import stderr
@@ -1406,16 +1409,11 @@ class pyFrame(pyAssimObj):
     @staticmethod
     def Cstruct2Frame(frameptr) -> 'pyFrame':
         """Unmarshalls a binary blob (Cstruct) into a Frame"""
-        print(f"Cstruct2Frame: {frameptr}")
         frameptr = cast(frameptr, cClass.Frame)
-        print(f"Cstruct2Frame: CCref-ing {frameptr}")
         CCref(frameptr)
         frametype = frameptr[0].type
-        print(f"Cstruct2Frame:  frametype {frametype}")
         Cclassname: str = proj_class_classname(frameptr).decode("utf8")
         our_c_class = getattr(cClass, Cclassname)
-        print(f"OUR C CLASS: {our_c_class}, {type(our_c_class)}")
-        print(f"FRAMEPTR: {frameptr}, {type(frameptr)}")
         class_frameptr = cast(frameptr, our_c_class)
         if Cclassname == "NetAddr":
             frame_result = pyNetAddr(frametype, None, Cstruct=class_frameptr)
@@ -1425,10 +1423,8 @@ class pyFrame(pyAssimObj):
             pyclassname = "py" + Cclassname
             assert pyclassname in globals()
             pyobjclass = globals()[pyclassname]
-            print(f"PYOBJCLASS: {pyobjclass}")
             assert issubclass(pyobjclass, pyFrame)
             frame_result = pyobjclass(frametype, Cstruct=class_frameptr)
-        print(f"FRAME_RESULT w/o EVAL: {frame_result}: {type(frame_result)}")
         return frame_result
 
 
@@ -1901,9 +1897,26 @@ class pyCryptCurve25519(pyCryptFrame):
         return warnings
 
 
+# How pyFrameSet.decode_frames() decodes each frame type - from the Frame classes in FrameTypes
+_STRING_VALUE, _INT_VALUE, _SEQNO_VALUE, _ADDR_VALUE, _RAW_VALUE = range(5)
+_FRAME_VALUE_KINDS = {
+    frametype: {
+        "pyCstringFrame": _STRING_VALUE,
+        "pyIntFrame": _INT_VALUE,
+        "pySeqnoFrame": _SEQNO_VALUE,
+        "pyAddrFrame": _ADDR_VALUE,
+        "pyIpPortFrame": _ADDR_VALUE,
+    }.get(info[0].__name__, _RAW_VALUE)
+    for frametype, info in FrameTypes.intframetypes.items()
+}
+
+
 class pyFrameSet(pyAssimObj):
     """Class for Frame Sets - for collections of Frames making up a logical packet"""
 
+    # decode_frames(views=True) returns string and blob values at least this long as memoryviews
+    VIEW_THRESHOLD = 4096
+
     def __init__(self, framesettype, Cstruct=None):
         "Initializer for pyFrameSet"
         if Cstruct is None:
@@ -1987,13 +2000,13 @@ class pyFrameSet(pyAssimObj):
         # But somehow, 'self' doesn't get freed like it ought to :-(
         # BUG??
         # return g_slist_length(self._Cstruct[0].framelist)
-        # So, let's do this instead...
+        # So, let's do this instead - following the 'next' pointers ourselves
         curframe = self._Cstruct[0].framelist
         count = 0
         while curframe:
             count += 1
-            curframe = g_slist_next(curframe)
-        return int(count)
+            curframe = curframe[0].next
+        return count
 
     def __delitem__(self, key):
         """Fail - we don't implement this"""
@@ -2028,6 +2041,72 @@ class pyFrameSet(pyAssimObj):
             yield yieldval
             curframe = g_slist_next(curframe)
 
+    def decode_frames(self, views=False):
+        """
+        Decode all our Frames in a single pass - without constructing a pyFrame for each one.
+        We read the Frames' C structs directly, so most Frames cost no ctypes function calls
+        at all - unlike iter(), which makes several for every Frame, and then more for every
+        getstr() or getint().
+        Only address Frames still go through pyFrame objects - to make their pyNetAddrs.
+
+        Values are:
+            string Frames:      str
+            integer Frames:     int
+            sequence numbers:   (qid, reqid)
+            address Frames:     pyNetAddr
+            everything else:    bytes (the raw Frame value)
+
+        With 'views' True, string and raw values at least VIEW_THRESHOLD bytes long
+        are returned as memoryviews of the Frame's own memory instead - with no copying
+        or decoding. They keep this FrameSet alive, but must not be modified.
+
+        :param views: bool: True to return large values as memoryviews
+        :return: [(int, object)]: (frametype, value) for each Frame - in order
+        """
+        threshold = pyFrameSet.VIEW_THRESHOLD if views else None
+        result = []
+        curframe = self._Cstruct[0].framelist
+        while curframe:
+            frameaddr = curframe[0].data
+            frame = Frame.from_address(frameaddr)
+            frametype = frame.type
+            kind = _FRAME_VALUE_KINDS.get(frametype, _RAW_VALUE)
+            if kind == _STRING_VALUE:
+                # String Frames' lengths include the trailing NUL
+                value = self._frame_bytes(frame.value, frame.length - 1, threshold)
+                if not isinstance(value, memoryview):
+                    value = value.decode("utf8")
+            elif kind == _INT_VALUE:
+                value = AssimCtypes.IntFrame.from_address(frameaddr)._value
+            elif kind == _SEQNO_VALUE:
+                seqno = SeqnoFrame.from_address(frameaddr)
+                value = (seqno._qid, seqno._reqid)
+            elif kind == _ADDR_VALUE:
+                value = pyFrame.Cstruct2Frame(cast(frameaddr, cClass.Frame)).getnetaddr()
+            else:
+                value = self._frame_bytes(frame.value, frame.length, threshold)
+            result.append((frametype, value))
+            curframe = curframe[0].next
+        return result
+
+    def _frame_bytes(self, address, length, threshold):
+        """
+        Return the 'length' bytes at 'address' - as a memoryview if there are at least
+        'threshold' of them (and 'threshold' isn't None), otherwise as bytes.
+
+        :param address: int: address of the Frame value
+        :param length: int: number of bytes
+        :param threshold: int: smallest length to return as a memoryview - or None
+        :return: bytes or memoryview
+        """
+        if not address or length <= 0:
+            return b""
+        if threshold is None or length < threshold:
+            return string_at(address, length)
+        cbytes = (ctypes.c_ubyte * length).from_address(address)
+        cbytes._frameset = self  # The Frame's memory belongs to us - keep us around
+        return memoryview(cbytes).cast("B")
+
     def fstypestr(self):
         """Return the frameset type name as a string"""
         return FrameSetTypes.get(self.get_framesettype())[0]
@@ -2233,7 +2312,6 @@ class pyConfigContext(pyAssimObj):
             # We're creating a new reference to the pre-existing NetAddr
             CCref(naddr)
             gotten_addr = pyNetAddr(None, Cstruct=naddr)
-            print(f"CCref of NetAddr {gotten_addr}")
             return gotten_addr
         raise IndexError("No such NetAddr value [%s]" % name)
 
@@ -2319,7 +2397,7 @@ class pyConfigContext(pyAssimObj):
             if isinstance(elem, pyConfigContext):
                 self._Cstruct[0].appendconfig(self._Cstruct, name, elem._Cstruct)
                 continue
-            if isinstance(elem, dict):
+            if isinstance(elem, (dict, ConfigSnapshot)):
                 cfgctx = pyConfigContext.from_dict(elem)
                 self._Cstruct[0].appendconfig(self._Cstruct, name, cfgctx._Cstruct)
                 continue
@@ -2381,9 +2459,7 @@ class pyConfigContext(pyAssimObj):
         except ValueError:
             suffix = None
             prefix = key
-        print(f"prefix {prefix} suffix {suffix}")
         if prefix not in self:
-            print(f"prefix {prefix} NOT IN self {self}")
             # Note that very similar code exists in GraphNodes get member function
             if not prefix.endswith("]"):
                 return alternative
@@ -2392,17 +2468,13 @@ class pyConfigContext(pyAssimObj):
                 proper = prefix[0 : len(prefix) - 1]
                 try:
                     (preprefix, idx) = proper.split("[", 1)
-                    print(f"preprefix {preprefix} idx {idx}")
                 except ValueError:
                     return alternative
-                print(f"preprefix in self? {preprefix in self}")
                 if preprefix not in self:
                     return alternative
                 try:
                     array = self[preprefix]
                     idx = int(idx)  # Possible ValueError
-                    print(f"ARRAY IS {type(array)}, {array}", file=stderr)
-                    print(f"INDEX IS {idx}", file=stderr)
                     value = array[idx]  # possible IndexError or TypeError
                     assert not isinstance(value, bytes)
                     if suffix is None:
@@ -2412,7 +2484,6 @@ class pyConfigContext(pyAssimObj):
                     return alternative
                 return value.deepget(suffix, alternative)
 
-        print(f"prefix {prefix} IN self {self}")
         prefixvalue = self[prefix]
         assert not isinstance(prefixvalue, bytes)
         if suffix is None:
@@ -2423,6 +2494,15 @@ class pyConfigContext(pyAssimObj):
         assert not isinstance(gotten, bytes)
         return gotten
 
+    def snapshot(self):
+        """
+        Return an immutable native Python copy of this pyConfigContext - see ConfigSnapshot.
+        Use this when you're going to read lots of values and won't be changing any of them.
+
+        :return: ConfigSnapshot
+        """
+        return ConfigSnapshot.from_configcontext(self)
+
     def has_key(self, key):
         """return True if it has the given key"""
         return self.__contains__(key)
@@ -2481,7 +2561,7 @@ class pyConfigContext(pyAssimObj):
             return self.setframe(name, value)
         if isinstance(value, pyConfigContext):
             return self.setconfig(name, value)
-        if isinstance(value, dict):
+        if isinstance(value, (dict, ConfigSnapshot)):
             return self.setconfig(name, pyConfigContext(value))
         if isinstance(value, (list, tuple)) or hasattr(value, "__iter__"):
             return self.setarray(name, value)
@@ -2494,6 +2574,200 @@ class pyConfigContext(pyAssimObj):
         self.setint(name, int(value))
 
 
+_SNAPSHOT_MISSING = object()  # deepget() cache marker for "no such value"
+
+
+class ConfigSnapshot(collections.abc.Mapping):
+    """
+    An immutable native Python copy of a pyConfigContext.
+
+    Every pyConfigContext read - __getitem__, get, deepget, keys - is one or more ctypes calls,
+    and most of them create new wrapper objects. Code which evaluates lots of expressions
+    against the same discovery data (FOREACH or ATTRSEARCH over proc_sys or fileattrs, for
+    example) crosses into C a great many times. A ConfigSnapshot walks the C structures once
+    and keeps the results as Python objects:
+        - JSON objects become ConfigSnapshots (which are read-only Mappings)
+        - arrays become tuples
+        - strings, ints, floats, bools and None are themselves
+        - NetAddrs and Frames stay pyNetAddrs and pyFrames (NetAddrs in arrays become strings,
+          just like pyConfigContext.getarray() returns them)
+
+    It supports the same read operations as pyConfigContext - including deepget(), whose
+    results are cached, since nothing underneath them can change.
+    """
+
+    __slots__ = ("_data", "_deepcache")
+
+    def __init__(self, data=None):
+        """
+        :param data: dict: already-converted values (we take ownership of it)
+        """
+        self._data = {} if data is None else data
+        self._deepcache = None
+
+    @staticmethod
+    def from_configcontext(cfgctx):
+        """
+        Construct a ConfigSnapshot from a pyConfigContext
+
+        :param cfgctx: pyConfigContext: what to take a snapshot of
+        :return: ConfigSnapshot
+        """
+        return ConfigSnapshot._from_cstruct(cfgctx._Cstruct)
+
+    @staticmethod
+    def from_dict(dictval):
+        """
+        Construct a ConfigSnapshot from a dict-like object - converting nested dicts and lists
+
+        :param dictval: dict-like object
+        :return: ConfigSnapshot
+        """
+        if isinstance(dictval, ConfigSnapshot):
+            return dictval
+        return ConfigSnapshot(
+            {str(key): ConfigSnapshot._from_python(dictval[key]) for key in dictval.keys()}
+        )
+
+    @staticmethod
+    def _from_python(value):
+        "Convert a (possibly nested) Python value the same way from_dict() does"
+        if isinstance(value, pyConfigContext):
+            return value.snapshot()
+        if hasattr(value, "keys"):
+            return ConfigSnapshot.from_dict(value)
+        if isinstance(value, (list, tuple)):
+            return tuple(ConfigSnapshot._from_python(elem) for elem in value)
+        return value
+
+    @staticmethod
+    def _from_cstruct(cstruct):
+        "Walk a C ConfigContext, converting each of its values"
+        data = {}
+        cfg = cstruct[0]
+        keylist = cast(cfg.keys(cstruct), POINTER(GSList))
+        curkey = keylist
+        while curkey:
+            key = u_string_at(curkey[0].data)
+            data[key] = ConfigSnapshot._from_cvalue(cfg.getvalue(cstruct, key), False)
+            curkey = g_slist_next(curkey)
+        g_slist_free(keylist)
+        return ConfigSnapshot(data)
+
+    # pylint: disable=R0911
+    @staticmethod
+    def _from_cvalue(valptr, inarray):
+        "Convert a C ConfigValue - reading the struct directly, without a pyConfigValue"
+        value = valptr[0]
+        vtype = value.valtype
+        if vtype == CFG_STRING:
+            strval = value.u.strvalue
+            return strval.data.decode("utf8") if isinstance(strval, String) else strval
+        if vtype == CFG_INT64:
+            return int(value.u.intvalue)
+        if vtype == CFG_BOOL:
+            return value.u.intvalue != 0
+        if vtype == CFG_FLOAT:
+            return float(value.u.floatvalue)
+        if vtype == CFG_CFGCTX:
+            return ConfigSnapshot._from_cstruct(value.u.cfgctxvalue)
+        if vtype == CFG_ARRAY:
+            ret = []
+            curlist = value.u.arrayvalue
+            while curlist:
+                elem = cast(curlist[0].data, cClass.ConfigValue)
+                ret.append(ConfigSnapshot._from_cvalue(elem, True))
+                curlist = g_slist_next(curlist)
+            return tuple(ret)
+        if vtype == CFG_NETADDR:
+            net = pyNetAddr(None, Cstruct=value.u.addrvalue)
+            # We're creating a new reference to the pre-existing NetAddr
+            CCref(net._Cstruct)
+            return str(net) if inarray else net
+        if vtype == CFG_FRAME:
+            #       Cstruct2Frame calls CCref() - so we don't need to
+            return pyFrame.Cstruct2Frame(value.u.framevalue)
+        return None
+
+    def snapshot(self):
+        "We're already a snapshot - return ourselves"
+        return self
+
+    def __getitem__(self, key):
+        """Return the value associated with 'key' - or raise KeyError"""
+        return self._data[key]
+
+    def __iter__(self):
+        """Iterate over our keys"""
+        return iter(self._data)
+
+    def __len__(self):
+        """Return the number of keys at our top level"""
+        return len(self._data)
+
+    def __contains__(self, key):
+        """return True if we contain the given key"""
+        return key in self._data
+
+    def has_key(self, key):
+        """return True if we contain the given key"""
+        return key in self._data
+
+    def get(self, key, alternative=None):
+        """return value if we contain the given key - 'alternative' if not"""
+        return self._data.get(key, alternative)
+
+    def deepget(self, key, alternative=None):
+        """return value if we contain the given *structured* key - 'alternative' if not
+
+        The key syntax is the same as for pyConfigContext.deepget: "a.b[2].c"
+        """
+        cache = self._deepcache
+        if cache is None:
+            cache = self._deepcache = {}
+        try:
+            value = cache[key]
+        except KeyError:
+            value = cache[key] = self._deeplookup(key)
+        return alternative if value is _SNAPSHOT_MISSING else value
+
+    def _deeplookup(self, key):
+        "Look up a *structured* key - returning _SNAPSHOT_MISSING if it's not there"
+        prefix, _, suffix = key.partition(".")
+        if prefix in self._data:
+            value = self._data[prefix]
+        else:
+            # Note that very similar code exists in pyConfigContext.deepget
+            if not prefix.endswith("]"):
+                return _SNAPSHOT_MISSING
+            preprefix, _, idx = prefix[:-1].partition("[")
+            if preprefix not in self._data:
+                return _SNAPSHOT_MISSING
+            try:
+                value = self._data[preprefix][int(idx)]
+            except (TypeError, IndexError, ValueError):
+                return _SNAPSHOT_MISSING
+        if not suffix:
+            return value
+        if not isinstance(value, ConfigSnapshot):
+            return _SNAPSHOT_MISSING
+        return value.deepget(suffix, _SNAPSHOT_MISSING)
+
+    def __str__(self):
+        """Return our JSON representation - like pyConfigContext's"""
+        return json.dumps(self, default=ConfigSnapshot._json_default, separators=(",", ":"))
+
+    def __repr__(self):
+        return "ConfigSnapshot(%s)" % str(self)
+
+    @staticmethod
+    def _json_default(obj):
+        "Make our values into something json.dumps() knows how to encode"
+        if isinstance(obj, ConfigSnapshot):
+            return dict(sorted(obj.items()))
+        return str(obj)
+
+
 class pyConfigValue(pyAssimObj):
     """A Python wrapper for a C implementation of something like a Python Dictionary"""
 
@@ -2580,12 +2854,18 @@ class pyNetIO(pyAssimObj):
 
     def setup_config(self, bind_addr_str: str) -> None:
         bind_addr = pyNetAddr(bind_addr_str)
-        if not self.bindaddr(bind_addr):
+        if not getattr(self, "prebound", False) and not self.bindaddr(bind_addr):
             raise NameError(f"Cannot bind to address {bind_addr}")
         if not self.mcastjoin(pyNetAddr(CMAADDR)):
             print(f"WARNING: Failed to join multicast at {CMAADDR}", file=stderr)
         self.setblockio(False)
 
+    def adopt_socket(self, fileno):
+        """Replace our (unbound) socket with an already-bound one - like a sharded CMA worker's
+        socket in its reuseport group. setup_config() won't bind it again."""
+        os.dup2(fileno, self.fileno())
+        self.prebound = True
+
     def setblockio(self, mode):
         """Set this NetIO object to blocking IO mode"""
         base = self._Cstruct[0]
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Admission control for STARTUP and HBDEAD storms.
+
+When a rack powers on, hundreds of STARTUPs arrive together - and when a switch fails,
+hundreds of HBDEADs do. Each one is expensive, and without some help they crowd out
+everything else the CMA has to do.
+
+The PacketListener asks our AdmissionController about each FrameSet before dispatching it.
+FrameSet types can each have a token bucket limiting how many we process per second.
+When a bucket is empty:
+    - STARTUPs are deferred: we ignore them. Nanoprobes send STARTUP outside our reliable
+      protocol and repeat it every 5 seconds until we answer it (see nano_reqconfig()) -
+      so the retry is built into the nanoprobe.
+    - Anything else is held - along with everything after it from the same sender, so they
+      stay in order - until the bucket has a token for it.
+
+Death reports get special treatment - DispatchHBDEAD hands them to us:
+    - Both of a dead drone's ring neighbors report its death. Reports about a drone whose
+      death we're already processing (or just processed) are merged into the first one.
+    - With a death window configured, we collect deaths for that long and then process
+      them as a batch - so a whole rack dying becomes one ring topology update.
+    A death we've started processing only counts once its transaction commits: the
+    MessageDispatcher calls commit_deaths() or abort_deaths() when each transaction ends.
+    After an abort, the next report of that death is news again - and the deaths from a
+    failed batch go back into the next one (once).
+"""
+from __future__ import print_function
+import time
+import collections
+from frameinfo import FrameSetTypes
+from cmashard import ShardMap
+
+
+class TokenBucket(object):
+    """
+    A token bucket: 'burst' tokens right away, refilled at 'rate' tokens per second.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: float: tokens per second
+        :param burst: int: the most tokens we can hold
+        """
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        self.tokens = self.burst
+        self.last = None
+
+    def take(self, now):
+        """
+        Take a token - if we have one
+
+        :param now: float: current time
+        :return: float: 0.0 if we took a token, otherwise seconds until we'll have one
+        """
+        if self.last is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1.0 - 1e-9:  # Don't let rounding errors cost us a token
+            self.tokens = max(self.tokens - 1.0, 0.0)
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+
+class AdmissionController(object):
+    """
+    Decides which incoming FrameSets we process now, and which ones wait.
+    It also collapses and batches death reports for DispatchHBDEAD.
+    """
+
+    ADMIT = 0  # Process it now
+    DEFER = 1  # Ignore it - its sender will send it again
+    HOLD = 2  # Keep it (and everything after it from its sender) until we have a token for it
+
+    STARTUP_RETRY = 5.0  # How often nanoprobes repeat an unanswered STARTUP (nano_reqconfig())
+    DEFER_MEMORY = 60.0  # How long we remember a drone whose STARTUP we deferred
+    unreliable_fstypes = {FrameSetTypes.STARTUP}
+
+    def __init__(self, limits=None, death_window_ms=0, death_max_batch=500, death_merge_s=30):
+        """
+        :param limits: {str: {str: int}}: {"rate": n, "burst": n} for each FrameSet type name
+        :param death_window_ms: int: how long to collect deaths before processing them together
+        :param death_max_batch: int: process our deaths right away when we have this many
+        :param death_merge_s: int: how long after processing a death we merge reports of it
+        """
+        self.buckets = {}
+        for name, limit in (limits or {}).items():
+            if name not in FrameSetTypes.strframetypes:
+                raise ValueError("Unknown FrameSet type [%s] in admission limits" % name)
+            if limit.get("rate", 0) > 0:
+                fstype = FrameSetTypes.strframetypes[name][0]
+                self.buckets[fstype] = TokenBucket(limit["rate"], limit.get("burst", 1))
+        self.death_window_ms = death_window_ms
+        self.death_max_batch = death_max_batch
+        self.death_merge_s = death_merge_s
+        # These are all in the order their entries were added
+        self._deferred = collections.OrderedDict()  # address -> when we last deferred it
+        self._pending_deaths = collections.OrderedDict()  # death key -> (address, reporter)
+        self._recent_deaths = collections.OrderedDict()  # death key -> when we processed it
+        # Deaths we've started processing in this transaction - (death key, (address, reporter)
+        # if it came from our batch, else None)
+        self._uncommitted = []
+        self._retried = set()  # death keys which have already gone back into a batch once
+        self.stats = {
+            "admitted": 0,
+            "deferred": 0,
+            "held": 0,
+            "merged": 0,
+            "dropped": 0,
+            "batches": 0,
+            "batched_deaths": 0,
+            "aborted_deaths": 0,
+        }
+
+    @staticmethod
+    def from_config(config):
+        """
+        Construct an AdmissionController from our configuration
+
+        :param config: pyConfigContext: our configuration
+        :return: AdmissionController
+        """
+        params = config.get("admission", {})
+        return AdmissionController(
+            limits=params.get("limits", {}),
+            death_window_ms=params.get("death_window_ms", 0),
+            death_max_batch=params.get("death_max_batch", 500),
+            death_merge_s=params.get("death_merge_s", 30),
+        )
+
+    def admit(self, fromaddr, frameset, now=None):
+        """
+        Decide what to do with this FrameSet
+
+        :param fromaddr: pyNetAddr: who sent it
+        :param frameset: pyFrameSet: the FrameSet
+        :param now: float: current time - for testing
+        :return: (int, float): ADMIT, DEFER or HOLD - and how many seconds it's likely to wait
+        """
+        fstype = frameset.get_framesettype()
+        bucket = self.buckets.get(fstype)
+        if bucket is None:
+            self.stats["admitted"] += 1
+            return AdmissionController.ADMIT, 0.0
+        now = time.time() if now is None else now
+        wait = bucket.take(now)
+        if fstype in AdmissionController.unreliable_fstypes:
+            key = repr(fromaddr)
+            if wait == 0.0:
+                self._deferred.pop(key, None)
+                self.stats["admitted"] += 1
+                return AdmissionController.ADMIT, 0.0
+            self._deferred.pop(key, None)
+            self._deferred[key] = now
+            self._forget_older(self._deferred, now - AdmissionController.DEFER_MEMORY)
+            self.stats["deferred"] += 1
+            return AdmissionController.DEFER, max(wait, AdmissionController.STARTUP_RETRY)
+        if wait == 0.0:
+            self.stats["admitted"] += 1
+            return AdmissionController.ADMIT, 0.0
+        self.stats["held"] += 1
+        return AdmissionController.HOLD, wait
+
+    @staticmethod
+    def _forget_older(timestamps, cutoff):
+        "Forget the entries in this time-ordered OrderedDict from before 'cutoff'"
+        while timestamps:
+            key, when = next(iter(timestamps.items()))
+            if when >= cutoff:
+                return
+            del timestamps[key]
+
+    def note_duplicate(self):
+        "Count a FrameSet we dropped because the same request is already waiting its turn"
+        self.stats["dropped"] += 1
+
+    @staticmethod
+    def death_key(addr):
+        """
+        Return the key we track a dead drone's address by.
+        IPv4 addresses and their IPv4-mapped IPv6 equivalents are the same drone.
+
+        :param addr: pyNetAddr: the address of the dead drone
+        :return: (str, int): its IP address and port
+        """
+        ipaddr, port = ShardMap.split_addr(addr)
+        if ipaddr.version == 6 and ipaddr.ipv4_mapped is not None:
+            ipaddr = ipaddr.ipv4_mapped
+        return str(ipaddr), port
+
+    def report_death(self, addr, reporter, now=None):
+        """
+        Note a death report from DispatchHBDEAD
+
+        :param addr: pyNetAddr: the address of the dead drone
+        :param reporter: pyNetAddr: who told us about it
+        :param now: float: current time - for testing
+        :return: bool: True if it's news - False if we merged it with an earlier report
+        """
+        now = time.time() if now is None else now
+        self._forget_older(self._recent_deaths, now - self.death_merge_s)
+        key = self.death_key(addr)
+        if key in self._pending_deaths or key in self._recent_deaths:
+            self.stats["merged"] += 1
+            return False
+        if self.death_window_ms > 0:
+            self._pending_deaths[key] = (addr, reporter)
+        else:
+            self._recent_deaths[key] = now
+            self._uncommitted.append((key, None))
+        return True
+
+    def forget_death(self, addr):
+        """
+        Forget about the death of the drone at this address - because it's come back to life.
+        Any new report of its death is news.
+
+        :param addr: pyNetAddr: the drone's address
+        :return: None
+        """
+        key = self.death_key(addr)
+        self._pending_deaths.pop(key, None)
+        self._recent_deaths.pop(key, None)
+        self._uncommitted = [entry for entry in self._uncommitted if entry[0] != key]
+        self._retried.discard(key)
+
+    def batch_deaths(self):
+        "Return True if DispatchHBDEAD should leave deaths to take_pending_deaths()"
+        return self.death_window_ms > 0
+
+    def pending_death_count(self):
+        "Return the number of deaths waiting for our batch"
+        return len(self._pending_deaths)
+
+    def deaths_overdue(self):
+        "Return True if we have so many deaths waiting we should process them now"
+        return len(self._pending_deaths) >= self.death_max_batch
+
+    def take_pending_deaths(self, now=None):
+        """
+        Take all our waiting deaths - for processing as a batch
+
+        :param now: float: current time - for testing
+        :return: [(pyNetAddr, pyNetAddr)]: (dead drone address, reporter address) pairs
+        """
+        now = time.time() if now is None else now
+        deaths = list(self._pending_deaths.values())
+        for key, death in self._pending_deaths.items():
+            self._recent_deaths[key] = now
+            self._uncommitted.append((key, death))
+        self._pending_deaths = collections.OrderedDict()
+        if deaths:
+            self.stats["batches"] += 1
+            self.stats["batched_deaths"] += len(deaths)
+        return deaths
+
+    def commit_deaths(self):
+        "The transaction processing our latest deaths has committed - they really happened"
+        for key, _death in self._uncommitted:
+            self._retried.discard(key)
+        self._uncommitted = []
+
+    def abort_deaths(self):
+        """
+        The transaction processing our latest deaths has aborted - forget we processed them.
+        Batched deaths go back into our next batch - unless they've failed before.
+
+        :return: None
+        """
+        for key, death in self._uncommitted:
+            self._recent_deaths.pop(key, None)
+            self.stats["aborted_deaths"] += 1
+            if death is None:
+                continue
+            if key in self._retried:
+                self._retried.discard(key)  # Failed twice - give up on it
+            else:
+                self._retried.add(key)
+                self._pending_deaths[key] = death
+        self._uncommitted = []
+
+    def summary(self):
+        "Return a string summarizing what we've done"
+        stats = self.stats
+        return (
+            "%d admitted, %d deferred (%d drones waiting), %d held, %d merged, %d dropped"
+            ", %d deaths in %d batches, %d deaths aborted"
+            % (
+                stats["admitted"],
+                stats["deferred"],
+                len(self._deferred),
+                stats["held"],
+                stats["merged"],
+                stats["dropped"],
+                stats["batched_deaths"],
+                stats["batches"],
+                stats["aborted_deaths"],
+            )
+        )
@@ -102,7 +102,9 @@ class ArpDiscoveryListener(DiscoveryListener):
         if not discoverychanged:
             return
         if json_obj["discovertype"] == "ARP":
-            self.processpkt_arp(drone, src_addr, json_obj)
+            # The NICs, IP addresses and network segments we update are shared by our domain
+            if not self.forwarded_to_domain_owner(drone, json_obj):
+                self.processpkt_arp(drone, src_addr, json_obj)
         elif json_obj["discovertype"] == "netconfig":
             self.processpkt_netconfig(drone, src_addr, json_obj)
         else:
@@ -34,9 +34,12 @@ import sys
 from sys import stderr
 import os
 import pwd
+import json
 import inject
 from py2neo import Graph
-from query import ClientQuery
+from query import ClientQuery, grab_category_scores
+from scorerollup import ScoreRollups
+from cypherprofile import CypherProfiler, DEFAULT_REPORT_FILE
 from consts import CMAconsts
 from AssimCtypes import (
     QUERYINSTALL_DIR,
@@ -223,6 +226,92 @@ class loadbp(object):
         return 0 if qcount > 0 else 1
 
 
+@RegisterCommand
+class checkscores(object):
+    "Class for the 'checkscores' action (sub-command). We check our score rollups"
+
+    def __init__(self):
+        "Default init function"
+        pass
+
+    @staticmethod
+    def usage():
+        "reports usage for this sub-command"
+        return "checkscores"
+
+    @staticmethod
+    def execute(store, _executor_context, otherargs, _flagoptions):
+        "Compare our score rollups against a full recomputation of the scores"
+        if len(otherargs) > 0:
+            return usage()
+        dtype_totals, _drone_totals, rule_totals = grab_category_scores(store=store)
+        differences = ScoreRollups.compare(store, dtype_totals, rule_totals)
+        for key, rollup_score, recomputed in differences:
+            print("%s: rollup %s, recomputed %s" % ("/".join(key), rollup_score, recomputed))
+        if differences:
+            print("%d score rollups are inconsistent." % len(differences), file=stderr)
+            return 1
+        return 0
+
+
+@RegisterCommand
+class rebuildscores(object):
+    "Class for the 'rebuildscores' action (sub-command). We recompute our score rollups"
+
+    def __init__(self):
+        "Default init function"
+        pass
+
+    @staticmethod
+    def usage():
+        "reports usage for this sub-command"
+        return "rebuildscores"
+
+    @staticmethod
+    def execute(store, _executor_context, otherargs, _flagoptions):
+        "Replace our score rollups with a full recomputation of the scores"
+        if len(otherargs) > 0:
+            return usage()
+        dtype_totals, _drone_totals, rule_totals = grab_category_scores(store=store)
+        count = ScoreRollups.rebuild(store, dtype_totals, rule_totals)
+        store.commit()
+        print("Rebuilt %d score rollups." % count)
+        return 0
+
+
+@RegisterCommand
+class cypherprofile(object):
+    "Class for the 'cypherprofile' action (sub-command). We report on the CMA's Cypher statements"
+
+    def __init__(self):
+        "Default init function"
+        pass
+
+    @staticmethod
+    def usage():
+        "reports usage for this sub-command"
+        return "cypherprofile [statement-shape-count [report-file]]"
+
+    @staticmethod
+    def execute(_store, _executor_context, otherargs, _flagoptions):
+        "Print the Cypher profile the CMA last saved"
+        if len(otherargs) > 2:
+            return usage()
+        try:
+            count = int(otherargs[0]) if otherargs else 20
+        except ValueError:
+            return usage()
+        filename = otherargs[1] if len(otherargs) > 1 else DEFAULT_REPORT_FILE
+        try:
+            with open(filename) as reportfile:
+                report = json.load(reportfile)
+        except (IOError, OSError, ValueError) as oops:
+            print("Cannot read Cypher profile %s: %s" % (filename, oops), file=stderr)
+            return 1
+        CypherProfiler.print_report(report, count=count)
+        return 0
+
+
 @RegisterCommand
 class genkeys(object):
     "Generate two CMA keys and store in optional directory."
@@ -353,8 +442,8 @@ def main(argv):
     ourstore = None
     executor_context = None
 
-    nodbcmds = {"genkeys", "neo4jpass"}
-    rwcmds = {"loadqueries", "loadbp"}
+    nodbcmds = {"genkeys", "neo4jpass", "cypherprofile"}
+    rwcmds = {"loadqueries", "loadbp", "rebuildscores"}
     ourstore = None
     command = None
     selected_options = {}
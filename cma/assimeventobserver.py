@@ -40,6 +40,8 @@ from AssimCtypes import NOTIFICATION_SCRIPT_DIR, setpipebuf
 from AssimCclasses import pyConfigContext, pyNetAddr
 from assimevent import AssimEvent
 from assimjson import JSONtree
+from eventworkers import DelimitedReader, EventWorkerPool, READ_SIZE
+import assimglib as glib
 
 DEBUG = False
 
@@ -147,9 +149,14 @@ class FIFOEventObserver(AssimEventObserver):
     are observed.  Each message encapsulates a single event, and is followed by a single
     NUL (zero) byte.  If the len(JSON) is 100, then 101 bytes are written to the
     FIFO, with the last being a single NUL byte (as noted in the previous sentence).
+
+    When the FIFO is full (our reader is behind), we hang on to events and write them when
+    there's room again - up to maxpending bytes of them. After that we drop new events.
     """
 
     NULstr = chr(0)  # Will this work in python 3?
+    maxpending = 16 * 1024 * 1024  # Most event bytes we'll hold while the FIFO is full
+    flush_ms = 100  # How often we retry writing held events (when we have a mainloop)
 
     def __init__(self, FIFOwritefd, constraints=None, maxerrcount=None):
         """Initializer for FIFO EventObserver class.
@@ -163,6 +170,11 @@ class FIFOEventObserver(AssimEventObserver):
         self.constraints = constraints
         self.errcount = 0
         self.maxerrcount = maxerrcount
+        self.pending = bytearray()  # Event bytes the FIFO didn't have room for (yet)
+        self.backpressured = False  # True while the FIFO is full
+        self.backpressure_count = 0  # Number of times the FIFO has filled up
+        self.dropped = 0  # Events dropped because we were holding too many
+        self.flush_timer = None
         # We want a big buffer in the FIFO between us and our clients - they might be slow
         # 4 MB ought to be plenty.  Most events are only a few hundred bytes...
         pipebufsize = setpipebuf(FIFOwritefd, 4096 * 1024)
@@ -189,22 +201,74 @@ class FIFOEventObserver(AssimEventObserver):
         if not self.is_interesting(event):
             return
 
-        json = str(JSONtree(event))
-        jsonlen = len(json)
-        json += FIFOEventObserver.NULstr
+        json = (str(JSONtree(event)) + FIFOEventObserver.NULstr).encode("utf8")
+        if len(self.pending) + len(json) > self.maxpending:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                print(
+                    "Event FIFO is full: %d events dropped so far" % self.dropped, file=sys.stderr
+                )
+            return
+        self.pending += json
         try:
             if DEBUG:
-                print("*************SENDING EVENT (%d bytes)" % (jsonlen + 1), file=sys.stderr)
-            os.write(self.FIFOwritefd, json.encode("utf8"))
+                print("*************SENDING EVENT (%d bytes)" % len(json), file=sys.stderr)
+            self.flush()
             self.errcount = 0
             if DEBUG:
-                print("*************EVENT SENT (%d bytes)" % (jsonlen + 1), file=sys.stderr)
+                print("*************EVENT SENT (%d bytes)" % len(json), file=sys.stderr)
         except OSError as e:
             if DEBUG:
                 print("+++++++++++++++++EVENT FIFO write error: %s" % str(e), file=sys.stderr)
             self.errcount += 1
             self.ioerror(event)
 
+    def flush(self):
+        """Write as much of our pending event data as the FIFO has room for.
+        Raises OSError for errors other than the FIFO being full.
+
+        :return: bool: True if everything has been written
+        """
+        while self.pending:
+            try:
+                written = os.write(self.FIFOwritefd, self.pending)
+            except BlockingIOError:
+                if not self.backpressured:
+                    self.backpressured = True
+                    self.backpressure_count += 1
+                    print(
+                        "Event FIFO is full - holding events until our reader catches up",
+                        file=sys.stderr,
+                    )
+                self._start_flush_timer()
+                return False
+            del self.pending[:written]
+        if self.backpressured:
+            self.backpressured = False
+            print(
+                "Event FIFO has room again (%d events dropped so far)" % self.dropped,
+                file=sys.stderr,
+            )
+        return True
+
+    def _start_flush_timer(self):
+        "Start a timer to write our pending events - if we have a mainloop to run it"
+        if self.flush_timer is None and glib.MainLoop.default is not None:
+            self.flush_timer = glib.GMainTimeout(
+                self.flush_ms, FIFOEventObserver._flush_timer_callback, self
+            )
+
+    @staticmethod
+    def _flush_timer_callback(observer):
+        "glib timer callback: write any pending events. Costs nothing when there are none"
+        if observer.pending:
+            try:
+                observer.flush()
+            except OSError:
+                # The next event will notice this and call ioerror()
+                pass
+        return True
+
     def ioerror(self, _unusedevent):
         """This function gets called when we get an I/O error writing to the FIFO.
         This is likely an EPIPE (broken pipe) error.
@@ -217,9 +281,18 @@ class ForkExecObserver(FIFOEventObserver):
     """Objects in this class execute scripts when events they are interested in
     are observed.  Note that these events come to us through a pipe
     that we create, but is written to by our base class FIFOEventObserver...
+
+    Our child process runs the scripts in one of two modes:
+        "pool" (the default): through an EventWorkerPool - each script has its own queue,
+            concurrency limit and timeout, and scripts which speak the stream protocol
+            are kept running and given batches of events. See eventworkers.py.
+        "legacy": each script is run (one at a time) for each event, and we wait for it
+            to finish before going on to the next one.
     """
 
-    def __init__(self, constraints=None, scriptdir=None):
+    MODES = ("pool", "legacy")
+
+    def __init__(self, constraints=None, scriptdir=None, config=None):
         """Initializer for ForkExecObserver class.
 
         Parameters:
@@ -229,12 +302,19 @@ class ForkExecObserver(FIFOEventObserver):
         scriptdir: str
             The directory where our scripts are found.  We execute them all whenever an
             event of the selected type occurs.
+        config: dict-like
+            Our "event_scripts" configuration - mode, max_concurrency, script_concurrency,
+            timeout, batch_size and max_queue. Missing values get the EventWorkerPool defaults.
         """
         if scriptdir is None:
             scriptdir = NOTIFICATION_SCRIPT_DIR
         if not os.path.isdir(scriptdir):
             raise ValueError("Script directory [%s] is not a directory" % scriptdir)
+        config = {} if config is None else config
+        if config.get("mode", "pool") not in self.MODES:
+            raise ValueError("Unknown event script mode [%s]" % config.get("mode"))
         self.scriptdir = scriptdir
+        self.config = config
         pipefds = os.pipe()
         self.FIFOreadfd = pipefds[0]
         FIFOEventObserver.__init__(self, pipefds[1], constraints)
@@ -258,7 +338,7 @@ class ForkExecObserver(FIFOEventObserver):
         if self.FIFOwritefd >= 0:
             os.close(self.FIFOwritefd)
             self.FIFOwritefd = -1
-        self.__init__(self.constraints, self.scriptdir)
+        self.__init__(self.constraints, self.scriptdir, self.config)
 
         if self.errcount < 2:
             # Try to keep from losing this event
@@ -286,37 +366,53 @@ class ForkExecObserver(FIFOEventObserver):
                 fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
             except IOError:
                 pass
-        currentbuf = ""
+        try:
+            if self.config.get("mode", "pool") == "legacy":
+                self._legacy_listen()
+            else:
+                self._make_pool().run(self.FIFOreadfd)
+        except KeyboardInterrupt:
+            sys.exit(0)
+        # W0703: catching too general exception Exception
+        # pylint: disable=W0703
+        except Exception as e:
+            print(
+                ("ForkExecObserver Got exception in child process: %s" % str(e)),
+                file=sys.stderr,
+            )
+            raise
+        # We don't want any kind of python cleanup going on here...
+        # so we access the 'protected' member _exit of os, and irritate pylint
+        # pylint: disable=W0212
+        os._exit(0)
+
+    def _make_pool(self):
+        """Create the EventWorkerPool which runs our scripts"""
+        kwargs = {}
+        for name in (
+            "max_concurrency",
+            "script_concurrency",
+            "timeout",
+            "batch_size",
+            "max_queue",
+        ):
+            if name in self.config:
+                kwargs[name] = self.config[name]
+        return EventWorkerPool(self.listscripts, self._JSONevent_env, **kwargs)
+
+    def _legacy_listen(self):
+        """Run each script for each event - one at a time - until our FIFO is closed"""
+        reader = DelimitedReader(FIFOEventObserver.NULstr.encode("utf8"))
         while True:
-            try:
-                if DEBUG:
-                    print("ISSUING EVENT READ...", file=sys.stderr)
-                currentbuf += os.read(self.FIFOreadfd, 4096).decode("utf8")
-                if DEBUG:
-                    print("EVENT READ returned %d bytes" % (len(currentbuf)), file=sys.stderr)
-                if len(currentbuf) == 0:
-                    # We don't want any kind of python cleanup going on here...
-                    # so we access the 'protected' member _exit of os, and irritate pylint
-                    # pylint: disable=W0212
-                    os._exit(0)
-                while True:
-                    if FIFOEventObserver.NULstr in currentbuf:
-                        (currentbuf, additional) = currentbuf.split(FIFOEventObserver.NULstr, 1)
-                        self.processJSONevent(currentbuf)
-                        currentbuf = additional
-                    else:
-                        break
-            except KeyboardInterrupt:
-                sys.exit(0)
-            # W0703: catching too general exception Exception
-            # pylint: disable=W0703
-            except Exception as e:
-                print(
-                    ("ForkExecObserver Got exception in child process: %s" % str(e)),
-                    file=sys.stderr,
-                )
-                currentbuf = ""
-                raise
+            if DEBUG:
+                print("ISSUING EVENT READ...", file=sys.stderr)
+            data = os.read(self.FIFOreadfd, READ_SIZE)
+            if DEBUG:
+                print("EVENT READ returned %d bytes" % (len(data)), file=sys.stderr)
+            if len(data) == 0:
+                return
+            for record in reader.feed(data):
+                self.processJSONevent(record.decode("utf8"))
 
     @staticmethod
     def _JSONevent_env(eventobj):
@@ -360,6 +456,8 @@ class ForkExecObserver(FIFOEventObserver):
         jsontmpfile.write(str(eventobj).encode("utf8"))
         jsontmpfile.seek(0)
         for script in self.listscripts():
+            # Each script reads the JSON from the start
+            jsontmpfile.seek(0)
             args = [script, eventtype, aobjclass]
             if DEBUG:
                 print("STARTING EVENT SCRIPT: %s" % (str(args)), file=sys.stderr)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100 fileencoding=utf-8
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Trace points for the CMA's hot paths.
+
+Each part of the CMA has a named TraceCategory with a level (off, info, debug or verbose).
+A trace point looks like this:
+
+    if STORE_TRACE.debug:
+        STORE_TRACE.emit("load_related cypher: %s", query)
+
+When the category is below that level, the trace point costs one attribute check - we don't
+format any strings or even evaluate the arguments. When it's enabled, the message goes into
+a ring buffer of recent trace messages (and to 'Trace.echo', if it's set) - so you can turn
+on lots of tracing in production and only look at it when something goes wrong.
+
+Trace levels are set with Trace.configure("store=debug,dispatch=info") - from the
+ASSIM_TRACE environment variable, or the CMA's --tracepoints option. Setting ASSIM_TRACE_ECHO
+copies trace messages to stderr as they happen. The ring buffer is
+dumped by Trace.dump() - which the CMA does on SIGQUIT and when a packet fails.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import collections
+
+TRACE_OFF = 0
+TRACE_INFO = 1
+TRACE_DEBUG = 2
+TRACE_VERBOSE = 3
+TRACE_LEVELS = {
+    "off": TRACE_OFF,
+    "info": TRACE_INFO,
+    "debug": TRACE_DEBUG,
+    "verbose": TRACE_VERBOSE,
+}
+DEFAULT_RING_SIZE = 10000
+
+
+class TraceCategory(object):
+    """
+    A named category of trace points - with one boolean attribute per level,
+    so that checking whether a trace point is enabled is a single attribute lookup.
+    """
+
+    __slots__ = ("name", "level", "info", "debug", "verbose")
+
+    def __init__(self, name, level=TRACE_OFF):
+        """
+        :param name: str: name of this category
+        :param level: int: initial trace level
+        """
+        self.name = name
+        self.set_level(level)
+
+    def set_level(self, level):
+        """
+        Set the level of trace points this category records
+
+        :param level: int: TRACE_OFF, TRACE_INFO, TRACE_DEBUG or TRACE_VERBOSE
+        :return: None
+        """
+        self.level = level
+        self.info = level >= TRACE_INFO
+        self.debug = level >= TRACE_DEBUG
+        self.verbose = level >= TRACE_VERBOSE
+
+    def emit(self, fmt, *args):
+        """
+        Record a trace message. Only call this after checking that the level is enabled.
+
+        :param fmt: str: %-style format string
+        :param args: arguments for 'fmt'
+        :return: None
+        """
+        Trace.record(self.name, fmt % args if args else fmt)
+
+
+class Trace(object):
+    """
+    Our trace categories and the ring buffer of recent trace messages
+    """
+
+    categories = {}
+    ring = collections.deque(maxlen=DEFAULT_RING_SIZE)
+    echo = None  # File to copy trace messages to as they happen - or None
+    default_level = TRACE_OFF  # Level for categories created after set_level("all", ...)
+    dropped = 0  # Messages which have fallen off the end of the ring
+
+    @staticmethod
+    def category(name):
+        """
+        Return the trace category with this name - creating it if need be
+
+        :param name: str: name of the category
+        :return: TraceCategory
+        """
+        if name not in Trace.categories:
+            Trace.categories[name] = TraceCategory(name, Trace.default_level)
+        return Trace.categories[name]
+
+    @staticmethod
+    def set_level(name, level):
+        """
+        Set the trace level of a category - or of every category, if 'name' is "all"
+
+        :param name: str: category name or "all"
+        :param level: int or str: trace level - a number or a name ("debug", etc)
+        :return: None
+        """
+        if isinstance(level, str):
+            if level not in TRACE_LEVELS:
+                raise ValueError("Unknown trace level [%s]" % level)
+            level = TRACE_LEVELS[level]
+        if name == "all":
+            Trace.default_level = level
+            for category in Trace.categories.values():
+                category.set_level(level)
+        else:
+            Trace.category(name).set_level(level)
+
+    @staticmethod
+    def configure(spec):
+        """
+        Set trace levels from a string like "store=debug,dispatch=info,all=off".
+        A category without a level ("store") is set to debug.
+
+        :param spec: str: comma-separated category=level settings
+        :return: None
+        """
+        for item in spec.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            name, _, level = item.partition("=")
+            Trace.set_level(name.strip(), level.strip() or "debug")
+
+    @staticmethod
+    def set_ring_size(size):
+        """
+        Change the number of messages our ring buffer holds - keeping the newest ones
+
+        :param size: int: number of messages to keep
+        :return: None
+        """
+        Trace.ring = collections.deque(Trace.ring, maxlen=size)
+
+    @staticmethod
+    def record(name, message):
+        """
+        Put a trace message in our ring buffer (and echo it, if we've been asked to)
+
+        :param name: str: category name
+        :param message: str: the (formatted) message
+        :return: None
+        """
+        entry = (time.time(), name, message)
+        if len(Trace.ring) == Trace.ring.maxlen:
+            Trace.dropped += 1
+        Trace.ring.append(entry)
+        if Trace.echo is not None:
+            print(Trace.format_entry(entry), file=Trace.echo)
+
+    @staticmethod
+    def format_entry(entry):
+        "Format a ring buffer entry for output"
+        timestamp, name, message = entry
+        return "%s.%03d %s: %s" % (
+            time.strftime("%H:%M:%S", time.localtime(timestamp)),
+            int((timestamp % 1) * 1000),
+            name,
+            message,
+        )
+
+    @staticmethod
+    def dump(outfile=None, clear=False):
+        """
+        Write the contents of our ring buffer - oldest first
+
+        :param outfile: file: where to write it (default: stderr)
+        :param clear: bool: True to empty the ring buffer afterwards
+        :return: int: number of messages written
+        """
+        outfile = sys.stderr if outfile is None else outfile
+        entries = list(Trace.ring)
+        print(
+            "==== Trace dump: %d messages (%d dropped) ====" % (len(entries), Trace.dropped),
+            file=outfile,
+        )
+        for entry in entries:
+            print(Trace.format_entry(entry), file=outfile)
+        print("==== End of trace dump ====", file=outfile)
+        if clear:
+            Trace.ring.clear()
+            Trace.dropped = 0
+        return len(entries)
+
+
+Trace.configure(os.environ.get("ASSIM_TRACE", ""))
+if os.environ.get("ASSIM_TRACE_ECHO"):
+    Trace.echo = sys.stderr
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+CMA throughput benchmark.
+
+We run a CMA in this process (PacketListener + MessageDispatcher, just like cma.py does)
+and point loadgen.py at it.  When the load generator finishes, we report how many packets
+per second the CMA processed, and the latency percentiles and Cypher statements per packet
+for each kind of packet it received.
+
+This needs a running Neo4j - and it EMPTIES the database it uses.
+We deliberately don't stub out the Store: the discovery listeners' cost is almost all
+Cypher, so a stubbed Store would measure nothing we care about.
+"""
+from __future__ import print_function
+import sys
+import os
+import time
+import importlib
+import subprocess
+import optparse
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+# pylint: disable=C0413
+import inject
+from AssimCtypes import (
+    CONFIGNAME_CMAINIT,
+    CONFIGNAME_CMAADDR,
+    CONFIGNAME_CMADISCOVER,
+    CONFIGNAME_CMAFAIL,
+    CONFIGNAME_OUTSIG,
+)
+from AssimCclasses import pyNetAddr, pyReliableUDP, pyPacketDecoder, pySignFrame
+from cmainit import CMAInjectables, CMAinit
+from cmaconfig import ConfigFile
+from cmadb import CMAdb
+from messagedispatcher import MessageDispatcher
+from dispatchtarget import DispatchTarget
+from packetlistener import PacketListener
+import assimglib as glib
+
+LOADGEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadgen.py")
+
+
+def start_cma(address):
+    """Create (but don't run) an in-process CMA listening on 'address'
+
+    :param address: str: address:port to listen on
+    :return: (PacketListener, MessageDispatcher)
+    """
+    config = ConfigFile()
+    ouraddr = pyNetAddr(address)
+    for name in (
+        CONFIGNAME_CMAINIT,
+        CONFIGNAME_CMAADDR,
+        CONFIGNAME_CMADISCOVER,
+        CONFIGNAME_CMAFAIL,
+    ):
+        config[name] = ouraddr
+    config[CONFIGNAME_OUTSIG] = pySignFrame(1)
+    config.complete_config()
+    CMAInjectables.set_config(config)
+    inject.configure_once(CMAInjectables.test_config_injection)
+    io = pyReliableUDP(config, pyPacketDecoder())
+    CMAinit(io, cleanoutdb=True, debug=False)
+    CMAdb.debug = False  # CMAinit turns it on
+    disp = MessageDispatcher(DispatchTarget.dispatchtable, encryption_required=False)
+    listener = PacketListener(config, disp, io=io, encryption_required=False)
+    for module in ["discoverylistener"] + list(config["optional_modules"]):
+        importlib.import_module(module)
+    return listener, disp
+
+
+def wait_for_loadgen(args):
+    """Mainloop timer callback - stop the mainloop once loadgen.py has exited.
+    We always return True - our caller removes the timer when it destroys it.
+    """
+    listener, child = args
+    if child.poll() is not None:
+        listener.mainloop.quit()
+    return True
+
+
+def report(disp, elapsed, outfile=sys.stdout):
+    """Print our results
+
+    :param disp: MessageDispatcher: the dispatcher that processed our packets
+    :param elapsed: float: seconds the CMA ran
+    :param outfile: file: where to print our report
+    """
+    summary = disp.dispatch_summary()
+    total = sum(stats["count"] for stats in summary.values())
+    print(
+        "CMA processed %d packets in %.2f seconds: %.1f packets/sec"
+        % (total, elapsed, total / max(elapsed, 1e-6)),
+        file=outfile,
+    )
+    print(
+        "%-16s %8s %9s %9s %9s %9s %9s"
+        % ("packet type", "count", "mean ms", "p50 ms", "p90 ms", "p99 ms", "stmts/pkt"),
+        file=outfile,
+    )
+    for fstype in sorted(summary):
+        stats = summary[fstype]
+        print(
+            "%-16s %8d %9.2f %9.2f %9.2f %9.2f %9.1f"
+            % (
+                fstype,
+                stats["count"],
+                stats["mean_ms"],
+                stats["p50_ms"],
+                stats["p90_ms"],
+                stats["p99_ms"],
+                stats["statements_per_packet"],
+            ),
+            file=outfile,
+        )
+
+
+def main():
+    "Run the CMA throughput benchmark"
+    parser = optparse.OptionParser(
+        prog="cma_throughput",
+        description="Measure CMA throughput under synthetic nanoprobe load",
+        usage="%prog [options] [-- loadgen.py options]",
+    )
+    parser.add_option("--cma", default="127.0.0.1:1984", help="address for our CMA [%default]")
+    opts, loadgen_args = parser.parse_args()
+    listener, disp = start_cma(opts.cma)
+    child = subprocess.Popen([sys.executable, LOADGEN, "--cma", opts.cma] + loadgen_args)
+    timerargs = (listener, child)  # glib doesn't hold a reference to this for us
+    timer = glib.GMainTimeout(250, wait_for_loadgen, timerargs)
+    start = time.time()
+    listener.listen()
+    elapsed = time.time() - start
+    del timer
+    report(disp, elapsed)
+    return child.returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Benchmark for reading discovery data through a pyConfigContext versus a ConfigSnapshot.
+
+We use real discovery payloads - by default we run the proc_sys and packages discovery
+agents on this machine, but you can give us saved discovery JSON with -f instead.
+For each payload we measure:
+    - how long snapshot() takes
+    - reading every value (deepget() of every leaf) from the pyConfigContext and the snapshot
+    - for proc_sys payloads: evaluating the proc_sys best practice rules against each of them
+      (what BestPractices.evaluate does for every proc_sys discovery packet)
+
+The snapshot times include the time to take the snapshot.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import optparse
+import subprocess
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+# pylint: disable=C0413
+from AssimCclasses import pyConfigContext
+from graphnodeexpression import GraphNodeExpression, ExpressionContext
+
+AGENTS = ("proc_sys", "packages")
+
+
+def find_file(relpath):
+    "Find a file in the source tree - wherever we're being run from"
+    for dirname in (".", "..", "../..", "../../.."):
+        pathname = os.path.join(dirname, relpath)
+        if os.access(pathname, os.R_OK):
+            return pathname
+    return None
+
+
+def run_agent(agent):
+    """Run a discovery agent and return its output - or None if it's not available
+
+    :param agent: str: name of the agent in discovery_agents
+    :return: str: JSON output from the agent, or None
+    """
+    pathname = find_file(os.path.join("discovery_agents", agent))
+    if pathname is None:
+        return None
+    try:
+        output = subprocess.check_output(["/bin/sh", pathname], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode("utf8")
+
+
+def leaf_paths(obj, prefix=""):
+    """Return the deepget() paths to all the leaves in this (pyConfigContext) object.
+    Keys with dots in them (like "kernel.sysrq") can't be reached with deepget(),
+    so we stop at the object containing them.
+    """
+    paths = []
+    for key in obj.keys():
+        path = prefix + key
+        value = obj[key]
+        if "." not in key and hasattr(value, "keys"):
+            paths.extend(leaf_paths(value, path + "."))
+        else:
+            paths.append(path)
+    return paths
+
+
+def read_all(obj, paths):
+    "Read every leaf value in our object - returning how many were found"
+    return sum(1 for path in paths if obj.deepget(path) is not None)
+
+
+def evaluate_rules(data, rules):
+    "Evaluate every rule against 'data' - returning the results"
+    context = ExpressionContext((data,))
+    return [GraphNodeExpression.evaluate(rules[ruleid]["rule"], context) for ruleid in rules]
+
+
+def timeit(repeat, function, *args):
+    "Return the result of function(*args) and the mean time it took over 'repeat' runs"
+    start = time.time()
+    for _ in range(repeat):
+        result = function(*args)
+    return result, (time.time() - start) / repeat
+
+
+def report(name, old, new):
+    "Print a comparison of two timings"
+    print(
+        "    %-28s pyConfigContext %8.3fms  snapshot %8.3fms  (%.1fx)"
+        % (name, 1000.0 * old, 1000.0 * new, old / max(new, 1e-9))
+    )
+
+
+def benchmark(name, jsontext, rules, repeat):
+    "Benchmark one discovery payload"
+    jsonobj = pyConfigContext(jsontext)
+    data = jsonobj["data"]
+    paths = leaf_paths(data)
+    print("%s: %d bytes of JSON, %d leaf values" % (name, len(jsontext), len(paths)))
+    _, snaptime = timeit(repeat, data.snapshot)
+    print("    %-28s %.3fms" % ("snapshot()", 1000.0 * snaptime))
+
+    oldcount, old = timeit(repeat, read_all, data, paths)
+    newcount, new = timeit(repeat, lambda: read_all(data.snapshot(), paths))
+    if oldcount != newcount:
+        print("MISMATCH: %d values from pyConfigContext, %d from snapshot" % (oldcount, newcount))
+        return 1
+    report("deepget() every value", old, new)
+
+    if rules is not None and jsonobj["discovertype"] == "proc_sys":
+        oldresults, old = timeit(repeat, evaluate_rules, data, rules)
+        newresults, new = timeit(repeat, lambda: evaluate_rules(data.snapshot(), rules))
+        if oldresults != newresults:
+            print("MISMATCH: rule results differ")
+            return 1
+        report("%d proc_sys rules" % len(rules), old, new)
+    return 0
+
+
+def main():
+    "Compare reading discovery data from pyConfigContexts and ConfigSnapshots"
+    parser = optparse.OptionParser(
+        prog="configcontext_snapshot_benchmark",
+        description="Compare pyConfigContext and ConfigSnapshot read performance",
+    )
+    parser.add_option(
+        "-f", "--file", action="append", default=[], help="discovery JSON file (repeatable)"
+    )
+    parser.add_option("-r", "--repeat", type="int", default=10, help="repetitions [%default]")
+    opts = parser.parse_args()[0]
+
+    payloads = []
+    for filename in opts.file:
+        with open(filename, "r") as jsonfile:
+            payloads.append((filename, jsonfile.read()))
+    if not payloads:
+        for agent in AGENTS:
+            output = run_agent(agent)
+            if output is None:
+                print("Cannot run the %s discovery agent - skipping it" % agent)
+                continue
+            payloads.append((agent, output))
+    rules = None
+    rulefile = find_file(os.path.join("best_practices", "proc_sys.json"))
+    if rulefile is not None:
+        with open(rulefile, "r") as rules_file:
+            # The rules are read-only too...
+            rules = pyConfigContext(rules_file.read()).snapshot()
+
+    for name, jsontext in payloads:
+        if benchmark(name, jsontext, rules, opts.repeat) != 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Benchmark for decoding the Frames in a FrameSet.
+
+We build a FrameSet shaped like a large JSDISCOVERY or ARP packet - lots of string and
+integer Frames - and run it through the packet encoder and decoder so it looks like one
+we received. Then we compare:
+    - the old way: iter() with getstr()/getint() on each pyFrame
+    - decode_frames() - a single pass over the C structs
+    - decode_frames(views=True) - the same, with memoryviews for the large values
+
+We check that both ways decode the same values.
+"""
+from __future__ import print_function
+import sys
+import time
+import optparse
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+# pylint: disable=C0413
+from frameinfo import FrameTypes
+from AssimCclasses import (
+    pyFrameSet,
+    pyCstringFrame,
+    pyIntFrame,
+    pySignFrame,
+    pyPacketDecoder,
+)
+
+
+def make_frameset(count, jsonsize):
+    """Make a received-looking FrameSet with 'count' (HOSTNAME, WALLCLOCK, JSDISCOVER) triples
+
+    :param count: int: how many triples of Frames to put in it
+    :param jsonsize: int: how big to make each JSDISCOVER string
+    :return: pyFrameSet
+    """
+    frameset = pyFrameSet(FrameTypes.JSDISCOVER)
+    for number in range(count):
+        frameset.append(pyCstringFrame(FrameTypes.HOSTNAME, "host%05d" % number))
+        frameset.append(pyIntFrame(FrameTypes.WALLCLOCK, 1000000 + number, intbytes=8))
+        json = '{"host": "host%05d", "data": "%s"}' % (number, "x" * jsonsize)
+        frameset.append(pyCstringFrame(FrameTypes.JSDISCOVER, json))
+    frameset.construct_packet(pySignFrame(1))
+    decoder = pyPacketDecoder()
+    return decoder.unpickle_packet(decoder.pickle_packet([frameset]))[0]
+
+
+def old_way(frameset):
+    "Decode the FrameSet with iter(), getstr() and getint()"
+    result = []
+    for frame in frameset.iter():
+        frametype = frame.frametype()
+        if isinstance(frame, pyCstringFrame):
+            value = frame.getstr()
+        elif isinstance(frame, pyIntFrame):
+            value = frame.getint()
+        else:
+            value = None
+        result.append((frametype, value))
+    return result
+
+
+def timeit(repeat, function, *args):
+    "Return the result of function(*args) and the mean time it took over 'repeat' runs"
+    start = time.time()
+    for _ in range(repeat):
+        result = function(*args)
+    return result, (time.time() - start) / repeat
+
+
+def main():
+    "Compare iter() against decode_frames()"
+    parser = optparse.OptionParser(
+        prog="frameset_decode_benchmark", description="Compare FrameSet decoding methods"
+    )
+    parser.add_option("-n", "--count", type="int", default=300, help="Frame triples [%default]")
+    parser.add_option("-j", "--jsonsize", type="int", default=8192, help="JSON bytes [%default]")
+    parser.add_option("-r", "--repeat", type="int", default=20, help="repetitions [%default]")
+    opts = parser.parse_args()[0]
+
+    frameset = make_frameset(opts.count, opts.jsonsize)
+    framecount = len(frameset)
+    print("FrameSet with %d frames" % framecount)
+
+    expected, old = timeit(opts.repeat, old_way, frameset)
+    decoded, bulk = timeit(opts.repeat, frameset.decode_frames)
+    viewed, views = timeit(opts.repeat, frameset.decode_frames, True)
+
+    for (oldtype, oldvalue), (newtype, newvalue) in zip(expected, decoded):
+        if oldtype != newtype or (oldvalue is not None and oldvalue != newvalue):
+            print("MISMATCH: (%s, %r) != (%s, %r)" % (oldtype, oldvalue, newtype, newvalue))
+            return 1
+    viewcount = sum(1 for _, value in viewed if isinstance(value, memoryview))
+
+    for name, seconds in (
+        ("iter()", old),
+        ("decode_frames()", bulk),
+        ("decode_frames(views)", views),
+    ):
+        print(
+            "%-22s %.3fms/FrameSet (%.2f us/frame)"
+            % (name, 1000.0 * seconds, 1e6 * seconds / framecount)
+        )
+    print("decode_frames() is %.1fx faster than iter()" % (old / max(bulk, 1e-9)))
+    print("decode_frames(views) is %.1fx faster than iter()" % (old / max(views, 1e-9)))
+    print("%d values returned as memoryviews" % viewcount)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
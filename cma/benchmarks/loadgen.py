@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Synthetic nanoprobe load generator.
+
+We impersonate lots of nanoprobes over loopback UDP - each one with its own
+pyReliableUDP socket bound to its own 127.x.y.z address - and replay discovery
+data recorded from our discovery_agents:
+
+    1.  Every nanoprobe sends a STARTUP (with its netconfig discovery)
+    2.  Every nanoprobe sends JSDISCOVERY packets (netconfig, tcpdiscovery, packages, proc_sys)
+    3.  Every nanoprobe sends an ARP discovery packet naming some of its neighbors
+    4.  Some nanoprobes report one of their neighbors dead (HBDEAD)
+
+We ACK everything the CMA sends us, but we don't heartbeat or run any discovery ourselves.
+The discovery data is personalized for each nanoprobe (host name, MAC and IP addresses),
+so each one looks like a different system to the CMA.
+
+Record the discovery data once with --record DIR, and replay it with --payloads DIR.
+Without --payloads we run the discovery agents when we start.
+
+On Linux, all of 127.0.0.0/8 is loopback, so no network configuration is needed.
+You may need to raise your open file limit (ulimit -n) for thousands of nanoprobes.
+"""
+from __future__ import print_function
+import sys
+import os
+import time
+import json
+import subprocess
+import optparse
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+# pylint: disable=C0413
+from AssimCtypes import CONFIGNAME_OUTSIG, CONFIGNAME_COMPRESS
+from AssimCclasses import (
+    pyNetAddr,
+    pyConfigContext,
+    pyReliableUDP,
+    pyPacketDecoder,
+    pySignFrame,
+    pyCompressFrame,
+    pyFrameSet,
+    pyCstringFrame,
+    pyIpPortFrame,
+)
+from frameinfo import FrameSetTypes, FrameTypes
+import assimglib as glib
+
+AGENTDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "discovery_agents")
+DISCOVERY_TYPES = ("netconfig", "tcpdiscovery", "packages", "proc_sys")
+PHASES = ("startup", "discovery", "arp", "hbdead")
+
+
+def record_payloads(dirname=None):
+    """Run our discovery agents and return their output - optionally saving it in 'dirname'
+
+    :param dirname: str: directory to save the JSON in (or None)
+    :return: {str: dict}: discovery type -> discovery JSON (as a dict)
+    """
+    payloads = {}
+    for dtype in DISCOVERY_TYPES:
+        agent = os.path.join(AGENTDIR, dtype)
+        output = subprocess.check_output(("sh", agent), stderr=subprocess.DEVNULL)
+        payloads[dtype] = json.loads(str(pyConfigContext(output.decode("utf8"))))
+        if dirname is not None:
+            with open(os.path.join(dirname, dtype + ".json"), "w") as jsonfile:
+                json.dump(payloads[dtype], jsonfile, indent=1)
+    return payloads
+
+
+def load_payloads(dirname):
+    """Load discovery JSON previously saved by record_payloads()
+
+    :param dirname: str: directory the JSON was saved in
+    :return: {str: dict}: discovery type -> discovery JSON (as a dict)
+    """
+    payloads = {}
+    for dtype in DISCOVERY_TYPES:
+        with open(os.path.join(dirname, dtype + ".json")) as jsonfile:
+            payloads[dtype] = json.load(jsonfile)
+    return payloads
+
+
+class FakeNanoprobe(object):
+    """One impersonated nanoprobe - with its own address, socket and discovery data"""
+
+    def __init__(self, number, cmaaddr, payloads, port=1984):
+        self.number = number
+        self.designation = "loadgen%06d" % number
+        # 127.0.0.0/8 is all loopback - stay away from 127.0.x.x
+        octets = [127, 1 + (number // 65536), (number // 256) % 256, number % 256]
+        self.ipaddr = ".".join([str(octet) for octet in octets])
+        self.addr = pyNetAddr(octets, port)
+        self.macaddr = "02:00:%02x:%02x:%02x:%02x" % tuple(octets)
+        self.cmaaddr = cmaaddr
+        self.ifname = None
+        self.payloads = self._personalize(payloads)
+        config = pyConfigContext(
+            init={
+                CONFIGNAME_OUTSIG: pySignFrame(1),
+                CONFIGNAME_COMPRESS: pyCompressFrame(compression_method="zlib"),
+            }
+        )
+        self.io = pyReliableUDP(config, pyPacketDecoder())
+        if not self.io.bindaddr(self.addr):
+            raise IOError("Cannot bind to %s" % self.addr)
+        self.io.setblockio(False)
+        self.watch = None
+        self.received = {}
+
+    def _personalize(self, payloads):
+        """Make our own copy of the discovery data - with our name, MAC and IP addresses.
+        Our default gateway interface gets our IP address; the others get MAC and IP
+        addresses made from our number and their interface number - so no two of our
+        probes share any of them.
+        """
+        result = {}
+        for dtype, payload in payloads.items():
+            payload = json.loads(json.dumps(payload))
+            payload["host"] = self.designation
+            if dtype == "netconfig":
+                for ifnum, (ifname, ifinfo) in enumerate(sorted(payload["data"].items())):
+                    if self.ifname is None and ifinfo.get("default_gw"):
+                        self.ifname = ifname
+                        ifinfo["address"] = self.macaddr
+                        ifinfo["ipaddrs"] = {
+                            "%s/8" % self.ipaddr: {"scope": "global", "name": ifname}
+                        }
+                        continue
+                    if "address" in ifinfo:
+                        ifinfo["address"] = "02:%02x:%s" % ((ifnum + 1) % 256, self.macaddr[6:])
+                    ipaddrs = ifinfo.get("ipaddrs", {})
+                    ifinfo["ipaddrs"] = dict(
+                        (self._interface_ipaddr(ifnum, ip), ipinfo)
+                        for ip, ipinfo in ipaddrs.items()
+                    )
+            result[dtype] = payload
+        if self.ifname is None:
+            self.ifname = "eth0"
+        return result
+
+    def _interface_ipaddr(self, ifnum, ip):
+        """Return an address like 'ip' (same family and mask) for our interface 'ifnum'.
+        IPv4 addresses come from 10.0.0.0/8 - room for a million probes with 16 interfaces.
+
+        :param ifnum: int: interface number
+        :param ip: str: recorded address in 'ip/mask' CIDR format
+        :return: str: our address in 'ip/mask' CIDR format
+        """
+        iponly, cidrmask = ip.split("/")
+        if ":" in iponly:
+            return "fd00::%x:%x:%x/%s" % (ifnum, self.number >> 16, self.number & 0xFFFF, cidrmask)
+        index = self.number * 16 + ifnum % 16
+        return "10.%d.%d.%d/%s" % ((index >> 16) % 256, (index >> 8) % 256, index % 256, cidrmask)
+
+    def _send(self, fstype, frames):
+        "Reliably send the CMA a FrameSet of the given type containing these frames"
+        fs = pyFrameSet(fstype)
+        for frame in frames:
+            fs.append(frame)
+        self.io.sendreliablefs(self.cmaaddr, (fs,))
+
+    def send_startup(self):
+        "Send the CMA our STARTUP packet"
+        self._send(
+            FrameSetTypes.STARTUP,
+            (
+                pyCstringFrame(FrameTypes.HOSTNAME, self.designation),
+                pyCstringFrame(FrameTypes.JSDISCOVER, json.dumps(self.payloads["netconfig"])),
+            ),
+        )
+
+    def send_discovery(self, dtype):
+        "Send the CMA one of our recorded discovery packets"
+        self._send(
+            FrameSetTypes.JSDISCOVERY,
+            (pyCstringFrame(FrameTypes.JSDISCOVER, json.dumps(self.payloads[dtype])),),
+        )
+
+    def send_arp(self, neighbors):
+        "Send the CMA an ARP discovery packet naming these neighbors"
+        arp = {
+            "discovertype": "ARP",
+            "description": "ARP map",
+            "source": "loadgen",
+            "host": self.designation,
+            "device": self.ifname,
+            "data": dict((probe.ipaddr, probe.macaddr) for probe in neighbors),
+        }
+        self._send(
+            FrameSetTypes.JSDISCOVERY, (pyCstringFrame(FrameTypes.JSDISCOVER, json.dumps(arp)),)
+        )
+
+    def send_hbdead(self, deadprobe):
+        "Tell the CMA our neighbor has died"
+        self._send(FrameSetTypes.HBDEAD, (pyIpPortFrame(FrameTypes.IPPORT, deadprobe.addr),))
+
+    def start_listening(self):
+        "Start processing packets from the CMA in our glib mainloop"
+        self.watch = glib.IOWatch(
+            self.io.fileno(), glib.IO_IN | glib.IO_PRI, FakeNanoprobe._read_callback, self
+        )
+
+    @staticmethod
+    def _read_callback(_source, _condition, probe):
+        "glib callback: read and ACK everything the CMA has sent us"
+        while True:
+            fromaddr, framesets = probe.io.recvframesets()
+            if fromaddr is None:
+                return True
+            for fs in framesets:
+                probe.io.ackmessage(fromaddr, fs)
+                fstype = FrameSetTypes.get(fs.get_framesettype())[0]
+                probe.received[fstype] = probe.received.get(fstype, 0) + 1
+
+
+class LoadGenerator(object):
+    """Drive a collection of FakeNanoprobes through our load phases at a given packet rate"""
+
+    tick_ms = 10
+
+    def __init__(self, probes, rate, phases=PHASES, dead_fraction=0.1, arp_neighbors=8, linger=5):
+        self.probes = probes
+        self.rate = rate
+        self.linger = linger
+        self.work = self._schedule(phases, dead_fraction, arp_neighbors)
+        self.sent = {}
+        self.mainloop = glib.MainLoop()
+        self.timer = None
+        self.start = None
+        self.finish = None
+        self.credit = 0.0
+
+    def _schedule(self, phases, dead_fraction, arp_neighbors):
+        "Return the list of (description, function, args) we're going to send, in order"
+        work = []
+        count = len(self.probes)
+        for phase in phases:
+            for number, probe in enumerate(self.probes):
+                if phase == "startup":
+                    work.append(("STARTUP", probe.send_startup, ()))
+                elif phase == "discovery":
+                    for dtype in DISCOVERY_TYPES:
+                        work.append(("JSDISCOVERY:" + dtype, probe.send_discovery, (dtype,)))
+                elif phase == "arp":
+                    neighbors = [
+                        self.probes[(number + j) % count] for j in range(1, arp_neighbors + 1)
+                    ]
+                    work.append(("JSDISCOVERY:ARP", probe.send_arp, (neighbors,)))
+                elif phase == "hbdead":
+                    if dead_fraction > 0 and number % max(int(1 / dead_fraction), 1) == 0:
+                        deadprobe = self.probes[(number + 1) % count]
+                        work.append(("HBDEAD", probe.send_hbdead, (deadprobe,)))
+        return work
+
+    def run(self):
+        "Send everything at our configured rate, linger a bit for the CMA's replies, then quit"
+        for probe in self.probes:
+            probe.start_listening()
+        self.work.reverse()  # So we can pop() them off in order
+        self.start = time.time()
+        self.timer = glib.GMainTimeout(LoadGenerator.tick_ms, LoadGenerator._tick, self)
+        self.mainloop.run()
+
+    @staticmethod
+    def _tick(loadgen):
+        "glib timer callback: send the next few packets"
+        loadgen.credit += loadgen.rate * LoadGenerator.tick_ms / 1000.0
+        while loadgen.work and loadgen.credit >= 1.0:
+            name, function, args = loadgen.work.pop()
+            function(*args)
+            loadgen.sent[name] = loadgen.sent.get(name, 0) + 1
+            loadgen.credit -= 1.0
+        if not loadgen.work:
+            if loadgen.finish is None:
+                loadgen.finish = time.time()
+            if time.time() - loadgen.finish >= loadgen.linger:
+                loadgen.mainloop.quit()
+        return True
+
+    def report(self, outfile=sys.stdout):
+        "Report what we sent and received"
+        elapsed = (self.finish or time.time()) - self.start
+        total = sum(self.sent.values())
+        print("Sent %d packets from %d nanoprobes in %.2f seconds (%.1f packets/sec)"
+              % (total, len(self.probes), elapsed, total / max(elapsed, 1e-6)), file=outfile)
+        for name in sorted(self.sent):
+            print("    sent %-24s %8d" % (name, self.sent[name]), file=outfile)
+        received = {}
+        for probe in self.probes:
+            for fstype, count in probe.received.items():
+                received[fstype] = received.get(fstype, 0) + count
+        for name in sorted(received):
+            print("    received %-20s %8d" % (name, received[name]), file=outfile)
+
+
+def main():
+    "Generate synthetic nanoprobe load"
+    parser = optparse.OptionParser(prog="loadgen", description="Synthetic nanoprobe load generator")
+    parser.add_option("--cma", default="127.0.0.1:1984", help="CMA address [%default]")
+    parser.add_option(
+        "-n",
+        "--nanoprobes",
+        type="int",
+        default=100,
+        help="number of nanoprobes to impersonate [%default]",
+    )
+    parser.add_option(
+        "-r", "--rate", type="float", default=200.0, help="packets per second to send [%default]"
+    )
+    parser.add_option(
+        "--phases", default=",".join(PHASES), help="comma-separated load phases to run [%default]"
+    )
+    parser.add_option(
+        "--dead-fraction",
+        type="float",
+        default=0.1,
+        help="fraction of nanoprobes to report dead [%default]",
+    )
+    parser.add_option(
+        "--arp-neighbors", type="int", default=8, help="neighbors in each ARP packet [%default]"
+    )
+    parser.add_option(
+        "--linger",
+        type="float",
+        default=5.0,
+        help="seconds to wait for CMA replies after sending everything [%default]",
+    )
+    parser.add_option("--payloads", help="directory of recorded discovery JSON to replay")
+    parser.add_option("--record", help="record discovery JSON into this directory and exit")
+    opts = parser.parse_args()[0]
+
+    if opts.record:
+        record_payloads(opts.record)
+        return 0
+    payloads = load_payloads(opts.payloads) if opts.payloads else record_payloads()
+    phases = [phase for phase in opts.phases.split(",") if phase]
+    for phase in phases:
+        if phase not in PHASES:
+            parser.error("Unknown phase %s: not one of %s" % (phase, PHASES))
+    cmaaddr = pyNetAddr(opts.cma)
+    probes = [FakeNanoprobe(number, cmaaddr, payloads) for number in range(1, opts.nanoprobes + 1)]
+    loadgen = LoadGenerator(
+        probes,
+        opts.rate,
+        phases=phases,
+        dead_fraction=opts.dead_fraction,
+        arp_neighbors=opts.arp_neighbors,
+        linger=opts.linger,
+    )
+    loadgen.run()
+    loadgen.report()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
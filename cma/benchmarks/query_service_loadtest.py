@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Load test for our REST query service (flask/hello.py).
+
+We run lots of concurrent clients, each repeatedly running a mix of queries - reading
+every page of their results (following the X-Next-Cursor headers) as NDJSON.
+We report throughput, latency percentiles and the service's own statistics.
+
+With --fixture N we first build a fixture graph of N drones - each with a NIC and an
+IP address - in the local Neo4j. This EMPTIES the database it uses.
+Without --url, we start the query service ourselves (with rate limiting off).
+"""
+from __future__ import print_function
+import sys
+import os
+import time
+import json
+import socket
+import optparse
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+
+DEFAULT_QUERIES = "allservers,allips,down,list"
+
+
+def build_fixture(count):
+    "Empty the database and create 'count' drones - each with a NIC and an IP address"
+    # pylint: disable=C0415
+    import inject
+    from AssimCclasses import pyNetAddr
+    from cmainit import CMAInjectables, CMAinit
+    from cmaconfig import ConfigFile
+    from cmadb import CMAdb
+    from consts import CMAconsts
+    from droneinfo import Drone
+    from graphnodes import NICNode, IPaddrNode
+
+    CMAInjectables.set_config(ConfigFile().complete_config())
+    inject.configure_once(CMAInjectables.test_config_injection)
+    CMAinit(None, cleanoutdb=True, debug=False)
+    CMAdb.debug = False  # CMAinit turns it on
+    start = time.time()
+    store = CMAdb.store
+    store.begin()
+    for number in range(count):
+        octets = [10, number // 65536, (number // 256) % 256, number % 256]
+        designation = "fixture%06d" % number
+        drone = Drone.add(designation, "fixture", primary_ip_addr=str(pyNetAddr(octets, 1984)))
+        nic = store.load_or_create(
+            NICNode,
+            domain=drone.domain,
+            macaddr="02:00:%02x:%02x:%02x:%02x" % tuple(octets),
+            scope=designation,
+            ifname="eth0",
+        )
+        store.relate(drone, CMAconsts.REL_nicowner, nic)
+        ipaddr = store.load_or_create(
+            IPaddrNode, ipaddr=str(pyNetAddr(octets).toIPv6()), domain=drone.domain, subnet=None
+        )
+        store.relate(nic, CMAconsts.REL_ipowner, ipaddr)
+        if (number % 500) == 499:
+            store.commit()
+            store.begin()
+    store.commit()
+    print("Built fixture graph of %d drones in %.1f seconds" % (count, time.time() - start))
+
+
+def free_port():
+    "Return a TCP port nobody's using right now"
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_service(port, stores, querypath):
+    "Start our query service - and wait until it's answering"
+    flaskdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flask")
+    args = [sys.executable, "hello.py", "--port", str(port), "--stores", str(stores), "--rate", "0"]
+    if querypath is not None:
+        args.extend(["--querypath", os.path.abspath(querypath)])
+    service = subprocess.Popen(args, cwd=flaskdir)
+    url = "http://127.0.0.1:%d" % port
+    for _ in range(600):
+        if service.poll() is not None:
+            raise RuntimeError("Query service exited with status %s" % service.returncode)
+        try:
+            urllib.request.urlopen(url + "/querystats").read()
+            return service, url
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    service.terminate()
+    raise RuntimeError("Query service never started answering")
+
+
+class Client(threading.Thread):
+    "One load-generating client - running all its queries 'repeat' times"
+
+    def __init__(self, url, queries, repeat, limit):
+        threading.Thread.__init__(self, daemon=True)
+        self.url = url
+        self.queries = queries
+        self.repeat = repeat
+        self.limit = limit
+        self.latencies = []
+        self.rows = 0
+        self.bytes = 0
+        self.statuses = {}
+
+    def fetch(self, path):
+        "Fetch one page - returning its next cursor (if it was a full page)"
+        start = time.time()
+        try:
+            with urllib.request.urlopen(self.url + path) as response:
+                rows = 0
+                for line in response:
+                    rows += 1
+                    self.bytes += len(line)
+                status = response.status
+                cursor = response.headers.get("X-Next-Cursor")
+        except urllib.error.HTTPError as err:
+            rows, status, cursor = 0, err.code, None
+        self.latencies.append(time.time() - start)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.rows += rows
+        return cursor if self.limit and rows == self.limit else None
+
+    def run(self):
+        for _ in range(self.repeat):
+            for queryname in self.queries:
+                path = "/doquery/%s" % queryname
+                cursor = self.fetch(path + ("?limit=%d" % self.limit if self.limit else ""))
+                while cursor is not None:
+                    cursor = self.fetch(path + "?" + urllib.parse.urlencode({"cursor": cursor}))
+
+
+def percentile(values, fraction):
+    "Return the given percentile of (sorted) values"
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def main():
+    "Load test our REST query service"
+    parser = optparse.OptionParser(
+        prog="query_service_loadtest", description="Load test the REST query service"
+    )
+    parser.add_option("--url", help="query service URL [start our own]")
+    parser.add_option("--fixture", type="int", help="build a fixture graph of this many drones")
+    parser.add_option("-c", "--clients", type="int", default=16, help="clients [%default]")
+    parser.add_option("-r", "--repeat", type="int", default=20, help="runs/client [%default]")
+    parser.add_option("-l", "--limit", type="int", default=500, help="page size [%default]")
+    parser.add_option("-q", "--queries", default=DEFAULT_QUERIES, help="queries [%default]")
+    parser.add_option("--stores", type="int", default=8, help="service Stores [%default]")
+    parser.add_option("--querypath", help="query directory for the service we start")
+    opts = parser.parse_args()[0]
+
+    if opts.fixture:
+        build_fixture(opts.fixture)
+    service = None
+    url = opts.url
+    if url is None:
+        service, url = start_service(free_port(), opts.stores, opts.querypath)
+    try:
+        queries = opts.queries.split(",")
+        clients = [Client(url, queries, opts.repeat, opts.limit) for _ in range(opts.clients)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - start
+        latencies = sorted(lat for client in clients for lat in client.latencies)
+        statuses = {}
+        for client in clients:
+            for status, count in client.statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+        print(
+            "%d clients: %d requests in %.2f seconds (%.1f requests/sec)"
+            % (opts.clients, len(latencies), elapsed, len(latencies) / max(elapsed, 1e-9))
+        )
+        print(
+            "%d rows, %.1f MB - latency p50 %.1fms, p95 %.1fms, p99 %.1fms, max %.1fms"
+            % (
+                sum(client.rows for client in clients),
+                sum(client.bytes for client in clients) / 1e6,
+                1000.0 * percentile(latencies, 0.50),
+                1000.0 * percentile(latencies, 0.95),
+                1000.0 * percentile(latencies, 0.99),
+                1000.0 * percentile(latencies, 1.0),
+            )
+        )
+        print("HTTP status counts: %s" % json.dumps(statuses, sort_keys=True))
+        stats = json.loads(urllib.request.urlopen(url + "/querystats").read().decode("utf8"))
+        print("Service statistics: %s" % json.dumps(stats, sort_keys=True))
+    finally:
+        if service is not None:
+            service.terminate()
+            service.wait()
+    return 0 if set(statuses) == {200} else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
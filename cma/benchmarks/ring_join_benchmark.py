@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Benchmark for joining lots of drones to TheOneRing at once - as happens when a whole
+data center powers up.
+
+We join N drones one at a time (HbRing.join) and then as a single batch (HbRing.join_many)
+and report the number of heartbeat messages each would send, and how long each took.
+
+This needs a running Neo4j - and it EMPTIES the database it uses.
+"""
+from __future__ import print_function
+import sys
+import time
+import optparse
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+import inject
+from AssimCclasses import pyNetAddr
+from cmainit import CMAInjectables, CMAinit
+from cmaconfig import ConfigFile
+from cmadb import CMAdb
+from droneinfo import Drone
+from transaction import NetTransaction
+
+
+def make_drones(first, count):
+    "Create 'count' new drones - numbered starting with 'first'"
+    CMAdb.store.begin()
+    drones = []
+    for number in range(first, first + count):
+        ipaddr = pyNetAddr([10, number // 65536, (number // 256) % 256, number % 256], 1984)
+        drones.append(Drone.add("drone%06d" % number, "bench", primary_ip_addr=str(ipaddr)))
+    CMAdb.store.commit()
+    return drones
+
+
+def run_one(title, count, batched):
+    """Create 'count' drones and add them to TheOneRing - individually or as one batch.
+
+    :param title: str: title for our results
+    :param count: int: how many drones to join
+    :param batched: bool: True if we should join them all as one batch
+    :return: (int, float): messages sent, seconds taken
+    """
+    CMAinit(None, cleanoutdb=True, debug=False)
+    CMAdb.debug = False  # CMAinit turns it on
+    drones = make_drones(1, count)
+    CMAdb.store.begin()
+    CMAdb.net_transaction = NetTransaction(None)
+    start = time.time()
+    if batched:
+        CMAdb.TheOneRing.join_many(drones)
+    else:
+        for drone in drones:
+            CMAdb.TheOneRing.join(drone)
+    CMAdb.store.commit()
+    elapsed = time.time() - start
+    messages = len(CMAdb.net_transaction.tree["packets"])
+    CMAdb.net_transaction = None  # We never actually send any of them
+    print(
+        "%-12s %6d drones: %7d heartbeat messages, %8.3f seconds (%.2f ms/drone)"
+        % (title, count, messages, elapsed, 1000.0 * elapsed / count)
+    )
+    return messages, elapsed
+
+
+def main():
+    "Run our ring join benchmarks"
+    parser = optparse.OptionParser(
+        prog="ring_join_benchmark", description="Compare individual and batched ring joins"
+    )
+    parser.add_option(
+        "-n",
+        "--drones",
+        action="append",
+        type="int",
+        dest="counts",
+        help="Number of drones to join (may be repeated) [default: 10, 100, 1000]",
+    )
+    opts = parser.parse_args()[0]
+    counts = opts.counts if opts.counts else [10, 100, 1000]
+    CMAInjectables.set_config(ConfigFile().complete_config())
+    inject.configure_once(CMAInjectables.test_config_injection)
+    for count in counts:
+        single = run_one("individual", count, batched=False)
+        batch = run_one("batched", count, batched=True)
+        print(
+            "%-12s %6d drones: %6.1fx fewer messages, %6.1fx faster"
+            % ("ratio", count, float(single[0]) / max(batch[0], 1), single[1] / max(batch[1], 1e-6))
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
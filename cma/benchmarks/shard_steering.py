@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Check that a sharded CMA's reuseport group steers every nanoprobe to the worker which owns it.
+
+We bind the sockets exactly the way ShardSupervisor does (without starting any workers),
+then impersonate lots of nanoprobes - each on its own 127.x.y.z address, like loadgen.py -
+plus some on ::1 with different ports. Each one sends a few packets, and we check that
+every packet arrives at the socket of the shard that ShardMap.shard_of() says owns it.
+We also report how evenly the nanoprobes are spread across the shards.
+
+This needs Linux (SO_REUSEPORT with BPF steering) - but no Neo4j and no nanoprobes.
+"""
+from __future__ import print_function
+import sys
+import socket
+import select
+import tempfile
+import optparse
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+# pylint: disable=C0413
+from cmashard import ShardSupervisor
+
+
+def probe_addresses(count, ipv6_count):
+    """Return the (family, address) of each simulated nanoprobe
+
+    :param count: int: number of IPv4 nanoprobes
+    :param ipv6_count: int: number of IPv6 nanoprobes (all on ::1)
+    :return: [(int, str)]
+    """
+    addrs = []
+    for number in range(count):
+        address = "127.%d.%d.%d" % (1 + number // 65025, (number // 255) % 255, 1 + number % 255)
+        addrs.append((socket.AF_INET, address))
+    addrs.extend([(socket.AF_INET6, "::1")] * ipv6_count)
+    return addrs
+
+
+def main():
+    "Check reuseport steering for a sharded CMA"
+    parser = optparse.OptionParser(
+        prog="shard_steering", description="Check sharded CMA packet steering over loopback"
+    )
+    parser.add_option("-n", "--shards", type="int", default=4, help="CMA shards [%default]")
+    parser.add_option("-p", "--probes", type="int", default=1000, help="nanoprobes [%default]")
+    parser.add_option("--ipv6", type="int", default=100, help="IPv6 nanoprobes [%default]")
+    parser.add_option("--packets", type="int", default=3, help="packets per probe [%default]")
+    parser.add_option("--port", type="int", default=19840, help="CMA port [%default]")
+    opts = parser.parse_args()[0]
+
+    supervisor = ShardSupervisor(opts.shards, "[::]:%d" % opts.port, tempfile.mkdtemp())
+    supervisor.create_sockets()
+    shardmap = supervisor.shardmap
+    received = [0] * opts.shards
+    owned = [0] * opts.shards
+    misrouted = 0
+    for family, address in probe_addresses(opts.probes, opts.ipv6):
+        probe = socket.socket(family, socket.SOCK_DGRAM)
+        probe.bind((address, 0))
+        source = probe.getsockname()
+        owner = shardmap.shard_of("[%s]:%d" % (source[0], source[1]))
+        owned[owner] += 1
+        target = "127.0.0.1" if family == socket.AF_INET else "::1"
+        for _ in range(opts.packets):
+            probe.sendto(b"STARTUP", (target, opts.port))
+            readable = select.select(supervisor.udpsocks, [], [], 1.0)[0]
+            for sock in readable:
+                sock.recvfrom(64)
+                shard = supervisor.udpsocks.index(sock)
+                received[shard] += 1
+                if shard != owner:
+                    misrouted += 1
+        probe.close()
+    total = opts.probes + opts.ipv6
+    print("%d nanoprobes, %d shards, %d packets each" % (total, opts.shards, opts.packets))
+    for shard in range(opts.shards):
+        print(
+            "  shard %d: owns %d nanoprobes (%.1f%%), received %d packets"
+            % (shard, owned[shard], 100.0 * owned[shard] / total, received[shard])
+        )
+    print("%d packets received by the wrong shard" % misrouted)
+    return 1 if misrouted or sum(received) != total * opts.packets else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Benchmark for finding the subnets an IP address belongs on.
+
+We compare the old way (test every Subnet with belongs_on_this_subnet) against lookups
+in our SubnetIndex radix trie. Both run entirely in memory - the old way also had to load
+every Subnet from Neo4j for each lookup, which we don't count here. So this understates
+the improvement considerably.
+
+We check that both ways find the same subnets for every address we look up with both.
+"""
+from __future__ import print_function
+import sys
+import time
+import random
+import optparse
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+# pylint: disable=C0413
+from graphnodes import Subnet
+from subnetindex import SubnetIndex
+
+DOMAIN = "global"
+
+
+def make_subnets(count):
+    """Make 'count' distinct IPv4 subnets with a mix of mask lengths
+
+    :param count: int: how many subnets to make
+    :return: [Subnet]
+    """
+    subnets = []
+    for number in range(count):
+        # Mostly /24s - with a /16 above each group of them, and a few /28s
+        second, third = (number // 256) % 256, number % 256
+        if third == 0:
+            cidr = "10.%d.0.0/16" % second
+        elif number % 17 == 0:
+            cidr = "10.%d.%d.16/28" % (second, third)
+        else:
+            cidr = "10.%d.%d.0/24" % (second, third)
+        subnets.append(Subnet(DOMAIN, cidr))
+    return subnets
+
+
+def make_addresses(count, subnet_count, seed=42):
+    """Make 'count' random addresses in (and around) our subnets
+
+    :param count: int: how many addresses to make
+    :param subnet_count: int: how many subnets we made
+    :param seed: int: random seed - so runs are repeatable
+    :return: [str]
+    """
+    rand = random.Random(seed)
+    seconds = min(256, subnet_count // 256 + 2)
+    return [
+        "10.%d.%d.%d" % (rand.randrange(seconds), rand.randrange(256), rand.randrange(256))
+        for _ in range(count)
+    ]
+
+
+def linear_lookup(subnets, ipaddr):
+    "Find matching subnets the old way"
+    return [subnet for subnet in subnets if subnet.belongs_on_this_subnet(ipaddr)]
+
+
+def main():
+    "Compare linear subnet searching against SubnetIndex lookups"
+    parser = optparse.OptionParser(
+        prog="subnet_index_benchmark", description="Compare linear and radix-trie subnet lookups"
+    )
+    parser.add_option("-s", "--subnets", type="int", default=10000, help="subnets [%default]")
+    parser.add_option("-l", "--lookups", type="int", default=100000, help="lookups [%default]")
+    parser.add_option(
+        "--linear-lookups",
+        type="int",
+        default=1000,
+        help="lookups to time the (slow) linear way - scaled up in the report [%default]",
+    )
+    opts = parser.parse_args()[0]
+
+    subnets = make_subnets(opts.subnets)
+    addresses = make_addresses(opts.lookups, opts.subnets)
+
+    start = time.time()
+    for node_id, subnet in enumerate(subnets):
+        SubnetIndex.add(
+            node_id, DOMAIN, subnet.ipaddr, subnet.cidrmask, subnet.context, subnet.net_segment
+        )
+    build = time.time() - start
+    print("Built index of %d subnets in %.3f seconds" % (len(subnets), build))
+
+    start = time.time()
+    matches = 0
+    for ipaddr in addresses:
+        matches += len(SubnetIndex.lookup(DOMAIN, ipaddr))
+    indexed = time.time() - start
+    print(
+        "SubnetIndex: %d lookups in %.3f seconds (%.2f us/lookup, %d matches)"
+        % (len(addresses), indexed, 1e6 * indexed / len(addresses), matches)
+    )
+
+    linear_addresses = addresses[: opts.linear_lookups]
+    start = time.time()
+    for ipaddr in linear_addresses:
+        expected = {subnet.name for subnet in linear_lookup(subnets, ipaddr)}
+        found = {subnets[node_id].name for node_id in SubnetIndex.lookup(DOMAIN, ipaddr)}
+        if expected != found:
+            print("MISMATCH for %s: %s != %s" % (ipaddr, sorted(expected), sorted(found)))
+            return 1
+    linear = time.time() - start
+    per_lookup = linear / len(linear_addresses)
+    print(
+        "Linear:      %d lookups in %.3f seconds (%.2f us/lookup) - %.1f seconds for %d"
+        % (
+            len(linear_addresses),
+            linear,
+            1e6 * per_lookup,
+            per_lookup * len(addresses),
+            len(addresses),
+        )
+    )
+    print("SubnetIndex is %.0fx faster" % (per_lookup * len(addresses) / max(indexed, 1e-9)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Benchmark for the cost of trace points.
+
+We compare three ways of handling the same diagnostic message in a hot loop:
+    - the old way: an unconditional print() to stderr (sent to /dev/null here,
+      so we're only measuring the formatting and write calls - not a real terminal)
+    - a disabled trace point (the normal production case)
+    - an enabled trace point, recording into the ring buffer
+
+To see the effect on packet processing as a whole, run cma_throughput.py with
+ASSIM_TRACE unset and then with ASSIM_TRACE=all=verbose.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import optparse
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+# pylint: disable=C0413
+from assimtrace import Trace, TRACE_OFF, TRACE_VERBOSE
+
+BENCH_TRACE = Trace.category("benchmark")
+
+
+class FakeFrameSet(object):
+    "Something with a moderately expensive __str__ - like a real FrameSet"
+
+    def __init__(self, number):
+        self.frames = ["frame%d-%d" % (number, index) for index in range(8)]
+
+    def __str__(self):
+        return "FakeFrameSet(%s)" % ", ".join(self.frames)
+
+
+def old_way(framesets, outfile):
+    "Unconditional prints - what the packet path used to do"
+    for frameset in framesets:
+        print(
+            "Dequeued FrameSet from ([%s], [%s])" % ("10.10.10.1:1984", str(frameset)),
+            file=outfile,
+        )
+
+
+def trace_way(framesets):
+    "Trace points - only formatted when enabled"
+    for frameset in framesets:
+        if BENCH_TRACE.debug:
+            BENCH_TRACE.emit("Dequeued FrameSet from %s: %s", "10.10.10.1:1984", frameset)
+
+
+def timeit(function, *args):
+    "Return how long function(*args) takes"
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def main():
+    "Compare print()s against disabled and enabled trace points"
+    parser = optparse.OptionParser(
+        prog="trace_benchmark", description="Measure the cost of trace points"
+    )
+    parser.add_option("-n", "--count", type="int", default=200000, help="messages [%default]")
+    opts = parser.parse_args()[0]
+
+    framesets = [FakeFrameSet(number) for number in range(opts.count)]
+    with open(os.devnull, "w") as devnull:
+        printed = timeit(old_way, framesets, devnull)
+    BENCH_TRACE.set_level(TRACE_OFF)
+    disabled = timeit(trace_way, framesets)
+    BENCH_TRACE.set_level(TRACE_VERBOSE)
+    enabled = timeit(trace_way, framesets)
+    BENCH_TRACE.set_level(TRACE_OFF)
+
+    for name, seconds in (
+        ("print() to /dev/null", printed),
+        ("trace point (off)", disabled),
+        ("trace point (on)", enabled),
+    ):
+        print(
+            "%-22s %d messages in %.3f seconds (%.3f us/message)"
+            % (name, opts.count, seconds, 1e6 * seconds / opts.count)
+        )
+    print("Disabled trace points are %.0fx cheaper than print()" % (printed / max(disabled, 1e-9)))
+    print("Ring buffer holds %d messages (%d dropped)" % (len(Trace.ring), Trace.dropped))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
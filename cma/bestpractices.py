@@ -37,8 +37,11 @@ import logging
 import sys
 import inject
 from droneinfo import Drone
+from cmadb import CMAdb
+from cmashard import CMAShard
 from consts import CMAconsts
 from graphnodes import BPRules, BPRuleSet
+from scorerollup import ScoreRollups
 from systemnode import SystemNode
 from discoverylistener import DiscoveryListener
 from graphnodeexpression import GraphNodeExpression, ExpressionContext
@@ -52,6 +55,7 @@ class BestPractices(DiscoveryListener):
 
     prio = DiscoveryListener.PRI_OPTION  # What priority are we?
     wanted_packets = []  # Used to register ourselves for discovery packets
+    readonly_json = True  # We only evaluate rules against our discovery data
     eval_objects = {}
     eval_classes = {}
     evaled_classes = {}
@@ -60,9 +64,9 @@ class BestPractices(DiscoveryListener):
     BASEURL = "http://db.ITBestPractices.info:%d"
 
     @inject.params(store="Store", log="logging.Logger")
-    def __init__(self, config, packetio, store=None, log=None, debug=False):
+    def __init__(self, config, packetio, store=None, log=None, debug=False, context=None):
         """Initialize our BestPractices object"""
-        DiscoveryListener.__init__(self, config, packetio, store, log, debug)
+        DiscoveryListener.__init__(self, config, packetio, store, log, debug, context=context)
         if self.__class__ != BestPractices:
             return
         for pkttype in config["allbpdiscoverytypes"]:
@@ -218,7 +222,7 @@ class BestPractices(DiscoveryListener):
         #   (drone, evaltype, BestPractices.eval_objects[evaltype])
         for rule_obj in BestPractices.eval_objects[evaltype]:
             # print  >> sys.stderr, 'Fetching %s rules for %s' % (evaltype, drone)
-            rulesobj = rule_obj.fetch_rules(drone, srcaddr, evaltype)
+            rulesobj = self._fetch_rules(rule_obj, drone, srcaddr, evaltype)
             # print >> sys.stderr, 'RULES ARE:', rulesobj
             statuses = pyConfigContext(
                 rule_obj.evaluate(drone, srcaddr, jsonobj, rulesobj, evaltype)
@@ -226,6 +230,17 @@ class BestPractices(DiscoveryListener):
             # print >> sys.stderr, 'RESULTS ARE:', statuses
             self.log_rule_results(statuses, drone, srcaddr, jsonobj, evaltype, rulesobj)
 
+    def _fetch_rules(self, rule_obj, drone, srcaddr, evaltype):
+        """Fetch the rules for this rule object - sharing them with the other listeners
+        processing this packet through our DiscoveryContext's bp_rules() view.
+        """
+        if self.context is None:
+            return rule_obj.fetch_rules(drone, srcaddr, evaltype)
+        return self.context.memo(
+            ("bp_rules", evaltype),
+            lambda: rule_obj.fetch_rules(drone, srcaddr, evaltype),
+        )
+
     @staticmethod
     def send_rule_event(oldstat, newstat, drone, ruleid, ruleobj, url):
         """ Newstat, ruleid, and ruleobj can never be None. """
@@ -291,7 +306,9 @@ class BestPractices(DiscoveryListener):
                     "%s %sED %s rule %s: %s [%s]"
                     % (drone, stat.upper(), rulecategory, ruleid, url, thisrule["rule"])
                 )
-        self.compute_score_updates(discoveryobj, drone, rulesobj, results, oldstats)
+        self.compute_score_updates(
+            discoveryobj, drone, rulesobj, results, oldstats, discovertype=discovertype
+        )
         setattr(drone, status_name, str(results))
 
     def compute_scores(self, drone, rulesobj, statuses):
@@ -322,7 +339,9 @@ class BestPractices(DiscoveryListener):
 
     # pylint  disable=R0914 -- too many local variables
     # pylint: disable=R0914
-    def compute_score_updates(self, discovery_json, drone, rulesobj, newstats, oldstats):
+    def compute_score_updates(
+        self, discovery_json, drone, rulesobj, newstats, oldstats, discovertype=None
+    ):
         """We compute the score updates for the rules and results we've been given.
         The drone is a Drone (or host), the 'rulesobj' contains the rules and their categories.
         Statuses contains the results of evaluating the rules.
@@ -334,13 +353,32 @@ class BestPractices(DiscoveryListener):
         Note that this can fail if we change our algorithm - because we don't know the values
             the old algorithm gave us, only what the current algorithm gives us on the old results.
 
-        @TODO: We eventually want to update the scores for the domain to which this drone
-        belongs.
-
+        We also update the score rollups for the domain to which this drone belongs
+        (see scorerollup.py) - when we have a Store to update them in. In a sharded CMA,
+        only the worker which owns the domain updates them.
 
+        'discovertype' is the type we evaluated the rules for - which defaults to the
+        discovery type of 'discovery_json'.
         """
-        _, oldcatscores, _ = self.compute_scores(drone, rulesobj, oldstats)
-        _, newcatscores, _ = self.compute_scores(drone, rulesobj, newstats)
+        _, oldcatscores, oldrulescores = self.compute_scores(drone, rulesobj, oldstats)
+        _, newcatscores, newrulescores = self.compute_scores(drone, rulesobj, newstats)
+        if self.store is not None:
+            if discovertype is None:
+                discovertype = discovery_json["discovertype"]
+            if CMAdb.shard is not None and not CMAdb.shard.owns_name(drone.domain):
+                # Another CMA worker owns this domain's rollups - so it does all the updating
+                CMAdb.shard.defer_name(
+                    drone.domain,
+                    "scorerollup",
+                    domain=drone.domain,
+                    discovertype=discovertype,
+                    old=oldrulescores,
+                    new=newrulescores,
+                )
+            else:
+                ScoreRollups.apply(
+                    self.store, drone.domain, discovertype, oldrulescores, newrulescores
+                )
         keys = set(newcatscores)
         keys |= set(oldcatscores)
         # I have no idea why "keys = set(newcatscores) | set(oldcatscores)" did not work...
@@ -391,10 +429,16 @@ class BestPractices(DiscoveryListener):
         """Evaluate our rules given the current/changed data.
         """
         jsonobj = wholejsonobj["data"]
+        # Every rule reads the same data, so we convert it (and the rules) to native
+        # Python once, instead of crossing into C for every value each rule looks at.
+        if hasattr(jsonobj, "snapshot"):
+            jsonobj = jsonobj.snapshot()
         # oldcontext = ExpressionContext((drone,), prefix='JSON_proc_sys')
         newcontext = ExpressionContext((jsonobj,))
         if hasattr(ruleobj, "_jsonobj"):
             ruleobj = getattr(ruleobj, "_jsonobj")
+        if hasattr(ruleobj, "snapshot"):
+            ruleobj = ruleobj.snapshot()
         ruleids = sorted(list(ruleobj.keys()))
         statuses = {"pass": [], "fail": [], "ignore": [], "NA": [], "score": 0.0}
         if len(ruleids) < 1:
@@ -432,6 +476,12 @@ class BestPractices(DiscoveryListener):
         return statuses
 
 
+@CMAShard.handler("scorerollup")
+def shard_scorerollup(args):
+    "Another CMA worker's drone changed scores in a domain whose score rollups we own"
+    ScoreRollups.apply(CMAdb.store, args["domain"], args["discovertype"], args["old"], args["new"])
+
+
 @BestPractices.register("proc_sys")
 @SystemNode.add_json_processor
 class BestPracticesCMA(BestPractices):
@@ -439,8 +489,8 @@ class BestPracticesCMA(BestPractices):
     application = "os"
     discovery_name = "JSON_proc_sys"
 
-    def __init__(self, config, packetio, store, log, debug):
-        BestPractices.__init__(self, config, packetio, store, log, debug)
+    def __init__(self, config, packetio, store, log, debug, context=None):
+        BestPractices.__init__(self, config, packetio, store, log, debug, context=context)
 
     def fetch_rules(self, drone, _unusedsrcaddr, discovertype):
         """Evaluate our rules given the current/changed data.
@@ -121,6 +121,7 @@ import AssimCtypes
 from AssimCclasses import pyCompressFrame, pyCryptCurve25519, pyCryptFrame
 from cmaconfig import ConfigFile
 from bestpractices import BestPractices
+from assimtrace import Trace
 
 sys.stdout = sys.stderr
 
@@ -240,6 +241,25 @@ def main():
         help="Trace CMA execution",
     )
 
+    parser.add_option(
+        "-t",
+        "--tracepoints",
+        action="store",
+        default=None,
+        dest="tracepoints",
+        metavar="category=level,...",
+        help="enable trace points - for example store=debug,dispatch=info (SIGQUIT dumps them)",
+    )
+
+    parser.add_option(
+        "--shards",
+        action="store",
+        default=1,
+        dest="shards",
+        metavar="N",
+        help="run N CMA worker processes, each owning a partition of the drones",
+    )
+
     parser.add_option(
         "-u",
         "--user",
@@ -273,6 +293,13 @@ def main():
         return 0
 
     opt.debug = int(opt.debug)
+    opt.shards = int(opt.shards)
+    if opt.tracepoints:
+        try:
+            Trace.configure(opt.tracepoints)
+        except ValueError as e:
+            print("Invalid --tracepoints value: %s" % e, file=sys.stderr)
+            return 1
 
     # This doesn't seem to work no matter where I invoke it...
     # But if we don't fork in daemonize_me() ('C' code), it works great...
@@ -309,6 +336,7 @@ def main():
     daemonize_me(opt.foreground, "/", opt.pidfile, 20)
 
     rmpid_and_exit_on_signal(opt.pidfile, signal.SIGTERM)
+    signal.signal(signal.SIGQUIT, lambda sig, stack: Trace.dump())
 
     # Next statement can't appear before daemonize_me() or bind() fails -- not quite sure why...
     assimilation_openlog("cma")
@@ -316,6 +344,9 @@ def main():
     from messagedispatcher import MessageDispatcher
     from dispatchtarget import DispatchTarget
     from monitoring import MonitoringRule
+    from warmstart import WarmStart
+    from admission import AdmissionController
+    from discoveryscheduler import DiscoveryScheduler
     from AssimCclasses import pyNetAddr, pySignFrame, pyReliableUDP, pyPacketDecoder
     from AssimCtypes import (
         CONFIGNAME_CMAINIT,
@@ -344,12 +375,6 @@ def main():
     print(f"Loading monitoring rules from '{MONRULEINSTALL_DIR}'", file=sys.stderr)
     MonitoringRule.load_tree(MONRULEINSTALL_DIR)
 
-    execobserver_constraints = {
-        "nodetype": ["Drone", "IPaddrNode", "MonitorAction", "NICNode", "ProcessNode", "SystemNode"]
-    }
-    ForkExecObserver(constraints=execobserver_constraints, scriptdir=NOTIFICATION_SCRIPT_DIR)
-    print("Fork/Event observer dispatching from %s" % NOTIFICATION_SCRIPT_DIR, file=sys.stderr)
-
     if opt.bind is not None:
         OurAddrStr = opt.bind
 
@@ -376,6 +401,31 @@ def main():
     configinfo[CONFIGNAME_OUTSIG] = pySignFrame(1)
     config = configinfo.complete_config()
 
+    shard = None
+    if opt.shards > 1:
+        # Every worker forks its own event script runner and opens its own Neo4j connections
+        from cmashard import ShardSupervisor
+
+        bindaddr = pyNetAddr(str(config[CONFIGNAME_CMAINIT]))
+        if bindaddr.port() == 0:
+            bindaddr.setport(DefaultPort)
+        supervisor = ShardSupervisor(opt.shards, bindaddr, os.path.dirname(opt.pidfile))
+        shard = supervisor.run()
+        if shard is None:  # We're the supervisor - and all our workers have stopped
+            remove_pid_file(opt.pidfile)
+            return 0
+
+    # We fork our event script runner before we open our sockets, so it doesn't inherit them
+    execobserver_constraints = {
+        "nodetype": ["Drone", "IPaddrNode", "MonitorAction", "NICNode", "ProcessNode", "SystemNode"]
+    }
+    ForkExecObserver(
+        constraints=execobserver_constraints,
+        scriptdir=NOTIFICATION_SCRIPT_DIR,
+        config=config.get("event_scripts", None),
+    )
+    print("Fork/Event observer dispatching from %s" % NOTIFICATION_SCRIPT_DIR, file=sys.stderr)
+
     addr = config[CONFIGNAME_CMAINIT]
     # pylint is confused: addr is a pyNetAddr, not a pyConfigContext
     # pylint: disable=E1101
@@ -391,6 +441,10 @@ def main():
         if elem in config:
             config[elem] = pyNetAddr(str(config[elem]), port=ourport)
     io = pyReliableUDP(config, pyPacketDecoder())
+    if shard is not None:
+        # Our supervisor bound our socket in the CMA's reuseport group for us
+        io.adopt_socket(shard.udpsock.fileno())
+        shard.udpsock.close()
     io.setrcvbufsize(10 * 1024 * 1024)  # No harm in asking - it will get us the best we can get...
     io.setsendbufsize(1024 * 1024)  # Most of the traffic volume is inbound from discovery
     cmainit.CMAInjectables.set_config(configinfo)
@@ -406,14 +460,25 @@ def main():
         pass
     drop_privileges_permanently(opt.userid)
     try:
-        cmainit.CMAinit(io, cleanoutdb=opt.erasedb, debug=(opt.debug > 0))
+        cmainit.CMAinit(
+            io,
+            cleanoutdb=opt.erasedb and (shard is None or shard.first),
+            debug=(opt.debug > 0),
+            ringname="The_One_Ring" if shard is None else shard.ring_name,
+        )
     except RuntimeError:
-        remove_pid_file(opt.pidfile)
+        if shard is None:
+            remove_pid_file(opt.pidfile)
         raise
+    if shard is not None:
+        CMAdb.shard = shard
+        shard.ready()
     for warn in cryptwarnings:
         CMAdb.log.warning(warn)
     cmadb = CMAdb()
     CMAdb.log.info("Listening on: %s" % str(config[CONFIGNAME_CMAINIT]))
+    if shard is not None:
+        CMAdb.log.info("CMA shard %d of %d" % (shard.index, opt.shards))
     CMAdb.log.info("Requesting return packets sent to: %s" % str(OurAddr))
     CMAdb.log.info("Socket input buffer size:  %d" % io.getrcvbufsize())
     CMAdb.log.info("Socket output buffer size: %d" % io.getsendbufsize())
@@ -459,7 +524,19 @@ def main():
 
     # Important to note that we don't want PacketListener to create its own 'io' object
     # or it will screw up the ReliableUDP protocol...
-    listener = PacketListener(config, disp, io=io)
+    CMAdb.admission = AdmissionController.from_config(config)
+    CMAdb.discovery_scheduler = DiscoveryScheduler.from_config(config)
+    listener = PacketListener(config, disp, io=io, shard=shard, admission=CMAdb.admission)
+    if shard is not None:
+        shard.listen(disp, CMAdb.log)
+    warmstart = WarmStart.from_config(config, shard=shard)
+    if warmstart is not None:
+        if opt.erasedb:
+            warmstart.discard()
+        else:
+            warmstart.load()
+        warmstart.start(listener.mainloop)
+        CMAdb.warmstart = warmstart
     mandatory_modules = ["discoverylistener"]
     for mandatory in mandatory_modules:
         importlib.import_module(mandatory)
@@ -494,6 +571,11 @@ def main():
         # that would involve adding some Drone callbacks for creation of new Drones
         BestPractices(config, io, CMAdb.store, CMAdb.log, opt.debug)
         listener.listen()
+    # We only get here if we were told to shut down
+    if warmstart is not None:
+        warmstart.save(clean=True)
+        if shard is None:
+            remove_pid_file(opt.pidfile)
     return 0
 
 
@@ -28,6 +28,8 @@ Not quite sure what all it will do, but hey, this comment is slightly better tha
 """
 
 # from sys import stderr
+import json
+from types import MappingProxyType
 from AssimCclasses import pyConfigContext, pyNetAddr, pySignFrame, pyCompressFrame
 from consts import CMAconsts
 
@@ -39,6 +41,11 @@ class ConfigFile(object):
     """
 
     callbacks = []
+    # Resolved agent parameters - see agent_params().
+    # id(config) -> (config, {(agenttype, agentname, dronedesignation): (json, frozen params)})
+    _agent_params_cache = {}
+    _agent_params_maxconfigs = 4  # We normally only see one or two configurations
+    agent_params_stats = {"hits": 0, "misses": 0, "flushes": 0}
     # A template is a pattern for how to validate a dict-like object
     # like those that come from pyConfigContexts -- which in turn model JSON
     default_template = {
@@ -123,6 +130,41 @@ class ConfigFile(object):
             "warn": int,  # How long to wait when issuing a late heartbeat warning
             "timeout": int,  # How long to wait before declaring a system dead
         },
+        "ring_join": {
+            "window_ms": int,  # How long to accumulate STARTUPs before joining them to the ring
+            "max_batch": int,  # Join immediately when this many drones are waiting
+        },
+        "admission": {
+            "limits": {str: {"rate": int, "burst": int}},  # Token buckets by FrameSet type name
+            "death_window_ms": int,  # How long to collect deaths before processing them together
+            "death_max_batch": int,  # Process collected deaths when this many are waiting
+            "death_merge_s": int,  # How long we merge repeated reports of a death
+        },
+        "discovery_schedule": {
+            "min_interval": int,  # Shortest interval (seconds) we shorten a discovery to
+            "max_interval": int,  # Longest interval we lengthen a discovery to (0 means off)
+            "stable_after": int,  # Unchanged results in a row before we lengthen an interval
+            "window_ms": int,  # How often we push new schedules to nanoprobes
+            "max_batch": int,  # Most drones we push new schedules to at once
+        },
+        "event_scripts": {
+            "mode": str,  # "pool" or "legacy" - how we run our event notification scripts
+            "max_concurrency": int,  # How many copies of each script can run at once
+            "script_concurrency": {str: int},  # Per-script overrides of max_concurrency
+            "timeout": int,  # Seconds a script gets to handle an event (or batch of events)
+            "batch_size": int,  # Most events we send to a stream worker at once
+            "max_queue": int,  # Most events queued for a script before we stop reading more
+        },
+        "cypher_profile": {
+            "slow_ms": int,  # Cypher statements at least this slow go in the slow-query log
+            "max_shapes": int,  # Most distinct statement shapes to keep statistics for
+            "explain_count": int,  # How many of the slowest statements to capture plans for
+            "report_file": str,  # Where to save the report for 'assimcli cypherprofile'
+        },
+        "warm_start": {
+            "file": str,  # Where to keep our warm-start snapshot ("" means no snapshots)
+            "interval": int,  # How often (in seconds) to write it - 0 means only at shutdown
+        },
         "bprulesbydomain": {str: str},  # Which best practice rule sets to use by default?
         "allbpdiscoverytypes": [str],  # List of all best practice discovery types
         "checksum_cmds": [str],  # Ordered List of checksum commands to use
@@ -273,6 +315,42 @@ class ConfigFile(object):
                 "warn": 5,  # How long to wait when issuing a late heartbeat warning
                 "timeout": 30,  # How long to wait before declaring a system dead
             },
+            "ring_join": {
+                "window_ms": 0,  # 0 means join each drone to the ring as its STARTUP arrives
+                "max_batch": 200,  # Largest number of drones to join the ring in one batch
+            },
+            "admission": {
+                # STARTUPs per second (0 means no limit) - and how many we take in a burst
+                "limits": {"STARTUP": {"rate": 0, "burst": 200}},
+                "death_window_ms": 0,  # 0 means process each death as its report arrives
+                "death_max_batch": 500,
+                "death_merge_s": 30,
+            },
+            "discovery_schedule": {
+                "min_interval": 30,
+                "max_interval": 3600,  # Quiet discoveries back off to once an hour
+                "stable_after": 3,
+                "window_ms": 1000,
+                "max_batch": 100,
+            },
+            "event_scripts": {
+                "mode": "pool",  # Run scripts through an EventWorkerPool
+                "max_concurrency": 1,  # One copy of each script - so it sees events in order
+                "script_concurrency": {},  # No per-script overrides
+                "timeout": 60,  # Kill scripts which take more than a minute
+                "batch_size": 100,  # Up to 100 events per batch for stream workers
+                "max_queue": 10000,  # Up to 10000 events waiting for each script
+            },
+            "cypher_profile": {
+                "slow_ms": 250,  # Log Cypher statements taking 250ms or more
+                "max_shapes": 2000,  # Statement shapes beyond this are lumped together
+                "explain_count": 5,  # Capture EXPLAIN plans for the 5 slowest statements
+                "report_file": "/var/run/assimilation/cypherprofile.json",
+            },
+            "warm_start": {
+                "file": "/var/lib/assimilation/warmstart.json",
+                "interval": 300,  # Write a snapshot every 5 minutes - and when we shut down
+            },
             "bprulesbydomain": {  # Default best practice rule sets by domain
                 # Default the global domain to the base rule set
                 CMAconsts.globaldomain: CMAconsts.BASERULESETNAME,
@@ -411,6 +489,9 @@ class ConfigFile(object):
     def __delitem__(self, name):
         """We're basically a dict lookalike - implement __delitem__"""
         del self.config[name]
+        for callbacktuple in ConfigFile.callbacks:
+            callback, args = callbacktuple
+            callback(self, name, args)
 
     def __len__(self):
         """We're basically a dict lookalike - implement __len__"""
@@ -448,6 +529,9 @@ class ConfigFile(object):
         """Create a complete configuration by merging with defaults
         and validating the merged config against our template."""
         ConfigFile._merge_config_elems(self.defaults, self.config)
+        for callbacktuple in ConfigFile.callbacks:
+            callback, args = callbacktuple
+            callback(self, None, args)
         ret = self.isvalid(self.config)
         if ret[0]:
             return self.config
@@ -553,6 +637,75 @@ class ConfigFile(object):
     @staticmethod
     def agent_params(config, agenttype, agentname, dronedesignation):
         """We return the agent parameters for the given type, agent name and drone
+        as a pyConfigContext. It's a fresh copy, so our caller is free to modify it.
+        See _resolve_agent_params() for how they're computed.
+        """
+        return pyConfigContext(
+            ConfigFile._cached_agent_params(config, agenttype, agentname, dronedesignation)[0]
+        )
+
+    @staticmethod
+    def agent_params_json(config, agenttype, agentname, dronedesignation):
+        "Return the agent parameters for the given type, agent name and drone as a JSON string"
+        return ConfigFile._cached_agent_params(config, agenttype, agentname, dronedesignation)[0]
+
+    @staticmethod
+    def agent_params_readonly(config, agenttype, agentname, dronedesignation):
+        """Return the agent parameters for the given type, agent name and drone as an
+        immutable (and shared) mapping. This is the cheapest way to look at them:
+        it's just a dictionary lookup once they've been computed.
+        Dicts in the result are read-only mappings and lists are tuples.
+        """
+        return ConfigFile._cached_agent_params(config, agenttype, agentname, dronedesignation)[1]
+
+    @staticmethod
+    def _cached_agent_params(config, agenttype, agentname, dronedesignation):
+        """Return the (JSON string, read-only mapping) pair for these agent parameters,
+        computing them if we haven't already done so for this configuration.
+        Our cache is flushed through our ConfigFile callback whenever a ConfigFile changes.
+        """
+        entry = ConfigFile._agent_params_cache.get(id(config))
+        if entry is None or entry[0] is not config:
+            if len(ConfigFile._agent_params_cache) >= ConfigFile._agent_params_maxconfigs:
+                ConfigFile._agent_params_cache = {}
+            entry = (config, {})
+            ConfigFile._agent_params_cache[id(config)] = entry
+        key = (agenttype, agentname, dronedesignation)
+        resolved = entry[1].get(key)
+        if resolved is not None:
+            ConfigFile.agent_params_stats["hits"] += 1
+            return resolved
+        ConfigFile.agent_params_stats["misses"] += 1
+        jsonstr = str(
+            ConfigFile._resolve_agent_params(config, agenttype, agentname, dronedesignation)
+        )
+        resolved = (jsonstr, ConfigFile._freeze(json.loads(jsonstr)))
+        entry[1][key] = resolved
+        return resolved
+
+    @staticmethod
+    def _freeze(value):
+        "Return an immutable version of this JSON-derived value"
+        if isinstance(value, dict):
+            return MappingProxyType({key: ConfigFile._freeze(val) for key, val in value.items()})
+        if isinstance(value, list):
+            return tuple(ConfigFile._freeze(val) for val in value)
+        return value
+
+    @staticmethod
+    def flush_agent_params_cache(_configfile=None, _name=None, _args=None):
+        """Forget all our precomputed agent parameters.
+        We're registered as a ConfigFile callback, so this happens whenever a ConfigFile
+        is created or changed. If you modify a configuration object some other way,
+        you need to call this yourself.
+        """
+        if ConfigFile._agent_params_cache:
+            ConfigFile.agent_params_stats["flushes"] += 1
+        ConfigFile._agent_params_cache = {}
+
+    @staticmethod
+    def _resolve_agent_params(config, agenttype, agentname, dronedesignation):
+        """We compute the agent parameters for the given type, agent name and drone
         The most specific values take priority over the less specific values
         creating a 3-level value inheritance scheme.
         - Top level is for all agents.
@@ -592,6 +745,7 @@ for container in ConfigFile.default_template["containers"]:
         "initial_discovery"
     ] = ConfigFile.default_template["initial_discovery"]
 ConfigFile.default_template["containers"]["vagrant"]["initial_discovery"].add("netconfig")
+ConfigFile.register_callback(ConfigFile.flush_agent_params_cache)
 
 if __name__ == "__main__":
     # pylint: disable=C0411,C0413
@@ -46,6 +46,10 @@ class CMAdb(object):
     store = None
     config = {}
     TheOneRing: Any
+    shard = None  # Our CMAShard - if we're one worker of a sharded CMA
+    warmstart = None  # Our WarmStart - if we're keeping warm-start snapshots
+    admission = None  # Our AdmissionController - if we rate limit incoming FrameSets
+    discovery_scheduler = None  # Our DiscoveryScheduler - if we adapt discovery intervals
     globaldomain = "global"
     underdocker = None
     # versions we know we can't work with...
@@ -38,6 +38,7 @@ import neobolt.exceptions as NeoExceptions
 from AssimCtypes import NEO4JCREDFILENAME, CMAUSERID
 from neo4j import NeoDockerServer, NeoServer
 from store import Store
+from neopool import Neo4jRouter
 from cmadb import CMAdb
 from hbring import HbRing
 from transaction import NetTransaction
@@ -212,6 +213,10 @@ class CMAInjectables(object):
         "NEO4J_PORT": 7687,
         "NEO4J_READONLY": False,
         "NEO4J_RETRIES": 300,
+        "NEO4J_READ_REPLICAS": [],  # URLs of read replicas for our reader pool
+        "NEO4J_WRITER_POOL_SIZE": 10,
+        "NEO4J_READER_POOL_SIZE": 10,
+        "NEO4J_POOL_TIMEOUT": 30.0,  # seconds to wait for a pooled connection (None: forever)
     }
     config = {}
 
@@ -309,15 +314,8 @@ class CMAInjectables(object):
                 print('DIR:', dir(neodatabase))
                 print(f"NAME: {neo_credentials.name} AUTH: {neo_credentials.auth}", file=stderr)
                 print("Constructing neodb:", file=stderr)
-                neodb = py2neo.Graph(
-                    url,
-                    user=neo_credentials.name,
-                    password=neo_credentials.auth,
-                    bolt=True,
-                    http=False,
-                    https=False,
-                    bolt_port=9999,
-                    secure=False,
+                neodb = CMAInjectables.new_graph(
+                    url, neo_credentials, CMAInjectables.settings["NEO4J_WRITER_POOL_SIZE"]
                 )
                 print(f"Built neodb: {neodb}", file=stderr)
                 # Neo4j started.  All is well with the world.
@@ -339,6 +337,46 @@ class CMAInjectables(object):
         #  print(f"setup_db: returning {neodb}", file=stderr)
         return neodb
 
+    @staticmethod
+    def new_graph(url, neo_credentials, max_connections):
+        """Return a py2neo.Graph connected to the given URL
+
+        :param url: str: URL of the Neo4j server
+        :param neo_credentials: Neo4jCreds: credentials to log in with
+        :param max_connections: int: most connections py2neo should open to this server
+        :return: py2neo.Graph
+        """
+        return py2neo.Graph(
+            url,
+            user=neo_credentials.name,
+            password=neo_credentials.auth,
+            bolt=True,
+            http=False,
+            https=False,
+            bolt_port=9999,
+            secure=False,
+            max_connections=max_connections,
+        )
+
+    @staticmethod
+    @inject.params(db="py2neo.Graph", neo_credentials="Neo4jCreds")
+    def setup_router(db, neo_credentials):
+        """Return a Neo4jRouter with writer and reader pools for our Stores
+        We're happy to be an injector for Neo4jRouter objects...
+        """
+        settings = CMAInjectables.settings
+        replicas = [
+            CMAInjectables.new_graph(url, neo_credentials, settings["NEO4J_READER_POOL_SIZE"])
+            for url in settings["NEO4J_READ_REPLICAS"]
+        ]
+        return Neo4jRouter(
+            db,
+            replicas,
+            writer_size=settings["NEO4J_WRITER_POOL_SIZE"],
+            reader_size=settings["NEO4J_READER_POOL_SIZE"],
+            timeout=settings["NEO4J_POOL_TIMEOUT"],
+        )
+
     @staticmethod
     @inject.params(config="Config")
     def setup_json_store(config):
@@ -379,13 +417,17 @@ class CMAInjectables(object):
         )
 
     @staticmethod
-    @inject.params(db="py2neo.Graph", log="logging.Logger")
-    def setup_store(db, log, readonly=None):
+    @inject.params(router="Neo4jRouter", log="logging.Logger")
+    def setup_store(router, log, readonly=None):
         """Return a Store object for mapping our objects to the database (OGM model)
+        Read-only Stores use our reader pool - everyone else uses the writer pool.
         We're happy to be an injector for Store objects...
         """
         readonly = CMAInjectables.settings["NEO4J_READONLY"] if readonly is None else readonly
-        store = Store(db=db, readonly=readonly, log=log)
+        pool = router.pool(readonly)
+        store = Store(
+            db=pool.graph, readonly=readonly, log=log, pool=pool, reader_pool=router.reader
+        )
         # print('RETURNING STORE: %s' % store, file=sys.stderr)
         return store
 
@@ -396,6 +438,7 @@ class CMAInjectables(object):
         binder.bind_to_constructor("logging.Logger", CMAInjectables.setup_prod_logging)
         binder.bind_to_provider("Neo4jCreds", Neo4jCreds)  # odd, but intentional...
         binder.bind_to_constructor("py2neo.Graph", CMAInjectables.setup_db)
+        binder.bind_to_constructor("Neo4jRouter", CMAInjectables.setup_router)
         binder.bind_to_constructor("Store", CMAInjectables.setup_store)
         binder.bind_to_provider("Config", CMAInjectables.setup_config)
         binder.bind_to_constructor("PersistentJSON", CMAInjectables.setup_json_store)
@@ -407,6 +450,7 @@ class CMAInjectables(object):
         binder.bind_to_constructor("logging.Logger", CMAInjectables.setup_test_logging)
         binder.bind_to_provider("Neo4jCreds", Neo4jCreds)  # odd, but intentional...
         binder.bind_to_constructor("py2neo.Graph", CMAInjectables.setup_db)
+        binder.bind_to_constructor("Neo4jRouter", CMAInjectables.setup_router)
         binder.bind_to_constructor("Store", CMAInjectables.setup_store)
         binder.bind_to_provider("Config", CMAInjectables.setup_config)
         binder.bind_to_constructor("PersistentJSON", CMAInjectables.setup_json_store)
@@ -451,13 +495,15 @@ class CMAinit(object):
         debug=False,
         encryption_required=False,
         use_network=True,
+        ringname="The_One_Ring",
     ):
         """Initialize and construct a global database instance
+
+        :param ringname: str: name of TheOneRing - each worker of a sharded CMA has its own
         """
         # print("CALLING NEW initglobal", file=sys.stderr)
         CMAdb.log = log
         CMAdb.debug = debug
-        CMAdb.debug = True
         CMAdb.io = io
         CMAdb.store = store
         self.db = db
@@ -469,6 +515,13 @@ class CMAinit(object):
             CMAdb.log.info("Re-initializing the NEO4j database")
             print("Re-initializing the NEO4j database to empty", file=stderr)
             self.delete_all()
+            # Drone.find() must not remember any of the Drones we just deleted
+            from droneinfo import Drone
+
+            Drone.flush_find_cache()
+            from subnetindex import SubnetIndex
+
+            SubnetIndex.invalidate()
             print("delete_all complete", file=stderr)
 
         CMAdb.use_network = use_network
@@ -479,7 +532,7 @@ class CMAinit(object):
             # print("CMAdb.store(cmadb.py):", CMAdb.store, file=sys.stderr)
             with store.begin(autocommit=False) as transaction:
                 CMAdb.TheOneRing = CMAdb.store.load_or_create(
-                    HbRing, name="The_One_Ring", ringtype=HbRing.THEONERING
+                    HbRing, name=ringname, ringtype=HbRing.THEONERING
                 )
                 print("Created TheOneRing: %s" % CMAdb.TheOneRing)
                 if CMAdb.use_network:
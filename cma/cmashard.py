@@ -0,0 +1,610 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Horizontal sharding of the CMA across worker processes.
+
+A sharded CMA is a supervisor process and N worker processes. Each worker is a complete CMA -
+with its own PacketListener, MessageDispatcher, Store connections and heartbeat ring - and it
+owns a deterministic partition of the drones, chosen by their source address and port.
+
+The supervisor binds one SO_REUSEPORT socket per worker to the CMA's address - all in one
+reuseport group - and attaches a classic BPF program to the group. The kernel runs it on every
+packet, and it steers the packet to the socket of the worker which owns its sender.
+Because the supervisor keeps every socket open, a worker which dies gets its own socket
+(and any packets queued on it) back when it's restarted - and no other worker's drones move.
+
+Things which cross partitions - like a drone telling us a drone in another partition has died -
+are sent to the owning worker over an explicit local message channel: a Unix datagram socket
+per worker. Each message is a JSON object naming an operation, and each operation has a handler
+function registered with @CMAShard.handler(name). The owning worker runs it in its own
+transaction.
+
+Nodes which drones share - switches, NICs and IP addresses learned from ARP and link discovery,
+subnets, network segments, IP:port endpoints and score rollups - are all owned by the worker
+which owns their domain's name (ShardMap.shard_of_name(domain)). Only that worker creates or
+changes them, so no two workers can race to create the same one. Discovery which updates them
+is sent there once the transaction which received it commits (see defer_name()).
+
+Each worker has its own caches, and here's how they cope with the other workers' changes:
+    - Drone.find() cache: workers which move IP addresses between drones tell all the
+      others to forget them (the "forgetips" operation)
+    - SubnetIndex: only a domain's owner reads or writes its subnets - so it sees every change
+    - Store mutation epochs (and QueryResultCache): a worker only counts its own commits,
+      so cached query results can miss changes made by other workers until they expire.
+
+On Linux, all of 127.0.0.0/8 is loopback - so loadgen.py can simulate nanoprobes on lots
+of different addresses, and benchmarks/shard_steering.py checks the steering on one machine.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import json
+import zlib
+import select
+import signal
+import socket
+import struct
+import ctypes
+import ipaddress
+import assimglib as glib
+from assimtrace import Trace
+
+SHARD_TRACE = Trace.category("shard")
+
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+SO_ATTACH_REUSEPORT_CBPF = 51  # Not (yet) in the socket module
+
+
+class ShardMap(object):
+    """
+    Deterministic partition of drones among our CMA workers - by source address and port.
+    shard_of() computes exactly what our BPF program computes in the kernel - so every worker
+    can tell which worker owns any drone, without asking anyone.
+    """
+
+    MULTIPLIER = 2654435761  # Knuth's multiplicative hash constant (2**32 / golden ratio)
+    # Classic BPF opcodes we use - from linux/filter.h
+    BPF_LD_B_ABS = 0x30
+    BPF_LD_H_ABS = 0x28
+    BPF_LD_W_ABS = 0x20
+    BPF_LD_H_IND = 0x48
+    BPF_LDX_B_MSH = 0xB1
+    BPF_RSH_K = 0x74
+    BPF_XOR_X = 0xAC
+    BPF_MUL_K = 0x24
+    BPF_MOD_K = 0x94
+    BPF_JA = 0x05
+    BPF_JEQ_K = 0x15
+    BPF_TAX = 0x07
+    BPF_RET_A = 0x16
+    SKF_NET_OFF = -0x100000  # Offsets relative to the start of the IP header
+
+    def __init__(self, nshards):
+        """
+        Create a ShardMap for this many CMA workers
+
+        :param nshards: int: number of CMA workers
+        """
+        if int(nshards) < 1:
+            raise ValueError("Invalid number of CMA shards [%s]" % nshards)
+        self.nshards = int(nshards)
+
+    @staticmethod
+    def split_addr(addr):
+        """
+        Split an address into its IP address and port
+
+        :param addr: pyNetAddr or str: address - like "10.10.10.1:1984" or "[::1]:1984"
+        :return: (ipaddress.IPv4Address or ipaddress.IPv6Address, int): IP address and port
+        """
+        addrstr = addr if isinstance(addr, str) else repr(addr)  # repr() is canonical
+        if addrstr.startswith("["):
+            host, _, port = addrstr[1:].partition("]:")
+        elif addrstr.count(":") == 1:
+            host, _, port = addrstr.partition(":")
+        else:  # IPv4 or IPv6 without a port
+            host, port = addrstr, "0"
+        return ipaddress.ip_address(host), int(port or 0)
+
+    def shard_of(self, addr):
+        """
+        Return the shard which owns the drone at this address.
+        We use the low 32 bits of the IP address - so IPv4 addresses and their IPv4-mapped
+        IPv6 equivalents land in the same place - mixed with the port.
+
+        :param addr: pyNetAddr or str: address of the drone (with its port)
+        :return: int: shard number
+        """
+        ipaddr, port = self.split_addr(addr)
+        key = ((int(ipaddr) & 0xFFFFFFFF) ^ port) * ShardMap.MULTIPLIER
+        return ((key & 0xFFFFFFFF) >> 16) % self.nshards
+
+    def shard_of_name(self, name):
+        """
+        Return the shard which owns something we know by name rather than by address -
+        like a switch's chassis id
+
+        :param name: str: name of the thing
+        :return: int: shard number
+        """
+        return zlib.crc32(str(name).encode("utf-8")) % self.nshards
+
+    def reuseport_program(self):
+        """
+        Return our reuseport BPF program - which returns the index of the socket that should
+        receive each packet. It computes shard_of() - for IPv4 or IPv6 (without extension
+        headers). Sockets are numbered in the order they joined the reuseport group.
+
+        :return: [(int, int, int, int)]: BPF instructions (code, jt, jf, k)
+        """
+        net = ShardMap.SKF_NET_OFF
+        return [
+            (ShardMap.BPF_LD_B_ABS, 0, 0, net),  # A = IP version/header length byte
+            (ShardMap.BPF_RSH_K, 0, 0, 4),  # A = IP version
+            (ShardMap.BPF_JEQ_K, 0, 5, 4),  # IPv4?
+            (ShardMap.BPF_LDX_B_MSH, 0, 0, net),  # X = IPv4 header length
+            (ShardMap.BPF_LD_H_IND, 0, 0, net),  # A = UDP source port
+            (ShardMap.BPF_TAX, 0, 0, 0),  # X = source port
+            (ShardMap.BPF_LD_W_ABS, 0, 0, net + 12),  # A = IPv4 source address
+            (ShardMap.BPF_JA, 0, 0, 3),
+            (ShardMap.BPF_LD_H_ABS, 0, 0, net + 40),  # A = UDP source port (IPv6)
+            (ShardMap.BPF_TAX, 0, 0, 0),  # X = source port
+            (ShardMap.BPF_LD_W_ABS, 0, 0, net + 20),  # A = low 32 bits of IPv6 source
+            (ShardMap.BPF_XOR_X, 0, 0, 0),
+            (ShardMap.BPF_MUL_K, 0, 0, ShardMap.MULTIPLIER),
+            (ShardMap.BPF_RSH_K, 0, 0, 16),
+            (ShardMap.BPF_MOD_K, 0, 0, self.nshards),
+            (ShardMap.BPF_RET_A, 0, 0, 0),
+        ]
+
+    def attach(self, sock):
+        """
+        Attach our reuseport program to this socket's reuseport group
+
+        :param sock: socket.socket: a bound socket in the group
+        :return: None
+        """
+        program = self.reuseport_program()
+        code = b"".join(
+            struct.pack("HBBI", op, jt, jf, k & 0xFFFFFFFF) for op, jt, jf, k in program
+        )
+        filterbuf = ctypes.create_string_buffer(code)
+        # struct sock_fprog {unsigned short len; struct sock_filter *filter;}
+        fprog = struct.pack("HL", len(program), ctypes.addressof(filterbuf))
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+
+
+class CMAShard(object):
+    """
+    A worker's place in a sharded CMA: which shard we are, which drones we own,
+    our UDP socket, and the local message channel to our sibling workers.
+    """
+
+    handlers = {}  # operation name -> handler function
+    # Largest message we send or receive over our channel sockets. Link discovery from a big
+    # switch can easily be more than 64K. The kernel may give our sockets smaller buffers
+    # than this (net.core.wmem_max) - then sending larger messages fails (and is logged).
+    MAX_MESSAGE = 4 * 1024 * 1024
+
+    def __init__(self, shardmap, index, rundir, channel, udpsock, first=False, ready_fd=None):
+        """
+        Create our worker's view of the sharded CMA
+
+        :param shardmap: ShardMap: who owns what
+        :param index: int: our shard number
+        :param rundir: str: directory where our channel sockets live
+        :param channel: socket.socket: our (bound) channel socket
+        :param udpsock: socket.socket: our (bound) socket in the CMA's reuseport group
+        :param first: bool: True if we're the first worker to start
+        :param ready_fd: int: pipe to tell our supervisor when we're ready - or None
+        """
+        self.shardmap = shardmap
+        self.index = index
+        self.rundir = rundir
+        self.channel = channel
+        self.udpsock = udpsock
+        self.first = first
+        self._ready_fd = ready_fd
+        self.dispatcher = None
+        self.log = None
+        self.iowatch = None
+        self.stats = {
+            "sent": 0,
+            "received": 0,
+            "send_errors": 0,
+            "unknown": 0,
+            "foreign": 0,
+            "bad_messages": 0,
+            "dropped": 0,
+        }
+        self._deferred = []  # (shard number, operation, args) to send when we commit
+
+    @property
+    def ring_name(self):
+        "Return the name of our partition of TheOneRing"
+        return "The_One_Ring_%d" % self.index
+
+    @staticmethod
+    def sockpath(rundir, index):
+        """
+        Return the pathname of a worker's channel socket
+
+        :param rundir: str: directory where our channel sockets live
+        :param index: int: shard number
+        :return: str: pathname of the socket
+        """
+        return os.path.join(rundir, "cma-shard-%d.sock" % index)
+
+    @staticmethod
+    def handler(operation):
+        """
+        Register a function to handle this operation when another worker sends it to us.
+        It is intended to be used as a decorator. The function is called with the arguments
+        the sender gave us (a dict) - inside its own database and network transaction.
+
+        :param operation: str: name of the operation
+        :return: decorator
+        """
+
+        def register(function):
+            "Register 'function' as our handler"
+            CMAShard.handlers[operation] = function
+            return function
+
+        return register
+
+    def owns(self, addr):
+        """
+        Return True if we own the drone at this address
+
+        :param addr: pyNetAddr or str: address of the drone
+        :return: bool
+        """
+        return self.shardmap.shard_of(addr) == self.index
+
+    def owns_name(self, name):
+        """
+        Return True if we own this named thing (switch, etc)
+
+        :param name: str: name of the thing
+        :return: bool
+        """
+        return self.shardmap.shard_of_name(name) == self.index
+
+    def send(self, index, operation, **args):
+        """
+        Send an operation to another worker. If that worker is being restarted, the message
+        waits in its socket until it's back. We never block - if its socket is full,
+        the message is dropped (and logged).
+
+        :param index: int: shard number of the worker to send it to
+        :param operation: str: name of the operation
+        :param args: arguments for the operation's handler
+        :return: bool: True if it was sent
+        """
+        message = json.dumps({"op": operation, "from": self.index, "args": args})
+        try:
+            message = message.encode("utf-8")
+            if len(message) > self.MAX_MESSAGE:
+                raise IOError("message of %d bytes is too large" % len(message))
+            self.channel.sendto(message, self.sockpath(self.rundir, index))
+        except (OSError, IOError) as oops:
+            self.stats["send_errors"] += 1
+            if self.log is not None:
+                self.log.warning("Could not send %s to CMA shard %d: %s" % (operation, index, oops))
+            return False
+        self.stats["sent"] += 1
+        if SHARD_TRACE.debug:
+            SHARD_TRACE.emit("Sent %s to shard %d: %s", operation, index, args)
+        return True
+
+    def forward(self, addr, operation, **args):
+        """
+        Send an operation to the worker which owns the drone at this address
+
+        :param addr: pyNetAddr or str: address of the drone
+        :param operation: str: name of the operation
+        :param args: arguments for the operation's handler
+        :return: bool: True if it was sent
+        """
+        return self.send(self.shardmap.shard_of(addr), operation, **args)
+
+    def forward_name(self, name, operation, **args):
+        """
+        Send an operation to the worker which owns this named thing
+
+        :param name: str: name of the thing
+        :param operation: str: name of the operation
+        :param args: arguments for the operation's handler
+        :return: bool: True if it was sent
+        """
+        return self.send(self.shardmap.shard_of_name(name), operation, **args)
+
+    def defer_name(self, name, operation, **args):
+        """
+        Like forward_name() - except that we send it once our current transaction commits.
+        Use this when the owner's handler needs to see what our transaction wrote - and
+        when it mustn't happen at all if our transaction aborts.
+
+        :param name: str: name of the thing
+        :param operation: str: name of the operation
+        :param args: arguments for the operation's handler
+        :return: None
+        """
+        self._deferred.append((self.shardmap.shard_of_name(name), operation, args))
+
+    def defer_broadcast(self, operation, **args):
+        """
+        Send an operation to all the other workers once our current transaction commits
+
+        :param operation: str: name of the operation
+        :param args: arguments for the operation's handler
+        :return: None
+        """
+        for index in range(self.shardmap.nshards):
+            if index != self.index:
+                self._deferred.append((index, operation, args))
+
+    def send_deferred(self):
+        """
+        Send the operations our transaction deferred - it has committed.
+        The MessageDispatcher calls this after each transaction commits.
+
+        :return: None
+        """
+        deferred, self._deferred = self._deferred, []
+        for index, operation, args in deferred:
+            self.send(index, operation, **args)
+
+    def drop_deferred(self):
+        """
+        Forget the operations our transaction deferred - it was aborted.
+        The MessageDispatcher calls this whenever a transaction fails.
+
+        :return: None
+        """
+        self.stats["dropped"] += len(self._deferred)
+        self._deferred = []
+
+    def ready(self):
+        """
+        Tell our supervisor we're initialized - so it can start the other workers
+
+        :return: None
+        """
+        if self._ready_fd is not None:
+            os.write(self._ready_fd, b"R")
+            os.close(self._ready_fd)
+            self._ready_fd = None
+
+    def listen(self, dispatcher, log):
+        """
+        Start processing messages from our sibling workers in our mainloop
+
+        :param dispatcher: MessageDispatcher: runs each message in its own transaction
+        :param log: logging.Logger: where to log problems
+        :return: None
+        """
+        self.dispatcher = dispatcher
+        self.log = log
+        self.iowatch = glib.IOWatch(
+            self.channel.fileno(), glib.IO_IN | glib.IO_PRI, CMAShard._channel_callback, self
+        )
+
+    @staticmethod
+    def _channel_callback(_source, _condition, shard):
+        "glib I/O callback: process everything our siblings have sent us"
+        shard.receive_all()
+        return True
+
+    def receive_all(self):
+        """
+        Process every message waiting in our channel socket
+
+        :return: int: number of messages we processed
+        """
+        count = 0
+        while True:
+            try:
+                data, _ancdata, flags, _addr = self.channel.recvmsg(self.MAX_MESSAGE)
+            except BlockingIOError:
+                return count
+            count += 1
+            self.stats["received"] += 1
+            if flags & socket.MSG_TRUNC:
+                self.stats["bad_messages"] += 1
+                self.log.warning("Truncated message from a CMA shard (%d bytes)" % len(data))
+                continue
+            try:
+                message = json.loads(data.decode("utf-8"))
+                operation = message["op"]
+                sender = message["from"]
+                args = message["args"]
+                handler = CMAShard.handlers.get(operation)
+            except (ValueError, KeyError, TypeError) as oops:
+                self.stats["bad_messages"] += 1
+                self.log.warning("Invalid message from a CMA shard: %s" % oops)
+                continue
+            if handler is None:
+                self.stats["unknown"] += 1
+                self.log.warning("Unknown operation %s from CMA shard %s" % (operation, sender))
+                continue
+            if SHARD_TRACE.debug:
+                SHARD_TRACE.emit("Received %s from shard %s: %s", operation, sender, args)
+            self.dispatcher.run_transaction(
+                "CMA shard %s from shard %s" % (operation, sender), handler, args
+            )
+
+    def summary(self):
+        """
+        Summarize what we've sent and received
+
+        :return: str: summary of our statistics
+        """
+        return "shard %d of %d: %s" % (
+            self.index,
+            self.shardmap.nshards,
+            ", ".join("%s %d" % (name, value) for name, value in sorted(self.stats.items())),
+        )
+
+
+class ShardSupervisor(object):
+    """
+    The supervisor of a sharded CMA. It binds all our sockets, then starts a worker process
+    for each shard, and restarts any worker which dies. The first worker initializes the
+    database before we start any of the others.
+    """
+
+    restart_delay = 1.0  # Seconds between a worker dying and restarting it
+    ready_timeout = 600.0  # Seconds we wait for the first worker to be ready
+
+    def __init__(self, nshards, bindaddr, rundir):
+        """
+        Create a supervisor for a sharded CMA
+
+        :param nshards: int: number of worker processes
+        :param bindaddr: pyNetAddr or str: the address:port our nanoprobes talk to
+        :param rundir: str: directory for our channel sockets
+        """
+        self.shardmap = ShardMap(nshards)
+        self.bindaddr = bindaddr
+        self.rundir = rundir
+        self.udpsocks = []
+        self.channels = []
+        self.workers = {}  # pid -> shard number
+        self.stopping = False
+
+    def create_sockets(self):
+        """
+        Bind one socket per worker in our reuseport group - in shard order - and attach our
+        steering program. Then bind each worker's channel socket.
+
+        :return: None
+        """
+        ipaddr, port = ShardMap.split_addr(self.bindaddr)
+        if ipaddr.is_unspecified:
+            host = "::"
+        elif ipaddr.version == 4:
+            host = "::ffff:%s" % ipaddr
+        else:
+            host = str(ipaddr)
+        for _ in range(self.shardmap.nshards):
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            sock.bind((host, port))
+            self.udpsocks.append(sock)
+        self.shardmap.attach(self.udpsocks[0])
+        for index in range(self.shardmap.nshards):
+            path = CMAShard.sockpath(self.rundir, index)
+            if os.path.exists(path):
+                os.unlink(path)
+            channel = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            channel.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, CMAShard.MAX_MESSAGE)
+            channel.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, CMAShard.MAX_MESSAGE)
+            channel.bind(path)
+            self.channels.append(channel)
+
+    def run(self):
+        """
+        Start our workers and supervise them until we're told to stop.
+        This returns in each worker process - and in the supervisor once every worker is gone.
+
+        :return: CMAShard: our shard - in a worker process, or None in the supervisor
+        """
+        self.create_sockets()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        readfd, writefd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(readfd)
+            return self._become_worker(0, first=True, ready_fd=writefd)
+        self.workers[pid] = 0
+        os.close(writefd)
+        # Only the first worker initializes the database - so the rest wait for it
+        select.select([readfd], [], [], ShardSupervisor.ready_timeout)
+        os.close(readfd)
+        pending = [] if self.stopping else list(range(1, self.shardmap.nshards))
+        while True:
+            for index in pending:
+                pid = os.fork()
+                if pid == 0:
+                    return self._become_worker(index)
+                self.workers[pid] = index
+            pending = []
+            if not self.workers:
+                break
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.workers.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            print(
+                "CMA shard %d (pid %d) exited with status 0x%x - restarting it."
+                % (index, pid, status),
+                file=sys.stderr,
+            )
+            time.sleep(ShardSupervisor.restart_delay)
+            pending.append(index)
+        for index in range(self.shardmap.nshards):
+            try:
+                os.unlink(CMAShard.sockpath(self.rundir, index))
+            except OSError:
+                pass
+        return None
+
+    def _become_worker(self, index, first=False, ready_fd=None):
+        """
+        Turn this (newly forked) process into the worker for this shard
+
+        :param index: int: shard number
+        :param first: bool: True if we're the first worker to start
+        :param ready_fd: int: pipe to tell our supervisor when we're ready - or None
+        :return: CMAShard: our shard
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # Our supervisor keeps everyone's sockets open - we only need our own
+        for other in range(self.shardmap.nshards):
+            if other != index:
+                self.udpsocks[other].close()
+                self.channels[other].close()
+        self.channels[index].setblocking(False)
+        return CMAShard(
+            self.shardmap,
+            index,
+            self.rundir,
+            self.channels[index],
+            self.udpsocks[index],
+            first=first,
+            ready_fd=ready_fd,
+        )
+
+    def _stop(self, _signum, _frame):
+        "Signal handler: stop all our workers - and then ourselves"
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100 fileencoding=utf-8
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Per-statement Cypher profiling and a slow-query log.
+
+Every statement a Store sends to Neo4j goes through Store._send(), which hands it to
+the Store's CypherProfiler. We group statements by their "shape" - the statement with
+its literals (strings, numbers, lists of them) and generated variable numbers stripped -
+so that the thousands of different "MATCH (Drone123) WHERE ... = 'host17'" statements
+we send show up as one line in the report.
+
+For each shape we keep a count, the total and maximum latency, a latency histogram,
+the number of rows it returned, and which FrameSet types or discovery listeners sent it
+(see CypherProfiler.calling()). Latency includes fetching the rows - which py2neo
+does lazily, so for 'run' statements we wrap the cursor in a ProfiledCursor and
+record the statement when its rows have all been read (or it's thrown away).
+
+Statements slower than 'slow_ms' go into the slow-query log - and we can capture
+the Neo4j EXPLAIN plans of the worst of them. We only EXPLAIN (never PROFILE) since
+PROFILE would run our update statements a second time.
+
+The CMA saves its report to a file every so often; 'assimcli cypherprofile' prints it.
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+import contextlib
+import collections
+
+DEFAULT_SLOW_MS = 250
+DEFAULT_MAX_SHAPES = 2000
+DEFAULT_EXPLAIN_COUNT = 5
+DEFAULT_REPORT_FILE = "/var/run/assimilation/cypherprofile.json"
+# Upper bounds (in milliseconds) of our latency histogram buckets - the last bucket is open
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+OTHER_SHAPE = "(other statements)"
+
+# Substitutions which turn a statement into its shape - in this order
+SHAPE_SUBSTITUTIONS = (
+    (re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\""), "?"),  # string literals
+    (re.compile(r"\b([A-Za-z_]+)\d+\b"), r"\1"),  # generated variable names (Drone123)
+    (re.compile(r"(?<![\w$.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b"), "?"),  # numbers
+    (re.compile(r"\[\s*\?(?:\s*,\s*\?)*\s*\]"), "[?]"),  # lists of literals
+    (re.compile(r"\s+"), " "),
+)
+
+
+def statement_shape(querystr):
+    """
+    Return the shape of a Cypher statement - with literals replaced by '?'
+
+    :param querystr: str: Cypher statement
+    :return: str: its shape
+    """
+    for pattern, replacement in SHAPE_SUBSTITUTIONS:
+        querystr = pattern.sub(replacement, querystr)
+    return querystr.strip()
+
+
+def histogram_bucket(elapsed_ms):
+    """
+    Return the index of the histogram bucket this latency belongs in
+
+    :param elapsed_ms: float: latency in milliseconds
+    :return: int: bucket index
+    """
+    for index, bound in enumerate(HISTOGRAM_BOUNDS_MS):
+        if elapsed_ms <= bound:
+            return index
+    return len(HISTOGRAM_BOUNDS_MS)
+
+
+def histogram_labels():
+    "Return the labels of our histogram buckets"
+    labels = ["<=%dms" % bound for bound in HISTOGRAM_BOUNDS_MS]
+    labels.append(">%dms" % HISTOGRAM_BOUNDS_MS[-1])
+    return labels
+
+
+class StatementProfile(object):
+    """Everything we know about the statements of one shape"""
+
+    __slots__ = (
+        "shape",
+        "count",
+        "writes",
+        "rows",
+        "errors",
+        "total_seconds",
+        "max_seconds",
+        "histogram",
+        "callers",
+        "worst",
+        "plan",
+    )
+
+    def __init__(self, shape):
+        """
+        :param shape: str: the shape of our statements
+        """
+        self.shape = shape
+        self.count = 0
+        self.writes = 0
+        self.rows = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.callers = collections.Counter()
+        self.worst = None  # (querystr, params) of our slowest statement
+        self.plan = None  # EXPLAIN output for 'worst' - if we captured one
+
+    def to_dict(self):
+        "Return our statistics as a JSON-compatible dict"
+        return {
+            "shape": self.shape,
+            "count": self.count,
+            "writes": self.writes,
+            "rows": self.rows,
+            "errors": self.errors,
+            "total_ms": 1000.0 * self.total_seconds,
+            "mean_ms": 1000.0 * self.total_seconds / max(self.count, 1),
+            "max_ms": 1000.0 * self.max_seconds,
+            "histogram": list(self.histogram),
+            "callers": dict(self.callers),
+            "plan": self.plan,
+        }
+
+
+class CypherProfiler(object):
+    """
+    Statistics on every Cypher statement a Store sends - grouped by statement shape
+    """
+
+    # What the CMA is doing right now - the FrameSet type, discovery listener, etc.
+    # Class-wide, since it describes our (single-threaded) packet processing, not a Store.
+    caller = None
+
+    def __init__(
+        self,
+        slow_ms=DEFAULT_SLOW_MS,
+        max_shapes=DEFAULT_MAX_SHAPES,
+        explain_count=DEFAULT_EXPLAIN_COUNT,
+        log=None,
+    ):
+        """
+        :param slow_ms: float: statements at least this slow go in the slow-query log
+        :param max_shapes: int: most shapes to keep track of - the rest are lumped together
+        :param explain_count: int: how many of the worst slow shapes to capture plans for
+        :param log: logging.Logger: where to log slow statements (or None)
+        """
+        self.slow_ms = slow_ms
+        self.max_shapes = max_shapes
+        self.explain_count = explain_count
+        self.log = log
+        self.profiles = {}
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.slow_log = collections.deque(maxlen=100)
+        self.started = time.time()
+        self._shape_cache = {}
+
+    def reset(self):
+        "Forget everything we've recorded"
+        self.profiles = {}
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.slow_log.clear()
+        self.started = time.time()
+
+    def configure(self, config):
+        """
+        Update our settings from the "cypher_profile" section of the CMA configuration
+
+        :param config: dict-like: configuration section (may be empty)
+        :return: None
+        """
+        self.slow_ms = config.get("slow_ms", self.slow_ms)
+        self.max_shapes = config.get("max_shapes", self.max_shapes)
+        self.explain_count = config.get("explain_count", self.explain_count)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def calling(name):
+        """
+        Context manager which charges statements sent inside it to 'name'.
+        Nested calls are charged to "outer/inner" - for example "JSDISCOVERY/TCPDiscoveryListener"
+
+        :param name: str: what we're doing
+        :return: generator(None)
+        """
+        saved = CypherProfiler.caller
+        CypherProfiler.caller = name if saved is None else "%s/%s" % (saved, name)
+        try:
+            yield
+        finally:
+            CypherProfiler.caller = saved
+
+    def shape(self, querystr):
+        """
+        Return the shape of this statement - remembering recent ones, since many of our
+        statements (like those from loaded queries) are sent over and over.
+
+        :param querystr: str: Cypher statement
+        :return: str: its shape
+        """
+        shape = self._shape_cache.get(querystr)
+        if shape is None:
+            if len(self._shape_cache) >= self.max_shapes:
+                self._shape_cache.clear()
+            shape = statement_shape(querystr)
+            self._shape_cache[querystr] = shape
+        return shape
+
+    def record(self, querystr, params, elapsed, rows, write, failed=False):
+        """
+        Record one statement
+
+        :param querystr: str: the Cypher statement
+        :param params: dict: its parameters
+        :param elapsed: float: seconds it took - including fetching its rows
+        :param rows: int: number of rows it returned
+        :param write: bool: True if it was part of our (update) transaction
+        :param failed: bool: True if Neo4j rejected it
+        :return: None
+        """
+        shape = self.shape(querystr)
+        profile = self.profiles.get(shape)
+        if profile is None:
+            if len(self.profiles) >= self.max_shapes:
+                shape = OTHER_SHAPE
+                profile = self.profiles.get(shape)
+            if profile is None:
+                profile = StatementProfile(shape)
+                self.profiles[shape] = profile
+        bucket = histogram_bucket(1000.0 * elapsed)
+        profile.count += 1
+        profile.rows += rows
+        profile.total_seconds += elapsed
+        profile.histogram[bucket] += 1
+        profile.callers[CypherProfiler.caller or "-"] += 1
+        self.histogram[bucket] += 1
+        if write:
+            profile.writes += 1
+        if failed:
+            profile.errors += 1
+        if elapsed > profile.max_seconds:
+            profile.max_seconds = elapsed
+            profile.worst = (querystr, params)
+        if 1000.0 * elapsed >= self.slow_ms:
+            self._log_slow(querystr, elapsed, rows)
+
+    def _log_slow(self, querystr, elapsed, rows):
+        "Add a statement to the slow-query log"
+        entry = {
+            "time": time.time(),
+            "ms": 1000.0 * elapsed,
+            "rows": rows,
+            "caller": CypherProfiler.caller,
+            "statement": querystr,
+        }
+        self.slow_log.append(entry)
+        if self.log is not None:
+            self.log.warning(
+                "Slow Cypher statement (%.1fms, %d rows, from %s): %s"
+                % (entry["ms"], rows, entry["caller"], " ".join(querystr.split()))
+            )
+
+    def worst(self, count=10, key="total_seconds"):
+        """
+        Return our worst statement shapes
+
+        :param count: int: how many to return
+        :param key: str: StatementProfile attribute to rank them by
+        :return: [StatementProfile]
+        """
+        return sorted(self.profiles.values(), key=lambda p: getattr(p, key), reverse=True)[
+            :count
+        ]
+
+    def capture_plans(self, store):
+        """
+        Capture EXPLAIN plans for the slowest statements of our worst slow shapes.
+        MessageDispatcher calls this with its periodic summary (every 100 packets) - not while
+        sending the statements - and each shape is EXPLAINed only once, so it stays cheap.
+
+        :param store: Store: Store to EXPLAIN them through
+        :return: int: number of plans captured
+        """
+        captured = 0
+        for profile in self.worst(self.explain_count, key="max_seconds"):
+            if profile.plan is not None or profile.worst is None:
+                continue
+            if 1000.0 * profile.max_seconds < self.slow_ms:
+                break
+            querystr, params = profile.worst
+            try:
+                profile.plan = store.explain(querystr, params)
+            # pylint: disable=W0703
+            except Exception as oops:
+                profile.plan = "EXPLAIN failed: %s" % oops
+            captured += 1
+        return captured
+
+    def report(self, count=None):
+        """
+        Return our statistics as a JSON-compatible dict
+
+        :param count: int: how many shapes to include (worst first) - None means all
+        :return: dict
+        """
+        profiles = self.worst(len(self.profiles) if count is None else count)
+        return {
+            "started": self.started,
+            "now": time.time(),
+            "slow_ms": self.slow_ms,
+            "histogram_labels": histogram_labels(),
+            "histogram": list(self.histogram),
+            "statements": sum(self.histogram),
+            "shapes": [profile.to_dict() for profile in profiles],
+            "slow_log": list(self.slow_log),
+        }
+
+    def save(self, filename=DEFAULT_REPORT_FILE):
+        """
+        Save our report in a file for 'assimcli cypherprofile' - replacing it atomically
+
+        :param filename: str: where to put it
+        :return: None
+        """
+        tmpname = filename + ".tmp"
+        with open(tmpname, "w") as tmpfile:
+            json.dump(self.report(), tmpfile)
+        os.rename(tmpname, filename)
+
+    def summary(self):
+        "Summarize our statistics for the logs"
+        worst = self.worst(1)
+        return "%d Cypher statements, %d shapes, %d slow; worst: %s" % (
+            sum(self.histogram),
+            len(self.profiles),
+            len(self.slow_log),
+            "%.1fms total for [%s]" % (1000.0 * worst[0].total_seconds, worst[0].shape[:80])
+            if worst
+            else "none",
+        )
+
+    @staticmethod
+    def print_report(report, count=20, outfile=sys.stdout):
+        """
+        Print a report (as returned by report()) legibly
+
+        :param report: dict: our report
+        :param count: int: how many shapes to print
+        :param outfile: file: where to print it
+        :return: None
+        """
+        elapsed = max(report["now"] - report["started"], 1e-9)
+        statements = report["statements"]
+        print(
+            "%d Cypher statements in %.0f seconds (%.1f/second), %d shapes"
+            % (statements, elapsed, statements / elapsed, len(report["shapes"])),
+            file=outfile,
+        )
+        CypherProfiler._print_histogram(report["histogram_labels"], report["histogram"], outfile)
+        for shape in report["shapes"][:count]:
+            print("", file=outfile)
+            print(
+                "%8.1fms total %6d statements %7.2fms mean %8.1fms max %8d rows %d errors"
+                % (
+                    shape["total_ms"],
+                    shape["count"],
+                    shape["mean_ms"],
+                    shape["max_ms"],
+                    shape["rows"],
+                    shape["errors"],
+                ),
+                file=outfile,
+            )
+            print("    %s" % shape["shape"], file=outfile)
+            callers = sorted(shape["callers"].items(), key=lambda item: item[1], reverse=True)
+            print(
+                "    from: %s" % ", ".join("%s (%d)" % caller for caller in callers[:5]),
+                file=outfile,
+            )
+            if shape["plan"]:
+                for line in shape["plan"].splitlines():
+                    print("    | %s" % line, file=outfile)
+        if report["slow_log"]:
+            print("", file=outfile)
+            print("Slow statements (>= %sms):" % report["slow_ms"], file=outfile)
+            for entry in report["slow_log"]:
+                print(
+                    "%s %8.1fms %6d rows %s: %s"
+                    % (
+                        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["time"])),
+                        entry["ms"],
+                        entry["rows"],
+                        entry["caller"],
+                        " ".join(entry["statement"].split())[:200],
+                    ),
+                    file=outfile,
+                )
+
+    @staticmethod
+    def _print_histogram(labels, histogram, outfile):
+        "Print a latency histogram as a bar chart"
+        total = max(sum(histogram), 1)
+        for label, count in zip(labels, histogram):
+            if count:
+                print(
+                    "%10s %8d %s" % (label, count, "#" * int(round(50.0 * count / total))),
+                    file=outfile,
+                )
+
+
+class ProfiledCursor(object):
+    """
+    Wraps a py2neo Cursor so that the statement gets recorded (with its row count and
+    the time it took to fetch its rows) when the caller finishes with it.
+    """
+
+    __slots__ = ("_cursor", "_profiler", "_querystr", "_params", "_write", "_elapsed", "_rows")
+
+    def __init__(self, cursor, profiler, querystr, params, write, elapsed):
+        """
+        :param cursor: py2neo.Cursor: the real cursor
+        :param profiler: CypherProfiler: who to record the statement with
+        :param querystr: str: Cypher statement
+        :param params: dict: its parameters
+        :param write: bool: True if it's part of our transaction
+        :param elapsed: float: seconds it took to send the statement
+        """
+        self._cursor = cursor
+        self._profiler = profiler
+        self._querystr = querystr
+        self._params = params
+        self._write = write
+        self._elapsed = elapsed
+        self._rows = 0
+
+    def forward(self, amount=1):
+        """
+        Move the cursor forward - just like py2neo.Cursor.forward()
+
+        :param amount: int: how many records to move forward
+        :return: int: how many records we actually moved
+        """
+        start = time.time()
+        moved = self._cursor.forward(amount)
+        self._elapsed += time.time() - start
+        if moved:
+            self._rows += moved
+        else:
+            self.finish()
+        return moved
+
+    @property
+    def current(self):
+        "The current record - just like py2neo.Cursor.current"
+        return self._cursor.current
+
+    def __getattr__(self, name):
+        "Everything else comes from the real cursor"
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._cursor, name)
+
+    def finish(self):
+        "Record our statement - if we haven't already"
+        if self._profiler is not None:
+            profiler, self._profiler = self._profiler, None
+            profiler.record(self._querystr, self._params, self._elapsed, self._rows, self._write)
+
+    def __del__(self):
+        "Callers often stop reading early (maxcount) - record the statement anyway"
+        self.finish()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100 fileencoding=utf-8
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Shared lookup context for the discovery listeners processing a single discovery packet.
+
+Every listener interested in a discovery packet used to work out the same things about the
+drone for itself - its IP addresses, its NICs, the processes it hosts, its best practice
+rules and so on - each one costing Neo4j round trips. A DiscoveryContext is created for each
+discovery packet and handed to every listener which processes it. Each view is loaded the
+first time some listener asks for it, and remembered until we're done with the packet.
+
+We count hits and misses per discovery type, so we can see how many round trips we save.
+Listeners which change something a view depends on must forget() that view.
+"""
+from consts import CMAconsts
+
+
+class DiscoveryContext(object):
+    """
+    Memoized, lazily loaded views of a drone's neighborhood - shared by all the listeners
+    processing one discovery packet.
+    """
+
+    stats = {}  # discovery type -> {"hits": int, "misses": int}
+
+    def __init__(self, drone, store, discovertype):
+        """
+        Create a context for processing one discovery packet
+
+        :param drone: Drone: the drone (or other SystemNode) the discovery came from
+        :param store: Store: our Store
+        :param discovertype: str: the type of discovery we're processing
+        """
+        self.drone = drone
+        self.store = store
+        self.discovertype = discovertype
+        self._views = {}
+        if discovertype not in DiscoveryContext.stats:
+            DiscoveryContext.stats[discovertype] = {"hits": 0, "misses": 0}
+        self._stats = DiscoveryContext.stats[discovertype]
+
+    def memo(self, key, loader):
+        """
+        Return the view named 'key' - calling 'loader' to load it if we don't have it yet
+
+        :param key: hashable: name of the view
+        :param loader: callable(): returns the value of the view
+        :return: object: the value of the view
+        """
+        if key in self._views:
+            self._stats["hits"] += 1
+            return self._views[key]
+        self._stats["misses"] += 1
+        value = loader()
+        self._views[key] = value
+        return value
+
+    def forget(self, *keys):
+        """
+        Forget the given views - because we've changed something they depend on
+
+        :param keys: hashable: names of the views to forget
+        :return: None
+        """
+        for key in keys:
+            self._views.pop(key, None)
+
+    def owned_ips(self):
+        """
+        Return the IP addresses our drone owns. Copy it before changing it...
+
+        :return: [IPaddrNode]
+        """
+        return self.memo("owned_ips", self.drone.get_owned_ips)
+
+    def nics(self):
+        """
+        Return the NICs our drone owns
+
+        :return: [NICNode]
+        """
+        return self.memo(
+            "nics", lambda: list(self.store.load_related(self.drone, CMAconsts.REL_nicowner))
+        )
+
+    def hosted(self):
+        """
+        Return everything our drone hosts - ProcessNodes and so on
+
+        :return: [GraphNode]
+        """
+        return self.memo(
+            "hosted", lambda: list(self.store.load_related(self.drone, CMAconsts.REL_hosting))
+        )
+
+    def bp_rules(self, discovertype):
+        """
+        Return our drone's merged best practice rules for this discovery type
+
+        :param discovertype: str: discovery type the rules apply to
+        :return: dict-like: merged rules
+        """
+        return self.memo(
+            ("bp_rules", discovertype), lambda: self.drone.get_merged_bp_rules(discovertype)
+        )
+
+    @staticmethod
+    def summary():
+        """
+        Summarize how well our contexts have done, by discovery type
+
+        :return: str: summary of our hits and misses
+        """
+        return ", ".join(
+            "%s: %d hits/%d misses" % (dtype, stats["hits"], stats["misses"])
+            for dtype, stats in sorted(DiscoveryContext.stats.items())
+        )
@@ -31,17 +31,21 @@ discovery packets as they arrive.
 
 More details are documented in the DiscoveryListener class
 """
-from typing import Dict
 import re
-from sys import stderr
 import os
 from droneinfo import Drone
 from consts import CMAconsts
+from cmadb import CMAdb
+from cmashard import CMAShard
+from store import Store
 from AssimCtypes import CONFIGNAME_TYPE, CONFIGNAME_INSTANCE, ADDR_FAMILY_IPV4
 from AssimCclasses import pyNetAddr, pyConfigContext
-from systemnode import ChildSystem
+from systemnode import SystemNode, ChildSystem
 
 from graphnodes import NICNode, IPaddrNode, ProcessNode, IPtcpportNode, NetworkSegment, Subnet
+from assimtrace import Trace
+
+DISCOVERY_TRACE = Trace.category("discovery")
 
 
 class DiscoveryListener(object):
@@ -57,14 +61,21 @@ class DiscoveryListener(object):
 
     prio = PRI_CONTRIB
     wanted_packets = None
+    # True if processpkt() only reads its JSON - it then gets a ConfigSnapshot instead of
+    # a pyConfigContext, which is much cheaper to read lots of values from.
+    readonly_json = False
+
+    def __init__(self, config, packetio, store, log, debug, context=None):
+        """Init function for DiscoveryListener
 
-    def __init__(self, config, packetio, store, log, debug):
-        """Init function for DiscoveryListener"""
+        :param context: DiscoveryContext: lookups shared by all listeners for this packet
+        """
         self.packetio = packetio
         self.store = store
         self.log = log
         self.debug = debug
         self.config = config
+        self.context = context
 
     @classmethod
     def priority(cls):
@@ -80,6 +91,30 @@ class DiscoveryListener(object):
         """A desired packet has been received - process it"""
         raise NotImplementedError("Abstract class - processpkt()")
 
+    def forwarded_to_domain_owner(self, drone, jsonobj):
+        """
+        In a sharded CMA, only the worker which owns a drone's domain writes the nodes its
+        drones share (see cmashard.py). If that's another worker, we send it this discovery
+        once our transaction commits - and it calls our processpkt() with it.
+        Nothing we send a drone can go through another worker - so only listeners which
+        just update the graph can do this.
+
+        :param drone: Drone: the drone which sent us this discovery
+        :param jsonobj: pyConfigContext: the discovery packet
+        :return: bool: True if we've sent it to another worker
+        """
+        if CMAdb.shard is None or CMAdb.shard.owns_name(drone.domain):
+            return False
+        CMAdb.shard.defer_name(
+            drone.domain,
+            "domaindiscovery",
+            listener=self.__class__.__name__,
+            designation=drone.designation,
+            domain=drone.domain,
+            json=str(jsonobj),
+        )
+        return True
+
 
 @Drone.add_json_processor
 class MonitoringAgentDiscoveryListener(DiscoveryListener):
@@ -144,7 +179,6 @@ class NetconfigDiscoveryListener(DiscoveryListener):
         """
         if ifinfo.get("virtual"):
             return drone.designation
-        print(f"SCOPE FROM {ifinfo}")
         return "_GLOBAL_"
 
     def guess_net_segment(self, system, if_info):
@@ -164,167 +198,236 @@ class NetconfigDiscoveryListener(DiscoveryListener):
             pairs.append((macaddr, addr_str))
         return NetworkSegment.guess_net_segment(self.store, system.domain, pairs)
 
+    # Everything we know about a drone's NICs and their IP addresses - in one round trip
+    PREFETCH_QUERY = """
+    MATCH (drone) WHERE ID(drone) = $drone_id
+    OPTIONAL MATCH (drone)-[:%s]->(nic:Class_NICNode)
+    OPTIONAL MATCH (nic)-[:%s]->(ip:Class_IPaddrNode)
+    RETURN nic, collect(ip) AS ips
+    """ % (
+        CMAconsts.REL_nicowner,
+        CMAconsts.REL_ipowner,
+    )
+    # NICNode attributes we never change when a NIC is rediscovered
+    NIC_IDENTITY_ATTRS = (
+        "domain",
+        "macaddr",
+        "net_segment",
+        "nodetype",
+        "time_create_ms",
+        "time_create_iso8601",
+    )
+
     def processpkt(self, drone, _, jsonobj, discoverychanged):
         """Save away the network configuration data we got from netconfig JSON discovery.
         This includes all our NICs, their MAC addresses, all our IP addresses and so on
         for any (non-loopback) interface.  Whee!
 
-        This code is more complicated than I'd like but it's not obvious how to simplify it...
+        We fetch everything we currently know about this drone's NICs and IP addresses
+        with a single query, work out what the discovery data says it should look like,
+        and then create, relate, update, separate and delete only what differs.
+        Rediscovering an unchanged configuration does no database writes at all.
         """
         assert drone.association.node_id is not None
-        store = drone.association.store
-        if not discoverychanged:
+        if not discoverychanged or self.forwarded_to_domain_owner(drone, jsonobj):
             return
         data = jsonobj["data"]  # The data portion of the JSON message
+        # Our IP addresses may be about to change - Drone.find() mustn't use stale ones
+        Drone.forget_cached(drone, ips_only=True)
+
+        current = self._current_nics(drone)
+        desired, primaryifname = self._desired_nics(drone, data)
+        # ...and they may have been some other Drone's until now
+        Drone.forget_cached_ips(ip for wanted in desired.values() for ip in wanted["ips"])
+        if self.context is not None:
+            self.context.forget("owned_ips", "nics")
+        if CMAdb.shard is not None:
+            moved = set(ip for wanted in desired.values() for ip in wanted["ips"])
+            moved.update(ip for _, currips in current.values() for ip in currips)
+            CMAdb.shard.defer_broadcast("forgetips", ipaddrs=sorted(moved))
+
+        # NICs which have disappeared
+        for macaddr in set(current) - set(desired):
+            nic = current.pop(macaddr)[0]
+            # @TODO Needs to be a 'careful, complete' reference count deletion...
+            # On the other hand, garbage collection is a good thought...
+            self.store.delete(nic)
+
+        primaryip = None
+        addedips = []
+        for macaddr, wanted in desired.items():
+            if macaddr in current:
+                nic, currips = current[macaddr]
+                # Setting an attribute to the value it already has writes nothing
+                for attr, value in Store.safe_attrs(wanted["nic"]).items():
+                    if attr not in self.NIC_IDENTITY_ATTRS:
+                        setattr(nic, attr, value)
+            else:
+                nic, currips = self._new_nic(drone, wanted), {}
+            newips = self._reconcile_ips(drone, nic, wanted, currips)
+            addedips.extend(newips[ipaddr] for ipaddr in newips if ipaddr not in currips)
+            # FIXME: Not an ideal way to determine primary (preferred) IP address...
+            # it's a bit idiosyncratic to Linux...
+            # A better way would be to use their 'startaddr' (w/o the port)
+            # This uses the IP address they used to talk to us.
+            if wanted["ifname"] == primaryifname and primaryip is None:
+                for ipaddr, ipinfo in wanted["ips"].items():
+                    if ipinfo["name"] == wanted["ifname"]:
+                        primaryip = newips[ipaddr]
+                        drone.primary_ip_addr = str(primaryip.ipaddr)
+                        break
+        if addedips:
+            # Anything listening on the ANY address is now listening on these too
+            tcplistener = TCPDiscoveryListener(
+                self.config, self.packetio, self.store, self.log, self.debug
+            )
+            tcplistener.add_any_endpoints(drone, addedips)
 
-        currmacs = {}  # Currmacs is a list of current NICNode objects belonging to this host
-        #                 indexed by MAC address
-        # Get our current list of NICs
-        iflist = self.store.load_related(drone, CMAconsts.REL_nicowner)
-        for nic in iflist:
-            currmacs[nic.macaddr] = nic
+    def _current_nics(self, drone):
+        """
+        Return the NICs and IP addresses this drone has now - using a single query
 
+        :param drone: Drone: the drone whose NICs we want
+        :return: {str: (NICNode, {str: IPaddrNode})}: indexed by MAC address, then IP address
+        """
+        current = {}
+        for row in self.store.load_cypher_query(
+            self.PREFETCH_QUERY, {"drone_id": drone.association.node_id}
+        ):
+            if row.nic is not None:
+                current[row.nic.macaddr] = (row.nic, {ip.ipaddr: ip for ip in row.ips})
+        return current
+
+    def _desired_nics(self, drone, data):
+        """
+        Work out what this drone's NICs and IP addresses ought to look like from discovery.
+        The NICNodes we return are only in memory - they're what we compare against.
+
+        :param drone: Drone: the drone that sent us this discovery
+        :param data: pyConfigContext: the data section of our netconfig discovery
+        :return: ({str: dict}, str): desired NIC info indexed by MAC address, primary ifname
+        """
+        desired = {}
         primaryifname = None
-        net_segments = {}
-        newmacs: Dict[str, NICNode] = {}  # Newmacs is a list of NICNode objects found/created by
-        # this discovery
-        #                 indexed by MAC address
         for ifname in data.keys():  # List of interfaces just below the data section
             ifinfo = data[ifname]
             if "address" not in ifinfo:
                 continue
-            macaddr = str(ifinfo["address"])
-            net_segment = self.guess_net_segment(drone, ifinfo)
-            net_segments[macaddr] = net_segment
-            # A slightly more generous/forgiving find operation than load_or_create()
-            newnic = NICNode.find_this_macaddr(
-                store, drone.domain, macaddr, system=drone, net_segment=net_segment
+            nic = NICNode(
+                drone.domain,
+                str(ifinfo["address"]),
+                self.determine_scope_from_ifinfo(drone, ifinfo),
+                ifname=ifname,
+                json=str(ifinfo),
             )
-            if newnic is None:
-                scope = self.determine_scope_from_ifinfo(drone, ifinfo)
-                newnic: NICNode = self.store.load_or_create(
-                    NICNode,
-                    domain=drone.domain,
-                    scope=scope,
-                    macaddr=macaddr,
-                    ifname=ifname,
-                    json=str(ifinfo),
-                    net_segment=net_segment,
-                )
-            newmacs[macaddr] = newnic
+            ips = {}
+            iptable = ifinfo.get("ipaddrs", {})
+            for ip in iptable.keys():  # keys are 'ip/mask' in CIDR format
+                iponly, cidrmask = ip.split("/")
+                ips[str(pyNetAddr(iponly).toIPv6())] = {
+                    "iponly": iponly,
+                    "cidrmask": int(cidrmask),
+                    "name": iptable[ip].get("name", ":::INVALID:::"),
+                }
+            desired[nic.macaddr] = {"nic": nic, "ifname": ifname, "ifinfo": ifinfo, "ips": ips}
             if "default_gw" in ifinfo and primaryifname is None:
                 primaryifname = ifname
+        return desired, primaryifname
 
-        # Now compare the two sets of MAC addresses (old and new) and update the "old" MAC
-        # address with info from the new discovery and deleting any MAC addresses that
-        # we don't have any more...
-        for macaddr in list(currmacs.keys()):
-            currmac = currmacs[macaddr]
-            if macaddr in newmacs:
-                # This MAC may need updating
-                newmacs[macaddr] = currmac.update_attributes(newmacs[macaddr])
-            else:
-                # This MAC has disappeared
-                self.store.separate(drone, CMAconsts.REL_ipowner, currmac)
-                # @TODO Needs to be a 'careful, complete' reference count deletion...
-                # On the other hand, garbage collection is a good thought...
-                self.store.delete(currmac)
-                del currmacs[macaddr]
-        del currmacs
-
-        # Create REL_nicowner relationships for any newly created NIC nodes
-        for macaddr in newmacs.keys():
-            nic = newmacs[macaddr]
-            self.store.relate_new(drone, CMAconsts.REL_nicowner, nic)
-
-        # Now newmacs contains all the updated info about our current NICs
-        # Let's figure out what's happening with our IP addresses...
+    def _new_nic(self, drone, wanted):
+        """
+        Find or create a NIC that this drone didn't have before, and make it ours
 
-        primaryip = None
+        :param drone: Drone: the drone that owns this NIC
+        :param wanted: dict: desired NIC info from _desired_nics()
+        :return: NICNode
+        """
+        desired = wanted["nic"]
+        net_segment = self.guess_net_segment(drone, wanted["ifinfo"])
+        nic = self.store.load_or_create(
+            NICNode,
+            domain=drone.domain,
+            scope=desired.scope,
+            macaddr=desired.macaddr,
+            ifname=wanted["ifname"],
+            json=desired.json,
+            net_segment=net_segment,
+        )
+        # It wasn't related to us - or we would have prefetched it...
+        self.store.relate(drone, CMAconsts.REL_nicowner, nic)
+        return nic
 
-        for macaddr, mac in newmacs.items():
-            ifname = mac.ifname
-            print (f'processpkt: Discovery MAC {ifname}:{macaddr} IS {mac}', file=stderr)
-            # print ('DATA IS:', str(data), file=stderr)
-            # print ('IFNAME IS', str(ifname), file=stderr)
-            if ifname not in data or "ipaddrs" not in data[ifname]:
-                print(f"processpkt: MAC {macaddr} interface {repr(ifname)} not found in {data}",
-                      file=stderr)
-                print(f"INTERFACE {repr(ifname)} IGNORED for Drone {drone}", file=stderr)
-                continue
-            iptable = data[ifname]["ipaddrs"]
-            currips = {}
-            iplist = self.store.load_related(mac, CMAconsts.REL_ipowner)
-            for ip in iplist:
-                currips[ip.ipaddr] = ip
+    def _reconcile_ips(self, drone, nic, wanted, currips):
+        """
+        Make this NIC's IP addresses match what discovery says they should be
 
-            newips = {}
-            for ip in iptable.keys():  # keys are 'ip/mask' in CIDR format
-                ipinfo = iptable[ip]
-                ipname = ipinfo.get("name", ":::INVALID:::")
-                # if ipinfo['scope'] != 'global':
-                #     continue
-                # print('PROCESSING IP %s' % ip, file=stderr)
-                iponly, cidrmask = ip.split("/")
-                netaddr = pyNetAddr(iponly).toIPv6()
-
-                print("MAC", dir(mac))
-                subnet_context = mac.scope
-                #   This is a more forgiving/generous subnet finding algorithm than load_or_create
-                subnet = Subnet.find_subnet(
-                    self.store,
-                    domain=drone.domain,
-                    ipaddr=iponly,
-                    cidrmask=int(cidrmask),
-                    context=subnet_context,
-                    net_segment=net_segments[macaddr],
+        :param drone: Drone: the drone that owns this NIC
+        :param nic: NICNode: the NIC whose IP addresses we're reconciling
+        :param wanted: dict: desired NIC info from _desired_nics()
+        :param currips: {str: IPaddrNode}: IP addresses the NIC has now
+        :return: {str: IPaddrNode}: the NIC's IP addresses now
+        """
+        newips = {}
+        for ipaddr, ipinfo in wanted["ips"].items():
+            ipnode = currips.get(ipaddr)
+            if ipnode is not None:
+                # Subnet names are built from these - so we can check without loading it
+                subnet_name = str(
+                    Subnet(drone.domain, ipinfo["iponly"], ipinfo["cidrmask"], context=nic.scope)
                 )
-                # print('Creating/Finding IP %s' % str(netaddr), file=stderr)
-                if subnet is None:
-                    subnet = self.store.load_or_create(
-                        Subnet,
-                        domain=drone.domain,
-                        ipaddr=iponly,
-                        cidrmask=int(cidrmask),
-                        context=subnet_context,
-                        net_segment=net_segments[macaddr],
-                    )
-                # print('Creating/Finding IP %s on subnet [%s]' % (str(netaddr), str(subnet)),
-                #       file=stderr)
+                if ipnode.subnet == subnet_name:
+                    newips[ipaddr] = ipnode
+                    continue
+            subnet = self._find_subnet(drone, nic, ipinfo)
+            if ipnode is None:
                 ipnode = self.store.load_or_create(
-                    IPaddrNode, ipaddr=str(netaddr), domain=drone.domain, subnet=subnet
+                    IPaddrNode, ipaddr=ipaddr, domain=drone.domain, subnet=subnet
                 )
+                self.store.relate(nic, CMAconsts.REL_ipowner, ipnode)
+            elif ipnode.subnet != subnet.name:
+                if ipnode.subnet is not None:
+                    self.store.delete_labels(ipnode, (Subnet.name_to_label(ipnode.subnet),))
+                ipnode.subnet = subnet.name
+                self.store.add_labels(ipnode, (subnet.subnet_label,))
+            newips[ipaddr] = ipnode
+
+        for ipaddr, currip in currips.items():
+            if ipaddr not in newips:
+                self.log.debug("Deleting address %s from MAC %s" % (currip, nic.macaddr))
+                # @TODO Needs to be a 'careful, complete' reference count deletion...
+                # @TODO May also need to delete a subnet if no other references...
+                self.store.delete(currip)
+        return newips
 
-                # FIXME: Not an ideal way to determine primary (preferred) IP address...
-                # it's a bit idiosyncratic to Linux...
-                # A better way would be to use their 'startaddr' (w/o the port)
-                # This uses the IP address they used to talk to us.
-                if ifname == primaryifname and primaryip is None and ipname == ifname:
-                    primaryip = ipnode
-                    drone.primary_ip_addr = str(primaryip.ipaddr)
-                newips[str(netaddr)] = ipnode
-
-            # compare the two sets of IP addresses (old and new)
-            for ipaddr in currips.keys():
-                currip = currips[ipaddr]
-                if ipaddr in newips:
-                    newips[ipaddr] = currip.update_attributes(newips[ipaddr])
-                else:
-                    # print ('Deleting address %s from MAC %s' %  (currip, macaddr), file=stderr)
-                    # print ('currip:%s, currips:%s' %  (str(currip), str(currips)), file=stderr)
-                    self.log.debug("Deleting address %s from MAC %s" % (currip, macaddr))
-                    self.log.debug("currip:%s, currips:%s" % (str(currip), str(currips)))
-                    self.store.separate(mac, rel_type=CMAconsts.REL_ipowner, obj=currip)
-                    # @TODO Needs to be a 'careful, complete' reference count deletion...
-                    # @TODO May also need to delete a subnet if no other references...
-                    # On the other hand, garbage collection is a good thought...
-                    self.store.delete(currip)
-                    del currips[ipaddr]
-
-            # Create REL_ipowner relationships for all the newly created IP nodes
-            for ipaddr in newips.keys():
-                ip = newips[ipaddr]
-                self.store.relate_new(mac, CMAconsts.REL_ipowner, ip)
+    def _find_subnet(self, drone, nic, ipinfo):
+        """
+        Find (or create) the Subnet this IP address is on.
+        Subnet.find_subnet() uses our in-memory SubnetIndex - so this is normally free.
+
+        :param drone: Drone: the drone this IP address belongs to
+        :param nic: NICNode: the NIC this IP address is on
+        :param ipinfo: dict: desired IP address info from _desired_nics()
+        :return: Subnet
+        """
+        #   This is a more forgiving/generous subnet finding algorithm than load_or_create
+        subnet = Subnet.find_subnet(
+            self.store,
+            domain=drone.domain,
+            ipaddr=ipinfo["iponly"],
+            cidrmask=ipinfo["cidrmask"],
+            context=nic.scope,
+            net_segment=nic.net_segment,
+        )
+        if subnet is None:
+            subnet = self.store.load_or_create(
+                Subnet,
+                domain=drone.domain,
+                ipaddr=ipinfo["iponly"],
+                cidrmask=ipinfo["cidrmask"],
+                context=nic.scope,
+                net_segment=nic.net_segment,
+            )
+        return subnet
 
 
 @Drone.add_json_processor
@@ -335,35 +438,207 @@ class TCPDiscoveryListener(DiscoveryListener):
     wanted_packets = ("tcpdiscovery",)
     netstatipportpat = re.compile("(.*):([^:]*)$")
 
+    # Forget server endpoints a process no longer listens on (ANY address: any of our IPs)
+    SEPARATE_SERVICES_QUERY = """
+    UNWIND $endpoints AS endpoint
+    MATCH (proc:Class_ProcessNode)-[rel:%s]->(ipport:Class_IPtcpportNode)
+    WHERE ID(proc) = endpoint.proc_id AND ipport.port = endpoint.port
+      AND (endpoint.ipaddr IS NULL OR ipport.ipaddr = endpoint.ipaddr)
+    DELETE rel
+    """ % (CMAconsts.REL_tcpservice,)
+    # Forget server endpoints a process is no longer a client of
+    SEPARATE_CLIENTS_QUERY = """
+    UNWIND $endpoints AS endpoint
+    MATCH (ipport:Class_IPtcpportNode)-[rel:%s]->(proc:Class_ProcessNode)
+    WHERE ID(proc) = endpoint.proc_id AND ipport.port = endpoint.port
+      AND ipport.ipaddr = endpoint.ipaddr
+    DELETE rel
+    """ % (CMAconsts.REL_tcpclient,)
+
     # disable=R0914 means too many local variables...
     # disable=R0912 means too many branches
     # pylint: disable=R0914,R0912
     def processpkt(self, drone, _, jsonobj, discoverychanged):
-        """Add TCP listeners and clients."""
+        """Add TCP listeners and clients.
+        We compare this discovery with the previous one - process by process and endpoint
+        by endpoint - and only update the processes and IP:ports that changed.
+        """
         if not discoverychanged:
             return
         data = jsonobj["data"]  # The data portion of the JSON message
         if self.debug:
             self.log.debug("_add_tcplisteners(data=%s)" % data)
+        olddata = self._previous_data(drone, jsonobj)
 
-        allourips = drone.get_owned_ips()
-        if self.debug:
-            self.log.debug("Processing keys(%s)" % data.keys())
-        newprocs = {}
-        newprocmap = {}
-        discoveryroles = {}
+        discoveryroles = []
         for procname in data.keys():  # List of nanoprobe-assigned names of processes...
             procinfo = data[procname]
+            if "listenaddrs" in procinfo and CMAconsts.ROLE_server not in discoveryroles:
+                discoveryroles.append(CMAconsts.ROLE_server)
+            if "clientaddrs" in procinfo and CMAconsts.ROLE_client not in discoveryroles:
+                discoveryroles.append(CMAconsts.ROLE_client)
+        for role in discoveryroles:
+            if drone.roles is None or role not in drone.roles:
+                drone.addrole(role)
+
+        newprocs, oldprocs = self.process_nodes(self.store, drone, jsonobj, self.context)
+        for procname, proc in oldprocs.items():
+            if len(proc.delrole(discoveryroles)) == 0:
+                # @TODO Needs to be a 'careful, complete' reference count deletion...
+                # On the other hand, garbage collection is a good thought...
+                self.log.debug("Deleting process %s from %s" % (procname, drone))
+                self.store.delete(proc)
+        if self.context is not None:
+            # We may have created or deleted processes - but "process_nodes" stays valid
+            self.context.forget("hosted")
+
+        endpoints = {"services": [], "clients": [], "lost_services": [], "lost_clients": []}
+        for procname in data.keys():  # List of names of processes...
+            processnode = newprocs[procname]
+            procinfo = data[procname]
+            oldinfo = olddata.get(procname, {})
+            processnode.procinfo = str(procinfo)  # Does nothing if it's unchanged
+            if self.debug:
+                self.log.debug("Processing key(%s): proc: %s" % (procname, processnode))
             if "listenaddrs" in procinfo:
-                if CMAconsts.ROLE_server not in discoveryroles:
-                    discoveryroles[CMAconsts.ROLE_server] = True
-                    drone.addrole(CMAconsts.ROLE_server)
+                if processnode.roles is None or CMAconsts.ROLE_server not in processnode.roles:
+                    processnode.addrole(CMAconsts.ROLE_server)
             if "clientaddrs" in procinfo:
-                if CMAconsts.ROLE_client not in discoveryroles:
-                    discoveryroles[CMAconsts.ROLE_client] = True
-                    drone.addrole(CMAconsts.ROLE_client)
-            # print ('CREATING PROCESS %s!!' % procname, file=stderr)
-            processproc = self.store.load_or_create(
+                if processnode.roles is None or CMAconsts.ROLE_client not in processnode.roles:
+                    processnode.addrole(CMAconsts.ROLE_client)
+            proc_id = processnode.association.node_id
+            added, removed = self._endpoint_changes(procinfo, oldinfo, "listenaddrs")
+            for ip, port in added:
+                endpoints["services"].append({"proc_id": proc_id, "ip": ip, "port": port})
+            for ip, port in removed:
+                netaddr = pyNetAddr(ip).toIPv6()
+                endpoints["lost_services"].append(
+                    {
+                        "proc_id": proc_id,
+                        "port": port,
+                        "ipaddr": None if netaddr.isanyaddr() else str(netaddr),
+                    }
+                )
+            added, removed = self._endpoint_changes(procinfo, oldinfo, "clientaddrs")
+            for ip, port in added:
+                endpoints["clients"].append({"proc_id": proc_id, "ip": ip, "port": port})
+            for ip, port in removed:
+                endpoints["lost_clients"].append(
+                    {"proc_id": proc_id, "port": port, "ipaddr": str(pyNetAddr(ip).toIPv6())}
+                )
+        if CMAdb.shard is not None and not CMAdb.shard.owns_name(drone.domain):
+            # IP:port endpoints are shared - so the worker which owns our domain updates them
+            CMAdb.shard.defer_name(
+                drone.domain,
+                "tcpendpoints",
+                designation=drone.designation,
+                domain=drone.domain,
+                endpoints=endpoints,
+            )
+        else:
+            self.update_endpoints(drone, endpoints)
+
+    def update_endpoints(self, drone, endpoints):
+        """
+        Add and remove the IP:port endpoints of our drone's processes
+
+        :param drone: Drone: the drone whose processes these are
+        :param endpoints: {str: [dict]}: endpoints to add ("services", "clients") and remove
+                          ("lost_services", "lost_clients") - by ProcessNode node id
+        :return: None
+        """
+        allourips = None
+        for endpoint in endpoints["services"]:
+            processnode = self.store.load_by_node_id(endpoint["proc_id"])
+            if not isinstance(processnode, ProcessNode):  # It went away before we got here
+                continue
+            if allourips is None:
+                allourips = self._owned_ips(drone)
+            self._add_serveripportnodes(
+                drone, endpoint["ip"], endpoint["port"], processnode, allourips
+            )
+        for endpoint in endpoints["clients"]:
+            processnode = self.store.load_by_node_id(endpoint["proc_id"])
+            if isinstance(processnode, ProcessNode):
+                self._add_clientipportnode(drone, endpoint["ip"], endpoint["port"], processnode)
+        if endpoints["lost_services"]:
+            self.store.update_cypher_query(
+                self.SEPARATE_SERVICES_QUERY, {"endpoints": endpoints["lost_services"]}
+            )
+        if endpoints["lost_clients"]:
+            self.store.update_cypher_query(
+                self.SEPARATE_CLIENTS_QUERY, {"endpoints": endpoints["lost_clients"]}
+            )
+
+    def add_any_endpoints(self, drone, ipaddrs):
+        """
+        Our drone has new IP addresses - so processes listening on the ANY address are now
+        listening on them as well.  Their tcpdiscovery data needn't change when this happens,
+        so NetconfigDiscoveryListener calls us to add IP:port endpoints for the new addresses.
+
+        :param drone: Drone: the drone which owns these IP addresses
+        :param ipaddrs: [IPaddrNode]: the IP addresses it didn't own before
+        :return: None
+        """
+        for processnode in self.store.load_related(drone, CMAconsts.REL_hosting):
+            if not isinstance(processnode, ProcessNode):
+                continue
+            procinfo = getattr(processnode, "procinfo", None)
+            if procinfo is None:
+                continue
+            listenaddrs = pyConfigContext(procinfo).get("listenaddrs", {})
+            for key in listenaddrs.keys():
+                ip, port = self.netstatipportpat.match(key).groups()
+                if pyNetAddr(ip).toIPv6().isanyaddr():
+                    self._add_serveripportnodes(drone, ip, int(port), processnode, list(ipaddrs))
+
+    @staticmethod
+    def process_nodes(store, drone, jsonobj, context=None):
+        """
+        Return the ProcessNodes for the processes in this tcpdiscovery packet - creating
+        any we don't have yet - and those of our processes which aren't in it any more.
+        Given a DiscoveryContext, we remember the answer for this packet, so that every
+        listener processing it shares the same ProcessNodes without going back to the database.
+
+        :param store: Store: our Store
+        :param drone: Drone: the drone which sent us this discovery
+        :param jsonobj: pyConfigContext: the tcpdiscovery packet
+        :param context: DiscoveryContext: lookups shared by the listeners for this packet
+        :return: ({str: ProcessNode}, {str: ProcessNode}): processes in this discovery,
+                 and processes we have which are no longer in it - both indexed by processname
+        """
+        if context is None:
+            hosted = store.load_related(drone, CMAconsts.REL_hosting)
+            return TCPDiscoveryListener._process_nodes(store, drone, jsonobj, hosted)
+        return context.memo(
+            "process_nodes",
+            lambda: TCPDiscoveryListener._process_nodes(store, drone, jsonobj, context.hosted()),
+        )
+
+    @staticmethod
+    def _process_nodes(store, drone, jsonobj, hosted):
+        """
+        Work out what process_nodes() returns - given everything our drone hosts
+
+        :param store: Store: our Store
+        :param drone: Drone: the drone which sent us this discovery
+        :param jsonobj: pyConfigContext: the tcpdiscovery packet
+        :param hosted: [GraphNode]: everything hosted by our drone
+        :return: ({str: ProcessNode}, {str: ProcessNode}): see process_nodes()
+        """
+        data = jsonobj["data"]
+        oldprocs = {}
+        # Several kinds of nodes have the same relationship to the host...
+        for proc in hosted:
+            if isinstance(proc, ProcessNode):
+                oldprocs[proc.processname] = proc
+        newprocs = {}
+        for procname in data.keys():  # List of nanoprobe-assigned names of processes...
+            if procname in oldprocs:
+                newprocs[procname] = oldprocs.pop(procname)
+                continue
+            procinfo = data[procname]
+            processproc = store.load_or_create(
                 ProcessNode,
                 domain=drone.domain,
                 processname=procname,
@@ -374,54 +649,55 @@ class TCPDiscoveryListener(DiscoveryListener):
                 gid=procinfo.get("gid", "unknown"),
                 cwd=procinfo.get("cwd", "/"),
             )
-            processproc.procinfo = str(procinfo)
+            # It wasn't hosted by us - or we would have found it above
+            store.relate(drone, CMAconsts.REL_hosting, processproc)
+            newprocs[procname] = processproc
+        return newprocs, oldprocs
 
-            newprocs[processproc.processname] = processproc
-            newprocmap[procname] = processproc
-            self.store.relate_new(drone, CMAconsts.REL_hosting, processproc)
-            if self.debug:
-                self.log.debug("procinfo(%s) - processproc created=> %s" % (procinfo, processproc))
+    def _owned_ips(self, drone):
+        """Return the IP addresses our drone owns - shared with other listeners if we can
 
-        oldprocs = {}
-        # Several kinds of nodes have the same relationship to the host...
-        for proc in self.store.load_related(drone, CMAconsts.REL_hosting):
-            if not isinstance(proc, ProcessNode):
-                continue
-            procname = proc.processname
-            oldprocs[procname] = proc
-            if procname not in newprocs:
-                if len(proc.delrole(discoveryroles.keys())) == 0:
-                    self.store.separate(drone, CMAconsts.REL_hosting, proc)
-                    # @TODO Needs to be a 'careful, complete' reference count deletion...
-                    # On the other hand, garbage collection is a good thought...
-                    print("TRYING TO DELETE node %s" % procname, file=stderr)
-                    for newprocname in newprocs:
-                        print("*** new procs: proc.procname %s" % str(newprocname), file=stderr)
-                    print(
-                        "*** DELETING proc: proc.procname %s: proc=%s" % (str(procname), str(proc)),
-                        file=stderr,
-                    )
-                    self.store.delete(proc)
+        :param drone: Drone: the drone which sent us this discovery
+        :return: [IPaddrNode]: a list we can change without affecting anyone else
+        """
+        if self.context is None:
+            return drone.get_owned_ips()
+        return list(self.context.owned_ips())
 
-        for procname in data.keys():  # List of names of processes...
-            processnode = newprocmap[procname]
-            procinfo = data[procname]
-            if self.debug:
-                self.log.debug("Processing key(%s): proc: %s" % (procname, processnode))
-            if "listenaddrs" in procinfo:
-                srvportinfo = procinfo["listenaddrs"]
-                processnode.addrole(CMAconsts.ROLE_server)
-                for srvkey in srvportinfo.keys():
-                    match = TCPDiscoveryListener.netstatipportpat.match(srvkey)
-                    (ip, port) = match.groups()
-                    self._add_serveripportnodes(drone, ip, int(port), processnode, allourips)
-            if "clientaddrs" in procinfo:
-                clientinfo = procinfo["clientaddrs"]
-                processnode.addrole(CMAconsts.ROLE_client)
-                for clientkey in clientinfo.keys():
-                    match = TCPDiscoveryListener.netstatipportpat.match(clientkey)
-                    (ip, port) = match.groups()
-                    self._add_clientipportnode(drone, ip, int(port), processnode)
+    @staticmethod
+    def _previous_data(drone, jsonobj):
+        """
+        Return the data from the previous discovery of this type - as a dict
+
+        :param drone: Drone: the drone which sent us this discovery
+        :param jsonobj: pyConfigContext: the new discovery packet
+        :return: dict: data from the previous discovery ({} if there wasn't one)
+        """
+        previous = drone.jsonval(jsonobj["instance"])
+        if previous is None:
+            return {}
+        return pyConfigContext(str(previous)).get("data", {})
+
+    @staticmethod
+    def _endpoint_changes(procinfo, oldinfo, addrtype):
+        """
+        Compare the endpoints of a process between two discoveries
+
+        :param procinfo: dict-like: the new discovery data for this process
+        :param oldinfo: dict-like: the previous discovery data for this process (or {})
+        :param addrtype: str: 'listenaddrs' or 'clientaddrs'
+        :return: ([(str, int)], [(str, int)]): (ip, port) endpoints added and removed
+        """
+        new = set(procinfo[addrtype].keys()) if addrtype in procinfo else set()
+        old = set(oldinfo[addrtype].keys()) if addrtype in oldinfo else set()
+        result = []
+        for endpoints in (new - old, old - new):
+            changes = []
+            for key in sorted(endpoints):
+                ip, port = TCPDiscoveryListener.netstatipportpat.match(key).groups()
+                changes.append((ip, int(port)))
+            result.append(changes)
+        return result[0], result[1]
 
     def _add_clientipportnode(self, drone, ipaddr, servport, processnode):
         """Add the information for a single client IPtcpportNode to the database."""
@@ -457,11 +733,12 @@ class TCPDiscoveryListener(DiscoveryListener):
             if not anyaddr:
                 return
         if not anyaddr:
-            print(
-                "LOOKING FOR %s (%s, %s) in: %s"
-                % (netaddr, type(ip), type(netaddr), [str(ip.ipaddr) for ip in allourips]),
-                file=stderr,
-            )
+            if DISCOVERY_TRACE.info:
+                DISCOVERY_TRACE.emit(
+                    "%s not found among our IP addresses: %s",
+                    netaddr,
+                    [str(ip.ipaddr) for ip in allourips],
+                )
             # raise ValueError('IP Address mismatch for Drone %s - could not find address %s'
             # %       (drone, addr))
             # Must not have been discovered yet. Hopefully discovery will come along and
@@ -526,3 +803,35 @@ class SystemSubclassDiscoveryListener(DiscoveryListener):
             # kick off discovery...
             # print('=====================REQUESTING DISCOVERY: %s' % (str(allparams)), file=stderr)
             system.request_discovery(allparams)
+
+
+@CMAShard.handler("domaindiscovery")
+def shard_domaindiscovery(args):
+    "Another CMA worker heard discovery which updates nodes shared in a domain we own"
+    drone = Drone.find(args["designation"], domain=args["domain"])
+    jsonobj = pyConfigContext(args["json"])
+    for processors in SystemNode._JSONprocessors:
+        for cls in processors.get(jsonobj["discovertype"], ()):
+            if cls.__name__ == args["listener"]:
+                listener = cls(
+                    CMAdb.config, CMAdb.net_transaction, CMAdb.store, CMAdb.log, CMAdb.debug
+                )
+                listener.processpkt(drone, None, jsonobj, True)
+                return
+    CMAdb.log.warning("Unknown discovery listener %s from CMA shard" % args["listener"])
+
+
+@CMAShard.handler("tcpendpoints")
+def shard_tcpendpoints(args):
+    "Another CMA worker's drone changed the IP:port endpoints of its processes in our domain"
+    drone = Drone.find(args["designation"], domain=args["domain"])
+    listener = TCPDiscoveryListener(
+        CMAdb.config, CMAdb.net_transaction, CMAdb.store, CMAdb.log, CMAdb.debug
+    )
+    listener.update_endpoints(drone, args["endpoints"])
+
+
+@CMAShard.handler("forgetips")
+def shard_forgetips(args):
+    "Another CMA worker changed which drones own these IP addresses"
+    Drone.forget_cached_ips(args["ipaddrs"])
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+On-demand discovery scheduling - repeat each discovery about as often as its data changes.
+
+Repeating discoveries (proc_sys, packages, checksums and so on) are requested with the
+fixed 'repeat' interval from their agent parameters. On a quiet fleet nearly every result
+comes back unchanged - and all we do with it is throw it away.
+
+Our DiscoveryScheduler watches the 'discoverychanged' result of each discovery each drone
+sends us (see SystemNode.logjson()), and adapts how often we ask for it:
+    - after 'stable_after' unchanged results in a row we double its interval
+      (up to 'max_interval')
+    - when it changes we halve its interval (down to 'min_interval')
+An interval never goes past its configured 'repeat' in the direction a bound doesn't allow.
+
+A nanoprobe replaces a discovery's schedule when we send it a DODISCOVER for the same
+instance - so that's how we push a new interval. Changes are collected, and every
+'window_ms' the MessageDispatcher sends each affected drone one DODISCOVER with all its
+changed discoveries in it - for at most 'max_batch' drones at a time.
+
+A nanoprobe runs a discovery right away whenever it gets a DODISCOVER for it (see
+discovery_register() in the nanoprobe) - not just when its interval comes around.
+So the first result after each request we send says nothing about how often the data
+changes on its own, and doesn't count toward a discovery's unchanged streak.
+"""
+from __future__ import print_function
+import collections
+from AssimCclasses import pyConfigContext
+
+
+class DiscoveryScheduler(object):
+    """
+    Adapts each drone's discovery intervals to how often their results change -
+    and pushes new schedules to nanoprobes in batches.
+    """
+
+    def __init__(
+        self, min_interval=30, max_interval=3600, stable_after=3, window_ms=1000, max_batch=100
+    ):
+        """
+        :param min_interval: int: shortest interval (seconds) we shorten a discovery to
+        :param max_interval: int: longest interval (seconds) we lengthen a discovery to
+        :param stable_after: int: how many unchanged results in a row before we lengthen it
+        :param window_ms: int: how often we push new schedules to nanoprobes
+        :param max_batch: int: most drones we push new schedules to at once
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.stable_after = max(stable_after, 1)
+        self.window_ms = window_ms
+        self.max_batch = max_batch
+        # (domain, designation, instance) -> {"base", "interval", "unchanged", "request",
+        #                                       "requested"}
+        self.schedules = {}
+        # (domain, designation) -> (SystemNode, set(instance)) - in the order they changed
+        self._pending = collections.OrderedDict()
+        self.stats = {"changed": 0, "unchanged": 0, "lengthened": 0, "shortened": 0, "pushed": 0}
+
+    @staticmethod
+    def from_config(config):
+        """
+        Construct a DiscoveryScheduler from our configuration
+
+        :param config: pyConfigContext: our configuration
+        :return: DiscoveryScheduler or None: None if adaptive scheduling is turned off
+        """
+        params = config.get("discovery_schedule", {})
+        if params.get("max_interval", 0) <= 0:
+            return None
+        return DiscoveryScheduler(
+            min_interval=params.get("min_interval", 30),
+            max_interval=params["max_interval"],
+            stable_after=params.get("stable_after", 3),
+            window_ms=params.get("window_ms", 1000),
+            max_batch=params.get("max_batch", 100),
+        )
+
+    def interval_for(self, system, instance, base, request):
+        """
+        Return the interval to ask for when we request this repeating discovery.
+        SystemNode.request_discovery() calls us for each repeating discovery it sends.
+
+        :param system: SystemNode: the system we're asking
+        :param instance: str: the discovery instance name
+        :param base: int: its configured repeat interval (seconds) - 0 means no repeats
+        :param request: pyConfigContext: the discovery request
+        :return: int: the interval (seconds) to ask for
+        """
+        key = (system.domain, system.designation, instance)
+        if base <= 0:
+            self.schedules.pop(key, None)
+            return base
+        schedule = self.schedules.get(key)
+        if schedule is None or schedule["base"] != base:
+            schedule = {"base": base, "interval": base, "unchanged": 0}
+            self.schedules[key] = schedule
+        schedule["request"] = str(request)
+        # The nanoprobe runs it as soon as it gets our request
+        schedule["requested"] = True
+        return schedule["interval"]
+
+    def _bounds(self, base):
+        "Return the (shortest, longest) intervals allowed for a discovery configured as 'base'"
+        return min(base, self.min_interval), max(base, self.max_interval)
+
+    def note_discovery(self, system, instance, changed):
+        """
+        Note a discovery result from this system - and adapt its interval to it
+
+        :param system: SystemNode: the system which sent it
+        :param instance: str: the discovery instance name
+        :param changed: bool: True if its data has changed
+        :return: None
+        """
+        schedule = self.schedules.get((system.domain, system.designation, instance))
+        if schedule is None:  # We didn't ask for it to repeat
+            return
+        requested = schedule.pop("requested", False)
+        shortest, longest = self._bounds(schedule["base"])
+        interval = schedule["interval"]
+        if changed:
+            self.stats["changed"] += 1
+            schedule["unchanged"] = 0
+            interval = max(interval // 2, shortest)
+            if interval < schedule["interval"]:
+                self.stats["shortened"] += 1
+        else:
+            self.stats["unchanged"] += 1
+            if requested:  # We asked for it just now - it didn't come from its interval
+                return
+            schedule["unchanged"] += 1
+            if schedule["unchanged"] < self.stable_after:
+                return
+            schedule["unchanged"] = 0
+            interval = min(interval * 2, longest)
+            if interval > schedule["interval"]:
+                self.stats["lengthened"] += 1
+        if interval == schedule["interval"]:
+            return
+        schedule["interval"] = interval
+        pendkey = (system.domain, system.designation)
+        entry = self._pending.get(pendkey)
+        if entry is None:
+            entry = (system, set())
+            self._pending[pendkey] = entry
+        entry[1].add(instance)
+
+    def pending_count(self):
+        "Return the number of drones waiting for a new schedule"
+        return len(self._pending)
+
+    def flush(self):
+        """
+        Push new schedules to (at most max_batch of) the drones waiting for them -
+        one DODISCOVER per drone. This has to be called inside a network transaction.
+
+        :return: int: the number of drones we sent new schedules to
+        """
+        count = 0
+        while self._pending and count < self.max_batch:
+            (domain, designation), (system, instances) = self._pending.popitem(last=False)
+            if getattr(system, "status", "up") != "up":
+                continue
+            requests = []
+            for instance in sorted(instances):
+                schedule = self.schedules.get((domain, designation, instance))
+                if schedule is not None:
+                    requests.append(pyConfigContext(init=schedule["request"]))
+            if requests:
+                # request_discovery() asks us for each interval
+                system.request_discovery(requests)
+                count += 1
+        self.stats["pushed"] += count
+        return count
+
+    def summary(self):
+        "Return a string summarizing what we've done"
+        stats = self.stats
+        intervals = [schedule["interval"] for schedule in self.schedules.values()]
+        stretched = sum(
+            1 for schedule in self.schedules.values() if schedule["interval"] > schedule["base"]
+        )
+        return (
+            "%d discoveries scheduled (%d stretched, mean interval %ds), %d changed"
+            ", %d unchanged results, %d lengthened, %d shortened, %d schedules pushed"
+            % (
+                len(self.schedules),
+                stretched,
+                sum(intervals) / len(intervals) if intervals else 0,
+                stats["changed"],
+                stats["unchanged"],
+                stats["lengthened"],
+                stats["shortened"],
+                stats["pushed"],
+            )
+        )
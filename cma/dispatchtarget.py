@@ -29,6 +29,7 @@ import sys
 sys.path.append("cma")
 from cmaconfig import ConfigFile
 from cmadb import CMAdb
+from cmashard import CMAShard
 from frameinfo import FrameSetTypes, FrameTypes
 from AssimCclasses import pyNetAddr, pyConfigContext, pySwitchDiscovery, pyCryptFrame
 from AssimCtypes import cryptcurve25519_save_public_key, DEFAULT_FSP_QID
@@ -72,6 +73,17 @@ class DispatchTarget(object):
         self.io = io
         self.config = config
 
+    @staticmethod
+    def note_alive(addr):
+        """Tell our AdmissionController the drone at 'addr' is alive - so the next
+        report of its death is news, not a duplicate of the last one.
+
+        :param addr: pyNetAddr: the drone's address
+        :return: None
+        """
+        if CMAdb.admission is not None:
+            CMAdb.admission.forget_death(addr)
+
     @staticmethod
     def register(classtoregister):
         """Register the given class in DispatchTarget.dispatchtable
@@ -102,15 +114,66 @@ class DispatchHBDEAD(DispatchTarget):
             frametype = frame.frametype()
             if frametype == FrameTypes.IPPORT:
                 addr = frame.getnetaddr()
-                deaddrone = self.droneinfo.find(addr)
-                if deaddrone is None:
-                    CMAdb.log.warning(f"DispatchHBDEAD: Unknown Drone@{addr} marked dead.")
+                if CMAdb.shard is not None and not CMAdb.shard.owns(addr):
+                    # Another CMA worker owns this drone - and the ring it's in
+                    CMAdb.shard.forward(addr, "hbdead", addr=repr(addr), reporter=repr(origaddr))
+                    continue
+                if not self.report_death(addr, origaddr, frameset):
                     return
-                if deaddrone.status == "up":
-                    CMAdb.log.warning( f"DispatchHBDEAD: Drone@{addr} is dead({deaddrone})")
-                    if CMAdb.debug:
-                        CMAdb.log.debug(f"DispatchHBDEAD: [{deaddrone}] is the guy who died!")
-                    deaddrone.death_report("dead", "HBDEAD packet received", origaddr, frameset)
+
+    def report_death(self, addr, origaddr, frameset):
+        """Process the death of the drone at 'addr' - as reported by 'origaddr'.
+        Both of its ring neighbors report it, so our AdmissionController merges duplicate
+        reports - and may collect deaths into a batch for report_deaths().
+
+        :param addr: pyNetAddr: address of the dead drone
+        :param origaddr: pyNetAddr: address of the drone which reported it
+        :param frameset: pyFrameSet: the HBDEAD FrameSet - or None
+        :return: bool: False if we don't know the dead drone
+        """
+        admission = CMAdb.admission
+        if admission is not None:
+            if not admission.report_death(addr, origaddr):
+                return True
+            if admission.batch_deaths():
+                if admission.deaths_overdue():
+                    self.report_deaths(admission.take_pending_deaths())
+                return True
+        deaddrone = self.droneinfo.find(addr)
+        if deaddrone is None:
+            CMAdb.log.warning(f"DispatchHBDEAD: Unknown Drone@{addr} marked dead.")
+            return False
+        if deaddrone.status == "up":
+            CMAdb.log.warning( f"DispatchHBDEAD: Drone@{addr} is dead({deaddrone})")
+            if CMAdb.debug:
+                CMAdb.log.debug(f"DispatchHBDEAD: [{deaddrone}] is the guy who died!")
+            deaddrone.death_report("dead", "HBDEAD packet received", origaddr, frameset)
+        return True
+
+    def report_deaths(self, reports):
+        """Process a batch of deaths. The dead drones leave each of their rings together -
+        so a whole rack dying costs one ring topology update instead of one per drone.
+        This has to be called inside a database (and network) transaction.
+
+        :param reports: [(pyNetAddr, pyNetAddr)]: (dead drone address, reporter address) pairs
+        :return: None
+        """
+        leavers = {}  # ring name -> (ring, [dead drones which have to leave it])
+        for addr, origaddr in reports:
+            deaddrone = self.droneinfo.find(addr)
+            if deaddrone is None:
+                CMAdb.log.warning(f"DispatchHBDEAD: Unknown Drone@{addr} marked dead.")
+                continue
+            if deaddrone.status != "up":
+                continue
+            CMAdb.log.warning(f"DispatchHBDEAD: Drone@{addr} is dead({deaddrone})")
+            rings = deaddrone.death_report(
+                "dead", "HBDEAD packet received", origaddr, None, leave_rings=False
+            )
+            for ring in rings:
+                leavers.setdefault(ring.name, (ring, []))[1].append(deaddrone)
+        for ring, drones in leavers.values():
+            ring.leave_many(drones)
 
 
 @DispatchTarget.register
@@ -267,11 +330,31 @@ class DispatchSTARTUP(DispatchTarget):
         # print('DRONE from find: ', drone, type(drone), drone.port, file=sys.stderr)
 
         drone.startaddr = str(origaddr)
+        self.note_alive(origaddr)
         if json is not None:
             drone.logjson(origaddr, json)
         if CMAdb.debug:
             CMAdb.log.debug("Joining TheOneRing: %s / %s / %s" % (drone, type(drone), drone.port))
-        CMAdb.TheOneRing.join(drone)
+        ring_join = self.config.get("ring_join", {})
+        if ring_join.get("window_ms", 0) > 0:
+            # The MessageDispatcher joins the whole batch when the window expires
+            joined = CMAdb.TheOneRing.defer_join(drone, max_batch=ring_join.get("max_batch", None))
+        else:
+            CMAdb.TheOneRing.join(drone)
+            joined = [drone]
+        for member in joined:
+            self.drone_joined(member)
+
+    def drone_joined(self, drone):
+        """
+        Our drone has joined TheOneRing - ask it for its initial discovery and tell
+        everyone it's up.  With batched ring joins, the MessageDispatcher calls this
+        for each drone in the batch once it has joined them.
+
+        :param drone: Drone: the drone which just joined TheOneRing
+        :return: None
+        """
+        sysname = drone.designation
         if CMAdb.debug:
             CMAdb.log.debug("Requesting Discovery from  %s" % str(drone))
         discovery_params = []
@@ -279,6 +362,7 @@ class DispatchSTARTUP(DispatchTarget):
             params = ConfigFile.agent_params(self.config, "discovery", agent, sysname)
             params["agent"] = agent
             params["instance"] = "_init_%s" % agent
+            params["repeat"] = 0  # Initial discovery runs once
             discovery_params.append(params)
         # Discover the permissions of all the lists of files we're configured to ask about
         # Note that there are several lists to keep the amount of data in any one list
@@ -289,6 +373,7 @@ class DispatchSTARTUP(DispatchTarget):
             params["agent"] = "fileattrs"
             params["instance"] = pathlist_name
             params["parameters"] = {"ASSIM_filelist": paths}
+            params["repeat"] = 0
             discovery_params.append(params)
         if CMAdb.debug:
             CMAdb.log.debug("Discovery details:  %s" % str(discovery_params))
@@ -369,18 +454,33 @@ class DispatchHBMARTIAN(DispatchTarget):
                 "DispatchHBMARTIAN: received [%s] FrameSet from address %s "
                 % (FrameSetTypes.get(fstype)[0], origaddr)
             )
-        reporter = self.droneinfo.find(origaddr)  # System receiving the MARTIAN FrameSet
         martiansrcaddr = None
         for frame in frameset.iter():
             frametype = frame.frametype()
             if frametype == FrameTypes.IPPORT:
                 martiansrcaddr = frame.getnetaddr()
                 break
+        if CMAdb.shard is not None and not CMAdb.shard.owns(martiansrcaddr):
+            # Another CMA worker owns the martian - and the ring it's in
+            CMAdb.shard.forward(
+                martiansrcaddr, "hbmartian", addr=repr(martiansrcaddr), reporter=repr(origaddr)
+            )
+            return
+        self.martian(origaddr, martiansrcaddr)
+
+    def martian(self, origaddr, martiansrcaddr):
+        """Process a report from 'origaddr' that it heard heartbeats from 'martiansrcaddr'
+
+        :param origaddr: pyNetAddr: address of the drone which heard the martian
+        :param martiansrcaddr: pyNetAddr: address of the martian
+        :return: None
+        """
+        reporter = self.droneinfo.find(origaddr)  # System receiving the MARTIAN FrameSet
         martiansrc = self.droneinfo.find(martiansrcaddr)  # Source of MARTIAN event
         if CMAdb.debug:
             CMAdb.log.debug(
-                "DispatchHBMARTIAN: received [%s] FrameSet from %s/%s about %s/%s"
-                % (FrameSetTypes.get(fstype)[0], reporter, origaddr, martiansrc, martiansrcaddr)
+                "DispatchHBMARTIAN: received HBMARTIAN FrameSet from %s/%s about %s/%s"
+                % (reporter, origaddr, martiansrc, martiansrcaddr)
             )
         if martiansrc.status != "up":
             if martiansrc.reason == "HBSHUTDOWN":
@@ -397,6 +497,7 @@ class DispatchHBMARTIAN(DispatchTarget):
                 )
             martiansrc.status = "up"
             martiansrc.reason = "HBMARTIAN"
+            self.note_alive(martiansrcaddr)
             martiansrc.send_hbmsg(martiansrcaddr, FrameSetTypes.STOPSENDEXPECTHB, (origaddr,))
             CMAdb.TheOneRing.join(martiansrc)
             AssimEvent(martiansrc, AssimEvent.OBJUP)
@@ -430,18 +531,33 @@ class DispatchHBBACKALIVE(DispatchTarget):
                 "DispatchHBBACKALIVE: received [%s] FrameSet from address %s"
                 % (FrameSetTypes.get(fstype)[0], origaddr)
             )
-        reporter = self.droneinfo.find(origaddr)  # System receiving the MARTIAN FrameSet
         alivesrcaddr = None
         for frame in frameset.iter():
             frametype = frame.frametype()
             if frametype == FrameTypes.IPPORT:
                 alivesrcaddr = frame.getnetaddr()
                 break
+        if CMAdb.shard is not None and not CMAdb.shard.owns(alivesrcaddr):
+            # Another CMA worker owns this drone - and the ring it's in
+            CMAdb.shard.forward(
+                alivesrcaddr, "hbbackalive", addr=repr(alivesrcaddr), reporter=repr(origaddr)
+            )
+            return
+        self.back_alive(origaddr, alivesrcaddr)
+
+    def back_alive(self, origaddr, alivesrcaddr):
+        """Process a report from 'origaddr' that 'alivesrcaddr' is alive after all
+
+        :param origaddr: pyNetAddr: address of the drone which heard it
+        :param alivesrcaddr: pyNetAddr: address of the drone we might have thought was dead
+        :return: None
+        """
+        reporter = self.droneinfo.find(origaddr)  # System receiving the MARTIAN FrameSet
         alivesrc = self.droneinfo.find(alivesrcaddr)  # Source of HBBACKALIVE event
         if CMAdb.debug:
             CMAdb.log.debug(
-                "DispatchHBBACKALIVE: received [%s] FrameSet from %s/%s about %s/%s"
-                % (FrameSetTypes.get(fstype)[0], reporter, origaddr, alivesrc, alivesrcaddr)
+                "DispatchHBBACKALIVE: received HBBACKALIVE FrameSet from %s/%s about %s/%s"
+                % (reporter, origaddr, alivesrc, alivesrcaddr)
             )
         if alivesrc.status != "up":
             if alivesrc.reason == "HBSHUTDOWN":
@@ -453,6 +569,7 @@ class DispatchHBBACKALIVE(DispatchTarget):
             )
             alivesrc.status = "up"
             alivesrc.reason = "HBBACKALIVE"
+            self.note_alive(alivesrcaddr)
             CMAdb.TheOneRing.join(alivesrc)
             AssimEvent(alivesrc, AssimEvent.OBJUP)
 
@@ -463,33 +580,22 @@ class DispatchJSDISCOVERY(DispatchTarget):
 
     def dispatch(self, origaddr, frameset):
         fstype = frameset.get_framesettype()
-        if True or CMAdb.debug:
+        if CMAdb.debug:
             CMAdb.log.debug(
                 "DispatchJSDISCOVERY: received [%s] FrameSet from [%s]"
                 % (FrameSetTypes.get(fstype)[0], repr(origaddr))
             )
-            print("DispatchJSDISCOVERY: received [%s] FrameSet from [%s]"
-                  % (FrameSetTypes.get(fstype)[0], repr(origaddr)), file=sys.stderr)
         sysname = None
-        print("ITERATING...")
-        print(f"ITERATING OVER frameset: {frameset}")
-        for frame in frameset.iter():
-            print(f"LOOKING AT FRAME: {frame}")
-            frametype = frame.frametype()
-            print(f"LOOKING AT FRAMEtype: {frametype}")
+        # JSDISCOVERY FrameSets can be large - decode them in one pass
+        for frametype, value in frameset.decode_frames():
             if frametype == FrameTypes.HOSTNAME:
-                print(f"LOOKING AT HOSTNAME:")
-                sysname = frame.getstr()
-                print(f"LOOKING AT HOSTNAME: {sysname}")
+                sysname = value
             elif frametype == FrameTypes.JSDISCOVER:
-                print(f"Dispatch JSDISCOVER from {origaddr}:{sysname}", file=sys.stderr)
-                json = frame.getstr()
+                json = value
                 jsonconfig = pyConfigContext(init=json)
-                print('JSON received: ', json, file=sys.stderr)
                 if sysname is None:
                     sysname = jsonconfig.getstring("host")
                 drone = self.droneinfo.find(sysname)
-                print('FOUND DRONE for %s IS: %s' % (sysname, drone), file=sys.stderr)
                 # print('LOGGING JSON FOR DRONE for %s IS: %s' % (drone, json), file=sys.stderr)
                 child = drone.find_child_system_from_json(jsonconfig)
                 # if child is not drone:
@@ -497,9 +603,6 @@ class DispatchJSDISCOVERY(DispatchTarget):
                 #            %   (str(child), json), file=sys.stderr)
                 child.logjson(origaddr, json)
                 sysname = None
-                print(f"END Dispatch JSDISCOVER from {origaddr}")
-            else:
-                pass  # print(f"UNHANDLED FRAMETYPE: {frametype}")
 
 
 @DispatchTarget.register
@@ -578,3 +681,27 @@ class DispatchCONNSHUT(DispatchTarget):
     def dispatch(self, origaddr, frameset):
         _origaddr = origaddr
         _frameset = frameset
+
+
+#
+#   Operations our sibling CMA workers send us about drones we own (sharded CMA only)
+#
+@CMAShard.handler("hbdead")
+def shard_hbdead(args):
+    "Another CMA worker heard that one of our drones died"
+    dispatcher = DispatchTarget.dispatchtable[FrameSetTypes.HBDEAD]
+    dispatcher.report_death(pyNetAddr(args["addr"]), pyNetAddr(args["reporter"]), None)
+
+
+@CMAShard.handler("hbmartian")
+def shard_hbmartian(args):
+    "Another CMA worker heard that one of our drones is a martian"
+    dispatcher = DispatchTarget.dispatchtable[FrameSetTypes.HBMARTIAN]
+    dispatcher.martian(pyNetAddr(args["reporter"]), pyNetAddr(args["addr"]))
+
+
+@CMAShard.handler("hbbackalive")
+def shard_hbbackalive(args):
+    "Another CMA worker heard that one of our drones is alive after all"
+    # DispatchHBBACKALIVE isn't in our dispatch table, but it doesn't need any configuration
+    DispatchHBBACKALIVE().back_alive(pyNetAddr(args["reporter"]), pyNetAddr(args["addr"]))
@@ -63,10 +63,14 @@ the code is simple and common - and the formats are more complicated.
 
 from __future__ import print_function  # , unicode_literals
 import sys, os, optparse
+import hashlib
+import threading
 import inject
-import assimcli
 from cmainit import CMAInjectables
 from store import Store
+from consts import CMAconsts
+from systemnode import SystemNode
+from query import reltype_expr
 from AssimCclasses import pyConfigContext, pyNetAddr
 from AssimCtypes import VERSION_STRING, LONG_LICENSE_STRING, SHORT_LICENSE_STRING
 
@@ -133,7 +137,7 @@ class DictObj(object):
             if ret is None or str(ret) == "":
                 raise ValueError
             ret = str(ret)
-            ret = ret.strip() if isinstance(ret, (str, unicode)) else ret
+            ret = ret.strip()
             return self._labelstring(name) + DictObj._fixup(ret)
         except ValueError:
             return self._failreturn(name)
@@ -194,9 +198,6 @@ class FancyDictObj(DictObj):
         if name.startswith("os-"):
             name = name[3:]
         try:
-            print("OBJ %s" % str(obj))
-            print("OBJ.os: %s" % str(obj["os"]))
-            print("OBJ.os.data: %s" % str(obj["os"]["data"]))
             if name in FancyDictObj.os_namemap:
                 return obj["os"]["data"][FancyDictObj.os_namemap[name]]
         except (KeyError, IndexError, TypeError):
@@ -288,8 +289,151 @@ class FancyDictObj(DictObj):
         self.kw["nic-attrs"] = FancyDictObj.nic_attrs
 
 
+class NodeView(object):
+    """A read-only view of a node made from its properties as they come from a Cypher cursor.
+    It looks enough like the node itself for our format rules.
+    The node object is only loaded if a format asks for one of its JSON attributes (like 'os').
+    """
+
+    def __init__(self, store, nodeid, props):
+        """
+        :param store: Store: Store to load the node from - if we need to
+        :param nodeid: int: Neo4j node id
+        :param props: dict: the node's properties
+        """
+        self._store = store
+        self._node_id = nodeid
+        self._props = props
+        self._node = None
+
+    def _jsonval(self, name):
+        "Return the JSON attribute with this name - or None"
+        if SystemNode.HASH_PREFIX + name not in self._props:
+            return None
+        if self._node is None:
+            self._node = self._store.load_by_node_id(self._node_id)
+        return self._node.jsonval(name)
+
+    def __contains__(self, name):
+        if name == "_node_id" or name in self._props:
+            return True
+        return SystemNode.HASH_PREFIX + name in self._props
+
+    def __getitem__(self, name):
+        if name == "_node_id":
+            return self._node_id
+        if name in self._props:
+            return self._props[name]
+        value = self._jsonval(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __getattr__(self, name):
+        props = self.__dict__.get("_props", {})
+        if name in props:
+            return props[name]
+        raise AttributeError(name)
+
+    def deepget(self, name, alternative=None):
+        "Return the value of this (possibly structured) name - or 'alternative'"
+        keyparts = name.split(".", 1)
+        try:
+            value = self[keyparts[0]]
+        except KeyError:
+            return alternative
+        if len(keyparts) == 1:
+            return value
+        if isinstance(value, str) and value.startswith("{"):
+            value = pyConfigContext(value)
+        return value.deepget(keyparts[1], alternative) if hasattr(value, "deepget") else alternative
+
+    def __str__(self):
+        return "NodeView(%d, %s)" % (self._node_id, self._props)
+
+
+class SubgraphCache(object):
+    """The dot lines we drew for each host's subgraph in one kind of drawing - along with a
+    fingerprint of the nodes and relationships we drew them from.
+    It can be shared by renders running in different threads.
+    """
+
+    def __init__(self):
+        self.hosts = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, host, fingerprint):
+        """
+        Return the dot lines for this host's subgraph - if it hasn't changed
+
+        :param host: str: designation of the host
+        :param fingerprint: str: fingerprint of its subgraph now
+        :return: ([(int, str)], [(int, int, int, str)]): lines from _draw_subgraph() - or None
+        """
+        with self._lock:
+            entry = self.hosts.get(host)
+            if entry is None or entry[0] != fingerprint:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def remember(self, host, fingerprint, lines):
+        """
+        Remember the dot lines for this host's subgraph
+
+        :param host: str: designation of the host
+        :param fingerprint: str: fingerprint of its subgraph
+        :param lines: ([(int, str)], [(int, int, int, str)]): lines from _draw_subgraph()
+        :return: None
+        """
+        with self._lock:
+            self.hosts[host] = (fingerprint, lines)
+
+    def prune(self, hosts):
+        """
+        Forget all the hosts but these
+
+        :param hosts: set(str): hosts to keep
+        :return: None
+        """
+        with self._lock:
+            for host in set(self.hosts) - hosts:
+                del self.hosts[host]
+
+    def report(self):
+        """
+        Return our statistics
+
+        :return: {str: int}: hits, misses and number of hosts we remember
+        """
+        return {"hits": self.hits, "misses": self.misses, "hosts": len(self.hosts)}
+
+
 class DotGraph(object):
-    """Class to format Assimilation graphs as 'dot' graphs"""
+    """Class to format Assimilation graphs as 'dot' graphs.
+    We page through our Drones, reading the nodes and relationships near each page of them
+    straight from Cypher cursors, and formatting them as they arrive.
+    Each node and relationship is drawn once - no matter how many hosts it's near.
+    """
+
+    # Our SubgraphCaches - by cache key (drawing type and depth)
+    subgraph_caches = {}
+    DEFAULT_DEPTH = None  # Draw everything reachable from our Drones
+    DEFAULT_PAGESIZE = 100
+
+    DRONE_PAGE_QUERY = """MATCH (drone:Class_Drone) WHERE drone.designation > $after %s
+        RETURN drone.designation AS host ORDER BY host LIMIT $pagesize"""
+    NODE_QUERY = """MATCH (drone:Class_Drone) WHERE drone.designation IN $hosts
+        MATCH (drone)-[%s*0..%s]-(n) WHERE n.nodetype IN $nodetypes
+        RETURN DISTINCT drone.designation AS host, ID(n) AS id, properties(n) AS props"""
+    RELATIONSHIP_QUERY = """MATCH (a)-[r%s]-(b) WHERE ID(a) IN $ids AND b.nodetype IN $nodetypes
+        RETURN DISTINCT ID(r) AS id, type(r) AS type, ID(startNode(r)) AS start_node,
+        ID(endNode(r)) AS end_node, properties(r) AS props"""
+    RELATIONSHIP_TYPES_QUERY = """CALL db.relationshipTypes() YIELD relationshipType
+        RETURN relationshipType AS type"""
 
     # pylint - too many arguments. It's a bit flexible...
     # pylint: disable=R0913
@@ -302,6 +446,9 @@ class DotGraph(object):
         dictclass=FancyDictObj,
         options=None,
         executor_context=None,
+        maxdepth=None,
+        pagesize=None,
+        cachekey=None,
     ):
         """Initialization
         Here are the main two things to understand:
@@ -321,52 +468,146 @@ class DotGraph(object):
             @dictclass - a dict-like class which can take a node or
                     relationship as a parameter for its constructor
                     along with extra keywords as the kw parameter.
+            @maxdepth - how many relationships away from each Drone to draw
+                    - None means everything connected to it
+            @pagesize - how many Drones to read at a time
+            @cachekey - which SubgraphCache to use (typically the drawing type)
+                    - None means don't cache
         """
         self.formatdict = formatdict
         self.store = store
-        self.nodeids = None
         self.dictclass = dictclass
         self.options = options
         self.executor_context = executor_context
-        if isinstance(dronelist, (str, unicode)):
+        self.maxdepth = self.DEFAULT_DEPTH if maxdepth is None else maxdepth
+        self.pagesize = self.DEFAULT_PAGESIZE if pagesize is None else pagesize
+        self.cache = None
+        if cachekey is not None:
+            cachekey = (cachekey, self.maxdepth)
+            self.cache = DotGraph.subgraph_caches.setdefault(cachekey, SubgraphCache())
+        if isinstance(dronelist, str):
             self.dronelist = [dronelist]
         else:
             self.dronelist = dronelist
+        self.stats = {"hosts": 0, "cached": 0, "nodes": 0, "relationships": 0}
 
     @staticmethod
     def idname(nodeid):
         "Format a node id so dot will like it (not numeric)"
         return "node_%d" % nodeid
 
-    def _outnodes(self, nodes):
-        """Yield the requested nodes, formatted for 'dot'
+    def render_options(self):
+        "Render overall graph options as a dot-formatted string"
+        if not self.options:
+            return ""
+        ret = []
+        for option in self.options:
+            optvalue = self.options[option]
+            if isinstance(optvalue, (str, bool, int, float)):
+                ret.append(' %s="%s"' % (str(option), str(optvalue)))
+            elif hasattr(optvalue, "__iter__"):
+                ret.append(' %s="%s"' % (str(option), ",".join(str(elem) for elem in optvalue)))
+        return "".join(ret)
+
+    def _add_ring_partitions(self):
+        """
+        A sharded CMA splits TheOneRing into a ring per worker (The_One_Ring_<n>).
+        We draw their 'next' relationships just the way we draw TheOneRing's.
+
+        :return: None
+        """
+        relformats = self.formatdict["relationships"]
+        if CMAconsts.REL_oneringnext not in relformats:
+            return
+        relformats = dict(relformats)
+        prefix = CMAconsts.REL_oneringnext + "_"
+        for row in self.store.load_cypher_query(self.RELATIONSHIP_TYPES_QUERY, reader=True):
+            if row.type.startswith(prefix):
+                relformats[row.type] = relformats[CMAconsts.REL_oneringnext]
+        self.formatdict = dict(self.formatdict, relationships=relformats)
+
+    def _host_pages(self):
+        "Yield our Drones' designations - a page at a time"
+        hostfilter = "" if self.dronelist is None else "AND drone.designation IN $hostlist"
+        query = self.DRONE_PAGE_QUERY % hostfilter
+        after = ""
+        while True:
+            params = {"after": after, "pagesize": self.pagesize, "hostlist": self.dronelist}
+            page = [row.host for row in self.store.load_cypher_query(query, params, reader=True)]
+            if page:
+                yield page
+            if len(page) < self.pagesize:
+                return
+            after = page[-1]
+
+    def _page_subgraphs(self, hosts):
+        """
+        Read the subgraphs around a page of hosts.
+        A host's relationships are all those touching its nodes - including those whose
+        other end is only near some other host.
+
+        :param hosts: [str]: designations of the hosts
+        :return: {str: ({int: dict}, [dict])}: each host's nodes (by id) and relationships
+        """
+        relstr = reltype_expr(list(self.formatdict["relationships"].keys()))
+        subgraphs = {host: ({}, []) for host in hosts}
+        hosts_of = {}
+        nodequery = self.NODE_QUERY % (relstr, "" if self.maxdepth is None else self.maxdepth)
+        nodetypes = list(self.formatdict["nodes"].keys())
+        params = {"hosts": hosts, "nodetypes": nodetypes}
+        for row in self.store.load_cypher_query(nodequery, params, reader=True):
+            subgraphs[row.host][0][row.id] = row.props
+            hosts_of.setdefault(row.id, set()).add(row.host)
+        relquery = self.RELATIONSHIP_QUERY % relstr
+        params = {"ids": list(hosts_of.keys()), "nodetypes": nodetypes}
+        for row in self.store.load_cypher_query(relquery, params, reader=True):
+            rel = dict(row.props)
+            rel.update({"type": row.type, "start_node": row.start_node, "end_node": row.end_node})
+            rel["_id"] = row.id
+            for host in hosts_of.get(row.start_node, set()) | hosts_of.get(row.end_node, set()):
+                subgraphs[host][1].append(rel)
+        return subgraphs
+
+    @staticmethod
+    def fingerprint(nodes, relationships):
+        """
+        Return a fingerprint of a subgraph - which changes when anything in it changes
+
+        :param nodes: {int: dict}: node properties by node id
+        :param relationships: [dict]: relationship properties (plus type and ends)
+        :return: str: fingerprint
+        """
+        digest = hashlib.sha1()
+        for nodeid in sorted(nodes):
+            digest.update(repr((nodeid, sorted(nodes[nodeid].items()))).encode("utf8"))
+        for rel in sorted(relationships, key=lambda rel: rel["_id"]):
+            digest.update(repr(sorted(rel.items())).encode("utf8"))
+        return digest.hexdigest()
+
+    def _draw_subgraph(self, nodes, relationships):
+        """
+        Format a host's subgraph for 'dot'
+
+        :param nodes: {int: dict}: node properties by node id
+        :param relationships: [dict]: relationship properties (plus type and ends)
+        :return: ([(int, str)], [(int, int, int, str)]): node lines - by id, and
+                 relationship lines - by id, start node id and end node id
         """
-        self.nodeids = set()
-        # print('NODES: %s' % nodes)
         nodeformats = self.formatdict["nodes"]
-        for node in nodes:
-            nodetype = node["nodetype"]
+        relformats = self.formatdict["relationships"]
+        nodelines = []
+        for nodeid in sorted(nodes):
+            nodetype = nodes[nodeid].get("nodetype")
             if nodetype not in nodeformats:
                 continue
-            nodeid = node["_node_id"]
-            self.nodeids.add(nodeid)
-            dictobj = self.dictclass(node, kw={"id": DotGraph.idname(nodeid)})
-            # print('Nodetype: %s' % node.nodetype, file=sys.stderr)
-            # print('nodeformats: %s' % nodeformats[node.nodetype],
-            #       file=sys.stderr)
-            yield nodeformats[nodetype] % dictobj
-
-    def _outrels(self, relationships):
-        """Yield relationships, formatted for 'dot'
-        """
-        relformats = self.formatdict["relationships"]
-        for rel in relationships:
+            dictobj = self.dictclass(
+                NodeView(self.store, nodeid, nodes[nodeid]), kw={"id": DotGraph.idname(nodeid)}
+            )
+            nodelines.append((nodeid, (nodeformats[nodetype] % dictobj).strip() + "\n"))
+        rellines = []
+        for rel in sorted(relationships, key=lambda rel: rel["_id"]):
             reltype = rel["type"]
-            if (
-                rel["end_node"] not in self.nodeids
-                or rel["start_node"] not in self.nodeids
-                or reltype not in relformats
-            ):
+            if reltype not in relformats:
                 continue
             dictobj = self.dictclass(
                 rel,
@@ -375,70 +616,77 @@ class DotGraph(object):
                     "to": DotGraph.idname(rel["end_node"]),
                 },
             )
-            yield relformats[reltype] % dictobj
-
-    def render_options(self):
-        "Render overall graph options as a dot-formatted string"
-        ret = ""
-        if not self.options:
-            return ""
-        for option in self.options:
-            optvalue = self.options[option]
-            if isinstance(optvalue, (str, unicode, bool, int, float)):
-                ret += ' %s="%s"' % (str(option), str(optvalue))
-                continue
-            if hasattr(optvalue, "__iter__"):
-                listval = ""
-                delim = ""
-                for elem in optvalue:
-                    listval += "%s%s" % (delim, elem)
-                    delim = ","
-                ret += ' %s="%s"' % (str(option), str(listval))
-        return ret
+            line = (relformats[reltype] % dictobj).strip() + "\n"
+            rellines.append((rel["_id"], rel["start_node"], rel["end_node"], line))
+        return nodelines, rellines
+
+    def render(self, changes_only=False):
+        """Yield 'dot' lines for our nodes and relationships - as we read them.
+        We only keep the ids of what we've drawn - and our SubgraphCache (if any).
+        We draw a relationship once we've drawn both its ends - whichever hosts they're near.
+
+        :param changes_only: bool: only draw hosts whose subgraph changed since our cache
+                                   last saw them (without the graph header and trailer)
+        :return: generator(str): dot lines
+        """
+        self._add_ring_partitions()
+        if not changes_only:
+            yield "Digraph G {%s\n" % self.render_options()
+        drawn_nodes = set()
+        drawn_rels = set()
+        pending_rels = {}  # Relationships waiting for us to draw their other end
+        seen = set()
+        for hosts in self._host_pages():
+            subgraphs = self._page_subgraphs(hosts)
+            for host in hosts:
+                seen.add(host)
+                self.stats["hosts"] += 1
+                nodes, relationships = subgraphs.pop(host)
+                lines = None
+                if self.cache is not None:
+                    fingerprint = self.fingerprint(nodes, relationships)
+                    lines = self.cache.lookup(host, fingerprint)
+                if lines is not None:
+                    self.stats["cached"] += 1
+                    if changes_only:
+                        # Our reader already has these nodes from an earlier drawing
+                        drawn_nodes.update(nodeid for nodeid, _ in lines[0])
+                        continue
+                else:
+                    lines = self._draw_subgraph(nodes, relationships)
+                    if self.cache is not None:
+                        self.cache.remember(host, fingerprint, lines)
+                nodelines, rellines = lines
+                for nodeid, line in nodelines:
+                    if nodeid not in drawn_nodes:
+                        drawn_nodes.add(nodeid)
+                        self.stats["nodes"] += 1
+                        yield line
+                for relid, start_node, end_node, line in rellines:
+                    if relid not in drawn_rels:
+                        pending_rels[relid] = (start_node, end_node, line)
+            for relid, (start_node, end_node, line) in sorted(pending_rels.items()):
+                if start_node in drawn_nodes and end_node in drawn_nodes:
+                    del pending_rels[relid]
+                    drawn_rels.add(relid)
+                    self.stats["relationships"] += 1
+                    yield line
+        if self.cache is not None and self.dronelist is None:
+            self.cache.prune(seen)
+        if not changes_only:
+            yield "}\n"
 
     def __iter__(self):
         """Yield 'dot' strings for our nodes and relationships"""
-        queryobj = None
-        yield "Digraph G {%s\n" % self.render_options()
-        nodetypes = self.formatdict["nodes"].keys()
-        reltypes = self.formatdict["relationships"].keys()
-        if self.dronelist is None:
-            params = {"nodetypes": nodetypes, "reltypes": reltypes}
-            queryname = "allhostsubgraph"
-        else:
-            queryname = "hostsubgraph"
-            params = {"nodetypes": nodetypes, "reltypes": reltypes, "hostname": self.dronelist}
-        print("NODETYPES: %s " % str(nodetypes), file=sys.stderr)
-        print("RELTYPES: %s " % str(reltypes), file=sys.stderr)
-        print("RELTYPES: %s " % str(reltypes), file=sys.stderr)
-        print("QUERYNAME: %s " % str(queryname), file=sys.stderr)
-        querymeta = assimcli.query.load_query_object(self.store, queryname)
-        print("QUERYMETA: %s " % str(querymeta), file=sys.stderr)
-        queryiter = querymeta.execute(
-            self.executor_context, expandjson=True, elemsonly=True, **params
-        )
-        # Subgraph queries produce a single row, with two elements:
-        #   nodes and relationships
-        for jsonline in queryiter:
-            queryobj = pyConfigContext(jsonline)
-            break
-
-        for line in self._outnodes(queryobj["nodes"]):
-            yield line.strip() + "\n"
-        for line in self._outrels(queryobj["relationships"]):
-            yield line.strip() + "\n"
-        yield "}\n"
+        return self.render()
 
     def out(self, outfile=sys.stdout):
         """Output nodes and relationships to the 'outfile'."""
-        outfile.writelines(self.__iter__())
+        outfile.writelines(self.render())
 
     def __str__(self):
         """Output nodes and relationships in a string."""
-        ret = ""
-        for line in self.__iter__():
-            ret += "%s\n" % line
-        return ret
+        return "".join(self.render())
 
 
 ip_format = r"""%(id)s [shape=box color=blue label="%(ipaddr)s%(:hostname)s"]"""
@@ -509,7 +757,7 @@ skin_formats = {
             "tcpservice": default_relfmt,
             "tcpclient": default_relfmt,
             "wiredto": wiredto_format,
-            "RingNext_The_One_Ring": default_relfmt,
+            CMAconsts.REL_oneringnext: default_relfmt,
         },
     }
 }
@@ -545,7 +793,7 @@ drawing_types = {
     "monring": {
         "description": "neighbor monitoring ring diagram",
         "nodes": ["Drone"],
-        "relationships": ["RingNext_The_One_Ring"],
+        "relationships": [CMAconsts.REL_oneringnext],
     },
 }
 
@@ -638,6 +886,29 @@ if __name__ == "__main__":
         nargs=2,
         help="(x,y) dimensions of drawing in inches",
     )
+    opts.add_option(
+        "--depth",
+        action="store",
+        dest="depth",
+        type="int",
+        default=DotGraph.DEFAULT_DEPTH,
+        help="Draw things at most this many relationships from each host [unlimited]",
+    )
+    opts.add_option(
+        "-H",
+        "--host",
+        action="append",
+        dest="hosts",
+        help="Only draw the neighborhood of this host (may be repeated)",
+    )
+    opts.add_option(
+        "--pagesize",
+        action="store",
+        dest="pagesize",
+        type="int",
+        default=DotGraph.DEFAULT_PAGESIZE,
+        help="Number of hosts to read from the database at a time [%default]",
+    )
     # opts.set_defaults('size', (30,8))
     cmdoptions, args = opts.parse_args()
     cmdoptions.skin = "default"
@@ -658,6 +929,9 @@ if __name__ == "__main__":
 
     dot = DotGraph(
         construct_dot_formats(cmdoptions.drawingtype, skintype=cmdoptions.skin),
+        dronelist=cmdoptions.hosts,
         options=graphoptions,
+        maxdepth=cmdoptions.depth,
+        pagesize=cmdoptions.pagesize,
     )
     dot.out()
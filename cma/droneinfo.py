@@ -24,7 +24,7 @@ We implement the Drone class - which implements all the properties of
 drones as a Python class.
 """
 from __future__ import print_function
-import time, sys
+import time
 
 # import os, traceback
 from cmadb import CMAdb
@@ -33,8 +33,13 @@ from graphnodes import registergraphclass
 from systemnode import SystemNode
 from frameinfo import FrameSetTypes, FrameTypes
 from AssimCclasses import pyNetAddr, DEFAULT_FSP_QID, pyCryptFrame
+from AssimCclasses import pyConfigContext, ConfigSnapshot
 from assimevent import AssimEvent
 from cmaconfig import ConfigFile
+from store import Store
+from assimtrace import Trace
+
+DRONE_TRACE = Trace.category("drone")
 
 
 # droneinfo.py:39: [R0904:Drone] Too many public methods (21/20)
@@ -57,6 +62,26 @@ class Drone(SystemNode):
     OwnedIPsQuery_txt = """MATCH (d:Class_Drone)-[:%s]->()-[:%s]->(ip:Class_IPaddrNode)
                            WHERE ID(d) = $droneid
                            return ip"""
+    # Process-wide write-through cache for find(): maps ("name", domain, designation, port)
+    # and ("ip", domain, IPv6 address) to Drone node ids. _find_cache_keys maps each node id
+    # back to its keys so we can forget them all at once, and _find_cache_ips maps each
+    # IPv6 address to its keys so we can forget an address without looking at every entry.
+    _find_cache = {}
+    _find_cache_keys = {}
+    _find_cache_ips = {}
+    # Entries loaded from a warm-start snapshot (see warmstart.py) which we haven't checked
+    # against the database yet: maps each key to the designation it ought to find.
+    _find_cache_unverified = {}
+    find_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0, "warm": 0, "stale": 0}
+    # Our best practice rules merged with the rules they're based on - by head rule node id.
+    # Each value is ([rule JSON strings, head first], ConfigSnapshot of the merged rules)
+    _merged_rules_cache = {}
+    MergedRulesQuery_txt = """MATCH (drone)-[:%s]->(head:Class_BPRules)
+                              WHERE ID(drone) = $droneid AND head.bp_class = $bp_class
+                              WITH head LIMIT 1
+                              MATCH path = (head)-[:%s*0..]->(rule:Class_BPRules)
+                              RETURN ID(head) AS head, rule.json AS json
+                              ORDER BY length(path)"""
 
     # R0913: Too many arguments to __init__()
     # pylint: disable=R0913
@@ -134,7 +159,6 @@ class Drone(SystemNode):
                 CMAdb.store.relate(
                     self, CMAconsts.REL_bprulefor, rule, properties={"bp_class": rule.bp_class}
                 )
-        print(f"PRIMARY IP for {self}: {repr(self.primary_ip_addr)})")
 
     def gen_current_bp_rules(self):
         """Return a generator producing all the best practice rules
@@ -164,27 +188,64 @@ class Drone(SystemNode):
         We return a dict-like object reflecting this merger suitable
         for evaluating the rules. You just walk the set of rules
         and evaluate them.
+
+        We fetch the JSON of the whole chain of rules in one query. If it's the same as the
+        last time we merged this chain, we return the (immutable) result of that merger.
         """
-        # Although we ought to hit the database once and get the PATH of the
-        # rules in one fell swoop, we don't yet support PATHs, so we're going
-        # at it the somewhat slower way -- incrementally.
-        start = self.get_bp_head_rule_for(trigger_discovery_type)
-        if start is None:
+        query = Drone.MergedRulesQuery_txt % (CMAconsts.REL_bprulefor, CMAconsts.REL_basis)
+        params = {"droneid": self.association.node_id, "bp_class": trigger_discovery_type}
+        head = None
+        texts = []
+        for row in CMAdb.store.load_cypher_query(query, params):
+            head = row.head
+            texts.append(row.json)
+        if head is None:
             return {}
-        ret = start.jsonobj()
-        this = start
-        while True:
-            nextrule = None
-            for nextrule in CMAdb.store.load_related(this, CMAconsts.REL_basis):
-                break
-            if nextrule is None:
-                break
-            nextobj = nextrule.jsonobj()
-            for elem in nextobj:
-                if elem not in ret:
-                    ret[elem] = nextobj[elem]
-            this = nextrule
-        return ret
+        cached = Drone._merged_rules_cache.get(head)
+        if cached is not None and cached[0] == texts:
+            return cached[1]
+        merged = Drone.merge_bp_rules(texts)
+        Drone._merged_rules_cache[head] = (texts, merged)
+        return merged
+
+    @staticmethod
+    def merge_bp_rules(texts):
+        """Merge a chain of best practice rules. Rules earlier in the chain override
+        the rules they're based on.
+
+        :param texts: [str]: JSON of each rule set in the chain - head first
+        :return: ConfigSnapshot: the merged rules
+        """
+        merged = {}
+        for text in texts:
+            rules = pyConfigContext(init=text).snapshot()
+            for ruleid in rules:
+                if ruleid not in merged:
+                    merged[ruleid] = rules[ruleid]
+        return ConfigSnapshot(merged)
+
+    @staticmethod
+    def merged_rules_cache_items():
+        """Return our merged best practice rule chains - for warm-start snapshots
+
+        :return: [(int, [str])]: (head rule node id, rule JSON chain) pairs
+        """
+        return [(head, texts) for head, (texts, _merged) in Drone._merged_rules_cache.items()]
+
+    @staticmethod
+    def warm_merged_rules(chains):
+        """Preload merged best practice rules from a warm-start snapshot.
+        get_merged_bp_rules() only uses them if the database still has the same rule chain.
+
+        :param chains: [(int, [str])]: (head rule node id, rule JSON chain) pairs
+        :return: int: number of rule chains loaded
+        """
+        count = 0
+        for head, texts in chains:
+            if head not in Drone._merged_rules_cache:
+                Drone._merged_rules_cache[head] = (texts, Drone.merge_bp_rules(texts))
+                count += 1
+        return count
 
     @staticmethod
     def bp_category_score_attrname(category):
@@ -215,11 +276,8 @@ class Drone(SystemNode):
     def get_owned_ips(self):
         """Return a list of all the IP addresses that this Drone owns"""
         params = {"droneid": self.association.node_id}
-        if CMAdb.debug:
-            print(
-                "IP owner query:\n%s\nparams %s" % (Drone.OwnedIPsQuery_subtxt, str(params)),
-                file=sys.stderr,
-            )
+        if DRONE_TRACE.verbose:
+            DRONE_TRACE.emit("IP owner query:\n%s\nparams %s", Drone.OwnedIPsQuery_subtxt, params)
 
         ip_list = [
             node for node in CMAdb.store.load_cypher_nodes(Drone.OwnedIPsQuery, params=params)
@@ -289,8 +347,8 @@ class Drone(SystemNode):
         #   One FrameTypes.RSCJSON frame containing JSON Heartbeat parameters
         #   one frame per dest, type FrameTypes.IPPORT
         #
-        params = ConfigFile.agent_params(CMAdb.config, "heartbeats", None, self.designation)
-        framelist = [{"frametype": FrameTypes.RSCJSON, "framevalue": str(params)}]
+        params = ConfigFile.agent_params_json(CMAdb.config, "heartbeats", None, self.designation)
+        framelist = [{"frametype": FrameTypes.RSCJSON, "framevalue": params}]
         for addr in addrlist:
             if addr is None:
                 continue
@@ -298,8 +356,13 @@ class Drone(SystemNode):
 
         CMAdb.net_transaction.add_packet(dest, fstype, framelist)
 
-    def death_report(self, status, reason, fromaddr, frameset):
-        "Process a death/shutdown report for us.  RIP us."
+    def death_report(self, status, reason, fromaddr, frameset, leave_rings=True):
+        """Process a death/shutdown report for us.  RIP us.
+
+        :param leave_rings: bool: False if our caller will take us out of our rings -
+                            as part of a batch with other deaths
+        :return: [HbRing]: the rings we still have to leave
+        """
         from hbring import HbRing
 
         # print ('DEAD REPORT: %s' % self, file=sys.stderr)
@@ -318,14 +381,17 @@ class Drone(SystemNode):
         self.time_status_iso8601 = time.strftime("%Y-%m-%d %H:%M:%S")
         if status == oldstatus:
             # He was already dead, Jim.
-            return
+            return []
         # There is a need for us to be a little more sophisticated
         # in terms of the number of peers this particular drone had
         # It's here in this place that we will eventually add the ability
         # to distinguish death of a switch or subnet or site from death of a single drone
-        for ring in self.find_associated_rings():
-            # print ('Calling Ring(%s).leave(%s).' % (ring_name, self), file=sys.stderr)
-            ring.leave(self)
+        rings = list(self.find_associated_rings())
+        if leave_rings:
+            for ring in rings:
+                # print ('Calling Ring(%s).leave(%s).' % (ring_name, self), file=sys.stderr)
+                ring.leave(self)
+            rings = []
         deadip = pyNetAddr(self.select_ip(), port=self.port)
         if CMAdb.debug:
             CMAdb.log.debug("Closing connection to %s/%d" % (deadip, DEFAULT_FSP_QID))
@@ -339,6 +405,7 @@ class Drone(SystemNode):
         if reason != "HBSHUTDOWN":
             self._io.closeconn(DEFAULT_FSP_QID, deadip)
         AssimEvent(self, AssimEvent.OBJDOWN)
+        return rings
 
     def find_associated_rings(self):
         """
@@ -363,10 +430,8 @@ class Drone(SystemNode):
         So, we need to create a forward link from partner1 to us and from us to partner2 (if any)
         """
         ouraddr = pyNetAddr(self.select_ip(), port=self.port)
-        print(f"OURADDR: {ouraddr}", file=sys.stderr)
-        print(f"PARTNER1: {partner1}", file=sys.stderr)
-        print(f"PARTNER2: {partner2}", file=sys.stderr)
-        print(f"PARTNER1.select_ip: {partner1.select_ip(ring)}", file=sys.stderr)
+        if DRONE_TRACE.debug:
+            DRONE_TRACE.emit("start_heartbeat: %s with %s and %s", ouraddr, partner1, partner2)
         partner1addr = pyNetAddr(partner1.select_ip(ring), port=partner1.port)
         if partner2 is not None:
             partner2addr = pyNetAddr(partner2.select_ip(ring), port=partner2.port)
@@ -442,7 +507,9 @@ class Drone(SystemNode):
 
     @staticmethod
     def find(designation, port=None, domain=None):
-        """Find a drone with the given designation or IP address, or Neo4J node."""
+        """Find a drone with the given designation or IP address, or Neo4J node.
+        Designation and IP lookups go through our find cache first - so most of them
+        never touch the database."""
         desigstr = str(designation)
         if isinstance(designation, Drone):
             designation.set_crypto_identity()
@@ -451,17 +518,27 @@ class Drone(SystemNode):
             if domain is None:
                 domain = CMAconsts.globaldomain
             designation = designation.lower()
+            key = ("name", domain, designation, port)
+            drone = Drone._find_cache_lookup(key)
+            if drone is not None:
+                # set_crypto_identity() already ran when we cached it
+                return drone
             drone = CMAdb.store.load_or_create(
                 Drone, port=port, domain=domain, designation=designation
             )
             assert drone.designation == designation
             assert drone.association.node_id is not None
             drone.set_crypto_identity()
+            Drone._find_cache_add(key, drone)
             return drone
         elif isinstance(designation, pyNetAddr):
             desig = designation.toIPv6()
             desig.setport(0)
             desigstr = str(desig)
+            key = ("ip", str(domain), desigstr)
+            drone = Drone._find_cache_lookup(key)
+            if drone is not None:
+                return drone
             # We do everything by IPv6 addresses...
             drone = CMAdb.store.load_cypher_node(
                 Drone.IPownerquery_1, {"ipaddr": desigstr, "domain": str(domain)}
@@ -469,6 +546,7 @@ class Drone(SystemNode):
             if drone is not None:
                 assert drone.association.node_id is not None
                 drone.set_crypto_identity()
+                Drone._find_cache_add(key, drone)
                 return drone
             if CMAdb.debug:
                 CMAdb.log.warn(
@@ -479,11 +557,8 @@ class Drone(SystemNode):
         if CMAdb.debug:
             CMAdb.log.debug("DESIGNATION2 (%s) = %s" % (designation, desigstr))
             CMAdb.log.debug("QUERY (%s) = %s" % (designation, Drone.IPownerquery_1))
-            print("DESIGNATION2 (%s) = %s" % (designation, desigstr), file=sys.stderr)
-            print("QUERY (%s) = %s" % (designation, Drone.IPownerquery_1), file=sys.stderr)
-        if CMAdb.debug:
-            print(f"drone.find({designation}) ({desigstr}) ({type(designation)}) => returning None",
-                  file=sys.stderr)
+        if DRONE_TRACE.debug:
+            DRONE_TRACE.emit("find(%s) (%s) => returning None", designation, desigstr)
             # tblist = traceback.extract_stack()
             # tblist = traceback.extract_tb(trace, 20)
             # CMAdb.log.info('======== Begin missing IP Traceback ========')
@@ -495,6 +570,169 @@ class Drone(SystemNode):
             # CMAdb.log.warn('drone.find(%s) (%s) (%s) => returning None' % (
         return None
 
+    @staticmethod
+    def _find_cache_lookup(key):
+        """Return the Drone our find cache has for this key - or None
+
+        :param key: tuple: ("name", domain, designation, port) or ("ip", domain, address)
+        :return: Drone or None
+        """
+        node_id = Drone._find_cache.get(key)
+        if node_id is not None:
+            drone = CMAdb.store.load_by_node_id(node_id)
+            if isinstance(drone, Drone) and Drone._verify_warm_entry(key, drone):
+                Drone.find_cache_stats["hits"] += 1
+                return drone
+            # It's been deleted out from under us (or its node id reused)...
+            Drone.forget_cached(node_id)
+        Drone.find_cache_stats["misses"] += 1
+        return None
+
+    @staticmethod
+    def _verify_warm_entry(key, drone):
+        """Check a find cache entry from a warm-start snapshot the first time we use it.
+        Node ids get reused, so the node it names has to be the same Drone it was then.
+
+        :param key: tuple: our find cache key
+        :param drone: Drone: the Drone our cache entry names
+        :return: bool: True if this entry is good
+        """
+        designation = Drone._find_cache_unverified.pop(key, None)
+        if designation is None:
+            return True
+        if drone.designation != designation or str(drone.domain) != key[1]:
+            Drone.find_cache_stats["stale"] += 1
+            return False
+        if key[0] == "ip":
+            # Its IP address may have moved to another Drone since our snapshot
+            owner = CMAdb.store.load_cypher_node(
+                Drone.IPownerquery_1, {"ipaddr": key[2], "domain": key[1]}
+            )
+            if owner is None or owner.association.node_id != drone.association.node_id:
+                Drone.find_cache_stats["stale"] += 1
+                return False
+        # Our snapshot might have had an out of date address for it
+        drone.set_crypto_identity()
+        return True
+
+    @staticmethod
+    def _find_cache_add(key, drone):
+        "Remember which Drone goes with this key"
+        Drone._find_cache_put(key, drone.association.node_id)
+        Drone._find_cache_unverified.pop(key, None)
+
+    @staticmethod
+    def _find_cache_put(key, node_id):
+        "Put this key into our find cache - and our indexes of it"
+        if Drone._find_cache.get(key, node_id) != node_id:
+            Drone._find_cache_drop(key)
+        Drone._find_cache[key] = node_id
+        Drone._find_cache_keys.setdefault(node_id, set()).add(key)
+        if key[0] == "ip":
+            Drone._find_cache_ips.setdefault(key[2], set()).add(key)
+
+    @staticmethod
+    def _find_cache_drop(key):
+        "Take this key out of our find cache - and our indexes of it"
+        node_id = Drone._find_cache.pop(key)
+        Drone._find_cache_unverified.pop(key, None)
+        indexes = [(Drone._find_cache_keys, node_id)]
+        if key[0] == "ip":
+            indexes.append((Drone._find_cache_ips, key[2]))
+        for index, indexkey in indexes:
+            keys = index.get(indexkey)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[indexkey]
+        Drone.find_cache_stats["invalidations"] += 1
+
+    @staticmethod
+    def warm_find_cache(entries):
+        """Preload our find cache from a warm-start snapshot.
+        Each entry is checked against the database the first time it's looked up.
+
+        :param entries: [(tuple, int, str)]: (key, node id, designation) tuples
+        :return: int: number of entries loaded
+        """
+        count = 0
+        for key, node_id, designation in entries:
+            if key in Drone._find_cache:
+                continue
+            Drone._find_cache_put(key, node_id)
+            Drone._find_cache_unverified[key] = designation
+            count += 1
+        Drone.find_cache_stats["warm"] += count
+        return count
+
+    @staticmethod
+    def forget_cached(drone, ips_only=False):
+        """Invalidate our find cache entries for this Drone.
+        This needs to be called whenever a Drone's IP addresses change, or it's deleted.
+
+        :param drone: Drone or int: the Drone (or its node id) to forget about
+        :param ips_only: bool: True if we should only forget its IP addresses
+        :return: None
+        """
+        node_id = drone if isinstance(drone, int) else drone.association.node_id
+        for key in list(Drone._find_cache_keys.get(node_id, ())):
+            if not ips_only or key[0] == "ip":
+                Drone._find_cache_drop(key)
+
+    @staticmethod
+    def forget_cached_ips(ipaddrs):
+        """Invalidate our find cache entries for these IP addresses - whichever Drone
+        they're cached for. This needs to be called whenever IP addresses might be moving
+        from one Drone to another.
+
+        :param ipaddrs: iterable(str): IPv6 addresses (as find() formats them)
+        :return: None
+        """
+        for ipaddr in set(ipaddrs):
+            for key in list(Drone._find_cache_ips.get(ipaddr, ())):
+                Drone._find_cache_drop(key)
+
+    @staticmethod
+    def flush_find_cache():
+        """Forget everything in our find cache - except warm-start entries we haven't used yet.
+        Used when a transaction aborts - since cached node ids might not exist any more.
+        Unused warm-start entries came from committed data, so no abort can invalidate them.
+        """
+        warm = Drone._find_cache_unverified
+        Drone.find_cache_stats["invalidations"] += len(Drone._find_cache) - len(warm)
+        cache = Drone._find_cache
+        Drone._find_cache = {}
+        Drone._find_cache_keys = {}
+        Drone._find_cache_ips = {}
+        for key in warm:
+            Drone._find_cache_put(key, cache[key])
+
+    @staticmethod
+    def _on_delete(_store, _drone, node_id):
+        "Store hook: a Drone was just deleted - its node id may be reused"
+        Drone.forget_cached(node_id)
+
+    @staticmethod
+    def find_cache_summary():
+        "Return a string summarizing how well our find cache is doing"
+        stats = Drone.find_cache_stats
+        lookups = stats["hits"] + stats["misses"]
+        return (
+            "Drone.find cache: %d entries, %d hits, %d misses (%.1f%% hit rate), %d %s"
+            ", %d warm-start entries (%d unused, %d stale)"
+            % (
+                len(Drone._find_cache),
+                stats["hits"],
+                stats["misses"],
+                (100.0 * stats["hits"] / lookups) if lookups else 0.0,
+                stats["invalidations"],
+                "invalidations",
+                stats["warm"],
+                len(Drone._find_cache_unverified),
+                stats["stale"],
+            )
+        )
+
     @staticmethod
     def add(
         designation,
@@ -516,6 +754,7 @@ class Drone(SystemNode):
             reason=reason,
         )
         assert drone.association.node_id is not None
+        Drone._find_cache_add(("name", domain, drone.designation, port), drone)
         drone.reason = reason
         drone.status = status
         drone.statustime = int(round(time.time() * 1000))
@@ -529,6 +768,10 @@ class Drone(SystemNode):
                 % (str(drone), drone.primary_ip_addr, primary_ip_addr)
             )
             drone.primary_ip_addr = str(primary_ip_addr)
+            Drone.forget_cached(drone, ips_only=True)
             if port is None:
                 drone.port = int(primary_ip_addr.port())
         return drone
+
+
+Store.register_node_hooks("Drone", on_delete=Drone._on_delete)
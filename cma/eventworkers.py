@@ -0,0 +1,599 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100
+#
+# This file is part of the Assimilation Project.
+#
+# The Assimilation software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Assimilation software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+"""
+This module implements the pool of workers which run our event notification scripts
+on behalf of the ForkExecObserver's child process.
+
+Each script has its own queue of events, and its own limit on how many copies of it can run
+at once (default: 1 - so each script sees its events in order). A slow or hung script only
+holds up its own queue - and only until its timeout expires. When any queue is full, we stop
+reading events from the FIFO, so the FIFO fills up and the FIFOEventObserver writing into it
+sees the backpressure.
+
+Scripts run in one of two ways:
+
+One process per event (the original way):
+    The script is run as "script eventtype nodetype" with ASSIM_* environment variables
+    describing the event, and the JSON for the event on stdin.
+
+Persistent stream workers:
+    Scripts which contain the line STREAM_MARKER ("ASSIM_EVENT_PROTOCOL=stream") in their
+    first 1024 bytes are started once as "script --event-stream" and kept running.
+    We write batches of events to their stdin as frames: a 4-byte big-endian length
+    followed by that many bytes of UTF-8 JSON - an array of objects like this:
+        {"eventtype": "up", "nodetype": "Drone", "event": {...the event JSON...}}
+    After processing each batch, the worker writes one frame back to its stdout
+    (its contents are up to the worker - '{}' is fine) to tell us it's ready for more.
+    When we close its stdin, the worker should exit.
+"""
+
+from __future__ import print_function, absolute_import
+import os
+import sys
+import time
+import json
+import fcntl
+import select
+import signal
+import struct
+import tempfile
+import subprocess
+import collections
+from assimevent import AssimEvent
+
+DEBUG = False
+
+STREAM_MARKER = b"ASSIM_EVENT_PROTOCOL=stream"
+STREAM_ARG = "--event-stream"
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME = 64 * 1024 * 1024
+READ_SIZE = 64 * 1024
+SCRIPT_RESCAN = 5.0  # How often we look for new (or removed) scripts (seconds)
+
+
+def encode_frame(payload):
+    """
+    Return a length-prefixed frame containing 'payload'
+
+    :param payload: bytes: frame contents
+    :return: bytes: the frame
+    """
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class DelimitedReader(object):
+    """
+    Splits a byte stream into records ending in a delimiter byte - like the NUL-terminated
+    events in our FIFO. Each byte is only searched once, however the reads are split up.
+    """
+
+    def __init__(self, delimiter=b"\0"):
+        """
+        :param delimiter: bytes: the (single byte) record terminator
+        """
+        self.delimiter = delimiter
+        self.buf = bytearray()
+        self.scanned = 0  # Bytes at the start of buf which we know have no delimiter
+
+    def feed(self, data):
+        """
+        Add data to our buffer and return any records it completes
+
+        :param data: bytes: data we just read
+        :return: [bytes]: completed records (without their delimiters)
+        """
+        buf = self.buf
+        buf += data
+        records = []
+        start = 0
+        while True:
+            end = buf.find(self.delimiter, max(start, self.scanned))
+            if end < 0:
+                break
+            records.append(bytes(buf[start:end]))
+            start = end + 1
+        if start:
+            del buf[:start]
+        self.scanned = len(buf)
+        return records
+
+
+class FrameReader(object):
+    """Splits a byte stream into length-prefixed frames (see encode_frame)"""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        """
+        Add data to our buffer and return any frames it completes
+
+        :param data: bytes: data we just read
+        :return: [bytes]: completed frame payloads
+        """
+        buf = self.buf
+        buf += data
+        frames = []
+        start = 0
+        while len(buf) - start >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(buf, start)
+            if length > MAX_FRAME:
+                raise ValueError("Frame length %d exceeds the maximum (%d)" % (length, MAX_FRAME))
+            if len(buf) - start - FRAME_HEADER.size < length:
+                break
+            start += FRAME_HEADER.size
+            frames.append(bytes(buf[start : start + length]))
+            start += length
+        if start:
+            del buf[:start]
+        return frames
+
+
+class QueuedEvent(object):
+    """An event waiting to be given to our scripts - shared by all their queues"""
+
+    __slots__ = ("eventtype", "nodetype", "jsontext", "eventobj", "_env")
+
+    def __init__(self, eventtype, nodetype, jsontext, eventobj):
+        """
+        :param eventtype: str: name of the event type ("up", "create", etc)
+        :param nodetype: str: type of the associated object
+        :param jsontext: str: canonical JSON for the event
+        :param eventobj: dict: the decoded event
+        """
+        self.eventtype = eventtype
+        self.nodetype = nodetype
+        self.jsontext = jsontext
+        self.eventobj = eventobj
+        self._env = None
+
+    def env(self, envfunction):
+        """
+        Return the environment for running a script for this event - computing it only once
+
+        :param envfunction: callable(eventobj): returns a dict of environment variables
+        :return: dict
+        """
+        if self._env is None:
+            self._env = envfunction(self.eventobj)
+        return self._env
+
+    def stream_json(self):
+        "Return our JSON as an element of a stream worker batch"
+        return '{"eventtype":%s,"nodetype":%s,"event":%s}' % (
+            json.dumps(self.eventtype),
+            json.dumps(self.nodetype),
+            self.jsontext,
+        )
+
+
+class ScriptRun(object):
+    """One run of a script for a single event"""
+
+    def __init__(self, script, event, env, timeout):
+        """
+        :param script: str: pathname of the script
+        :param event: QueuedEvent: the event to tell it about
+        :param env: dict: its environment
+        :param timeout: float: how long it may run (seconds)
+        """
+        self.script = script
+        with tempfile.TemporaryFile() as jsontmpfile:
+            jsontmpfile.write(event.jsontext.encode("utf8"))
+            jsontmpfile.seek(0)
+            self.proc = subprocess.Popen(
+                [script, event.eventtype, event.nodetype], env=env, stdin=jsontmpfile
+            )
+        self.deadline = time.time() + timeout
+
+    def finished(self):
+        "Return True if our script has exited"
+        return self.proc.poll() is not None
+
+    def kill(self):
+        "Kill our script - it took too long"
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+        self.proc.wait()
+
+
+class StreamWorker(object):
+    """A persistent copy of a script which speaks our stream protocol"""
+
+    def __init__(self, script, timeout):
+        """
+        :param script: str: pathname of the script
+        :param timeout: float: how long it may take to process a batch (seconds)
+        """
+        self.script = script
+        self.timeout = timeout
+        self.proc = subprocess.Popen(
+            [script, STREAM_ARG], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        self.infd = self.proc.stdin.fileno()
+        self.outfd = self.proc.stdout.fileno()
+        for fd in (self.infd, self.outfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.outbuf = bytearray()
+        self.acks = FrameReader()
+        self.batchsize = 0  # Number of events in the batch it's working on - if any
+        self.deadline = None
+        self.dead = False
+
+    @property
+    def busy(self):
+        "Return True if we're waiting for this worker to finish a batch"
+        return self.batchsize > 0
+
+    def send(self, events):
+        """
+        Send a batch of events to our worker
+
+        :param events: [QueuedEvent]: the events to send
+        :return: None
+        """
+        payload = "[%s]" % ",".join(event.stream_json() for event in events)
+        self.outbuf += encode_frame(payload.encode("utf8"))
+        self.batchsize = len(events)
+        self.deadline = time.time() + self.timeout
+        self.writable()
+
+    def writable(self):
+        "Write as much of our pending batch as the worker's stdin will take"
+        if not self.outbuf:
+            return
+        try:
+            written = os.write(self.infd, self.outbuf)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.dead = True
+            return
+        del self.outbuf[:written]
+
+    def readable(self):
+        """
+        Read acknowledgements from our worker
+
+        :return: int: number of events it has finished with
+        """
+        try:
+            data = os.read(self.outfd, READ_SIZE)
+        except BlockingIOError:
+            return 0
+        except OSError:
+            data = b""
+        if not data:
+            self.dead = True
+            return 0
+        try:
+            acks = self.acks.feed(data)
+        except ValueError as e:
+            print("Event worker %s: bad reply: %s" % (self.script, e), file=sys.stderr)
+            self.dead = True
+            return 0
+        done = 0
+        if acks and self.busy:
+            done = self.batchsize
+            self.batchsize = 0
+            self.deadline = None
+        return done
+
+    def stop(self, kill=False):
+        """
+        Stop our worker - politely (by closing its stdin) or by killing it
+
+        :param kill: bool: True to kill it right now
+        :return: None
+        """
+        if kill:
+            try:
+                self.proc.kill()
+            except OSError:
+                pass
+        for pipe in (self.proc.stdin, self.proc.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        try:
+            self.proc.wait(timeout=None if kill else self.timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class EventWorkerPool(object):
+    """
+    Runs our event scripts for each event they should hear about - see the module docs.
+    """
+
+    # pylint: disable=R0913
+    def __init__(
+        self,
+        listscripts,
+        envfunction,
+        max_concurrency=1,
+        script_concurrency=None,
+        timeout=60,
+        batch_size=100,
+        max_queue=10000,
+    ):
+        """
+        :param listscripts: callable(): returns the list of scripts to run
+        :param envfunction: callable(eventobj): returns the environment for a script run
+        :param max_concurrency: int: how many copies of each script can run at once
+        :param script_concurrency: dict: per-script overrides of max_concurrency - by basename
+        :param timeout: float: seconds a script gets to handle an event (or a batch of them)
+        :param batch_size: int: most events to send to a stream worker at once
+        :param max_queue: int: most events a script's queue holds before we stop reading events
+        """
+        self.listscripts = listscripts
+        self.envfunction = envfunction
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.script_concurrency = dict(script_concurrency or {})
+        self.timeout = float(timeout)
+        self.batch_size = max(int(batch_size), 1)
+        self.max_queue = max(int(max_queue), 1)
+        self.queues = collections.OrderedDict()  # script -> deque of QueuedEvents
+        self.running = {}  # script -> [ScriptRun]
+        self.workers = {}  # script -> [StreamWorker]
+        self.streamscripts = {}  # script -> (mtime, True if it's a stream worker)
+        self.lastscan = 0.0
+        self.stats = collections.Counter()
+
+    def scripts(self):
+        "Return our current list of scripts - rescanning the script directory now and then"
+        now = time.time()
+        if now - self.lastscan >= SCRIPT_RESCAN:
+            self.lastscan = now
+            current = self.listscripts()
+            for script in list(self.queues):
+                if script not in current and not (self.queues[script] or self.running[script]):
+                    self._retire(script)
+            for script in current:
+                if script not in self.queues:
+                    self.queues[script] = collections.deque()
+                    self.running[script] = []
+                    self.workers[script] = []
+        return list(self.queues)
+
+    def _retire(self, script):
+        "Forget about a script which has been removed"
+        for worker in self.workers.pop(script, []):
+            worker.stop()
+        self.running.pop(script, None)
+        self.streamscripts.pop(script, None)
+        del self.queues[script]
+
+    def is_stream(self, script):
+        """
+        Return True if this script speaks our stream protocol
+
+        :param script: str: pathname of the script
+        :return: bool
+        """
+        try:
+            mtime = os.stat(script).st_mtime
+        except OSError:
+            return False
+        cached = self.streamscripts.get(script)
+        if cached is None or cached[0] != mtime:
+            try:
+                with open(script, "rb") as scriptfile:
+                    cached = (mtime, STREAM_MARKER in scriptfile.read(1024))
+            except IOError:
+                cached = (mtime, False)
+            self.streamscripts[script] = cached
+        return cached[1]
+
+    def concurrency(self, script):
+        "Return how many copies of this script can run at once"
+        limit = self.script_concurrency.get(os.path.basename(script), self.max_concurrency)
+        return max(int(limit), 1)
+
+    def submit(self, jsonbytes):
+        """
+        Queue up an event (as read from the FIFO) for each of our scripts
+
+        :param jsonbytes: bytes: JSON for the event
+        :return: bool: True if it was a valid event
+        """
+        try:
+            eventobj = json.loads(jsonbytes.decode("utf8"))
+            event = QueuedEvent(
+                AssimEvent.eventtypenames[eventobj["eventtype"]],
+                str(eventobj["associatedobject"]["nodetype"]),
+                json.dumps(eventobj, sort_keys=True, separators=(",", ":"), ensure_ascii=False),
+                eventobj,
+            )
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            print("Ignoring malformed event (%s): %r" % (e, jsonbytes[:200]), file=sys.stderr)
+            self.stats["malformed"] += 1
+            return False
+        self.stats["events"] += 1
+        for script in self.scripts():
+            self.queues[script].append(event)
+        return True
+
+    def full(self):
+        "Return True if any script's queue is full - so we should stop reading events"
+        return any(len(queue) >= self.max_queue for queue in self.queues.values())
+
+    def idle(self):
+        "Return True if we have nothing queued or running"
+        if any(self.queues.values()) or any(self.running.values()):
+            return False
+        return not any(worker.busy for workers in self.workers.values() for worker in workers)
+
+    def dispatch(self):
+        "Start work for any script with queued events and room to run"
+        for script, queue in self.queues.items():
+            if not queue:
+                continue
+            try:
+                if self.is_stream(script):
+                    self._dispatch_stream(script, queue)
+                else:
+                    self._dispatch_runs(script, queue)
+            except OSError as e:
+                print(
+                    "Cannot run event script %s: %s - dropping %d events" % (script, e, len(queue)),
+                    file=sys.stderr,
+                )
+                self.stats["dropped"] += len(queue)
+                queue.clear()
+
+    def _dispatch_runs(self, script, queue):
+        "Start one-process-per-event runs of this script"
+        running = self.running[script]
+        limit = self.concurrency(script)
+        while queue and len(running) < limit:
+            event = queue.popleft()
+            if DEBUG:
+                print("STARTING EVENT SCRIPT: %s %s" % (script, event.eventtype), file=sys.stderr)
+            running.append(ScriptRun(script, event, event.env(self.envfunction), self.timeout))
+            self.stats["runs"] += 1
+
+    def _dispatch_stream(self, script, queue):
+        "Send batches of events to this script's stream workers - starting workers as needed"
+        workers = self.workers[script]
+        idle = [worker for worker in workers if not worker.busy]
+        while queue and not idle and len(workers) < self.concurrency(script):
+            worker = StreamWorker(script, self.timeout)
+            workers.append(worker)
+            idle.append(worker)
+            self.stats["workers_started"] += 1
+        for worker in idle:
+            if not queue:
+                break
+            batch = [queue.popleft() for _ in range(min(self.batch_size, len(queue)))]
+            worker.send(batch)
+            self.stats["batches"] += 1
+
+    def reap(self):
+        "Clean up after finished, dead and timed-out scripts"
+        now = time.time()
+        for script, running in self.running.items():
+            for run in list(running):
+                if run.finished():
+                    running.remove(run)
+                elif now > run.deadline:
+                    print(
+                        "Event script %s timed out after %.0f seconds" % (script, self.timeout),
+                        file=sys.stderr,
+                    )
+                    run.kill()
+                    running.remove(run)
+                    self.stats["timeouts"] += 1
+        for script, workers in self.workers.items():
+            for worker in list(workers):
+                timedout = worker.busy and now > worker.deadline
+                if not (worker.dead or timedout or worker.proc.poll() is not None):
+                    continue
+                if worker.busy:
+                    print(
+                        "Event worker %s %s - %d events lost"
+                        % (script, "timed out" if timedout else "died", worker.batchsize),
+                        file=sys.stderr,
+                    )
+                    self.stats["timeouts" if timedout else "worker_deaths"] += 1
+                    self.stats["lost"] += worker.batchsize
+                worker.stop(kill=True)
+                workers.remove(worker)
+
+    def _poll_timeout(self):
+        "Return how long we can wait in select() before we have to check on things"
+        deadlines = [run.deadline for running in self.running.values() for run in running]
+        for workers in self.workers.values():
+            deadlines.extend(worker.deadline for worker in workers if worker.busy)
+        if deadlines:
+            return max(min(deadlines) - time.time(), 0.0)
+        return None
+
+    def run(self, fifofd):
+        """
+        Read events from our FIFO and run our scripts for them - until we get EOF on the FIFO
+        and have finished everything we queued up.
+
+        :param fifofd: int: file descriptor of the FIFO to read NUL-terminated events from
+        :return: None
+        """
+        # SIGCHLD wakes up our select() - so we start the next run as soon as a script exits
+        wakeupfds = os.pipe()
+        for fd in wakeupfds:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        oldhandler = signal.signal(signal.SIGCHLD, lambda _signum, _frame: None)
+        oldwakeupfd = signal.set_wakeup_fd(wakeupfds[1])
+        try:
+            self._run(fifofd, wakeupfds[0])
+        finally:
+            signal.set_wakeup_fd(oldwakeupfd)
+            signal.signal(signal.SIGCHLD, oldhandler)
+            for fd in wakeupfds:
+                os.close(fd)
+        self.shutdown()
+
+    def _run(self, fifofd, wakeupfd):
+        "Our select() loop - see run()"
+        reader = DelimitedReader(b"\0")
+        eof = False
+        while not (eof and self.idle()):
+            streams = [worker for workers in self.workers.values() for worker in workers]
+            readers = {worker.outfd: worker for worker in streams}
+            writers = {worker.infd: worker for worker in streams if worker.outbuf}
+            rlist = list(readers)
+            rlist.append(wakeupfd)
+            if not eof and not self.full():
+                rlist.append(fifofd)
+            try:
+                readable, writable, _ = select.select(
+                    rlist, list(writers), [], self._poll_timeout()
+                )
+            except InterruptedError:
+                continue
+            if wakeupfd in readable:
+                try:
+                    while os.read(wakeupfd, READ_SIZE):
+                        pass
+                except BlockingIOError:
+                    pass
+            if fifofd in readable:
+                data = os.read(fifofd, READ_SIZE)
+                if not data:
+                    eof = True
+                for record in reader.feed(data):
+                    self.submit(record)
+            for fd in writable:
+                writers[fd].writable()
+            for fd in readable:
+                if fd in readers:
+                    self.stats["acked"] += readers[fd].readable()
+            self.reap()
+            self.dispatch()
+
+    def shutdown(self):
+        "Stop all our stream workers"
+        for workers in self.workers.values():
+            for worker in workers:
+                worker.stop()
+            del workers[:]
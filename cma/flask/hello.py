@@ -24,19 +24,45 @@
 #
 #
 """
-Prototype code for providing a REST interface for the Assimilation project.
+REST query service for the Assimilation project.
+
+    /doquery/<queryname>?name=value...  execute a query - streaming its results as
+                                        newline-delimited JSON (one result per line)
+        &limit=N                        return at most N results - the X-Next-Cursor
+                                        header then holds a cursor for the next page
+        ?cursor=C                       return the page that cursor C refers to
+    /querymeta/<queryname>              return the metadata for a query
+    /draw/<drawingtype>                 stream a 'dot' drawing (see drawwithdot.py)
+        ?depth=N&host=H...              of what's within N relationships of hosts H...
+                                        (without depth: everything connected to them)
+        &changes=1                      of only the hosts that changed since the last one
+    /querystats                         return cache, Store pool and rate limit stats
+
+Requests are served concurrently - each one by a read-only Store from our StorePool.
+Each client (address) is rate limited. A page with fewer than 'limit' results is the last.
 Please note that there is no authentication at all, which is why they aren't activated...
 """
 from __future__ import print_function
 import sys
-from flask import Flask, request, Response
-from py2neo import Graph
+import os
+import math
+import json
+import optparse
+from flask import Flask, request, Response, jsonify
 
 sys.path.append("..")
-from store import Store
-from graphnodes import GraphNode
 from query import ClientQuery
+from queryservice import (
+    StorePool,
+    PooledStream,
+    RateLimiter,
+    CursorCodec,
+    stream_query,
+    NDJSON_MIMETYPE,
+)
 import cmainit
+from cmainit import CMAInjectables
+from drawwithdot import DotGraph, drawing_types, construct_dot_formats
 from AssimCtypes import QUERYINSTALL_DIR
 
 # These next two imports are actually needed because they register
@@ -45,83 +71,189 @@ from AssimCtypes import QUERYINSTALL_DIR
 from droneinfo import Drone
 from hbring import HbRing
 
-allqueries = {}
+MAXLIMIT = 10000  # Largest page size we allow
+MAXDEPTH = 6  # Largest drawing neighborhood we allow
+DOT_MIMETYPE = "text/vnd.graphviz"
+allqueries = {}  # queryname -> JSON metadata
+store_pool = None  # StorePool - set up by setup()
+rate_limiter = RateLimiter()
+cursors = CursorCodec(os.urandom(32))
 
 app = Flask(__name__)
 
 
-@app.route("/")
-def hello_world():
-    """"Dummy code for printing hello world on the root (/) page"""
-    return "Hello World! %s" % str(request.args)
+def error_response(status, message, headers=None):
+    """Return a JSON error response"""
+    response = jsonify({"error": message})
+    response.status_code = status
+    if headers:
+        response.headers.extend(headers)
+    return response
 
 
 @app.route("/querymeta/<queryname>")
 def query_meta(queryname):
-    """Dummy code for returning the metadata for a particular query
-    - that doesn't do anything yet."""
-    return 'Hello Query Metadata "%s"!' % queryname
+    """Return the metadata for a particular query"""
+    if queryname not in allqueries:
+        return error_response(404, "No such query: %s" % queryname)
+    return Response(allqueries[queryname], mimetype="application/json")
 
 
 @app.route("/doquery/<queryname>")
 def doquery(queryname):
-    """Prototype code for executing a particular query.
-    The error cases are detected, but not handled correctly yet.
-    """
+    """Execute a particular query - streaming (a page of) its results as NDJSON"""
+    wait = rate_limiter.allow(request.remote_addr)
+    if wait > 0:
+        return error_response(429, "Too many requests", {"Retry-After": str(math.ceil(wait))})
     if queryname not in allqueries:
-        return "No such query: %s" % queryname
-    query = allqueries[queryname]
+        return error_response(404, "No such query: %s" % queryname)
+    args = request.args.to_dict()
     try:
-        req = {}
-        argdict = dict(request.args)
-        for arg in argdict:
-            req[arg] = str(argdict[arg][0])
-        query.validate_parameters(req)
+        if "cursor" in args:
+            params, offset, limit = cursors.decode(args["cursor"], queryname)
+        else:
+            offset = 0
+            limit = args.pop("limit", None)
+            if limit is not None:
+                limit = int(limit)
+                if limit < 1 or limit > MAXLIMIT:
+                    raise ValueError("limit must be between 1 and %d" % MAXLIMIT)
+            params = args
     except ValueError as e:
-        return "Invalid Parameters to %s [%s]" % (queryname, str(e))
+        return error_response(400, str(e))
+    try:
+        pooled = store_pool.acquire()
+    except RuntimeError as e:
+        return error_response(503, str(e), {"Retry-After": "1"})
+    try:
+        lines = stream_query(pooled.query(queryname, allqueries[queryname]), params, offset, limit)
+    except ValueError as e:
+        store_pool.release(pooled)
+        return error_response(400, "Invalid Parameters to %s [%s]" % (queryname, str(e)))
+    except Exception:
+        store_pool.release(pooled)
+        raise
+    headers = {}
+    if limit is not None:
+        headers["X-Next-Cursor"] = cursors.encode(queryname, params, offset + limit, limit)
     return Response(
-        query.execute(None, idsonly=False, expandjson=True, maxjson=1024, **req),
-        mimetype="application/javascript",
+        PooledStream(store_pool, pooled, lines), mimetype=NDJSON_MIMETYPE, headers=headers
     )
 
 
-if __name__ == "__main__":
+@app.route("/draw/<drawingtype>")
+def draw(drawingtype):
+    """Stream a 'dot' drawing of the graph. Hosts whose subgraphs haven't changed since the
+    last drawing of this type are drawn from our cache - 'changes=1' draws only changed ones.
+    """
+    wait = rate_limiter.allow(request.remote_addr)
+    if wait > 0:
+        return error_response(429, "Too many requests", {"Retry-After": str(math.ceil(wait))})
+    if drawingtype not in drawing_types:
+        return error_response(404, "No such drawing type: %s" % drawingtype)
+    try:
+        depth = request.args.get("depth", DotGraph.DEFAULT_DEPTH)
+        if depth is not None:
+            depth = int(depth)
+            if depth < 0 or depth > MAXDEPTH:
+                raise ValueError("depth must be between 0 and %d" % MAXDEPTH)
+    except ValueError as e:
+        return error_response(400, str(e))
+    hosts = request.args.getlist("host") or None
+    changes_only = request.args.get("changes", "0").lower() in ("1", "true", "yes")
+    try:
+        pooled = store_pool.acquire()
+    except RuntimeError as e:
+        return error_response(503, str(e), {"Retry-After": "1"})
+    dot = DotGraph(
+        construct_dot_formats(drawingtype),
+        store=pooled.store,
+        dronelist=hosts,
+        maxdepth=depth,
+        cachekey=drawingtype,
+    )
+    return Response(
+        PooledStream(store_pool, pooled, dot.render(changes_only)), mimetype=DOT_MIMETYPE
+    )
 
-    def setup(dbhost="localhost", dbport=7474, dburl=None, querypath=None):
-        """
-        Program to set up for running our REST server.
-        We do these things:
-            - Attach to the database
-            - Initialize our type objects so things like ClientQuery will work...
-            - Load the queries into the database from flat files
-                Not sure if doing this here makes the best sense, but it
-                works, and currently we're the only one who cares about them
-                so it seems reasonable -- at the moment ;-)
-                Also we're most likely to iterate changing on those relating to the
-                REST server, so fixing them just by restarting the REST server seems
-                to make a lot of sense (at the moment)
-            - Remember the set of queries in the 'allqueries' hash table
-        """
-        if dburl is None:
-            dburl = "http://%s:%d/db/data/" % (dbhost, dbport)
-        print('CREATING Graph("%s")' % dburl, file=sys.stderr)
-        neodb = Graph(dburl)
-        qstore = Store(neodb, None, None)
-        print(GraphNode.classmap)
-        print("LOADING TREE!")
-        if querypath is None:
-            querypath = "/home/alanr/monitor/src/queries"
-        queries = ClientQuery.load_tree(qstore, querypath)
-        for q in queries:
-            allqueries[q.queryname] = q
-        qstore.commit()
-        for q in allqueries:
-            allqueries[q].bind_store(qstore)
-        # queryquery = 'START q1=node:ClientQuery({queryname}) RETURN q1 LIMIT 1'
-        # print 'Neodb =', neodb
-        # print 'qstore =', qstore
-
-    cmainit.CMAinit(io=None, readonly=True, use_network=False)
-    setup(querypath=QUERYINSTALL_DIR)
-    app.debug = True
-    app.run()
+
+@app.route("/querystats")
+def query_stats():
+    """Return our query result cache, drawing cache, Store pool and rate limiter
+    statistics as JSON"""
+    drawings = {}
+    for (drawingtype, depth), cache in DotGraph.subgraph_caches.items():
+        drawings["%s/%s" % (drawingtype, "all" if depth is None else depth)] = cache.report()
+    return jsonify(
+        {
+            "cache": ClientQuery.cache_stats(),
+            "drawings": drawings,
+            "stores": store_pool.report() if store_pool is not None else None,
+            "ratelimit": rate_limiter.report(),
+        }
+    )
+
+
+def setup(querypath, stores=8, rate=10.0, burst=20, secret=None):
+    """
+    Set up for running our REST server.
+    We do these things:
+        - Set up injection so we get read-only Stores using the Neo4j reader pool
+        - Read the queries from flat files - we never update the database
+        - Create our StorePool, rate limiter and cursor codec
+
+    :param querypath: str: directory tree containing our queries
+    :param stores: int: number of read-only Stores (concurrent queries)
+    :param rate: float: requests/second per client - 0 means no limit
+    :param burst: int: requests per client at once
+    :param secret: bytes: secret for signing cursors - shared by all servers behind a balancer
+    :return: None
+    """
+    global store_pool, rate_limiter, cursors
+    CMAInjectables.default_cma_injection_configuration(
+        {"NEO4J_READONLY": True, "NEO4J_READER_POOL_SIZE": stores}
+    )
+    cmainit.CMAinit(io=None, use_network=False)
+    for queryname, path in ClientQuery.query_files(querypath):
+        with open(path, "r") as queryfile:
+            metadata = queryfile.read()
+        try:
+            json.loads(metadata)
+        except ValueError as e:
+            print("%s is invalid: %s" % (path, str(e)), file=sys.stderr)
+            continue
+        allqueries[queryname] = metadata
+    store_pool = StorePool(
+        lambda: CMAInjectables.setup_store(readonly=True),
+        ClientQuery,
+        size=stores,
+        timeout=30.0,
+    )
+    rate_limiter = RateLimiter(rate=rate, burst=burst)
+    if secret is not None:
+        cursors = CursorCodec(secret)
+
+
+def main():
+    """Run our REST query server"""
+    parser = optparse.OptionParser(prog="hello", description="Assimilation REST query service")
+    parser.add_option("--host", default="127.0.0.1", help="address to listen on [%default]")
+    parser.add_option("--port", type="int", default=5000, help="port to listen on [%default]")
+    parser.add_option("--querypath", default=QUERYINSTALL_DIR, help="query directory [%default]")
+    parser.add_option("--stores", type="int", default=8, help="concurrent queries [%default]")
+    parser.add_option("--rate", type="float", default=10.0, help="requests/sec/client [%default]")
+    parser.add_option("--burst", type="int", default=20, help="request burst/client [%default]")
+    parser.add_option("--secret-file", help="file with the secret for signing cursors")
+    opts = parser.parse_args()[0]
+    secret = None
+    if opts.secret_file:
+        with open(opts.secret_file, "rb") as secretfile:
+            secret = secretfile.read().strip()
+    setup(opts.querypath, stores=opts.stores, rate=opts.rate, burst=opts.burst, secret=secret)
+    print("Serving %d queries on %s:%d" % (len(allqueries), opts.host, opts.port), file=sys.stderr)
+    app.run(host=opts.host, port=opts.port, threaded=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -37,6 +37,7 @@ from cmadb import CMAdb
 from AssimCtypes import ADDR_FAMILY_IPV4, ADDR_FAMILY_IPV6, ADDR_FAMILY_802
 from AssimCclasses import pyNetAddr, pyConfigContext
 from store_association import StoreAssociation
+from subnetindex import SubnetIndex
 
 
 def nodeconstructor(**properties):
@@ -881,25 +882,18 @@ class Subnet(GraphNode):
     @staticmethod
     def find_matching_subnets(store, domain, ipaddr, contexts):
         """
-        Yield each matching subnet in turn. Might be zero or one - could be more
-        This is slow if you have lots of subnets to search
+        Yield each matching subnet in turn. Might be zero or one - could be more.
+        The most specific (longest prefix) subnets are yielded first.
+        We look them up in our SubnetIndex, so this is fast no matter how many subnets we have.
         :param store: Store: store to search
         :param domain: str: domain to search - could be None
         :param ipaddr: str: IP address
         :param contexts: [str] or None: Contexts that interest us - or None
         :return: generator(Subnet)
         """
-        query = "MATCH(subnet:Class_Subnet) WHERE "
-        if domain is not None:
-            query += "subnet.domain = $domain "
-        if contexts is not None:
-            if domain is not None:
-                query += "AND "
-            query += "subnet.context in $contexts "
-        query += "RETURN subnet"
-
-        for subnet in store.load_cypher_nodes(query, {"domain": domain, "contexts": contexts}):
-            if subnet.belongs_on_this_subnet(ipaddr):
+        for node_id in SubnetIndex.matching(store, domain, ipaddr, contexts=contexts):
+            subnet = store.load_by_node_id(node_id)
+            if subnet is not None:
                 yield subnet
 
     @staticmethod
@@ -989,23 +983,10 @@ class Subnet(GraphNode):
         :return: Subnet: or None
         """
         ipaddr, cidrmask = Subnet.str_to_ip_cidr(ipaddr, cidrmask)
-        query = """
-        MATCH (n:Class_Subnet) WHERE n.ipaddr = $ipaddr AND n.cidrmask = $cidrmask
-        AND n.domain = $domain
-        """
-        if context is not None:
-            query += " AND n.context = $context"
-        if net_segment is not None:
-            query += " AND n.net_segment = $net_segment"
-        parameters = {
-            "cidrmask": int(cidrmask),
-            "context": context,
-            "domain": domain,
-            "ipaddr": str(ipaddr),
-            "net_segment": net_segment,
-        }
-        query += " RETURN n"
-        return store.load_cypher_node(query, parameters)
+        node_id = SubnetIndex.exact(
+            store, domain, ipaddr, cidrmask, context=context, net_segment=net_segment
+        )
+        return None if node_id is None else store.load_by_node_id(node_id)
 
     def belongs_on_this_subnet(self, ipaddr):
         """
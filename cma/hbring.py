@@ -35,6 +35,100 @@ class HbRing(GraphNode):
     THEONERING = 3  # And The One Ring to rule them all...
     memberprefix = "RingMember_"
     nextprefix = "RingNext_"
+    #
+    # Ring topology queries. %(label)s is our member label, %(next)s our 'next' relationship type
+    #
+    # Find an insert point (a member and its successor) - and whether $droneid is a member
+    INSERTPOINT_QUERY = """OPTIONAL MATCH (drone) WHERE ID(drone) = $droneid
+        OPTIONAL MATCH (a:%(label)s) WHERE ID(a) <> $droneid
+        WITH drone, a LIMIT 1
+        OPTIONAL MATCH (a)-[:%(next)s]->(b)
+        RETURN coalesce(drone:%(label)s, false) AS ismember, a, b LIMIT 1"""
+    # Join an empty ring
+    JOIN_EMPTY_QUERY = """MATCH (drone) WHERE ID(drone) = $droneid AND NOT drone:%(label)s
+        OPTIONAL MATCH (other:%(label)s)
+        WITH drone, count(other) AS others WHERE others = 0
+        SET drone:%(label)s
+        RETURN drone"""
+    # Join a ring with one member ($insertid)
+    JOIN_ONE_QUERY = """MATCH (drone) WHERE ID(drone) = $droneid AND NOT drone:%(label)s
+        MATCH (a:%(label)s) WHERE ID(a) = $insertid AND NOT (a)-[:%(next)s]->()
+        SET drone:%(label)s
+        CREATE (a)-[:%(next)s {ring_name: $ring_name}]->(drone)
+        CREATE (drone)-[:%(next)s {ring_name: $ring_name}]->(a)
+        RETURN a"""
+    # Join a ring with two or more members - splicing in after $insertid
+    JOIN_SPLICE_QUERY = """MATCH (drone) WHERE ID(drone) = $droneid AND NOT drone:%(label)s
+        MATCH (a:%(label)s)-[r:%(next)s]->(b) WHERE ID(a) = $insertid
+        WITH drone, a, r, b LIMIT 1
+        SET drone:%(label)s
+        DELETE r
+        CREATE (a)-[:%(next)s {ring_name: $ring_name}]->(drone)
+        CREATE (drone)-[:%(next)s {ring_name: $ring_name}]->(b)
+        WITH a, b
+        MATCH (b)-[:%(next)s]->(c)
+        RETURN a, b, c LIMIT 1"""
+    # Splice a chain of new members in between $insertid and $nextid (which must be adjacent).
+    # $links is the list of [from, to] node id pairs making up the new chain - including
+    # [$insertid, first] and [last, $nextid]. Returns no rows if anything was stale.
+    JOIN_CHAIN_QUERY = """OPTIONAL MATCH (m:%(label)s) WHERE ID(m) IN $droneids
+        WITH count(m) AS already WHERE already = 0
+        MATCH (a:%(label)s)-[r:%(next)s]->(b:%(label)s) WHERE ID(a) = $insertid AND ID(b) = $nextid
+        WITH a, r, b, exists((b)-[:%(next)s]->(a)) AS wasring2 LIMIT 1
+        DELETE r
+        WITH wasring2
+        UNWIND $links AS link
+        MATCH (x) WHERE ID(x) = link[0]
+        MATCH (y) WHERE ID(y) = link[1]
+        SET x:%(label)s, y:%(label)s
+        CREATE (x)-[:%(next)s {ring_name: $ring_name}]->(y)
+        RETURN wasring2, count(*) AS linked"""
+    MEMBERS_AMONG_QUERY = """MATCH (drone:%(label)s) WHERE ID(drone) IN $droneids
+        RETURN ID(drone) AS droneid"""
+    # Leave a ring - returning (previous, next, next-of-next) as they were before we left
+    LEAVE_QUERY = """MATCH (drone:%(label)s) WHERE ID(drone) = $droneid
+        REMOVE drone:%(label)s
+        WITH drone
+        OPTIONAL MATCH (prev)-[rp:%(next)s]->(drone)
+        OPTIONAL MATCH (drone)-[rn:%(next)s]->(next)
+        OPTIONAL MATCH (next)-[:%(next)s]->(nextnext)
+        WITH prev, rp, next, rn, nextnext LIMIT 1
+        DELETE rp, rn
+        FOREACH (_ IN CASE WHEN prev IS NOT NULL AND prev <> next THEN [1] ELSE [] END |
+            CREATE (prev)-[:%(next)s {ring_name: $ring_name}]->(next))
+        RETURN prev, next, nextnext"""
+    # The ring links into and out of the drones in $droneids - and the successor of each 'to'
+    LEAVE_LINKS_QUERY = """MATCH (a:%(label)s)-[:%(next)s]->(b)
+        WHERE ID(a) IN $droneids OR ID(b) IN $droneids
+        OPTIONAL MATCH (b)-[:%(next)s]->(c)
+        RETURN a, b, ID(c) AS afterb"""
+    # Several drones leave at once. $links are the [from, to] node id pairs which close the gaps
+    LEAVE_MANY_QUERY = """MATCH (drone:%(label)s) WHERE ID(drone) IN $droneids
+        REMOVE drone:%(label)s
+        WITH drone
+        OPTIONAL MATCH (drone)-[r:%(next)s]-()
+        WITH collect(DISTINCT r) AS rels
+        FOREACH (r IN rels | DELETE r)
+        WITH count(*) AS ignored
+        UNWIND (CASE WHEN size($links) = 0 THEN [null] ELSE $links END) AS link
+        OPTIONAL MATCH (x) WHERE ID(x) = link[0]
+        OPTIONAL MATCH (y) WHERE ID(y) = link[1]
+        FOREACH (_ IN CASE WHEN x IS NULL OR y IS NULL THEN [] ELSE [1] END |
+            CREATE (x)-[:%(next)s {ring_name: $ring_name}]->(y))
+        RETURN sum(CASE WHEN x IS NULL OR y IS NULL THEN 0 ELSE 1 END) AS linked"""
+    PARTNERS_QUERY = """MATCH (d1)-[:%(next)s]-(d2) WHERE ID(d1) = $id1 AND ID(d2) = $id2
+        RETURN count(*) AS partners"""
+    LINKS_QUERY = """MATCH (drone:%(label)s)-[:%(next)s]->(next) RETURN drone, next"""
+    LINK_IDS_QUERY = """MATCH (drone:%(label)s)-[:%(next)s]->(next)
+        RETURN ID(drone) AS drone, ID(next) AS next"""
+    AUDIT_QUERY = """MATCH (drone:%(label)s)
+        OPTIONAL MATCH (drone)-[outrel:%(next)s]->()
+        WITH drone, count(outrel) AS outdeg
+        OPTIONAL MATCH (drone)<-[inrel:%(next)s]-()
+        WITH drone, outdeg, count(inrel) AS indeg
+        WITH count(drone) AS members, collect([ID(drone), outdeg, indeg]) AS degrees
+        OPTIONAL MATCH (a)-[stray:%(next)s]->(b) WHERE NOT a:%(label)s OR NOT b:%(label)s
+        RETURN members, degrees, count(stray) AS strays"""
 
     def __init__(self, name, ringtype):
         """Constructor for a heartbeat ring.
@@ -50,6 +144,10 @@ class HbRing(GraphNode):
         self._ringinitfinished = False
         self._insertpoint1 = None
         self._insertpoint2 = None
+        self._pending_joins = {}
+        self._uncommitted_joins = {}  # Drones joined by a transaction which hasn't committed
+        self._retried_joins = set()  # Node ids which have already gone back into a batch once
+        self._warm_members = set()  # Node ids our warm-start snapshot says are members
 
     @classmethod
     def meta_key_attributes(cls):
@@ -61,27 +159,34 @@ class HbRing(GraphNode):
         if self._ringinitfinished:
             return
         self._ringinitfinished = True
+        self._load_insertpoints()
+
+    def _cypher(self, query):
+        """Fill in our ring-specific label and relationship type names in this Cypher query.
+        Labels and relationship types can't be Cypher parameters, so they get
+        substituted in as text - everything else is passed as a parameter.
+        """
+        return query % {"label": self.our_member_label, "next": self.ournexttype}
+
+    def _load_insertpoints(self, drone=None):
+        """(Re)load our insert points from the database in a single query.
+        We pick an arbitrary member (other than 'drone') and its ring successor (if any).
+
+        :param drone: Drone: drone which is not a candidate insert point (or None)
+        :return: bool: True if 'drone' is already a member of this ring
+        """
         self._insertpoint1 = None
         self._insertpoint2 = None
-        # print('CMAdb(hbring.py):', CMAdb, file=stderr)
-        # print('self.association.store(hbring.py):', self.association.store, file=stderr)
-        # print('Our relation type: %s' % self.our_member_label, file=stderr)
-        # query = ('OPTIONAL MATCH (node1:Class_Drone)-[:%s]->(node2) RETURN node1, node2 LIMIT 1'
-        #          % self.ournexttype)
-        # for  member1, member2 in self.association.store.load_cypher_query(query):
-        #    break
-        # print("MEMBER1: %s, MEMBER2: %s" % (member1, member2), file=stderr)
-        for rel in self.members():
-            self._insertpoint1 = rel
-            # print('INSERTPOINT1: ', self._insertpoint1, file=stderr)
-            # print('Our relation type: %s' % self.ournexttype, file=stderr)
-            ip2rellist = self.association.store.load_related(self._insertpoint1, self.ournexttype)
-            for rel2 in ip2rellist:
-                self._insertpoint2 = rel2
-                break
-            break
-        # print('INSERTPOINT1: %s, POINT2: %s '
-        #       % (self._insertpoint1, self._insertpoint2)), file=stderr)
+        droneid = -1 if drone is None else drone.association.node_id
+        # This runs in our transaction, so we see any ring changes we haven't committed yet
+        rows = self.association.store.update_cypher_query(
+            self._cypher(HbRing.INSERTPOINT_QUERY), {"droneid": droneid}
+        )
+        for row in rows:
+            self._insertpoint1 = row.a
+            self._insertpoint2 = row.b
+            return row.ismember
+        return False
 
     def _findringpartners(self, drone):
         """Find (one or) two partners for this drone to heartbeat with.
@@ -97,102 +202,246 @@ class HbRing(GraphNode):
         return partners
 
     def join(self, drone):
-        """Add this drone to our ring"""
+        """Add this drone to our ring.
+
+        Each join is a single parameterized Cypher statement (two if our insert
+        points turn out to be stale). Our insert points are always adjacent in the ring:
+        _insertpoint1-[:next]->_insertpoint2.
+        """
         assert drone.association.node_id is not None
         if CMAdb.debug:
             CMAdb.log.debug(
                 "1:Adding Drone %s to ring %s w/port %s" % (str(drone), str(self), drone.port)
             )
-        assert self.our_member_label not in self.association.store.labels(drone)
-        # Create a 'ringmember' relationship to this drone
-        #######  self.association.store.relate(self, self.ourreltype, drone)
-        self.association.store.add_labels(drone, (self.our_member_label,))
-        # Should we keep a 'ringip' relationship for this drone?
-        # Probably eventually...
-
-        # print('Adding drone %s to talk to partners' % drone, file=stderr)
-        thisring = {"ring_name": self.name}
+        if not self._ringinitfinished:
+            self._ringinitfinished = True
+            self._load_insertpoints(drone)
+        if drone.association.node_id in self._warm_members:
+            # Our warm-start snapshot says it's already a member - go straight to checking
+            self._warm_members.discard(drone.association.node_id)
+        elif self._try_join(drone):
+            return
+        # Our insert points must have been stale - reload them and try again
+        if self._load_insertpoints(drone):
+            raise ValueError("Drone %s is already a member of %s" % (drone, self))
+        if not self._try_join(drone):
+            raise RuntimeError("Cannot add Drone %s to %s" % (drone, self))
+
+    def _try_join(self, drone):
+        """Splice this drone into our ring at our current insert point.
+
+        :param drone: Drone: drone to add to the ring
+        :return: bool: False if our insert points were stale (nothing was changed)
+        """
+        store = self.association.store
+        params = {"droneid": drone.association.node_id, "ring_name": self.name}
         if self._insertpoint1 is None:  # Zero nodes previously
+            rows = store.update_cypher_query(self._cypher(HbRing.JOIN_EMPTY_QUERY), params)
+            if not rows:
+                return False
             self._insertpoint1 = drone
-            return
+            return True
 
-        if CMAdb.debug:
-            CMAdb.log.debug(
-                "2:Adding Drone %s to ring %s w/port %s" % (str(drone), str(self), drone.port)
-            )
         if self._insertpoint2 is None:  # One node previously
             # Create the initial circular list.
             # FIXME: Ought to label ring membership relationships with IP involved
             # This is because we might change configurations and we need to know
             # what IP we're actually using for this connection...
-            self.association.store.relate(
-                drone, self.ournexttype, self._insertpoint1, attrs=thisring
-            )
-            self.association.store.relate(
-                self._insertpoint1, self.ournexttype, drone, attrs=thisring
-            )
+            params["insertid"] = self._insertpoint1.association.node_id
+            rows = store.update_cypher_query(self._cypher(HbRing.JOIN_ONE_QUERY), params)
+            if not rows:
+                return False
+            partner = rows[0].a
             if CMAdb.debug:
                 CMAdb.log.debug(
                     "3:Adding Drone %s to ring %s w/port %s" % (str(drone), str(self), drone.port)
                 )
-            drone.start_heartbeat(self, self._insertpoint1)
-            self._insertpoint1.start_heartbeat(self, drone)
-            self._insertpoint2 = self._insertpoint1
+            drone.start_heartbeat(self, partner)
+            partner.start_heartbeat(self, drone)
             self._insertpoint1 = drone
-            # print('RING2 IS NOW:', str(self), file=stderr)
-            return
+            self._insertpoint2 = partner
+            return True
 
         # Two or more nodes previously
-        nextnext = None
-        for nextnext in self.association.store.load_related(
-            self._insertpoint2, self.ournexttype, attrs=thisring
-        ):
-            break
-        if CMAdb.debug:
-            CMAdb.log.debug(
-                "4:Adding Drone %s to ring %s w/port %s" % (str(drone), str(self), drone.port)
-            )
-        if nextnext is not None and nextnext is not self._insertpoint1:
-            # print('HAD AT LEAST 3 NODES BEFORE', file=stderr)
-            # At least 3 nodes before
-            # We had X->point1->point2->nextnext (where X and nextnext might be the same)
-            # We just verified that point1 and Y are different
-            #
-            # What we have right now is insertpoint1->insertpoint2->nextnext
-            # Let's move the insert point down the ring so that the same node doesn't get hit
-            # over and over with stop/start requests
-            #
-            self._insertpoint1 = self._insertpoint2
-            self._insertpoint2 = nextnext
-            self._insertpoint1.stop_heartbeat(self, self._insertpoint2)
-            self._insertpoint2.stop_heartbeat(self, self._insertpoint1)
-        self.association.store.separate(
-            self._insertpoint1, self.ournexttype, self._insertpoint2, attrs=thisring
-        )
-        # Now we just have had X->point1 and point2->Y
+        # We splice ourselves in just after _insertpoint2:  insertpoint2->drone->nextnext
+        # Moving the insert point down the ring keeps the same nodes from being hit
+        # over and over with stop/start requests as new drones arrive.
+        params["insertid"] = self._insertpoint2.association.node_id
+        rows = store.update_cypher_query(self._cypher(HbRing.JOIN_SPLICE_QUERY), params)
+        if not rows:
+            return False
+        prevnode, nextnode, nextnext = rows[0]
         if CMAdb.debug:
             CMAdb.log.debug(
                 "5:Adding Drone %s to ring %s w/port %s" % (str(drone), str(self), drone.port)
             )
-        drone.start_heartbeat(self, self._insertpoint1, self._insertpoint2)
-        self._insertpoint1.start_heartbeat(self, drone)
-        self._insertpoint2.start_heartbeat(self, drone)
-        self.association.store.relate(self._insertpoint1, self.ournexttype, drone, attrs=thisring)
-        # after above statement: we have x->insertpoint1-> drone and insertpoint2->y
-        self.association.store.relate(drone, self.ournexttype, self._insertpoint2, attrs=thisring)
-        # after above statement: we have insertpoint1-> drone->insertpoint2
-        #
+        if nextnext is not prevnode:
+            # At least 3 nodes before - prevnode and nextnode are no longer neighbors
+            prevnode.stop_heartbeat(self, nextnode)
+            nextnode.stop_heartbeat(self, prevnode)
+        drone.start_heartbeat(self, prevnode, nextnode)
+        prevnode.start_heartbeat(self, drone)
+        nextnode.start_heartbeat(self, drone)
         # In the future we might want to mark these relationships with the IP addresses involved
         # so that even if the systems change network configurations we can still know what IP to
         # remove.  Right now we rely on the configuration not changing "too much".
         # FIXME: Ought to label relationships with IP addresses involved.
         #
-        # We should ensure that we don't keep beating the same nodes over and over
-        # again as new nodes join the system.  Instead the latest newbie becomes the next
-        # insert point in the ring - spreading the work to the new guys as they arrive.
-        # Probably should use nextnext from above...
+        # The latest newbie becomes the next insert point in the ring - spreading the work
+        # to the new guys as they arrive.
         self._insertpoint1 = drone
-        # print('RING3 IS NOW:', str(self), 'DRONE ADDED:', drone, file=stderr)
+        self._insertpoint2 = nextnode
+        return True
+
+    def defer_join(self, drone, max_batch=None):
+        """Queue this drone up to join our ring in our next batched join.
+        When lots of drones start up at once, joining them in batches saves most of
+        the database work and nearly all the heartbeat start/stop messages that
+        joining them one at a time would cost.
+
+        :param drone: Drone: drone to add to the ring
+        :param max_batch: int: join everything now if we have this many drones queued
+        :return: [Drone]: the drones we joined to our ring (if we joined a full batch)
+        """
+        assert drone.association.node_id is not None
+        self._pending_joins[drone.association.node_id] = drone
+        if max_batch is not None and len(self._pending_joins) >= max_batch:
+            return self.flush_pending_joins()
+        return []
+
+    def pending_join_count(self):
+        "Return the number of drones waiting to join this ring"
+        return len(self._pending_joins)
+
+    def flush_pending_joins(self):
+        """Add all the drones queued by defer_join() to our ring in one operation.
+        Drones which have died since they were queued are quietly dropped.
+        This has to be called inside a database (and network) transaction - and followed
+        by commit_joins() or abort_joins() once we know what became of it.
+
+        :return: [Drone]: the drones we joined to our ring
+        """
+        drones = [drone for drone in self._pending_joins.values() if drone.status == "up"]
+        self._uncommitted_joins.update(self._pending_joins)
+        self._pending_joins = {}
+        if drones:
+            self.join_many(drones)
+        return drones
+
+    def commit_joins(self):
+        "The transaction joining our latest batch has committed - they really joined"
+        self._retried_joins.difference_update(self._uncommitted_joins)
+        self._uncommitted_joins = {}
+
+    def abort_joins(self):
+        """
+        The transaction joining our latest batch has aborted - so none of them joined.
+        They go back into our next batch - unless they've failed before.
+
+        :return: None
+        """
+        for nodeid, drone in self._uncommitted_joins.items():
+            if nodeid in self._retried_joins:
+                self._retried_joins.discard(nodeid)  # Failed twice - give up on it
+                CMAdb.log.warning("Giving up on joining %s to %s" % (drone, self))
+            else:
+                self._retried_joins.add(nodeid)
+                self._pending_joins.setdefault(nodeid, drone)
+        self._uncommitted_joins = {}
+
+    def join_many(self, drones):
+        """Add several drones to our ring at once.
+
+        The new drones are spliced into the ring as a single chain in one Cypher statement,
+        and heartbeat start/stop messages are computed from the final ring topology only.
+        Joining N drones this way costs N+4 heartbeat messages (at most) instead of the
+        5N or so that N individual joins cost.
+
+        :param drones: [Drone]: drones to add to the ring
+        :return: None
+        """
+        if not self._ringinitfinished:
+            self._ringinitfinished = True
+            self._load_insertpoints()
+        drones = self._unique_drones(drones)
+        # After a restart, lots of returning drones are often still members.
+        # If our warm-start snapshot says so, we skip the join we expect to fail.
+        warm = [drone for drone in drones if drone.association.node_id in self._warm_members]
+        if not warm and self._join_chain(drones):
+            return
+        # Our insert points were stale, or some of these drones are already members.
+        # Forget the members, reload our insert points and try again.
+        store = self.association.store
+        params = {"droneids": [drone.association.node_id for drone in drones]}
+        rows = store.update_cypher_query(self._cypher(HbRing.MEMBERS_AMONG_QUERY), params)
+        members = set(row.droneid for row in rows)
+        self._warm_members.difference_update(params["droneids"])
+        for drone in drones:
+            if drone.association.node_id in members:
+                CMAdb.log.warning("Drone %s is already a member of %s" % (drone, self))
+        drones = [drone for drone in drones if drone.association.node_id not in members]
+        self._load_insertpoints()
+        if not self._join_chain(drones):
+            raise RuntimeError("Cannot add %d Drones to %s" % (len(drones), self))
+
+    @staticmethod
+    def _unique_drones(drones):
+        "Return these drones in their original order - without any duplicates"
+        seen = set()
+        result = []
+        for drone in drones:
+            assert drone.association.node_id is not None
+            if drone.association.node_id not in seen:
+                seen.add(drone.association.node_id)
+                result.append(drone)
+        return result
+
+    def _join_chain(self, drones):
+        """Splice this list of drones into our ring as a chain between our insert points.
+        We join drones one at a time until the ring has at least two members.
+
+        :param drones: [Drone]: drones to add to the ring (none of them members)
+        :return: bool: False if our insert points were stale (nothing was changed)
+        """
+        drones = list(drones)
+        while drones and self._insertpoint2 is None:
+            if not self._try_join(drones[0]):
+                return False
+            drones.pop(0)
+        if not drones:
+            return True
+        prevnode = self._insertpoint1
+        nextnode = self._insertpoint2
+        chain = [prevnode] + drones + [nextnode]
+        nodeids = [node.association.node_id for node in chain]
+        params = {
+            "droneids": nodeids[1:-1],
+            "insertid": nodeids[0],
+            "nextid": nodeids[-1],
+            "links": [[nodeids[j], nodeids[j + 1]] for j in range(len(nodeids) - 1)],
+            "ring_name": self.name,
+        }
+        rows = self.association.store.update_cypher_query(
+            self._cypher(HbRing.JOIN_CHAIN_QUERY), params
+        )
+        if not rows:
+            return False
+        if rows[0].linked != len(params["links"]):
+            raise RuntimeError("Ring %s: chain join only made %d links" % (self, rows[0].linked))
+        if CMAdb.debug:
+            CMAdb.log.debug("Added %d Drones to ring %s in one batch" % (len(drones), self))
+        # Only the final topology matters: prevnode->drones[0]->...->drones[-1]->nextnode
+        if not rows[0].wasring2:
+            # At least 3 nodes before - prevnode and nextnode are no longer neighbors
+            prevnode.stop_heartbeat(self, nextnode)
+            nextnode.stop_heartbeat(self, prevnode)
+        for j in range(1, len(chain) - 1):
+            chain[j].start_heartbeat(self, chain[j - 1], chain[j + 1])
+        prevnode.start_heartbeat(self, chain[1])
+        nextnode.start_heartbeat(self, chain[-2])
+        self._insertpoint1 = chain[-2]
+        self._insertpoint2 = nextnode
+        return True
 
     def dump_ring_in_order(self, title="Drones in Ring Order", our_drone=None):
         """
@@ -209,56 +458,32 @@ class HbRing(GraphNode):
             )
 
     def leave(self, drone):
-        """Remove a drone from this heartbeat Ring."""
+        """Remove a drone from this heartbeat Ring.
+        The database side of this is done in a single Cypher statement."""
         store = self.association.store
-        # print('DRONE %s leaving Ring [%s]' % (drone, self), file=stderr)
-        # self.dump_ring_in_order('RING BEFORE DELETION', drone)
-
-        # labels = store.labels(drone)
-        # print("ALL LABELS (del): %s" % str(labels), file=sys.stderr)
-        assert self.our_member_label in store.labels(drone)
-        store.delete_labels(drone, (self.our_member_label,))
-        thisring = {"ring_name": self.name}
-        prevnode = None
-        nextnode = None
-        for prevnode in store.load_in_related(drone, self.ournexttype, attrs=thisring):
-            break
-        for nextnode in store.load_related(drone, self.ournexttype, attrs=thisring):
-            break
-
-        # Clean out the parent (ring) relationship to our dearly departed drone
-        # print('Separating ourselves (%s) from drone %s' % (self, drone), file=stderr)
-        # Clean out the next link relationships to our dearly departed drone
+        params = {"droneid": drone.association.node_id, "ring_name": self.name}
+        self._warm_members.discard(drone.association.node_id)
+        rows = store.update_cypher_query(self._cypher(HbRing.LEAVE_QUERY), params)
+        assert len(rows) == 1  # Otherwise it wasn't a member of this ring
+        prevnode, nextnode, nextnext = rows[0]
+
         if nextnode is None and prevnode is None:  # Previous length:  1
             self._insertpoint1 = None  # result length:    0
             self._insertpoint2 = None
-            # No other database links to remove
             if CMAdb.debug:
                 CMAdb.log.debug("Last Drone %s has now left the building..." % drone)
-            # self.dump_ring_in_order('RING AFTER DELETION(1)', drone)
             return
 
-        # Clean out the next link relationships to our dearly departed drone
-        store.separate(prevnode, self.ournexttype, obj=drone, attrs=thisring)
-        store.separate(drone, self.ournexttype, obj=nextnode, attrs=thisring)
-
-        # print('PREVNODE: %s NEXTNODE: %s prev is next? %s'
-        #       % (str(prevnode), str(nextnode), prevnode is nextnode), file=stderr)
-
         if prevnode is nextnode:  # Previous length:  2
             # drone.stop_heartbeat(self, prevnode)  # Result length:    1
             # but drone is dead - don't talk to it.
             prevnode.stop_heartbeat(self, drone)
             self._insertpoint2 = None
             self._insertpoint1 = prevnode
-            # self.dump_ring_in_order('RING AFTER DELETION(2)', drone)
             return
 
         # Previous length had to be >= 3        # Previous length:  >=3
         #                                       # Result length:    >=2
-        nextnext = None
-        for nextnext in store.load_related(nextnode, self.ournexttype, attrs=thisring):
-            break
         prevnode.stop_heartbeat(self, drone)
         nextnode.stop_heartbeat(self, drone)
         if nextnext is not prevnode:  # Previous length:  >= 4
@@ -269,20 +494,91 @@ class HbRing(GraphNode):
         # drone.stop_heartbeat(self, prevnode, nextnode) # don't send packets to dead machines
         self._insertpoint1 = prevnode
         self._insertpoint2 = nextnode
-        store.relate(prevnode, self.ournexttype, nextnode, attrs=thisring)
-        # self.dump_ring_in_order('RING AFTER DELETION(3)', drone)
+
+    def leave_many(self, drones):
+        """Remove several (dead) drones from this ring at once.
+
+        When a switch or a rack fails, lots of neighboring drones die together. Having them
+        leave one at a time costs a Cypher statement apiece, and heartbeat start messages to
+        survivors which are only going to be told to stop again by the next leave.
+        Here we read the links around all of them, close each gap in the ring with a single
+        link, and compute heartbeat changes from the final ring topology only.
+
+        :param drones: [Drone]: drones to remove - all of them members of this ring
+        :return: None
+        """
+        drones = self._unique_drones(drones)
+        if len(drones) < 3:
+            for drone in drones:
+                self.leave(drone)
+            return
+        store = self.association.store
+        deadids = set(drone.association.node_id for drone in drones)
+        self._warm_members.difference_update(deadids)
+        params = {"droneids": list(deadids)}
+        successor = {}
+        after = {}
+        nodes = {}
+        deadnodes = {}
+        for row in store.update_cypher_query(self._cypher(HbRing.LEAVE_LINKS_QUERY), params):
+            aid = row.a.association.node_id
+            bid = row.b.association.node_id
+            successor[aid] = bid
+            after[bid] = row.afterb
+            for nodeid, node in ((aid, row.a), (bid, row.b)):
+                (deadnodes if nodeid in deadids else nodes)[nodeid] = node
+        # Each gap runs from a survivor through one or more dead drones to the next survivor
+        gaps = []
+        for previd in nodes:
+            if successor.get(previd) not in deadids:
+                continue
+            firstdead = successor[previd]
+            lastdead = firstdead
+            while successor.get(lastdead) in deadids:
+                lastdead = successor[lastdead]
+                if lastdead == firstdead:
+                    raise RuntimeError("Ring %s: dead drones form a cycle" % self)
+            nextid = successor.get(lastdead)
+            if nextid is None:
+                raise RuntimeError("Ring %s: drone %s has no successor" % (self, lastdead))
+            gaps.append((previd, firstdead, lastdead, nextid))
+        params["links"] = [[gap[0], gap[3]] for gap in gaps if gap[0] != gap[3]]
+        params["ring_name"] = self.name
+        rows = store.update_cypher_query(self._cypher(HbRing.LEAVE_MANY_QUERY), params)
+        if not rows or rows[0].linked != len(params["links"]):
+            raise RuntimeError("Ring %s: could not close %d gaps" % (self, len(params["links"])))
+        # Dead drones get no packets - only their surviving neighbors hear about it
+        started = set()
+        for previd, firstdead, lastdead, nextid in gaps:
+            nodes[previd].stop_heartbeat(self, deadnodes[firstdead])
+            nodes[nextid].stop_heartbeat(self, deadnodes[lastdead])
+            pair = frozenset((previd, nextid))
+            if previd == nextid or pair in started or after.get(nextid) == previd:
+                # All alone - or already heartbeating in the other direction
+                continue
+            started.add(pair)
+            nodes[previd].start_heartbeat(self, nodes[nextid])
+            nodes[nextid].start_heartbeat(self, nodes[previd])
+        if CMAdb.debug:
+            CMAdb.log.debug(
+                "%d Drones left ring %s in one batch - closing %d gaps"
+                % (len(drones), self, len(gaps))
+            )
+        if not gaps:  # No survivors had dead neighbors - the ring is empty (or was tiny)
+            self._load_insertpoints()
+            return
+        previd, _, _, nextid = gaps[-1]
+        self._insertpoint1 = nodes[previd]
+        self._insertpoint2 = None if previd == nextid else nodes[nextid]
 
     def are_partners(self, drone1, drone2):
         "Return True if these two drones are heartbeat partners in our ring"
-        thisring = {"ring_name": self.name}
         CMAdb.log.debug("calling are_partners(%s-[%s]-%s)" % (drone1, self.ournexttype, drone2))
-        nextelems = self.association.store.load_related(drone1, self.ournexttype, attrs=thisring)
-        for elem in nextelems:  # nextelems is a generator
-            if elem is drone2:
-                return True
-        prevelems = self.association.store.load_in_related(drone1, self.ournexttype, attrs=thisring)
-        for elem in prevelems:  # prevelems is a generator
-            return elem is drone2
+        params = {"id1": drone1.association.node_id, "id2": drone2.association.node_id}
+        for row in self.association.store.load_cypher_query(
+            self._cypher(HbRing.PARTNERS_QUERY), params
+        ):
+            return row.partners > 0
         return False
 
     def members(self):
@@ -291,59 +587,78 @@ class HbRing(GraphNode):
         return self.association.store.load_cypher_nodes(query)
 
     def members_ring_order(self, start=None):
-        "Return all the Drones that are members of this ring - in ring order"
-        if start is None:
-            for member in self.members():
-                start = member
-                break
+        """Return all the Drones that are members of this ring - in ring order.
+        We fetch all the ring links in one query and follow them in memory."""
+        successor = {}
+        first = None
+        for row in self.association.store.load_cypher_query(self._cypher(HbRing.LINKS_QUERY)):
+            if first is None:
+                first = row.drone
+            successor[row.drone] = row.next
         if start is None:
-            # print('NO START', file=stderr)
+            start = first
+        if start is None:  # Zero or one members - so no links
+            for drone in self.members():
+                yield drone
             return
-        startid = start.association.node_id
-        # We can't pre-compile this, but we hopefully we won't use it much...
-        q = (
-            """MATCH p=allShortestPaths((Drone:Class_Drone)-[:%s*0..]->(NextDrone))
-             WHERE ID(Drone) = $id
-             RETURN NextDrone ORDER BY length(p)"""
-            % self.ournexttype
-        )
-        for elem in self.association.store.load_cypher_nodes(q, {"id": startid}):
-            yield elem
-        return
+        drone = start
+        while True:
+            yield drone
+            drone = successor.pop(drone, None)
+            if drone is None or drone is start:
+                return
+
+    def member_ids_ring_order(self):
+        """Return the node ids of all our members in ring order - for warm-start snapshots.
+        Like members_ring_order(), it takes a single query - but no nodes get loaded.
+
+        :return: [int]: member node ids in ring order
+        """
+        store = self.association.store
+        successor = {}
+        first = None
+        for row in store.load_cypher_query(self._cypher(HbRing.LINK_IDS_QUERY), reader=True):
+            if first is None:
+                first = row.drone
+            successor[row.drone] = row.next
+        if first is None:  # Zero or one members - so no links
+            query = "MATCH (drone:%s) RETURN ID(drone) AS droneid" % self.our_member_label
+            return [row.droneid for row in store.load_cypher_query(query, reader=True)]
+        result = []
+        droneid = first
+        while droneid is not None:
+            result.append(droneid)
+            droneid = successor.pop(droneid, None)
+            if droneid == first:
+                break
+        return result
+
+    def warm_start(self, member_ids):
+        """Remember which drones our warm-start snapshot says are members of this ring.
+        It's only a hint: it saves trying to join returning drones which are probably
+        already members. Every hint gets checked against the database before we act on it.
+
+        :param member_ids: [int]: node ids of our members when the snapshot was taken
+        :return: None
+        """
+        self._warm_members = set(member_ids)
 
     def AUDIT(self):
-        """Audit our ring to see if it's well-formed"""
+        """Audit our ring to see if it's well-formed.
+        One aggregate query checks the in and out degree of every member at once,
+        and that our ring links only connect ring members."""
         print("STARTING RING AUDIT", file=stderr)
-        listmembers = {}
-        ringmembers = {}
-        mbrcount = 0
-        ringmembers = {drone for drone in self.members()}
-        listmembers = {drone for drone in self.members_ring_order()}
-        assert listmembers.difference(ringmembers) == set()
-        assert ringmembers.difference(listmembers) == set()
-
-        for drone in listmembers:
-            nextcount = 0
-            nextlist = self.association.store.load_related(drone, self.ournexttype)
-            # pylint: disable=W0612
-            for elem in nextlist:
-                nextcount += 1
-            incount = 0
-            inlist = self.association.store.load_in_related(drone, self.ournexttype)
-            for elem in inlist:
-                incount += 1
-            #  print('CHECKING %s status: %s mbrcount: %d, nextcount:%d'
-            #  ', incount:%d, labels: %s'
-            #  %   (drone, drone.status, mbrcount, nextcount, incount,
-            #       str(drone.association.store.labels(drone))), file=stderr)
-            # assert drone.status == 'up'
-            assert mbrcount < 2 or nextcount == 1
-            assert mbrcount < 2 or incount == 1
-
-        for drone in listmembers:
-            assert drone in ringmembers
-        for drone in ringmembers:
-            assert drone in listmembers
+        for row in self.association.store.load_cypher_query(self._cypher(HbRing.AUDIT_QUERY)):
+            expected = 1 if row.members > 1 else 0
+            badnodes = [
+                nodeid
+                for (nodeid, outdeg, indeg) in row.degrees
+                if outdeg != expected or indeg != expected
+            ]
+            if badnodes:
+                print("RING AUDIT: bad ring degrees: %s" % row.degrees, file=stderr)
+            assert not badnodes
+            assert row.strays == 0
         print("FINISHING RING AUDIT", file=stderr)
 
     def __str__(self):
@@ -74,6 +74,26 @@ class LinkDiscoveryListener(DiscoveryListener):
     prio = DiscoveryListener.PRI_OPTION
     wanted_packets = ("__LinkDiscovery", "netconfig")
 
+    # A switch's port NICs and the NICs they're wired to - in one round trip
+    SWITCH_PORTS_QUERY = """
+    MATCH (switch)-[:nicowner]->(port:Class_NICNode) WHERE ID(switch) = $switch_id
+    OPTIONAL MATCH (port)-[:wiredto]-(peer:Class_NICNode)
+    RETURN port, collect(peer) AS peers
+    """
+    # A drone's NICs and the switch ports they're wired to - in one round trip
+    DRONE_NICS_QUERY = """
+    MATCH (drone)-[:nicowner]->(nic:Class_NICNode) WHERE ID(drone) = $drone_id
+    OPTIONAL MATCH (nic)-[:wiredto]-(port:Class_NICNode)
+    RETURN nic, collect(port) AS ports
+    """
+    # Forget wiring which has moved elsewhere
+    SEPARATE_WIRING_QUERY = """
+    UNWIND $pairs AS pair
+    MATCH (nic:Class_NICNode)-[rel:wiredto]-(other:Class_NICNode)
+    WHERE ID(nic) = pair[0] AND ID(other) = pair[1]
+    DELETE rel
+    """
+
     # R0914:684,4:LinkDiscoveryListener.processpkt: Too many local variables (25/15)
     # pylint: disable=R0914
 
@@ -118,13 +138,11 @@ class LinkDiscoveryListener(DiscoveryListener):
     def processpkt_linkdiscovery(self, drone, _unused_srcaddr, jsonobj):
         "Add Low Level (Link Level) discovery data to the database"
         #
-        #   This code doesn't yet deal with moving network connections around
-        #   it is certain that it won't delete the old information and replace it
-        #   There are two possibilities:
+        #   When network connections move around, _process_ports() replaces the old wiring:
         #       We are connecting to a switch port which is previously connected:
         #           Drop any wiredto connection that already exists to that port
         #       We are connecting to somewhere different
-        #           Drop any wiredto relationship between the switch port and us
+        #           Drop any wiredto relationship between our NIC and its old port
         #
         data = jsonobj["data"]
         # print('SWITCH JSON: %s' % str(data), file=sys.stderr)
@@ -134,6 +152,9 @@ class LinkDiscoveryListener(DiscoveryListener):
             )
             return
         chassisid = data["ChassisId"]
+        if self.forwarded_to_domain_owner(drone, jsonobj):
+            # Switches and their NICs are shared by our domain - its owner updates them
+            return
         attrs = {}
         for key in data.keys():
             if key == "ports" or key == "SystemCapabilities":
@@ -209,8 +230,29 @@ class LinkDiscoveryListener(DiscoveryListener):
             self.store.relate_new(switch, CMAconsts.REL_nicowner, mgmtnic)
 
     def _process_ports(self, drone, switch, chassisid, ports):
-        "Process the ports listed in JSON data from switch discovery"
+        """Process the ports listed in JSON data from switch discovery.
+        We load the switch's port NICs and our drone's NICs - with their wiring - using one
+        query each, then create or update only the ports whose attributes changed, and add
+        or drop only the wiredto relationships which differ from what the switch told us.
+
+        :param drone: Drone: the drone which heard from this switch
+        :param switch: SystemNode: the switch we heard from
+        :param chassisid: str: the switch's chassis id
+        :param ports: dict-like: the 'ports' section of our link discovery data
+        :return: None
+        """
+        switchports = {}
+        for row in self.store.load_cypher_query(
+            self.SWITCH_PORTS_QUERY, {"switch_id": switch.association.node_id}
+        ):
+            switchports[row.port.macaddr] = (row.port, row.peers)
+        dronenics = {}  # Indexed by interface name
+        for row in self.store.load_cypher_query(
+            self.DRONE_NICS_QUERY, {"drone_id": drone.association.node_id}
+        ):
+            dronenics[row.nic.ifname] = (row.nic, row.ports)
 
+        stale_wiring = []
         for portname in ports.keys():
             attrs = {}
             thisport = ports[portname]
@@ -219,28 +261,47 @@ class LinkDiscoveryListener(DiscoveryListener):
                 if isinstance(value, pyNetAddr):
                     value = str(value)
                 attrs[key] = value
+            attrs["json"] = str(thisport)
+            attrs["ifname"] = thisport["PortId"]
             if "sourceMAC" in thisport:
-                nicmac = thisport["sourceMAC"]
+                nicmac = str(thisport["sourceMAC"])
             else:
                 nicmac = chassisid  # Hope that works ;-)
-            nicnode = self.store.load_or_create(
-                NICNode,
-                domain=drone.domain,
-                macaddr=nicmac,
-                scope="global",
-                json=str(thisport),
-                ifname=thisport["PortId"],
-                **attrs
-            )
-            self.store.relate(switch, CMAconsts.REL_nicowner, nicnode, {"causes": True})
+            if nicmac in switchports:
+                nicnode, peers = switchports[nicmac]
+                # Setting an attribute to the value it already has writes nothing
+                for attr, value in attrs.items():
+                    setattr(nicnode, attr, value)
+            else:
+                nicnode = self.store.load_or_create(
+                    NICNode, domain=drone.domain, macaddr=nicmac, scope="global", **attrs
+                )
+                self.store.relate(switch, CMAconsts.REL_nicowner, nicnode, {"causes": True})
+                peers = []
+                switchports[nicmac] = (nicnode, peers)
             try:
                 assert thisport["ConnectsToHost"] == drone.designation
                 matchif = thisport["ConnectsToInterface"]
-                niclist = self.store.load_related(drone, CMAconsts.REL_nicowner)
-                for dronenic in niclist:
-                    # print("NIClist NIC: %s::%s" % (type(dronenic), dronenic), file=sys.stderr)
-                    if dronenic.ifname == matchif:
-                        self.store.relate_new(nicnode, CMAconsts.REL_wiredto, dronenic)
-                        break
             except KeyError:
-                self.log.error("OOPS! got an exception...")
+                self.log.error("Port %s from switch %s: no connection info" % (portname, chassisid))
+                continue
+            if matchif not in dronenics:
+                continue
+            dronenic, oldports = dronenics[matchif]
+            nic_id = nicnode.association.node_id
+            dronenic_id = dronenic.association.node_id
+            if dronenic_id not in [peer.association.node_id for peer in peers]:
+                self.store.relate(nicnode, CMAconsts.REL_wiredto, dronenic)
+                peers.append(dronenic)
+            # Our NIC has moved here from some other port
+            for oldport in oldports:
+                if oldport.association.node_id != nic_id:
+                    stale_wiring.append([dronenic_id, oldport.association.node_id])
+            # Someone else used to be connected to this port. When we don't know the port's own
+            # MAC address, all its ports share one NIC - so we can't tell who's moved where.
+            if "sourceMAC" in thisport:
+                for peer in peers:
+                    if peer.association.node_id != dronenic_id:
+                        stale_wiring.append([nic_id, peer.association.node_id])
+        if stale_wiring:
+            self.store.update_cypher_query(self.SEPARATE_WIRING_QUERY, {"pairs": stale_wiring})
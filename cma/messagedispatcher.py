@@ -28,29 +28,46 @@ import os
 import sys
 import traceback
 import gc
+import time
+import collections
 from datetime import datetime
 import inject
 from cmadb import CMAdb
 from transaction import NetTransaction
 from dispatchtarget import DispatchTarget
+from droneinfo import Drone
+from discoverycontext import DiscoveryContext
+from assimtrace import Trace
+from cypherprofile import CypherProfiler, DEFAULT_REPORT_FILE
 from frameinfo import FrameSetTypes
 from AssimCtypes import proj_class_live_object_count, proj_class_max_object_count
 from AssimCclasses import pyAssimObj, dump_c_objects
+import assimglib as glib
+
+DISPATCH_TRACE = Trace.category("dispatch")
 
 
 class MessageDispatcher(object):
     "We dispatch incoming messages where they need to go."
 
+    # How many recent dispatch times we keep per FrameSet type for our percentiles
+    latency_samples = 10000
+
     @inject.params(store="Store")
     def __init__(self, dispatchtable, store=None, logtimes=False, encryption_required=True):
         "Constructor for MessageDispatcher - requires a dispatch table as a parameter"
         self.dispatchtable = dispatchtable
         self.default = DispatchTarget()
         self.io = None
+        self.config = None
+        self.join_timer = None
+        self.death_timer = None
+        self.schedule_timer = None
         self.store = store
         self.dispatchcount = 0
         self.logtimes = logtimes or CMAdb.debug
         self.encryption_required = encryption_required
+        self.dispatch_stats = {}
 
     def dispatch(self, origaddr, frameset):
         """
@@ -63,21 +80,34 @@ class MessageDispatcher(object):
         """
         self.dispatchcount += 1
         assert self.io is not None
+        dispatchstart = time.time()
+        statements = self.store.stats["statements"]
 
         try:
             # The __enter__ functions are called in the order given, but the exits are called in the
             # opposite order they're listed. The exits are what commit the transactions...
             # As a result, the idempotent NetTransaction is committed first...
-            print("Starting new transaction", file=sys.stderr)
-            with self.store.db.begin(autocommit=False) as self.store.db_transaction, NetTransaction(
+            if DISPATCH_TRACE.debug:
+                DISPATCH_TRACE.emit("Starting new transaction")
+            with CypherProfiler.calling(frameset.fstypestr()), self.store.db.begin(
+                autocommit=False
+            ) as self.store.db_transaction, NetTransaction(
                 self.io, encryption_required=self.encryption_required
             ) as CMAdb.net_transaction:
-                print(f"STARTING ACTION: {frameset.fstypestr()}", file=sys.stderr)
+                if DISPATCH_TRACE.info:
+                    DISPATCH_TRACE.emit("STARTING ACTION: %s", frameset.fstypestr())
                 self._try_dispatch_action(origaddr, frameset)
-                print(f"END OF ACTION: {frameset.fstypestr()}", file=sys.stderr)
-            print(f"END OF DB TRANSACTION: {frameset.fstypestr()}", file=sys.stderr)
+            CMAdb.TheOneRing.commit_joins()
+            if CMAdb.admission is not None:
+                CMAdb.admission.commit_deaths()
+            if CMAdb.shard is not None:
+                CMAdb.shard.send_deferred()
+            if DISPATCH_TRACE.debug:
+                DISPATCH_TRACE.emit("END OF DB TRANSACTION: %s", frameset.fstypestr())
             if (self.dispatchcount % 100) == 1:
                 self._check_memory_usage()
+                self._log_dispatch_summary()
+                self._save_cypher_profile()
         # W0703 == Too general exception catching...
         # pylint: disable=W0703
         except Exception as e:
@@ -93,21 +123,240 @@ class MessageDispatcher(object):
             # pylint: disable=W0703
             except Exception as e2:
                 CMAdb.log.critical("Database transaction retry failed: %s" % str(e2))
-        print('TRANSACTIONs COMMITTED!', file=sys.stderr)
-        if True or CMAdb.debug:
+        if CMAdb.debug:
             fstypename = FrameSetTypes.get(frameset.get_framesettype())[0]
             CMAdb.log.debug(
                 "MessageDispatcher - ACKing %s message from %s" % (fstypename, origaddr)
             )
         # We want to ack the packet even in the failed case - retries are unlikely to help
         # and we need to avoid getting stuck in a loop retrying it forever...
-        print('ACKING MESSAGE', file=sys.stderr)
         self.io.ackmessage(origaddr, frameset)
-        print('MESSAGE ACKED', file=sys.stderr)
         if not self.store.db_transaction.finished:
             CMAdb.log.critical("MessageDispatcher: DB transaction NOT committed!")
             self.store.db_transaction.finish()
-        print('DISPATCH DONE', file=sys.stderr)
+        self.store.bump_epochs()
+        if self.join_timer is None and CMAdb.TheOneRing.pending_join_count() > 0:
+            self._start_join_timer()
+        admission = CMAdb.admission
+        if self.death_timer is None and admission is not None and admission.batch_deaths():
+            if admission.pending_death_count() > 0:
+                self._start_death_timer()
+        scheduler = CMAdb.discovery_scheduler
+        if self.schedule_timer is None and scheduler is not None and scheduler.pending_count() > 0:
+            self._start_schedule_timer()
+        self._record_dispatch(
+            frameset.get_framesettype(),
+            time.time() - dispatchstart,
+            self.store.stats["statements"] - statements,
+        )
+        if DISPATCH_TRACE.info:
+            DISPATCH_TRACE.emit("DISPATCH DONE: %s from %s", frameset.fstypestr(), origaddr)
+
+    def _record_dispatch(self, fstype, elapsed, statements):
+        """Record how long it took to dispatch a FrameSet and how many Neo4j statements it took
+
+        :param fstype: int: FrameSet type
+        :param elapsed: float: dispatch time in seconds
+        :param statements: int: number of Cypher statements we ran
+        :return: None
+        """
+        stats = self.dispatch_stats.get(fstype)
+        if stats is None:
+            stats = {
+                "count": 0,
+                "statements": 0,
+                "totaltime": 0.0,
+                "samples": collections.deque(maxlen=MessageDispatcher.latency_samples),
+            }
+            self.dispatch_stats[fstype] = stats
+        stats["count"] += 1
+        stats["statements"] += statements
+        stats["totaltime"] += elapsed
+        stats["samples"].append(elapsed)
+
+    def dispatch_summary(self, percentiles=(50, 90, 99)):
+        """Summarize our dispatch statistics by FrameSet type.
+        Percentiles are computed over the most recent 'latency_samples' dispatches of each type.
+
+        :param percentiles: [int]: which latency percentiles to report
+        :return: {str: dict}: FrameSet type name -> count, mean/percentile/max latencies (ms)
+                 and Cypher statements per packet
+        """
+        summary = {}
+        for fstype, stats in self.dispatch_stats.items():
+            samples = sorted(stats["samples"])
+            result = {
+                "count": stats["count"],
+                "mean_ms": 1000.0 * stats["totaltime"] / stats["count"],
+                "max_ms": 1000.0 * samples[-1],
+                "statements_per_packet": float(stats["statements"]) / stats["count"],
+            }
+            for pct in percentiles:
+                # Nearest-rank percentile
+                rank = max(int(round(pct / 100.0 * len(samples))) - 1, 0)
+                result["p%d_ms" % pct] = 1000.0 * samples[min(rank, len(samples) - 1)]
+            summary[FrameSetTypes.get(fstype)[0]] = result
+        return summary
+
+    def _log_dispatch_summary(self):
+        "Put a summary of our dispatch statistics in the logs"
+        for fstypename, result in sorted(self.dispatch_summary().items()):
+            CMAdb.log.info(
+                "Dispatch stats for %s: %d packets, mean %.1fms, p50 %.1fms, p90 %.1fms,"
+                " p99 %.1fms, max %.1fms, %.1f statements/packet"
+                % (
+                    fstypename,
+                    result["count"],
+                    result["mean_ms"],
+                    result["p50_ms"],
+                    result["p90_ms"],
+                    result["p99_ms"],
+                    result["max_ms"],
+                    result["statements_per_packet"],
+                )
+            )
+
+    def _save_cypher_profile(self):
+        """Capture plans for our slowest Cypher statements, and save the Cypher profile
+        for 'assimcli cypherprofile'
+        """
+        profiler = self.store.profiler
+        CMAdb.log.info("Cypher profile: %s" % profiler.summary())
+        profile_config = self.config.get("cypher_profile", {}) if self.config else {}
+        try:
+            profiler.capture_plans(self.store)
+            profiler.save(profile_config.get("report_file", DEFAULT_REPORT_FILE))
+        except (IOError, OSError) as oops:
+            CMAdb.log.warning("Could not save Cypher profile: %s" % oops)
+
+    def _start_join_timer(self):
+        """Start the timer which joins the drones queued up by DispatchSTARTUP to TheOneRing.
+        It repeats every window_ms milliseconds, and costs nothing when nothing is queued.
+        """
+        window_ms = self.config.get("ring_join", {}).get("window_ms", 0)
+        self.join_timer = glib.GMainTimeout(
+            max(window_ms, 1), MessageDispatcher._join_timer_callback, self
+        )
+
+    @staticmethod
+    def _join_timer_callback(dispatcher):
+        "glib timer callback: join any queued drones to TheOneRing"
+        if CMAdb.TheOneRing.pending_join_count() > 0:
+            dispatcher.flush_pending_joins()
+        return True
+
+    def flush_pending_joins(self):
+        """
+        Join all the drones queued up by DispatchSTARTUP to TheOneRing.
+        Like dispatch(), this is done in its own database and network transaction.
+
+        :return: None
+        """
+        self.run_transaction("Batched ring join", self._flush_pending_joins)
+
+    def _flush_pending_joins(self):
+        "Join all the drones queued up by DispatchSTARTUP to TheOneRing - inside a transaction"
+        joinstart = datetime.now()
+        joincount = CMAdb.TheOneRing.pending_join_count()
+        startup = self.dispatchtable[FrameSetTypes.STARTUP]
+        for drone in CMAdb.TheOneRing.flush_pending_joins():
+            startup.drone_joined(drone)
+        CMAdb.log.info(
+            "Batched join of %d drones to %s: %s"
+            % (joincount, CMAdb.TheOneRing, datetime.now() - joinstart)
+        )
+        if CMAdb.debug:
+            CMAdb.TheOneRing.AUDIT()
+
+    def _start_death_timer(self):
+        """Start the timer which processes the deaths our AdmissionController collects.
+        Like our join timer, it repeats every death_window_ms milliseconds.
+        """
+        self.death_timer = glib.GMainTimeout(
+            max(CMAdb.admission.death_window_ms, 1), MessageDispatcher._death_timer_callback, self
+        )
+
+    @staticmethod
+    def _death_timer_callback(dispatcher):
+        "glib timer callback: process any deaths collected by our AdmissionController"
+        if CMAdb.admission.pending_death_count() > 0:
+            dispatcher.flush_pending_deaths()
+        return True
+
+    def flush_pending_deaths(self):
+        """
+        Process all the deaths collected by our AdmissionController as one batch.
+        Like dispatch(), this is done in its own database and network transaction.
+
+        :return: None
+        """
+        self.run_transaction("Batched death reports", self._flush_pending_deaths)
+
+    def _flush_pending_deaths(self):
+        "Process all the deaths collected by our AdmissionController - inside a transaction"
+        deathstart = datetime.now()
+        deaths = CMAdb.admission.take_pending_deaths()
+        self.dispatchtable[FrameSetTypes.HBDEAD].report_deaths(deaths)
+        CMAdb.log.info(
+            "Batch of %d death reports: %s" % (len(deaths), datetime.now() - deathstart)
+        )
+        if CMAdb.debug:
+            CMAdb.TheOneRing.AUDIT()
+
+    def _start_schedule_timer(self):
+        """Start the timer which pushes new discovery schedules from our DiscoveryScheduler.
+        Like our join timer, it repeats every window_ms milliseconds.
+        """
+        self.schedule_timer = glib.GMainTimeout(
+            max(CMAdb.discovery_scheduler.window_ms, 1),
+            MessageDispatcher._schedule_timer_callback,
+            self,
+        )
+
+    @staticmethod
+    def _schedule_timer_callback(dispatcher):
+        "glib timer callback: push any new discovery schedules to their nanoprobes"
+        if CMAdb.discovery_scheduler.pending_count() > 0:
+            dispatcher.run_transaction("Discovery schedule push", CMAdb.discovery_scheduler.flush)
+        return True
+
+    def run_transaction(self, description, action, *args):
+        """
+        Run 'action' in its own database and network transaction - the way dispatch() does
+        for incoming FrameSets. We do this for work which doesn't arrive as a FrameSet - like
+        batched ring joins and messages from our sibling CMA workers.
+
+        :param description: str: what we're doing - for our logs
+        :param action: callable(*args): what to do
+        :param args: arguments to 'action'
+        :return: None
+        """
+        try:
+            with self.store.db.begin(autocommit=False) as self.store.db_transaction, NetTransaction(
+                self.io, encryption_required=self.encryption_required
+            ) as CMAdb.net_transaction:
+                action(*args)
+            CMAdb.TheOneRing.commit_joins()
+            if CMAdb.admission is not None:
+                CMAdb.admission.commit_deaths()
+            if CMAdb.shard is not None:
+                CMAdb.shard.send_deferred()
+        # pylint: disable=W0703
+        except Exception as e:
+            CMAdb.log.critical("%s failed: exception of type %s: %s" % (description, type(e), e))
+            CMAdb.TheOneRing.abort_joins()
+            if CMAdb.admission is not None:
+                CMAdb.admission.abort_deaths()
+            if CMAdb.shard is not None:
+                CMAdb.shard.drop_deferred()
+            if CMAdb.store is not None:
+                CMAdb.store.abort()
+                Drone.flush_find_cache()
+            CMAdb.net_transaction = None
+        if not self.store.db_transaction.finished:
+            CMAdb.log.critical("MessageDispatcher: %s DB transaction NOT committed!" % description)
+            self.store.db_transaction.finish()
+        self.store.bump_epochs()
 
     # [R0912:MessageDispatcher._try_dispatch_action] Too many branches (13/12)
     # pylint: disable=R0912
@@ -124,16 +373,16 @@ class MessageDispatcher(object):
             self.dispatchtable[fstype].dispatch(origaddr, frameset)
         else:
             self.default.dispatch(origaddr, frameset)
-        print("DISPATCH COMPLETED", file=sys.stderr)
         dispatchend = datetime.now()
-        if True or self.logtimes:
+        if self.logtimes:
             CMAdb.log.info(
                 "Initial dispatch time for %s frameset: %s" % (fstype, dispatchend - dispatchstart)
             )
-            print("Initial dispatch time for %s frameset: %s"
-                  % (fstype, dispatchend - dispatchstart), file=sys.stderr)
+        if DISPATCH_TRACE.debug:
+            DISPATCH_TRACE.emit(
+                "Initial dispatch time for %s frameset: %s", fstype, dispatchend - dispatchstart
+            )
         if CMAdb.debug:
-            print("PERFORMING RING AUDIT", file=sys.stderr)
             # This is a VERY expensive call...
             # Good thing we only do it when debug is enabled...
             CMAdb.TheOneRing.AUDIT()
@@ -147,7 +396,6 @@ class MessageDispatcher(object):
             CMAdb.log.info(
                 "Total dispatch time for %s frameset: %s" % (fstype, dispatchend - dispatchstart)
             )
-        print("TRY DISPATCH ACTION RETURNING", file=sys.stderr)
 
     @staticmethod
     def _process_exception(e, origaddr, frameset):
@@ -183,9 +431,20 @@ class MessageDispatcher(object):
         CMAdb.log.info("======== End %s Message %s Exception Traceback ========" % (fstypename, e))
         print(f"======== End {fstypename} Message {e} Exception Traceback ========",
               file=sys.stderr)
+        if Trace.ring:
+            # What we were doing just before this happened
+            Trace.dump(clear=True)
+        # The drones we joined didn't join - and the deaths we processed didn't happen after all
+        CMAdb.TheOneRing.abort_joins()
+        if CMAdb.admission is not None:
+            CMAdb.admission.abort_deaths()
+        if CMAdb.shard is not None:
+            CMAdb.shard.drop_deferred()
         if CMAdb.store is not None:
             CMAdb.log.critical("Aborting Neo4j transaction %s" % CMAdb.store)
             CMAdb.store.abort()
+            # Anything we cached during this transaction might not exist any more
+            Drone.flush_find_cache()
         if CMAdb.net_transaction is not None:
             CMAdb.log.critical("Aborting network transaction %s" % CMAdb.net_transaction.tree)
             CMAdb.net_transaction = None
@@ -202,6 +461,18 @@ class MessageDispatcher(object):
         CMAdb.log.info(
             "Total/max allocated C-Objects: %s/%s" % (cobjcount, proj_class_max_object_count())
         )
+        CMAdb.log.info(Drone.find_cache_summary())
+        CMAdb.log.info("Discovery context lookups: %s" % DiscoveryContext.summary())
+        if CMAdb.store.pool is not None:
+            CMAdb.log.info("Neo4j connections: %s" % CMAdb.store.pool.summary())
+        if CMAdb.shard is not None:
+            CMAdb.log.info("CMA shard: %s" % CMAdb.shard.summary())
+        if CMAdb.warmstart is not None:
+            CMAdb.log.info("Warm-start snapshots: %s" % CMAdb.warmstart.summary())
+        if CMAdb.admission is not None:
+            CMAdb.log.info("Admission control: %s" % CMAdb.admission.summary())
+        if CMAdb.discovery_scheduler is not None:
+            CMAdb.log.info("Discovery scheduling: %s" % CMAdb.discovery_scheduler.summary())
         if gctotal < 20 and cobjcount > 5000:
             dump_c_objects()
 
@@ -216,6 +487,9 @@ class MessageDispatcher(object):
     def setconfig(self, io, config):
         "Save our configuration away.  We need it before we can do anything."
         self.io = io
+        self.config = config
+        if self.store is not None:
+            self.store.profiler.configure(config.get("cypher_profile", {}))
         self.default.setconfig(io, config)
         for msgtype in self.dispatchtable.keys():
             self.dispatchtable[msgtype].setconfig(io, config)
@@ -36,8 +36,7 @@ from sys import stderr
 import hashlib
 from monitoring import MonitoringRule, MonitorAction
 from systemnode import SystemNode
-from graphnodes import ProcessNode
-from discoverylistener import DiscoveryListener
+from discoverylistener import DiscoveryListener, TCPDiscoveryListener
 from cmaconfig import ConfigFile
 
 
@@ -56,19 +55,13 @@ class TCPDiscoveryGenerateMonitoring(DiscoveryListener):
         # self.log.debug('In TCPDiscoveryGenerateMonitoring::processpkt for %s with %s (%s)'
         #               %    (drone, _discoverychanged, str(jsonobj)))
         data = jsonobj["data"]  # The data portion of the JSON message
+        # TCPDiscoveryListener has normally already found (or created) these for this packet
+        processes = TCPDiscoveryListener.process_nodes(
+            self.store, drone, jsonobj, self.context
+        )[0]
         for procname in data.keys():  # List of nanoprobe-assigned names of processes...
             procinfo = data[procname]
-            processproc = self.store.load_or_create(
-                ProcessNode,
-                domain=drone.domain,
-                processname=procname,
-                host=drone.designation,
-                pathname=procinfo.get("exe", "unknown"),
-                argv=procinfo.get("cmdline", "unknown"),
-                uid=procinfo.get("uid", "unknown"),
-                gid=procinfo.get("gid", "unknown"),
-                cwd=procinfo.get("cwd", "/"),
-            )
+            processproc = processes[procname]
             if "listenaddrs" not in procinfo:
                 # We only monitor services, not clients...
                 continue
@@ -124,7 +117,7 @@ class TCPDiscoveryGenerateMonitoring(DiscoveryListener):
         else:
             classtype = "%s::%s" % (monitorclass, monitortype)
         # Compute interval and timeout - based on global 'config'
-        agent_params = ConfigFile.agent_params(
+        agent_params = ConfigFile.agent_params_readonly(
             self.config, "monitoring", classtype, drone.designation
         )
         # This produces the following metadata:
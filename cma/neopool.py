@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100 fileencoding=utf-8
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Pooled Neo4j connections - with separate pools for writers and readers.
+
+A Neo4jPool is a bounded set of connection slots to one or more Neo4j servers
+(py2neo.Graph objects). Every statement a Store sends outside of its transaction
+checks out a slot - and a statement's cursor keeps its slot until its results have all
+been read, or it's closed (py2neo cursors stream their rows lazily over the connection).
+When all the slots are in use,
+we wait for one (for 30 seconds by default) - and keep track of how long we waited,
+so you can tell when a pool is too small.
+
+A Neo4jRouter holds two pools: the writer pool (always the primary server) and the
+reader pool (the read replicas, when there are any - otherwise the primary again).
+Read-only Stores, and the queries run by ClientQuery, use the reader pool - so readers
+(assimcli, the query service) can't starve the CMA's packet processing of connections.
+
+Neither class knows anything about py2neo beyond calling run(), evaluate() and begin(),
+so they work just as well with a stub in place of a real database.
+"""
+from __future__ import print_function
+import time
+import threading
+import contextlib
+
+
+class Neo4jPool(object):
+    """
+    A bounded pool of connection slots to one or more (equivalent) Neo4j servers.
+    Slots are handed out round-robin across our servers.
+    """
+
+    # The CMA is single-threaded - if its own cursors hold every slot, nobody will ever
+    # release one. So by default we give up (and say so) instead of waiting forever.
+    DEFAULT_TIMEOUT = 30.0
+
+    def __init__(self, name, graphs, size, timeout=DEFAULT_TIMEOUT):
+        """
+        Create a pool of connection slots
+
+        :param name: str: name of this pool ("writer" or "reader")
+        :param graphs: [py2neo.Graph]: the servers this pool connects to
+        :param size: int: maximum number of slots in use at once
+        :param timeout: float: seconds to wait for a free slot - None means forever
+        """
+        if not graphs:
+            raise ValueError("Neo4jPool %s needs at least one database" % name)
+        if size < 1:
+            raise ValueError("Neo4jPool %s size must be positive [%s]" % (name, size))
+        self.name = name
+        self.graphs = list(graphs)
+        self.size = size
+        self.timeout = timeout
+        self._in_use = 0
+        self._next = 0
+        self._cond = threading.Condition()
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        "Reset our statistics"
+        self.stats = {
+            "checkouts": 0,  # Slots handed out
+            "waits": 0,  # Checkouts which had to wait for a free slot
+            "wait_seconds": 0.0,  # Total time spent waiting for slots
+            "max_wait_seconds": 0.0,  # Longest single wait
+            "timeouts": 0,  # Checkouts which gave up waiting
+            "max_in_use": 0,  # Most slots in use at once
+        }
+
+    @property
+    def graph(self):
+        "Return the first (primary) server in this pool - for starting transactions"
+        return self.graphs[0]
+
+    def acquire(self, timeout=None):
+        """
+        Check out a connection slot - waiting for one if need be
+
+        :param timeout: float: seconds to wait - defaults to the pool timeout
+        :return: py2neo.Graph: the server to use for this slot
+        """
+        timeout = self.timeout if timeout is None else timeout
+        with self._cond:
+            if self._in_use >= self.size:
+                start = time.time()
+                deadline = None if timeout is None else start + timeout
+                while self._in_use >= self.size:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        raise RuntimeError(
+                            "No connection free in Neo4j %s pool after %s seconds"
+                            " (%d of %d slots in use)"
+                            % (self.name, timeout, self._in_use, self.size)
+                        )
+                    self._cond.wait(remaining)
+                waited = time.time() - start
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += waited
+                self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+            self._in_use += 1
+            self.stats["checkouts"] += 1
+            self.stats["max_in_use"] = max(self.stats["max_in_use"], self._in_use)
+            graph = self.graphs[self._next % len(self.graphs)]
+            self._next += 1
+            return graph
+
+    def release(self):
+        "Return a connection slot to the pool"
+        with self._cond:
+            if self._in_use <= 0:
+                raise RuntimeError("Neo4jPool %s released more slots than it gave out" % self.name)
+            self._in_use -= 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager for using a connection slot
+
+        :param timeout: float: seconds to wait - defaults to the pool timeout
+        :return: generator(py2neo.Graph): yields the server to use
+        """
+        graph = self.acquire(timeout)
+        try:
+            yield graph
+        finally:
+            self.release()
+
+    def mean_wait(self):
+        "Return the mean time (seconds) a checkout waited for a slot"
+        return self.stats["wait_seconds"] / max(self.stats["checkouts"], 1)
+
+    def summary(self):
+        """
+        Summarize our statistics for the logs
+
+        :return: str: summary of this pool
+        """
+        fmt = "%s pool: %d/%d in use (max %d), %d checkouts, %d waits (mean %.1fms, max %.1fms)"
+        return fmt % (
+            self.name,
+            self._in_use,
+            self.size,
+            self.stats["max_in_use"],
+            self.stats["checkouts"],
+            self.stats["waits"],
+            1000.0 * self.mean_wait(),
+            1000.0 * self.stats["max_wait_seconds"],
+        )
+
+
+class PooledCursor(object):
+    """
+    Wraps a py2neo Cursor so that it keeps its Neo4jPool slot until its rows have all
+    been read - or it's closed (or goes away).
+    """
+
+    __slots__ = ("_cursor", "_pool")
+
+    def __init__(self, cursor, pool):
+        """
+        :param cursor: py2neo.Cursor: the real cursor
+        :param pool: Neo4jPool: the pool whose slot it's using
+        """
+        self._cursor = cursor
+        self._pool = pool
+
+    def forward(self, amount=1):
+        """
+        Move the cursor forward - just like py2neo.Cursor.forward()
+        We give back our slot once there's nothing left to read.
+
+        :param amount: int: how many records to move forward
+        :return: int: how many records we actually moved
+        """
+        moved = self._cursor.forward(amount)
+        if not moved:
+            self.close()
+        return moved
+
+    @property
+    def current(self):
+        "The current record - just like py2neo.Cursor.current"
+        return self._cursor.current
+
+    def __getattr__(self, name):
+        "Everything else comes from the real cursor"
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._cursor, name)
+
+    def close(self):
+        "Give our slot back to our pool - if we haven't already"
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            pool.release()
+            close = getattr(self._cursor, "close", None)
+            if close is not None:
+                close()
+
+    def __del__(self):
+        "Callers often stop reading early (maxcount) - give our slot back anyway"
+        self.close()
+
+
+class Neo4jRouter(object):
+    """
+    Routes Stores and queries to our writer or reader Neo4jPool
+    """
+
+    def __init__(
+        self,
+        primary,
+        replicas=None,
+        writer_size=10,
+        reader_size=10,
+        timeout=Neo4jPool.DEFAULT_TIMEOUT,
+    ):
+        """
+        Create our writer and reader pools
+
+        :param primary: py2neo.Graph: our primary (writable) database
+        :param replicas: [py2neo.Graph]: read replicas - if any
+        :param writer_size: int: size of the writer pool
+        :param reader_size: int: size of the reader pool
+        :param timeout: float: seconds to wait for a free slot - None means forever
+        """
+        self.writer = Neo4jPool("writer", [primary], writer_size, timeout=timeout)
+        self.reader = Neo4jPool("reader", replicas or [primary], reader_size, timeout=timeout)
+
+    def pool(self, readonly):
+        """
+        Return the pool a Store should use
+
+        :param readonly: bool: True if the Store is read-only
+        :return: Neo4jPool
+        """
+        return self.reader if readonly else self.writer
+
+    def summary(self):
+        "Summarize both our pools for the logs"
+        return "%s; %s" % (self.writer.summary(), self.reader.summary())
@@ -33,9 +33,12 @@ from AssimCtypes import CMAADDR, CONFIGNAME_CMAINIT
 from frameinfo import FrameSetTypes
 from cmadb import CMAdb
 import assimglib as glib  # We've replaced gi.repository and gobject with our own 'glib' module
+from assimtrace import Trace
+from admission import AdmissionController
 
 
 callback_save = []
+PACKET_TRACE = Trace.category("packet")
 
 # R0903 is too few public methods
 # pylint: disable=R0903
@@ -66,8 +69,19 @@ class PacketListener(object):
 
     unencrypted_fstypes = {FrameSetTypes.STARTUP}
 
-    def __init__(self, config, dispatch, io=None, encryption_required=True):
+    HOLD_INTERVAL_MS = 100  # How often we look at frameset queues held by admission control
+
+    def __init__(
+        self, config, dispatch, io=None, encryption_required=True, shard=None, admission=None
+    ):
+        """Create a PacketListener
+
+        :param shard: CMAShard: which drones we own - if we're one worker of a sharded CMA
+        :param admission: AdmissionController: rate limits for FrameSets - None means no limits
+        """
         self.config = config
+        self.shard = shard
+        self.admission = admission
         self.encryption_required = encryption_required
         if io is None:
             self.io = pyReliableUDP(config, pyPacketDecoder())
@@ -85,6 +99,8 @@ class PacketListener(object):
         #   % (self.mainloop, self.mainloop.mainloop))
         self.prio_queues = [[] for _ in range(PacketListener.LOWEST_PRIO + 1)]
         self.queue_addrs = {}  # Indexed by IP addresses - which queue is this IP in?
+        self.held_queues = []  # Frameset queues waiting for admission control
+        self.hold_timer = None
 
     @staticmethod
     def frameset_prio(frameset):
@@ -107,32 +123,95 @@ class PacketListener(object):
 
         We keep a separate hash table (queue_addrs) which associates frameset queues with
         the corresponding IP addresses.
+
+        A frameset queue which admission control is holding ('held') isn't in any priority
+        queue until hold_timer releases it.
         """
         prio = self.frameset_prio(frameset)
         if fromaddr not in self.queue_addrs:
             # Then we need to create a new frameset queue for it
-            queue = {"addr": fromaddr, "Q": [frameset], "prio": prio}
+            queue = {"addr": fromaddr, "Q": [frameset], "prio": prio, "held": False}
             self.queue_addrs[fromaddr] = queue
             self.prio_queues[prio].append(queue)
         else:
             # The frameset queue exists.  Append our frameset to the queue
             queue = self.queue_addrs[fromaddr]
+            if self.admission is not None and self._is_repeat(queue, frameset):
+                # A nanoprobe repeats its STARTUP until we answer it - one is enough
+                self.admission.note_duplicate()
+                return
             queue["Q"].append(frameset)
             oldprio = queue["prio"]
             # Do we need to move the frameset queue to a different priority queue?
-            if prio < oldprio:
+            if prio < oldprio and queue["held"]:
+                queue["prio"] = prio
+            elif prio < oldprio:
                 queue["prio"] = prio
                 self.prio_queues[oldprio].remove(queue)
                 self.prio_queues[prio].append(queue)
 
+    @staticmethod
+    def _is_repeat(queue, frameset):
+        "Return True if this unreliable frameset is already waiting in this frameset queue"
+        fstype = frameset.get_framesettype()
+        if fstype not in AdmissionController.unreliable_fstypes:
+            return False
+        return any(fs.get_framesettype() == fstype for fs in queue["Q"])
+
+    def hold_frameset(self, fromaddr, frameset):
+        """Put this frameset back at the head of its frameset queue, and hold that queue out
+        of our priority queues until hold_timer releases it. Later framesets from the same
+        address wait behind it - so they stay in order.
+
+        :param fromaddr: pyNetAddr: where 'frameset' came from
+        :param frameset: pyFrameSet: the frameset admission control wants to hold
+        :return: None
+        """
+        queue = self.queue_addrs.get(fromaddr)
+        if queue is None:
+            queue = {"addr": fromaddr, "Q": [], "prio": self.frameset_prio(frameset)}
+            self.queue_addrs[fromaddr] = queue
+        elif not queue["held"]:
+            self.prio_queues[queue["prio"]].remove(queue)
+        queue["Q"].insert(0, frameset)
+        queue["held"] = True
+        queue["prio"] = min([self.frameset_prio(fs) for fs in queue["Q"]])
+        self.held_queues.append(queue)
+        if self.hold_timer is None:
+            self.hold_timer = glib.GMainTimeout(
+                PacketListener.HOLD_INTERVAL_MS, PacketListener._hold_timer_callback, self
+            )
+
+    def release_held_queues(self):
+        "Put our held frameset queues back into their priority queues"
+        for queue in self.held_queues:
+            queue["held"] = False
+            self.prio_queues[queue["prio"]].append(queue)
+        self.held_queues = []
+
+    @staticmethod
+    def _hold_timer_callback(listener):
+        """glib timer callback: give our held framesets another chance at admission.
+        The timer keeps running only while something is still held.
+        """
+        if listener.held_queues:
+            listener.release_held_queues()
+            # pylint: disable=W0703
+            try:
+                listener.queueanddispatch()
+            except Exception as e:
+                PacketListener.process_pkt_exception(e)
+        if listener.held_queues:  # Some of them were held again
+            return True
+        listener.hold_timer = None
+        return False
+
     def dequeue_a_frameset(self):
         """Read a frameset from our frameset queue system in priority order
         We read from the highest priority queues first, moving down the
         priority scheme if there are no higher priority queues with packets to read.
         """
-        print("DEQUEUEING A FRAMESET")
         for prio_queue in self.prio_queues:
-            print('PRIORITY QUEUE: Length %d' % len(prio_queue))
             if len(prio_queue) == 0:
                 continue
             frameset_queue = prio_queue.pop(0)
@@ -250,39 +329,38 @@ class PacketListener(object):
     def _read_all_available(self):
         "Read All available framesets into our queue system"
         while True:
-            print("Calling io.recvframesets()", file=sys.stderr)
             (fromaddr, framesetlist) = self.io.recvframesets()
             # print >> stderr, ("Got FrameSet from str([%s], [%s])"
             #                       % (str(fromaddr), repr(fromaddr)))
-            print(f"Returned from io.recvframesets({fromaddr})", file=sys.stderr)
             if fromaddr is None:
                 break
             else:
                 fromstr = repr(fromaddr)
-                print(f"io.recvframesets gave({fromstr})", file=sys.stderr)
                 if CMAdb.debug:
                     CMAdb.log.debug(
                         "_read_all_available: Received FrameSet from str([%s], [%s])"
                         % (str(fromaddr), fromstr)
                     )
-            print(f"io.recvframesets Got FSList({framesetlist})", file=sys.stderr)
+            if self.shard is not None and not self.shard.owns(fromaddr):
+                # Our reuseport group steers packets to their owners - so this must be
+                # a copy of a multicast packet. One of our sibling workers will handle it.
+                self.shard.stats["foreign"] += 1
+                continue
             for frameset in framesetlist:
-                print(f"io.recvframesets Got FS({frameset})", file=sys.stderr)
+                if PACKET_TRACE.verbose:
+                    PACKET_TRACE.emit("Received FrameSet from %s: %s", fromstr, frameset)
+                elif PACKET_TRACE.debug:
+                    PACKET_TRACE.emit("Received %s from %s", frameset.fstypestr(), fromstr)
                 if CMAdb.debug:
                     CMAdb.log.debug("FrameSet Gotten ([%s]: [%s])" % (str(fromaddr),
                                                                       str(frameset)[:1024]))
                 self.enqueue_frameset(frameset, fromaddr)
-        print(f"Returning from read_all_available", file=sys.stderr)
 
     def queueanddispatch(self):
         "Queue and dispatch all available framesets in priority order"
         while True:
-            print("Calling read_all_available", file=sys.stderr)
             self._read_all_available()
-            print("About to Dequeue FrameSet from read_all_available", file=sys.stderr)
             fromaddr, frameset = self.dequeue_a_frameset()
-            print("Dequeued FrameSet from ([%s], [%s])" % (str(fromaddr), str(frameset)),
-                  file=sys.stderr)
             if fromaddr is None:
                 # print >> stderr, ('FROMADDR IS NONE IN QUEUEANDDISPATCH')
                 return
@@ -303,4 +381,19 @@ class PacketListener(object):
                     "Unencrypted %s frameset received from %s: frameset is %s"
                     % (frameset.fstypestr(), fromaddr, fsstr)
                 )
+            if self.admission is not None:
+                verdict, wait = self.admission.admit(fromaddr, frameset)
+                if verdict == AdmissionController.DEFER:
+                    if PACKET_TRACE.debug:
+                        PACKET_TRACE.emit(
+                            "Deferred %s from %s for %.1fs", frameset.fstypestr(), fromaddr, wait
+                        )
+                    continue
+                if verdict == AdmissionController.HOLD:
+                    if PACKET_TRACE.debug:
+                        PACKET_TRACE.emit(
+                            "Holding %s from %s for %.3fs", frameset.fstypestr(), fromaddr, wait
+                        )
+                    self.hold_frameset(fromaddr, frameset)
+                    continue
             self.dispatcher.dispatch(fromaddr, frameset)
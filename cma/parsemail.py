@@ -36,17 +36,17 @@ from sys import stderr
 import os
 import re
 import time
+import io
 import json
 import gzip
 
-try:
-    import io.StringIO as StringIO
-except ImportError:
-    import StringIO
 from version_utils import rpm
 import requests
 
 
+GZIP_MAGIC = b"\x1f\x8b"
+
+
 # pylint: disable=R0903
 class Mbox(object):
     """
@@ -55,9 +55,11 @@ class Mbox(object):
 
     KEYWORD_RE = re.compile(r"([^:]*): *(.*)")
 
-    def __init__(self, msg_string):
-        self._msg_string = msg_string
-        self._fileobj = StringIO.StringIO(msg_string)
+    def __init__(self, msg_source):
+        """
+        :param msg_source: str or file: mbox text - or an open (text) file to stream it from
+        """
+        self._fileobj = io.StringIO(msg_source) if isinstance(msg_source, str) else msg_source
         self.firstline = None
 
     # pylint: disable=R0912
@@ -67,7 +69,7 @@ class Mbox(object):
         :return: (dict, str) - dictionary of keywords, and string with body text
         """
         state = "init"
-        body = ""
+        body = []
         keyword = None
         keywords = {}
         if self.firstline is None:
@@ -98,20 +100,22 @@ class Mbox(object):
                         keywords[keyword] = match.group(2)
                     else:
                         print("OOPS: Line is [%s]" % line, file=stderr)
+            elif line.startswith("From "):
+                state = "init"
+                yieldval = (keywords, "".join(body))
+                keywords = {"fromline": line}
+                body = []
+                yield yieldval
             else:
-                if line.startswith("From "):
-                    state = "init"
-                    self.firstline = line
-                    yieldval = (keywords, body)
-                    keywords = {}
-                    body = ""
-                    yield yieldval
-                body += line + "\n"
+                body.append(line + "\n")
             line = self._fileobj.readline()
             if line == "":
                 break
             line = line.rstrip()
             # print('GOT LINE3 [%s] state %s' % (line, state), file=stderr)
+        if keywords:
+            # The last email in the mbox isn't followed by a "From " line
+            yield keywords, "".join(body)
 
 
 def parse_email_mbox_gz(url, cls):
@@ -121,24 +125,54 @@ def parse_email_mbox_gz(url, cls):
     :param cls: class to instantiate the announcements with
     :return: [Announcement]
     """
-    try:
-        mbox_text = gzip.GzipFile(fileobj=StringIO.StringIO(requests.get(url).content)).read()
-    except IOError as io_error:
-        if "not a gzipped file" in str(io_error).lower():
-            return
-        raise
+    content = requests.get(url).content
+    if not content.startswith(GZIP_MAGIC):
+        return
+    mboxfile = io.TextIOWrapper(
+        gzip.GzipFile(fileobj=io.BytesIO(content)), encoding="utf-8", errors="replace"
+    )
+    for announcement in parse_email_mbox(mboxfile, url, cls):
+        yield announcement
 
+
+def parse_email_mbox_file(pathname, cls):
+    """
+    Parse a local email archive in mbox format - gzipped or not.
+    The file is read (and decompressed) as we go - never all at once.
+    :param pathname: str: pathname of the mbox archive
+    :param cls: class to instantiate the announcements with
+    :return: [Announcement]
+    """
+    with open(pathname, "rb") as rawfile:
+        gzipped = rawfile.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    if gzipped:
+        mboxfile = gzip.open(pathname, "rt", encoding="utf-8", errors="replace")
+    else:
+        mboxfile = open(pathname, "r", encoding="utf-8", errors="replace")
+    with mboxfile:
+        for announcement in parse_email_mbox(mboxfile, pathname, cls):
+            yield announcement
+
+
+def parse_email_mbox(mboxfile, url, cls):
+    """
+    Parse the security announcements in an (open) email archive in mbox format
+    :param mboxfile: file: text file (or str) containing the mbox archive
+    :param url: str: URL or pathname the archive came from
+    :param cls: class to instantiate the announcements with
+    :return: [Announcement]
+    """
     bad_names = cls.KNOWN_BAD_NAMES
-    for headers, body in Mbox(mbox_text).emails():
+    for headers, body in Mbox(mboxfile).emails():
         headers["announcement-source"] = url
-        subject = headers["subject"].lower()
+        subject = headers.get("subject", "").lower()
         if (
             "bugfix" in subject
             or "errata" in subject
             or ("security" not in subject and "usn" not in subject)
         ):
             # We only care about security fixes...
-            print("Skipping %s" % subject)
+            print("Skipping %s" % subject, file=stderr)
             continue
         try:
             result = cls(url=url, text=body, metadata=headers)
@@ -174,6 +208,7 @@ class Announcement(object):
     BASE_PACKAGE_RE = re.compile("[A-Za-z_0-9]+(-[A-Za-z_+]+)*")
     SPACES_RE = re.compile("[ ]+")
     NEXTPART = re.compile("----* next part --*$", re.IGNORECASE)
+    CVE_RE = re.compile(r"CVE-[0-9]{4}-[0-9]{4,}")
     KNOWN_BAD_NAMES = {}
     MBOX_ANNOUNCEMENT_URL_FMT = None
 
@@ -207,6 +242,21 @@ class Announcement(object):
         """
         raise NotImplementedError("Abstract method _parse_text()")
 
+    def fixes(self):
+        """
+        Yield the fixed package versions this announcement provides.
+
+        :return: generator((str, str, str, str)): (distro, OS release, package, fixed version)
+        """
+        raise NotImplementedError("Abstract method fixes()")
+
+    def cves(self):
+        """
+        Return the CVEs this announcement mentions
+        :return: [str]: sorted list of CVE names
+        """
+        return sorted(set(self.CVE_RE.findall(self._text)))
+
     def _get_file(self):
         """
         Returns the text value from a given file
@@ -488,7 +538,7 @@ class CentOSAnnouncement(Announcement):
         sections["patches"] = {}
         for section_name in self.PATCHES:
             if section_name in sections:
-                this_sect = " ".join(sections[section_name])
+                this_sect = " ".join(sections[section_name]).strip()
                 this_sect = self.SPACES_RE.split(this_sect)
                 for index in range(0, len(this_sect), 2):
                     if this_sect[index] == "":
@@ -548,6 +598,17 @@ class CentOSAnnouncement(Announcement):
             raise ValueError("No patches in %s", self.url)
         return sections
 
+    def fixes(self):
+        """
+        Yield the fixed (binary) package versions this announcement provides.
+
+        :return: generator((str, str, str, str)): (distro, OS release, package, fixed version)
+        """
+        for patchfile, patch in self.data["patches"].items():
+            if patch["arch"] != "src":
+                package = self.rpm_version_info(patchfile)
+                yield patch["os"], patch["osrel"], package.name, patch["version"]
+
     @staticmethod
     def guess_other_urls(url):
         """
@@ -664,7 +725,7 @@ class UbuntuAnnouncement(Announcement):
                 unsupported = True
                 continue
             if section_name in sections:
-                this_sect = " ".join(sections[section_name])
+                this_sect = " ".join(sections[section_name]).strip()
                 this_sect = self.SPACES_RE.split(this_sect)
                 for index in range(0, len(this_sect), 2):
                     if this_sect[index] == "":
@@ -690,6 +751,17 @@ class UbuntuAnnouncement(Announcement):
             raise ValueError("No patches in %s", self.url)
         return sections
 
+    def fixes(self):
+        """
+        Yield the fixed package versions this announcement provides.
+
+        :return: generator((str, str, str, str)): (distro, OS release, package, fixed version)
+        """
+        for patch, version in self.data["patches"].items():
+            package, osrel = patch.split("::", 1)
+            distro, release = osrel.split()[:2]
+            yield distro, release, package, version
+
 
 # pylint: disable=R0912,R0914
 def analyze_all_mbox_vulnerabilities(years, announcement_cls):
@@ -745,8 +817,7 @@ def analyze_all_mbox_vulnerabilities(years, announcement_cls):
                 date_key = (vulnerability.data["epoch_time"], announcement_name)
                 mbox_archive_by_date[date_key] = vulnerability
                 mbox_archive_by_name[announcement_name] = vulnerability
-    keys = mbox_archive_by_date.keys()
-    keys.sort(reverse=True)
+    keys = sorted(mbox_archive_by_date.keys(), reverse=True)
     #  print('\n'.join([str(key) for key in keys]))
     release_patches = {}
     for _, announcement_name in keys:
@@ -760,15 +831,13 @@ def analyze_all_mbox_vulnerabilities(years, announcement_cls):
                 continue
             package_url = patch["package"]
             release_patches[osrel][base_package] = (patch_name, announcement_name, package_url)
-    releases = release_patches.keys()
-    releases.sort()
+    releases = sorted(release_patches.keys())
     current_announcements = {}
     better_urls = {}
     unknown = "**Unknown**"
     for release in releases:
         #  print("==== %s ============" % release)
-        package_names = release_patches[release].keys()
-        package_names.sort()
+        package_names = sorted(release_patches[release].keys())
         for package_name in package_names:
             package_info = release_patches[release][package_name]
             #  print("%s => %s" % (package_name, release_patches[release][package_name]))
@@ -797,5 +866,6 @@ def analyze_all_mbox_vulnerabilities(years, announcement_cls):
     return current_announcements.items()
 
 
-analyze_all_mbox_vulnerabilities((2018, 2017, 2016), CentOSAnnouncement)
-analyze_all_mbox_vulnerabilities((2018,), UbuntuAnnouncement)
+if __name__ == "__main__":
+    analyze_all_mbox_vulnerabilities((2018, 2017, 2016), CentOSAnnouncement)
+    analyze_all_mbox_vulnerabilities((2018,), UbuntuAnnouncement)
@@ -35,6 +35,7 @@ import time
 import re
 import collections
 import operator
+import threading
 import inject
 from neobolt.exceptions import ServiceUnavailable
 from graphnodes import GraphNode, registergraphclass
@@ -42,12 +43,147 @@ from AssimCclasses import pyConfigContext, pyNetAddr
 from AssimCtypes import ADDR_FAMILY_IPV6, ADDR_FAMILY_IPV4, ADDR_FAMILY_802
 from assimjson import JSONtree
 from bestpractices import BestPractices
+from scorerollup import ScoreRollups
 from cmadb import CMAdb
 from droneinfo import Drone
 from consts import CMAconsts
+from store import Store
 from invariant_data import SQLiteInstance
 
 
+class QueryResultCache(object):
+    """An LRU cache of (filtered JSON) ClientQuery results.
+    Each result is tagged with the Store.epoch_stamp() of the labels its query depends on
+    when it started running. When a commit modifies nodes with any of those labels,
+    the stamp changes and the result is stale.
+    Epochs only see commits made in this process. Results also expire after 'maxage'
+    seconds - which bounds how long we can miss changes made by other processes.
+    It's thread-safe - so concurrent query services can share it.
+    """
+
+    def __init__(self, maxentries=256, maxbytes=1024 * 1024, maxage=10.0):
+        """
+        :param maxentries: int: maximum number of results to keep
+        :param maxbytes: int: results larger than this aren't cached
+        :param maxage: float: seconds a result stays valid - None means forever
+        """
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.maxage = maxage
+        self.entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.oversize = 0
+
+    def lookup(self, key, stamp):
+        """
+        Return the cached result for 'key' - if it's still valid
+
+        :param key: tuple: what we're looking for
+        :param stamp: tuple: current Store.epoch_stamp() for the query
+        :return: [str]: the JSON strings of the result, or None
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            oldstamp, created, chunks = entry
+            if oldstamp != stamp or (
+                self.maxage is not None and time.time() - created > self.maxage
+            ):
+                del self.entries[key]
+                self.stale += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return chunks
+
+    def cache_results(self, key, stamp, resultiter):
+        """
+        Generator which yields the strings from 'resultiter' - and caches them once
+        they've all been read (unless they're too large).
+        If our consumer stops early (it only wanted one page), we read the rest of the
+        results when it closes us - so later pages come from our cache.
+
+        :param key: tuple: where to cache them
+        :param stamp: tuple: Store.epoch_stamp() taken before the query started
+        :param resultiter: iterator yielding JSON strings
+        :return: generator yielding the same JSON strings
+        """
+        created = time.time()
+        chunks = []
+        size = 0
+        resultiter = iter(resultiter)
+        try:
+            for chunk in resultiter:
+                if chunks is not None:
+                    chunks, size = self._add_chunk(chunks, size, chunk)
+                yield chunk
+        except GeneratorExit:
+            # pylint: disable=W0703
+            try:
+                for chunk in resultiter:
+                    chunks, size = self._add_chunk(chunks, size, chunk)
+                    if chunks is None:
+                        break
+            except Exception:
+                chunks = None
+            self._store(key, stamp, created, chunks)
+            raise
+        self._store(key, stamp, created, chunks)
+
+    def _add_chunk(self, chunks, size, chunk):
+        """
+        Add this chunk to the ones we're collecting - unless that makes them too large
+
+        :return: ([str], int): the chunks (None if they're too large) and their size
+        """
+        if chunks is None:
+            return None, size
+        size += len(chunk)
+        if size > self.maxbytes:
+            with self._lock:
+                self.oversize += 1
+            return None, size
+        chunks.append(chunk)
+        return chunks, size
+
+    def _store(self, key, stamp, created, chunks):
+        "Cache these chunks - if we have them"
+        if chunks is None or self.maxentries <= 0:
+            return
+        with self._lock:
+            self.entries[key] = (stamp, created, chunks)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxentries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Forget all our cached results"""
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Return our statistics
+
+        :return: {str: number}: hits, misses, stale and oversize counts, hit rate, entries
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "oversize": self.oversize,
+            "hitrate": float(self.hits) / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+        }
+
+
 @registergraphclass
 class ClientQuery(GraphNode):
     """This class defines queries which can be requested from clients (typically JavaScript)
@@ -55,6 +191,8 @@ class ClientQuery(GraphNode):
     """
 
     node_query_url = "/doquery/GetaNodeById"
+    # Shared by all our queries - set it to None to disable result caching
+    result_cache = QueryResultCache()
 
     def __init__(self, queryname, json_metadata=None):
         """Parameters
@@ -96,6 +234,9 @@ class ClientQuery(GraphNode):
         self._store = None
         self._db = None
         self._queryobj = None
+        self._param_names = None
+        self._labels = None
+        self._validators = None
         if json_metadata is None:
             self._JSON_metadata = None
         else:
@@ -129,11 +270,28 @@ class ClientQuery(GraphNode):
             self._db = db
         self._queryobj = QueryExecutor.construct_query(self._store, self._JSON_metadata)
         self.validate_json()
+        self._prepare()
+
+    def _prepare(self):
+        """Work out everything execute() needs that doesn't depend on its parameters"""
+        self._param_names = frozenset(self._queryobj.parameter_names())
+        self._labels = self._queryobj.labels()
+        paramdict = self._JSON_metadata["parameters"]
+        self._validators = {}
+        for param in paramdict.keys():
+            pinfo = paramdict[param]
+            self._validators[param] = (ClientQuery._validationmethods[pinfo["type"]], pinfo)
 
     def parameter_names(self):
         """Return the parameter names that go with this query"""
         return self._queryobj.parameter_names()
 
+    @staticmethod
+    def cache_stats():
+        """Return statistics from our result cache - or None if we're not caching"""
+        cache = ClientQuery.result_cache
+        return None if cache is None else cache.stats()
+
     def execute(
         self,
         executor_context,
@@ -143,12 +301,13 @@ class ClientQuery(GraphNode):
         elemsonly=False,
         **params
     ):
-        """Execute the query and return an iterator that produces sanitized (filtered) results"""
+        """Execute the query and return an iterator that produces sanitized (filtered) results
+        Results may come from our result cache - if nothing they depend on has changed.
+        """
         if self._db is None:
             raise ValueError("query must be bound to a Store")
 
-        queryobj = QueryExecutor.construct_query(self._store, self._JSON_metadata)
-        qparams = queryobj.parameter_names()
+        qparams = self._param_names
         for pname in qparams:
             if pname not in params:
                 raise ValueError(
@@ -160,10 +319,26 @@ class ClientQuery(GraphNode):
                     'Excess parameter "%s" supplied for %s query' % (pname, self.queryname)
                 )
         fixedparams = self.validate_parameters(params)
-        resultiter = queryobj.result_iterator(fixedparams)
-        return self.filter_json(
+        cache = ClientQuery.result_cache
+        if cache is not None:
+            key = (
+                self.queryname,
+                id(self._db),
+                tuple(sorted((name, repr(value)) for name, value in fixedparams.items())),
+                (executor_context, idsonly, expandjson, maxjson, elemsonly),
+            )
+            # Take the stamp first - so commits made while we're running make our result stale
+            stamp = Store.epoch_stamp(self._labels)
+            chunks = cache.lookup(key, stamp)
+            if chunks is not None:
+                return iter(chunks)
+        resultiter = self._queryobj.result_iterator(fixedparams)
+        resultiter = self.filter_json(
             executor_context, idsonly, expandjson, maxjson, resultiter, elemsonly
         )
+        if cache is None:
+            return resultiter
+        return cache.cache_results(key, stamp, resultiter)
 
     def supports_cmdline(self, language="en"):
         """Return True if this query supports command line formatting"""
@@ -354,21 +529,22 @@ class ClientQuery(GraphNode):
         """
         parameters is a Dict-like object containing parameter names and values
         """
+        if self._validators is None:
+            self._queryobj = QueryExecutor.construct_query(self._store, self._JSON_metadata)
+            self._prepare()
         # Let's see if all the parameters were supplied
-        paramdict = self._JSON_metadata["parameters"]
-        queryobj = QueryExecutor.construct_query(self._store, self._JSON_metadata)
-        for param in queryobj.parameter_names():
+        for param in self._param_names:
             if param not in parameters:
                 raise ValueError("Parameter %s not supplied" % param)
         # Let's see if any extraneous parameters were supplied
+        validators = self._validators
         for param in parameters.keys():
-            if param not in paramdict:
+            if param not in validators:
                 raise ValueError("Invalid Parameter %s supplied" % param)
         result = {}
         for param in parameters.keys():
-            value = parameters[param]
-            canonvalue = ClientQuery._validate_value(param, paramdict[param], value)
-            result[param] = canonvalue
+            validator, pinfo = validators[param]
+            result[param] = validator(param, pinfo, parameters[param])
         return result
 
     @staticmethod
@@ -551,8 +727,9 @@ class ClientQuery(GraphNode):
         return ret
 
     @staticmethod
-    def load_tree(store, rootdirname, followlinks=False):
-        """Returns a generator that will returns all the Queries in that directory structure"""
+    def query_files(rootdirname, followlinks=False):
+        """Returns a generator that returns (queryname, pathname) for all the query files
+        in that directory structure"""
         tree = os.walk(rootdirname, topdown=True, onerror=None, followlinks=followlinks)
         rootprefixlen = len(rootdirname) + 1
         for walktuple in tree:
@@ -561,14 +738,18 @@ class ClientQuery(GraphNode):
             prefix = dirpath[rootprefixlen:]
             filenames.sort()
             for filename in filenames:
-                queryname = prefix + filename
-                path = os.path.join(dirpath, filename)
                 if filename.startswith("."):
                     continue
-                try:
-                    yield ClientQuery.load_from_file(store, path, queryname)
-                except ValueError as e:
-                    print("%s is invalid: %s" % (path, str(e)), file=stderr)
+                yield prefix + filename, os.path.join(dirpath, filename)
+
+    @staticmethod
+    def load_tree(store, rootdirname, followlinks=False):
+        """Returns a generator that will returns all the Queries in that directory structure"""
+        for queryname, path in ClientQuery.query_files(rootdirname, followlinks):
+            try:
+                yield ClientQuery.load_from_file(store, path, queryname)
+            except ValueError as e:
+                print("%s is invalid: %s" % (path, str(e)), file=stderr)
 
     @staticmethod
     def load_directory(store, directoryname):
@@ -591,6 +772,7 @@ def grab_category_scores(categories=None, domains=None, debug=False, store=None)
     and totals by drone/category
     Categories is None, a desired category, or a list of desired categories.
     domains is None, a desired domain, or a list of desired domains.
+    This looks at every Drone - ScoreRollups.totals() is much cheaper when it's enough.
     """
     if domains is None:
         cypher = """MATCH(drone:Class_Drone) RETURN drone"""
@@ -685,6 +867,12 @@ class QueryExecutor(object):
         """
         raise NotImplementedError("QueryExecutor is an abstract class")
 
+    def labels(self):
+        """We return a sorted tuple of the graph labels our results depend on.
+        We return None if they could depend on anything in the graph.
+        """
+        return None
+
 
 @QueryExecutor.register
 class CypherExecutor(QueryExecutor):
@@ -693,6 +881,11 @@ class CypherExecutor(QueryExecutor):
     STATE_START = 1
     STATE_BACKSLASH = 2
     STATE_GOTDOLLAR = 3
+    # Things that look like node patterns: (var), (var:Label1:Label2), (var {...}), ()
+    # This also matches function calls like labels(n) - which just makes us more cautious.
+    NODE_PATTERN = re.compile(r"\(\s*(\w*)\s*((?::\s*\w+\s*)*)[){]")
+    # Things which can find nodes without node patterns
+    NONPATTERN_MATCH = re.compile(r"\b(START|CALL)\b", re.IGNORECASE)
 
     @staticmethod
     def construct_query(store, metadata):
@@ -736,7 +929,36 @@ class CypherExecutor(QueryExecutor):
         """We return an iterator which will yield the results of performing
         this query with these parameters.
         """
-        return self.store.load_cypher_query(self.query, params=params)
+        return self.store.load_cypher_query(self.query, params=params, reader=True)
+
+    def labels(self):
+        """We return a sorted tuple of the graph labels our results depend on.
+        We return None if they could depend on anything in the graph.
+        Every node pattern in our query has to have one of our class labels (Class_*),
+        or be a variable which has one elsewhere in the query - otherwise we give up.
+        Other labels (like subnet labels) aren't tracked by the Store for all the nodes
+        that have them, so we give up on them too.
+        """
+        if self.NONPATTERN_MATCH.search(self.query):
+            return None
+        labels = set()
+        labeled = set()
+        bare = set()
+        for var, labelstr in self.NODE_PATTERN.findall(self.query):
+            if not labelstr:
+                if var == "":
+                    return None
+                bare.add(var)
+                continue
+            for label in labelstr.split(":")[1:]:
+                label = label.strip()
+                if not label.startswith("Class_"):
+                    return None
+                labels.add(label)
+            labeled.add(var)
+        if not labels or not bare.issubset(labeled):
+            return None
+        return tuple(sorted(labels))
 
 
 @QueryExecutor.register
@@ -745,6 +967,8 @@ class PythonExec(QueryExecutor):
 
     EXECUTOR_METHODS = {}
     PARAMETERS = []
+    # The graph labels our results depend on - None means anything in the graph
+    LABELS = None
 
     def parameter_names(self):
         """We return a set of parameters that we expect.
@@ -752,6 +976,12 @@ class PythonExec(QueryExecutor):
         Return the parameter names our cypher query uses"""
         return self.PARAMETERS
 
+    def labels(self):
+        """We return a sorted tuple of the graph labels our results depend on.
+        We return None if they could depend on anything in the graph.
+        """
+        return self.LABELS
+
     @staticmethod
     def register(ourclass):
         PythonExec.EXECUTOR_METHODS[ourclass.__name__] = ourclass
@@ -785,7 +1015,7 @@ class AllPythonRuleScores(PythonExec):
         """We return an iterator which will yield the results of performing
         this query with these parameters.
         """
-        dtype_totals, _drone_totals, rule_totals = grab_category_scores(self.store)
+        dtype_totals, rule_totals = ScoreRollups.totals(self.store)
         # 0:  domain
         # 1:  category name
         # 2:  discovery-type
@@ -809,7 +1039,7 @@ class PythonSecRuleScores(PythonExec):
         """We return an iterator which will yield the results of performing
         this query with these parameters.
         """
-        dtype_totals, _drone_totals, rule_totals = grab_category_scores(categories="security")
+        dtype_totals, rule_totals = ScoreRollups.totals(self.store, categories="security")
         # 0:  domain
         # 1:  category name
         # 2:  discovery-type
@@ -873,7 +1103,7 @@ class AllPythonTotalScores(PythonExec):
     PARAMETERS = []
 
     def result_iterator(self, _params):
-        dtype_totals, _drone_totals, _rule_totals = grab_category_scores()
+        dtype_totals, _rule_totals = ScoreRollups.totals(self.store)
         for tup in yield_total_scores(dtype_totals):
             yield tup
 
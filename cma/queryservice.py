@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100 fileencoding=utf-8
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+The parts of our REST query service (flask/hello.py) that don't depend on the web framework.
+
+    StorePool       a bounded pool of read-only Stores - each with its own bound copies of
+                    our ClientQuery objects, since neither Stores nor queries are thread-safe
+    PooledStream    a response body which gives its Store back to the pool when it's done
+    RateLimiter     token buckets limiting how many requests each client can make
+    CursorCodec     opaque (signed) pagination cursors
+    stream_query    newline-delimited JSON (NDJSON) output of one page of a query's results
+
+Results are streamed as ClientQuery.filter_json() produces them - one JSON object per line -
+so memory use doesn't grow with the size of the result.
+Pages are found by skipping rows - with the ClientQuery result cache, that's cheap when
+nothing has changed.
+"""
+from __future__ import print_function
+import time
+import json
+import hmac
+import base64
+import hashlib
+import binascii
+import threading
+import contextlib
+import collections
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+class PooledStore(object):
+    """A read-only Store checked out of a StorePool - along with queries bound to it"""
+
+    def __init__(self, store, querymaker):
+        """
+        :param store: Store: our read-only Store
+        :param querymaker: callable(str, str): makes a ClientQuery from a name and JSON metadata
+        """
+        self.store = store
+        self._querymaker = querymaker
+        self._queries = {}
+
+    def query(self, queryname, metadata):
+        """
+        Return our copy of this query - bound to our Store
+
+        :param queryname: str: name of the query
+        :param metadata: str: JSON metadata for the query
+        :return: ClientQuery
+        """
+        query = self._queries.get(queryname)
+        if query is None:
+            query = self._querymaker(queryname, metadata)
+            query.bind_store(self.store)
+            self._queries[queryname] = query
+        return query
+
+
+class PooledStream(object):
+    """
+    A (WSGI) response body which gives its PooledStore back to its StorePool when it's closed.
+    WSGI servers close response bodies whether or not they ever started reading them -
+    which generators can't be relied on to notice.
+    """
+
+    def __init__(self, pool, pooled, lines):
+        """
+        :param pool: StorePool: where 'pooled' came from
+        :param pooled: PooledStore: the Store 'lines' is reading from
+        :param lines: iterator(str): response lines
+        """
+        self.pool = pool
+        self.pooled = pooled
+        self.lines = lines
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def close(self):
+        "Stop reading our lines, and give our Store back - once"
+        if self.pooled is None:
+            return
+        try:
+            if hasattr(self.lines, "close"):
+                self.lines.close()
+        finally:
+            self.pool.release(self.pooled)
+            self.pooled = None
+
+
+class StorePool(object):
+    """
+    A bounded pool of read-only Stores for concurrent query requests.
+    Each request checks out a Store for as long as it's streaming results.
+    Stores are created as they're needed - up to 'size' of them.
+    They all share the Neo4j reader connection pool of the Stores our factory makes.
+    """
+
+    def __init__(self, storefactory, querymaker, size=8, timeout=None):
+        """
+        :param storefactory: callable(): returns a new read-only Store
+        :param querymaker: callable(str, str): makes a ClientQuery from a name and JSON metadata
+        :param size: int: maximum number of Stores in use at once
+        :param timeout: float: seconds to wait for a free Store - None means forever
+        """
+        if size < 1:
+            raise ValueError("StorePool size must be positive [%s]" % size)
+        self.storefactory = storefactory
+        self.querymaker = querymaker
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._created = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self.stats = {"checkouts": 0, "waits": 0, "timeouts": 0, "max_in_use": 0}
+
+    def acquire(self, timeout=None):
+        """
+        Check out a PooledStore - waiting for one if need be
+
+        :param timeout: float: seconds to wait - defaults to the pool timeout
+        :return: PooledStore
+        """
+        timeout = self.timeout if timeout is None else timeout
+        with self._cond:
+            if self._in_use >= self.size:
+                self.stats["waits"] += 1
+                deadline = None if timeout is None else time.time() + timeout
+                while self._in_use >= self.size:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        raise RuntimeError("No query Store free after %s seconds" % timeout)
+                    self._cond.wait(remaining)
+            self._in_use += 1
+            self.stats["checkouts"] += 1
+            self.stats["max_in_use"] = max(self.stats["max_in_use"], self._in_use)
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        # Creating a Store can be slow - don't hold our lock while we do it
+        try:
+            store = self.storefactory()
+            if not store.readonly:
+                raise ValueError("StorePool Stores must be read-only")
+            return PooledStore(store, self.querymaker)
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, pooled):
+        """
+        Return a PooledStore to the pool
+
+        :param pooled: PooledStore: what acquire() gave us
+        :return: None
+        """
+        with self._cond:
+            if self._in_use <= 0:
+                raise RuntimeError("StorePool released more Stores than it gave out")
+            self._in_use -= 1
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager for using a pooled Store
+
+        :param timeout: float: seconds to wait - defaults to the pool timeout
+        :return: generator(PooledStore): yields the PooledStore to use
+        """
+        pooled = self.acquire(timeout)
+        try:
+            yield pooled
+        finally:
+            self.release(pooled)
+
+    def report(self):
+        """
+        Return our statistics
+
+        :return: {str: int}: our statistics, and how many Stores we have and are using
+        """
+        with self._cond:
+            result = dict(self.stats)
+            result.update({"size": self.size, "created": self._created, "in_use": self._in_use})
+        return result
+
+
+class RateLimiter(object):
+    """
+    Per-client token buckets. Each client gets 'burst' requests right away,
+    and then 'rate' more per second.
+    We remember at most 'maxclients' clients - forgetting the least recently seen ones.
+    A forgotten client starts over with a full bucket.
+    """
+
+    def __init__(self, rate=10.0, burst=20, maxclients=10000):
+        """
+        :param rate: float: requests per second each client may make - 0 means no limit
+        :param burst: int: how many requests each client may make at once
+        :param maxclients: int: how many clients to remember
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.maxclients = maxclients
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def allow(self, client, now=None):
+        """
+        Decide if this client may make a request now
+
+        :param client: str: who's asking (typically their address)
+        :param now: float: current time - for testing
+        :return: float: 0.0 if they may, otherwise seconds until they may
+        """
+        if self.rate <= 0:
+            self.allowed += 1
+            return 0.0
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, last = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1.0:
+                tokens -= 1.0
+                wait = 0.0
+                self.allowed += 1
+            else:
+                wait = (1.0 - tokens) / self.rate
+                self.limited += 1
+            self._buckets[client] = (tokens, now)
+            while len(self._buckets) > self.maxclients:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def report(self):
+        """
+        Return our statistics
+
+        :return: {str: number}: requests allowed and limited, and clients we remember
+        """
+        return {"allowed": self.allowed, "limited": self.limited, "clients": len(self._buckets)}
+
+
+class CursorCodec(object):
+    """
+    Makes and reads opaque pagination cursors.
+    A cursor holds the query name, its parameters, where the next page starts and how long
+    pages are. It's signed - so clients can't make up their own (or other queries') cursors.
+    Services which share a secret can read each other's cursors.
+    """
+
+    def __init__(self, secret):
+        """
+        :param secret: bytes: key for signing our cursors
+        """
+        self.secret = secret
+
+    def _signature(self, payload):
+        "Return the signature for this (encoded) cursor payload"
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()[:16]
+
+    def encode(self, queryname, params, offset, limit):
+        """
+        Make a cursor for the page of this query starting at 'offset'
+
+        :param queryname: str: name of the query
+        :param params: {str: str}: parameters to the query
+        :param offset: int: number of results before this page
+        :param limit: int: number of results per page
+        :return: str: opaque cursor
+        """
+        payload = json.dumps(
+            {"q": queryname, "p": params, "o": offset, "l": limit},
+            sort_keys=True,
+            separators=(",", ":"),
+        ).encode("utf8")
+        token = self._signature(payload) + payload
+        return base64.urlsafe_b64encode(token).decode("ascii").rstrip("=")
+
+    def decode(self, cursor, queryname):
+        """
+        Read a cursor for this query
+
+        :param cursor: str: cursor from encode()
+        :param queryname: str: query it's supposed to be for
+        :return: ({str: str}, int, int): query parameters, offset and limit
+        """
+        try:
+            token = base64.urlsafe_b64decode(str(cursor) + "=" * (-len(cursor) % 4))
+        except (binascii.Error, ValueError):
+            raise ValueError("Invalid cursor")
+        signature, payload = token[:16], token[16:]
+        if len(signature) != 16 or not hmac.compare_digest(signature, self._signature(payload)):
+            raise ValueError("Invalid cursor")
+        contents = json.loads(payload.decode("utf8"))
+        if contents["q"] != queryname:
+            raise ValueError("Cursor is for query %s - not %s" % (contents["q"], queryname))
+        return contents["p"], contents["o"], contents["l"]
+
+
+def stream_query(query, params, offset=0, limit=None, maxjson=1024, executor_context=None):
+    """
+    Execute a query, and return a generator yielding one page of its results as
+    newline-delimited JSON. Parameter errors are raised (as ValueError) by us - not
+    the generator - so they can be reported before a response is started.
+
+    :param query: ClientQuery: query (bound to a Store) to execute
+    :param params: {str: str}: parameters to the query
+    :param offset: int: number of results to skip
+    :param limit: int: maximum number of results to yield - None means all of them
+    :param maxjson: int: maximum size of JSON attributes to expand
+    :param executor_context: security context to execute the query in
+    :return: generator(str): NDJSON lines
+    """
+    results = query.execute(
+        executor_context, idsonly=False, expandjson=True, maxjson=maxjson, elemsonly=True, **params
+    )
+    return _ndjson_page(results, offset, limit)
+
+
+def _ndjson_page(results, offset, limit):
+    """
+    Generator yielding one page of (filtered) query results as NDJSON lines
+
+    :param results: iterator(str): JSON results - one per result row
+    :param offset: int: number of results to skip
+    :param limit: int: maximum number of results to yield - None means all of them
+    :return: generator(str): NDJSON lines
+    """
+    count = 0
+    try:
+        for result in results:
+            count += 1
+            if count <= offset:
+                continue
+            yield result + "\n"
+            if limit is not None and count >= offset + limit:
+                return
+    finally:
+        # A result cache reads (and caches) the rest of the results when it's closed -
+        # so the next page doesn't have to run the query again
+        close = getattr(results, "close", None)
+        if close is not None:
+            close()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100 fileencoding=utf-8
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Materialized best practice score rollups.
+
+The score queries used to load every Drone and add up their scores in Python each time
+they were run. Instead, we keep a BPScoreRollup node for each (domain, category, discovery
+type) holding the total score across all the Drones in the domain - and the total for
+each rule. BestPractices.compute_score_updates() adjusts them whenever a Drone's scores
+change, so reading the totals costs one small query - no matter how many Drones we have.
+
+Rollups are only adjusted incrementally - so if the scoring rules or algorithm change
+(or Drones are deleted), the totals can drift from what a full recomputation would say.
+'assimcli checkscores' compares them, and 'assimcli rebuildscores' recomputes them.
+
+Adjusting a rollup reads, modifies and writes its node - so in a sharded CMA only one
+worker may do it. The worker which owns the domain (ShardMap.shard_of_name()) updates its
+rollups, and the others send their adjustments to it (see BestPractices).
+"""
+from __future__ import print_function
+import json
+from graphnodes import GraphNode, registergraphclass
+
+SCORE_TOLERANCE = 1e-6  # Scores are sums of small integers - this is plenty
+
+
+@registergraphclass
+class BPScoreRollup(GraphNode):
+    """Total best practice scores for a (domain, category, discovery type) across all Drones"""
+
+    def __init__(self, domain, category, discovery_type, score=0.0, rule_scores="{}"):
+        """
+        :param domain: str: domain the Drones belong to
+        :param category: str: best practice score category ("security", etc.)
+        :param discovery_type: str: discovery type the rules evaluate
+        :param score: float: total score
+        :param rule_scores: str: JSON object mapping rule ids to their total scores
+        """
+        GraphNode.__init__(self, domain=domain)
+        self.category = category
+        self.discovery_type = discovery_type
+        self.score = float(score)
+        self.rule_scores = rule_scores
+
+    @classmethod
+    def meta_key_attributes(cls):
+        """Return our key attributes in order of significance"""
+        return ["category", "discovery_type", "domain"]
+
+    def rule_score_dict(self):
+        """Return our rule scores as a dict"""
+        return json.loads(self.rule_scores)
+
+
+class ScoreRollups(object):
+    """Maintenance and queries for our BPScoreRollup nodes"""
+
+    QUERY = """MATCH (r:Class_BPScoreRollup) RETURN r"""
+
+    @staticmethod
+    def apply(store, domain, discovery_type, oldrulescores, newrulescores):
+        """
+        Adjust the rollups for one Drone's change in scores for one discovery type
+
+        :param store: Store: our Store
+        :param domain: str: the Drone's domain
+        :param discovery_type: str: the discovery type the rules evaluate
+        :param oldrulescores: {category: {ruleid: float}}: the Drone's old scores
+        :param newrulescores: {category: {ruleid: float}}: the Drone's new scores
+        :return: {category: float}: how much each category's total changed
+        """
+        diffs = {}
+        for category in set(oldrulescores) | set(newrulescores):
+            oldscores = oldrulescores.get(category, {})
+            newscores = newrulescores.get(category, {})
+            rulediffs = {}
+            for ruleid in set(oldscores) | set(newscores):
+                diff = newscores.get(ruleid, 0.0) - oldscores.get(ruleid, 0.0)
+                if diff != 0.0:
+                    rulediffs[ruleid] = diff
+            if not rulediffs:
+                continue
+            rollup = store.load_or_create(
+                BPScoreRollup, domain=domain, category=category, discovery_type=discovery_type
+            )
+            rulescores = rollup.rule_score_dict()
+            for ruleid, diff in rulediffs.items():
+                total = rulescores.get(ruleid, 0.0) + diff
+                if abs(total) < SCORE_TOLERANCE:
+                    rulescores.pop(ruleid, None)
+                else:
+                    rulescores[ruleid] = total
+            diffs[category] = sum(rulediffs.values())
+            rollup.score = rollup.score + diffs[category]
+            rollup.rule_scores = json.dumps(rulescores, sort_keys=True)
+        return diffs
+
+    @staticmethod
+    def totals(store, categories=None, domains=None):
+        """
+        Return the rollup totals - organized the same way as grab_category_scores() does
+
+        :param store: Store: our Store
+        :param categories: str or [str]: categories that interest us - None means all
+        :param domains: str or [str]: domains that interest us - None means all
+        :return: (dtype_totals, rule_totals): scores by (domain, category, discovery-type)
+                 and by (domain, category, discovery-type, rule)
+        """
+        if isinstance(categories, str):
+            categories = (categories,)
+        if isinstance(domains, str):
+            domains = (domains,)
+        dtype_totals = {}
+        rule_totals = {}
+        for rollup in store.load_cypher_nodes(ScoreRollups.QUERY):
+            if categories and rollup.category not in categories:
+                continue
+            if domains and rollup.domain not in domains:
+                continue
+            dtype_totals.setdefault(rollup.domain, {}).setdefault(rollup.category, {})
+            dtype_totals[rollup.domain][rollup.category][rollup.discovery_type] = rollup.score
+            rule_totals.setdefault(rollup.domain, {}).setdefault(rollup.category, {})
+            rule_totals[rollup.domain][rollup.category][
+                rollup.discovery_type
+            ] = rollup.rule_score_dict()
+        return dtype_totals, rule_totals
+
+    @staticmethod
+    def _flatten(dtype_totals, rule_totals):
+        """
+        Flatten our nested totals into {(domain, category, dtype[, ruleid]): score}
+        leaving out zero scores - they're the same as missing ones.
+        """
+        result = {}
+        for domain, cats in dtype_totals.items():
+            for category, dtypes in cats.items():
+                for dtype, score in dtypes.items():
+                    result[(domain, category, dtype)] = score
+        for domain, cats in rule_totals.items():
+            for category, dtypes in cats.items():
+                for dtype, rules in dtypes.items():
+                    for ruleid, score in rules.items():
+                        result[(domain, category, dtype, ruleid)] = score
+        return {key: score for key, score in result.items() if abs(score) >= SCORE_TOLERANCE}
+
+    @staticmethod
+    def compare(store, dtype_totals, rule_totals):
+        """
+        Compare our rollups with the results of a full recomputation
+
+        :param store: Store: our Store
+        :param dtype_totals: dict: recomputed scores by (domain, category, discovery-type)
+        :param rule_totals: dict: recomputed scores by (domain, category, discovery-type, rule)
+        :return: [(key, rollup_score, recomputed_score)]: everything which differs
+        """
+        expected = ScoreRollups._flatten(dtype_totals, rule_totals)
+        actual = ScoreRollups._flatten(*ScoreRollups.totals(store))
+        result = []
+        for key in sorted(set(expected) | set(actual)):
+            ours, theirs = actual.get(key, 0.0), expected.get(key, 0.0)
+            if abs(ours - theirs) >= SCORE_TOLERANCE:
+                result.append((key, ours, theirs))
+        return result
+
+    @staticmethod
+    def rebuild(store, dtype_totals, rule_totals):
+        """
+        Replace our rollups with the results of a full recomputation.
+        The caller commits the transaction.
+
+        :param store: Store: our Store
+        :param dtype_totals: dict: recomputed scores by (domain, category, discovery-type)
+        :param rule_totals: dict: recomputed scores by (domain, category, discovery-type, rule)
+        :return: int: number of rollups we kept or created
+        """
+        count = 0
+        wanted = set()
+        for domain, cats in dtype_totals.items():
+            for category, dtypes in cats.items():
+                for dtype, score in dtypes.items():
+                    rules = rule_totals.get(domain, {}).get(category, {}).get(dtype, {})
+                    rollup = store.load_or_create(
+                        BPScoreRollup, domain=domain, category=category, discovery_type=dtype
+                    )
+                    rollup.score = float(score)
+                    rollup.rule_scores = json.dumps(
+                        {ruleid: rscore for ruleid, rscore in rules.items() if rscore != 0.0},
+                        sort_keys=True,
+                    )
+                    wanted.add((domain, category, dtype))
+                    count += 1
+        for rollup in list(store.load_cypher_nodes(ScoreRollups.QUERY)):
+            if (rollup.domain, rollup.category, rollup.discovery_type) not in wanted:
+                store.delete(rollup)
+        return count
@@ -52,8 +52,13 @@ import inject
 import py2neo
 from neobolt.exceptions import ServiceUnavailable
 from assimevent import AssimEvent
+from assimtrace import Trace
+from cypherprofile import CypherProfiler, ProfiledCursor
+from neopool import PooledCursor
 from AssimCclasses import pyNetAddr
 
+STORE_TRACE = Trace.category("store")
+
 
 # R0902: Too many instance attributes (17/10) // R0904: Too many public methods (27/20)
 # pylint: disable=R0902,R0904
@@ -121,16 +126,40 @@ class Store(object):
     do anything special for this case at the moment.
     """
 
-    debug = True
+    debug = False
     log = None
+    # GraphNode class name -> [(on_create, on_delete)] - see register_node_hooks()
+    node_hooks = {}
+    # Functions to call when a transaction is aborted - see register_node_hooks()
+    abort_hooks = []
+    # Graph mutation epochs - see bump_epochs() and epoch_stamp().
+    # They're class-wide because all the Stores in a process share the same database.
+    # mutation_epoch counts commits which changed anything at all, unlabeled_epoch counts
+    # commits which changed things we couldn't attribute to labels (update_cypher_query()),
+    # and label_epochs counts commits which changed nodes with each label.
+    mutation_epoch = 0
+    unlabeled_epoch = 0
+    label_epochs = {}
 
     # @inject.params(db='py2neo.Graph', log='logging.Logger')
-    def __init__(self, db, log, readonly=False, factory_constructor=None):
+    def __init__(
+        self,
+        db,
+        log,
+        readonly=False,
+        factory_constructor=None,
+        pool=None,
+        reader_pool=None,
+        profiler=None,
+    ):
         """
         Constructor for Transactional Write (Batch) Store objects
         ---------
         Parameters:
         db             - Database to associate with this object
+        pool           - Neo4jPool for statements run outside our transaction (or None)
+        reader_pool    - Neo4jPool for read-only queries (defaults to 'pool')
+        profiler       - CypherProfiler to record our statements with (default: a new one)
         """
         from graphnodes import GraphNode
 
@@ -149,9 +178,33 @@ class Store(object):
         self.weaknoderefs = {}
         self.factory = factory_constructor if factory_constructor else GraphNode.factory
         self.db_transaction = None
+        self.pool = pool
+        self.reader_pool = reader_pool if reader_pool is not None else pool
+        self.profiler = profiler if profiler is not None else CypherProfiler(log=log)
+        # Labels we've modified since we last bumped our epochs (None: unknown labels)
+        self.touched_labels = set()
         # print("RETURNING class %s" % self.__class__.__name__)
         return
 
+    @staticmethod
+    def register_node_hooks(classname, on_create=None, on_delete=None, on_abort=None):
+        """
+        Register functions to be called when nodes of a given class are created or deleted.
+        This lets in-memory indexes of our nodes stay in sync with the database.
+        The hooks are called as soon as the node is created or deleted in our transaction,
+        so anything which caches what they are told must also register an 'on_abort' hook.
+
+        :param classname: str: name of the GraphNode class we want to hear about
+        :param on_create: callable(Store, GraphNode): called after a node is created
+        :param on_delete: callable(Store, GraphNode, int): called after a node
+                          (with the given node id) is deleted
+        :param on_abort: callable(Store): called when a transaction is aborted
+        :return: None
+        """
+        Store.node_hooks.setdefault(classname, []).append((on_create, on_delete))
+        if on_abort is not None:
+            Store.abort_hooks.append(on_abort)
+
     def __str__(self):
         """
 
@@ -237,13 +290,17 @@ class Store(object):
         cypher = subj.association.cypher_delete_node_query()
         if self.debug:
             print("DELETE cypher:", cypher, file=stderr)
-        self.db_transaction.run(cypher).forward()
+        self._touch(subj)
+        self._run(self.db_transaction, cypher).forward()
         node_id = subj.association.node_id
         subj._association = None
         if subj in self.clients:
             self.clients.remove(subj)
         if node_id in self.weaknoderefs:
             del self.weaknoderefs[node_id]
+        for _, on_delete in Store.node_hooks.get(subj.__class__.__name__, ()):
+            if on_delete is not None:
+                on_delete(self, subj, node_id)
 
     @staticmethod
     def _get_key_values(clsobj, clsargs=None, subj=None):
@@ -287,7 +344,8 @@ class Store(object):
         cypher = subj.association.cypher_find_match_clause() + "\n" + label_cypher
         if self.debug:
             print('ADD_LABELS:"%s"' % cypher, file=stderr)
-        self.db_transaction.run(cypher).forward()
+        self._touch(subj, labels)
+        self._run(self.db_transaction, cypher).forward()
 
     def delete_labels(self, subj, labels):
         """
@@ -302,7 +360,8 @@ class Store(object):
         cypher = subj.association.cypher_find_match_clause() + "\n" + label_cypher
         if self.debug:
             print("DELETE_LABELS(%s)" % cypher, file=stderr)
-        self.db_transaction.run(cypher).forward()
+        self._touch(subj, labels)
+        self._run(self.db_transaction, cypher).forward()
 
     #
     # functions that return nodes, typically from the database
@@ -340,7 +399,7 @@ class Store(object):
             query = subj.association.cypher_find_query()
             # print('LOAD class %s: query: %s' % (cls.__name__, query), file=stderr)
             # self._log.debug('LOAD class %s: query: %s' % (cls.__name__, query))
-            node = self.db.evaluate(query)
+            node = self._evaluate(self.db, query)
             # print('QUERY RETURNED node %s' % node)
         except py2neo.GraphError as oops:
             self._log.warning("QUERY RETURNED GraphError %s" % oops)
@@ -361,21 +420,18 @@ class Store(object):
         :param clsargs: arguments to the class constructor
         :return: object: as created by the 'cls' constructor
         """
-        self.debug = True
-        if self.debug:
-            print("LOAD OR CREATE: %s" % (str(clsargs)), file=stderr)
-            self._log.debug("LOAD OR CREATE: %s" % (str(clsargs)))
+        if STORE_TRACE.debug:
+            STORE_TRACE.emit("LOAD OR CREATE: %s", clsargs)
         obj = self.load(cls, **clsargs)
-        print(f"LOAD/CREATE OBJECT: {obj}")
         if obj is not None:
-            if self.debug:
-                print("LOADED node[%s]: %s" % (str(clsargs), str(obj)))
+            if STORE_TRACE.debug:
+                STORE_TRACE.emit("LOADED node[%s]: %s", clsargs, obj)
             return obj
-        print('NOT LOADED node[%s]: %s' % (str(clsargs), str(obj)))
+        if STORE_TRACE.debug:
+            STORE_TRACE.emit("NOT LOADED node[%s] - creating it", clsargs)
         subj = self.callconstructor(cls, clsargs)
         assert subj is not None
         self._audit_weaknodes_clients()
-        print(f"LOAD clsargs WERE {clsargs}")
         self.register(subj)
         self._audit_weaknodes_clients()
         if AssimEvent.event_observation_enabled:
@@ -397,14 +453,13 @@ class Store(object):
             rel_type, direction=direction, other_node=other_association, attrs=attrs
         )
         # print("load_related: %s" % query, file=stderr)
-        if self.debug:
-            print("load_related cypher:", query, file=stderr)
-        cursor = self.db.run(query)
-        print(f"load_related cypher: {cursor}")
+        if STORE_TRACE.debug:
+            STORE_TRACE.emit("load_related cypher: %s", query)
+        cursor = self._run(self.db, query)
         while cursor.forward():
-            print(f"Yielding node : {cursor.current[0]}")
+            if STORE_TRACE.verbose:
+                STORE_TRACE.emit("load_related yielding node: %s", cursor.current[0])
             yield self._construct_obj_from_node(cursor.current[0])
-        print("returning from load_related_cypher")
 
     def load_in_related(self, subj, rel_type, obj=None, attrs=None):
         """
@@ -436,23 +491,24 @@ class Store(object):
         count = 0
         if params is None:
             params = {}
-        if self.debug or debug:
+        if debug:
             print("load_cypher_nodes: Starting query %s(%s)" % (querystr, params), file=stderr)
-        cursor = self.db.run(querystr, params)
-        print("db.run complete.", file=stderr)
+        elif STORE_TRACE.debug:
+            STORE_TRACE.emit("load_cypher_nodes: %s(%s)", querystr, params)
+        cursor = self._run(self.db, querystr, params)
         while cursor.forward():
-            print("cursor.forward complete.", file=stderr)
             item = self._construct_obj_from_node(cursor.current[0])
-            print("construct_obj_from_node complete.", file=stderr)
-            if self.debug or debug:
+            if debug:
                 print(f"YIELDING result: {item}", file=stderr)
+            elif STORE_TRACE.verbose:
+                STORE_TRACE.emit("load_cypher_nodes yielding: %s", item)
             yield item
             count += 1
             if maxcount is not None and count >= maxcount:
                 if debug:
                     print("quitting on maxcount (%d)" % count, file=stderr)
                 break
-        if self.debug or debug:
+        if debug:
             print("quitting on end of query output (%d)" % count, file=stderr)
         return
 
@@ -469,7 +525,22 @@ class Store(object):
             return node
         return None
 
-    def load_cypher_query(self, querystr, params=None, maxcount=None):
+    def load_by_node_id(self, node_id):
+        """
+        Load the object associated with the given Neo4j node id.
+        If we already have that object in memory, we return it without touching the database.
+
+        :param node_id: int: Neo4j node id
+        :return: object: associated with the node - or None
+        """
+        if node_id in self.weaknoderefs:
+            obj = self.weaknoderefs[node_id]()
+            if obj is not None and obj.association is not None:
+                return obj
+        return self.load_cypher_node("MATCH (n) WHERE ID(n) = $node_id RETURN n",
+                                     {"node_id": node_id})
+
+    def load_cypher_query(self, querystr, params=None, maxcount=None, reader=False):
         """
         Iterator returning results from a query translated into classes, and so on
         Each iteration returns a namedtuple with node fields as classes, etc.
@@ -480,35 +551,103 @@ class Store(object):
         :param querystr: str: Cypher query string
         :param params: {str,str}:  parameters for the query
         :param maxcount: int: maximum number of nodes to yield (or None)
+        :param reader: bool: True if this query may be answered by a read replica
         :return: generator(object): all the objects from the query
         """
         count = 0
         if params is None:
             params = {}
-        if self.debug:
-            print("load_cypher_query: %s" % querystr, file=stderr)
-        cursor = self.db.run(querystr, params)
-        print(f"Cypher cursor: {cursor}", file=stderr)
+        if STORE_TRACE.debug:
+            STORE_TRACE.emit("load_cypher_query: %s(%s)", querystr, params)
+        cursor = self._run(self.db, querystr, params, reader=reader)
         tuple_class = None
         while cursor.forward():
-            print(f"Cypher cursor forward... {cursor}", file=stderr)
             yieldval = []
             current = cursor.current
-            print(f"Cypher cursor current... {current}", file=stderr)
             # print('CURRENT.keys[%s]: cursor.current.keys(): %s'
             #       % (type(current), str(current.keys())))
             for elem in current:
                 yieldval.append(self._yielded_value(elem))
             if tuple_class is None:
                 tuple_class = collections.namedtuple("CypherQueryResult", " ".join(current.keys()))
-            print(f"Cypher yielding... {yieldval}", file=stderr)
+            if STORE_TRACE.verbose:
+                STORE_TRACE.emit("load_cypher_query yielding: %s", yieldval)
             yield tuple_class(*yieldval)
             # yield yieldval
             count += 1
             if maxcount is not None and count >= maxcount:
-                print(f"Cypher returning on maxcount...", file=stderr)
                 return
-        print(f"Cypher returning...", file=stderr)
+
+    def update_cypher_query(self, querystr, params=None):
+        """
+        Execute a (parameterized) Cypher statement which may modify the database as part
+        of our current transaction. This lets callers express multi-step graph updates
+        as a single round trip instead of a series of relate/separate/label calls.
+        Unlike load_cypher_query(), the statement is executed eagerly - so the results are
+        returned as a list of namedtuples rather than through a generator.
+
+        :param querystr: str: Cypher query string
+        :param params: {str,str}:  parameters for the query
+        :return: [namedtuple]: all the result rows - with nodes translated into objects
+        """
+        if self.readonly:
+            raise RuntimeError("Attempt to update the database through a read-only store")
+        if params is None:
+            params = {}
+        if self.debug:
+            print("update_cypher_query: %s(%s)" % (querystr, params), file=stderr)
+        self._bump_stat("cypherupdate")
+        # We can't tell which labels an arbitrary Cypher statement modifies
+        self.touched_labels.add(None)
+        cursor = self._run(self.db_transaction, querystr, params)
+        result = []
+        tuple_class = None
+        while cursor.forward():
+            current = cursor.current
+            if tuple_class is None:
+                tuple_class = collections.namedtuple("CypherQueryResult", " ".join(current.keys()))
+            result.append(tuple_class(*[self._yielded_value(elem) for elem in current]))
+        return result
+
+    def explain(self, querystr, params=None):
+        """
+        Return Neo4j's EXPLAIN plan for a Cypher statement - without running it.
+        This bypasses our profiler - it's how the profiler captures plans.
+
+        :param querystr: str: Cypher statement
+        :param params: {str,str}: parameters for the statement
+        :return: str: the plan - one operator per line, indented to show the plan tree
+        """
+        cursor = self._execute("run", self.db, "EXPLAIN " + querystr, params or {}, reader=True)
+        return "\n".join(self._format_plan(cursor.plan()))
+
+    @staticmethod
+    def _format_plan(plan, depth=0):
+        """
+        Format a py2neo plan (and its children) for humans
+
+        :param plan: py2neo plan object (or None)
+        :param depth: int: how deep in the plan tree we are
+        :return: [str]: one line per operator
+        """
+        if plan is None:
+            return ["(no plan returned)"]
+        args = getattr(plan, "args", None) or {}
+        details = [
+            "%s=%s" % (key, args[key]) for key in ("EstimatedRows", "Details") if key in args
+        ]
+        lines = [
+            "%s%s %s %s"
+            % (
+                "  " * depth,
+                getattr(plan, "operator_type", plan),
+                sorted(getattr(plan, "identifiers", None) or []),
+                " ".join(details),
+            )
+        ]
+        for child in getattr(plan, "children", None) or ():
+            lines.extend(Store._format_plan(child, depth + 1))
+        return lines
 
     def _yielded_value(self, value):
         """
@@ -572,7 +711,9 @@ class Store(object):
         # print('ADDREL Cypher:', cypher, file=stderr)
         if self.debug:
             print("relate(%s)" % cypher, file=stderr)
-        self.db_transaction.run(cypher).forward()
+        self._touch(subj)
+        self._touch(obj)
+        self._run(self.db_transaction, cypher).forward()
 
     def relate_new(self, subj, rel_type, obj, attrs=None):
         """
@@ -619,7 +760,10 @@ class Store(object):
         )
         if self.debug:
             print("delrel(%s)" % cypher, file=stderr)
-        self.db_transaction.run(cypher).forward()
+        self._touch(subj)
+        if obj is not None:
+            self._touch(obj)
+        self._run(self.db_transaction, cypher).forward()
 
     def separate_in(self, subj, rel_type=None, obj=None):
         """
@@ -851,6 +995,9 @@ class Store(object):
             "nodedelete",
             "addlabels",
             "dellabels",
+            "cypherupdate",
+            "statements",
+            "writes",
             "commit",
         ):
             self.stats[statname] = 0
@@ -867,6 +1014,89 @@ class Store(object):
         """
         self.stats[statname] += increment
 
+    def _run(self, runner, querystr, params=None, reader=False):
+        """
+        Run a Cypher statement - every statement we send to Neo4j comes through here
+        or through _evaluate(). Statements run in our transaction also count as "writes" -
+        we only read outside of it.
+
+        :param runner: py2neo.Graph or py2neo.Transaction: what to run it with
+        :param querystr: str: Cypher statement
+        :param params: dict: parameters for the statement
+        :param reader: bool: True if this may go to our reader pool (read replicas)
+        :return: py2neo.Cursor
+        """
+        return self._send("run", runner, querystr, params, reader)
+
+    def _evaluate(self, runner, querystr, params=None):
+        """
+        Run a Cypher statement and return the first value of its first record
+
+        :param runner: py2neo.Graph or py2neo.Transaction: what to run it with
+        :param querystr: str: Cypher statement
+        :param params: dict: parameters for the statement
+        :return: object
+        """
+        return self._send("evaluate", runner, querystr, params)
+
+    def _send(self, method, runner, querystr, params, reader=False):
+        """
+        Send a Cypher statement to Neo4j and record it with our profiler.
+        Cursors come back wrapped in a ProfiledCursor - so that the time taken to fetch
+        the rows (and how many there were) gets recorded too.
+
+        :param method: str: "run" or "evaluate"
+        :param runner: py2neo.Graph or py2neo.Transaction: what to run it with
+        :param querystr: str: Cypher statement
+        :param params: dict: parameters for the statement
+        :param reader: bool: True if this may go to our reader pool
+        :return: ProfiledCursor or object: whatever 'method' returns
+        """
+        self._bump_stat("statements")
+        write = runner is self.db_transaction
+        if write:
+            self._bump_stat("writes")
+        start = time.time()
+        try:
+            result = self._execute(method, runner, querystr, params, reader)
+        except Exception:
+            self.profiler.record(querystr, params, time.time() - start, 0, write, failed=True)
+            raise
+        elapsed = time.time() - start
+        if method == "run":
+            return ProfiledCursor(result, self.profiler, querystr, params, write, elapsed)
+        self.profiler.record(querystr, params, elapsed, 0 if result is None else 1, write)
+        return result
+
+    def _execute(self, method, runner, querystr, params, reader=False):
+        """
+        Execute a Cypher statement - through our connection pool, unless it's part
+        of our transaction (which has its own connection).
+
+        :param method: str: "run" or "evaluate"
+        :param runner: py2neo.Graph or py2neo.Transaction: what to run it with
+        :param querystr: str: Cypher statement
+        :param params: dict: parameters for the statement
+        :param reader: bool: True if this may go to our reader pool
+        :return: py2neo.Cursor, PooledCursor or object: whatever 'method' returns
+        """
+        if runner is self.db_transaction:
+            return getattr(runner, method)(querystr, params)
+        pool = self.reader_pool if reader else self.pool
+        if pool is None or runner is not self.db:
+            return getattr(runner, method)(querystr, params)
+        if method != "run":
+            with pool.connection() as graph:
+                return getattr(graph, method)(querystr, params)
+        # The rows come back lazily over this connection - so the cursor keeps its slot
+        graph = pool.acquire()
+        try:
+            cursor = graph.run(querystr, params)
+        except Exception:
+            pool.release()
+            raise
+        return PooledCursor(cursor, pool)
+
     def _localsearch(self, cls, key_values, need_node=False):
         """
         Search the 'client' array and the weaknoderefs to see if we can find
@@ -1110,10 +1340,10 @@ class Store(object):
             # print("Clients of %s include: %s" % (self, str(self.clients)), file=stderr)
 
         if node is None:
-            print(f"CREATING NODE {str(node)[:100]}", file=stderr)
             self.execute_create_node(subj)
             node_id = subj.association.node_id
-            print(f"CREATED NODE {subj} with node id {node_id}", file=stderr)
+            if STORE_TRACE.debug:
+                STORE_TRACE.emit("CREATED NODE %s with node id %s", subj, node_id)
         else:
             node_id = self.neo_node_id(node)
             subj.association.node_id = node_id
@@ -1147,7 +1377,6 @@ class Store(object):
             assert self.weaknoderefs[node_id]() == subj
             self._audit_weaknodes_clients()
         if node is None and hasattr(subj, "post_db_init"):
-            print('POST_DB_INIT...[%s' % type(subj), file=stderr)
             subj.post_db_init()
         return subj
 
@@ -1158,19 +1387,18 @@ class Store(object):
         :param subj:
         :return: None
         """
-        print(f"IN execute_create_node {subj}")
         assert isinstance(subj, self.graph_node)
         cypher = subj.association.cypher_create_node_query()
         cypher += "\n RETURN ID(%s)" % subj.association.variable_name
-        if True or self.debug:
-            print("CREATE CYPHER: %s" % cypher, file=stderr)
-            self._log.info("CREATE CYPHER: %s" % cypher)
+        if STORE_TRACE.debug:
+            STORE_TRACE.emit("CREATE CYPHER: %s", cypher)
+        self._touch(subj)
         # Let's work around a weird random failure in Neo4j
         retry_times = 5
         node_id = None
         for j in range(retry_times):
             try:
-                node_id = self.db_transaction.evaluate(cypher)
+                node_id = self._evaluate(self.db_transaction, cypher)
                 break
             except AssertionError as failure:
                 if j == (retry_times - 1):
@@ -1180,6 +1408,9 @@ class Store(object):
         assert node_id is not None
         # print('NODE_ID:', node_id, file=stderr)
         subj.association.node_id = node_id
+        for on_create, _ in Store.node_hooks.get(subj.__class__.__name__, ()):
+            if on_create is not None:
+                on_create(self, subj)
 
     def batch_execute_node_updates(self):
         """
@@ -1194,7 +1425,8 @@ class Store(object):
             cypher += subj.association.cypher_update_clause()  # Defaults to dirty attributes
             if self.debug:
                 print("batch_execute_node_updates:%s" % cypher, file=stderr)
-            self.db_transaction.run(cypher).forward()
+            self._touch(subj)
+            self._run(self.db_transaction, cypher).forward()
 
     def begin(self, autocommit=False):
         """
@@ -1226,13 +1458,61 @@ class Store(object):
         start = datetime.now()
         self.batch_execute_node_updates()
         self.db_transaction.commit()
+        self.bump_epochs()
         end = datetime.now()
         self.stats["lastcommit"] = end
         self.stats["totaltime"] += end - start
 
         if self.debug:
             print("DB TRANSACTION COMPLETED SUCCESSFULLY", file=stderr)
-            self.abort()
+        self._clear_clients()
+
+    def _touch(self, subj, labels=None):
+        """
+        Remember that we've modified this node in our transaction - so that bump_epochs()
+        knows which labels to bump. Relationship changes touch the nodes at both ends.
+
+        :param subj: GraphNode: node we've modified
+        :param labels: (str,): extra labels we're adding to or removing from it
+        :return: None
+        """
+        self.touched_labels.update(subj.meta_labels())
+        if labels is not None:
+            self.touched_labels.update(labels)
+
+    def bump_epochs(self):
+        """
+        Bump the mutation epochs of everything we've modified since we last did this.
+        Call this after a transaction has committed - commit() does it for you.
+        Rolled back changes may get counted too - that's harmless, it just makes
+        some cached results look stale.
+
+        :return: None
+        """
+        if not self.touched_labels:
+            return
+        Store.mutation_epoch += 1
+        for label in self.touched_labels:
+            if label is None:
+                Store.unlabeled_epoch += 1
+            else:
+                Store.label_epochs[label] = Store.label_epochs.get(label, 0) + 1
+        self.touched_labels = set()
+
+    @staticmethod
+    def epoch_stamp(labels=None):
+        """
+        Return a value which changes whenever a commit modifies nodes with any of these labels.
+        Something computed from the graph is still valid as long as the stamp of the labels
+        it depends on hasn't changed.
+
+        :param labels: (str,): labels to stamp - None means anything in the graph
+        :return: tuple: opaque (comparable) stamp
+        """
+        if labels is None:
+            return (Store.mutation_epoch,)
+        epochs = Store.label_epochs
+        return (Store.unlabeled_epoch,) + tuple(epochs.get(label, 0) for label in labels)
 
     def abort(self):
         """
@@ -1241,6 +1521,17 @@ class Store(object):
         :param self:
         :return:
         """
+        self._clear_clients()
+        for on_abort in Store.abort_hooks:
+            on_abort(self)
+
+    def _clear_clients(self):
+        """
+        Forget the objects we've been tracking in this transaction - it's over.
+        Unlike abort(), this doesn't run our abort hooks - commit() uses it too.
+
+        :return: None
+        """
         for subj in self.clients:
             assert isinstance(subj, self.graph_node)
             # print('CLIENT/subj: %s' % subj, file=stderr)
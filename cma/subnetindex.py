@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100 fileencoding=utf-8
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+An in-memory longest-prefix-match index of our Subnets.
+
+Finding the subnets an IP address belongs on used to mean loading every Subnet in the
+database and testing each one in Python. Instead, we keep a binary radix trie of all our
+Subnets (per domain), keyed by the bits of their (IPv6) base address. A lookup walks at most
+'cidrmask' levels of the trie - no matter how many subnets we have.
+
+The index is process-wide and holds only Neo4j node ids and the attributes we search on.
+The Store calls our hooks when Subnets are created or deleted, so it stays in sync with the
+database. The first lookup loads every existing Subnet with a single query.
+If a transaction is aborted we forget everything and reload on the next lookup.
+"""
+import ipaddress
+from AssimCtypes import ADDR_FAMILY_IPV4
+from AssimCclasses import pyNetAddr
+from store import Store
+
+IPV6_BITS = 128
+IPV4_MAPPED = 0xFFFF00000000  # ::ffff:0.0.0.0 - how IPv4 addresses look in IPv6
+
+
+class SubnetIndex(object):
+    """
+    A process-wide radix trie of Subnets for longest-prefix-match lookups.
+
+    Each trie node is a list: [zero-child, one-child, entries-or-None]
+    Each entry is a tuple: (node_id, context, net_segment)
+    """
+
+    ZERO = 0
+    ONE = 1
+    ENTRIES = 2
+
+    _tries = {}  # domain -> root of the trie for that domain
+    _by_id = {}  # node_id -> (domain, prefix, cidrmask, entry)
+    _deleted_ids = set()  # Subnets deleted before we loaded the index
+    _loaded = False
+    stats = {"lookups": 0, "loads": 0, "invalidations": 0}
+
+    @staticmethod
+    def ip_to_int(ipaddr):
+        """
+        Convert an IP address to the 128-bit integer for its IPv6 form.
+        IPv4 addresses are mapped into IPv6 (::ffff:a.b.c.d) - just like our Subnets do.
+
+        :param ipaddr: str, pyNetAddr or IPaddrNode: the address to convert
+        :return: int: 128-bit integer value of the address
+        """
+        if not isinstance(ipaddr, (str, pyNetAddr)):
+            ipaddr = ipaddr.ipaddr  # IPaddrNode
+        if isinstance(ipaddr, str):
+            try:
+                addr = ipaddress.ip_address(ipaddr)
+                if addr.version == 4:
+                    return IPV4_MAPPED | int(addr)
+                return int(addr)
+            except ValueError:
+                pass  # Probably has a port or brackets - let pyNetAddr sort it out
+        addr = pyNetAddr(str(ipaddr))
+        addr.setport(0)
+        if addr.addrtype() == ADDR_FAMILY_IPV4:
+            addr = addr.toIPv6()
+        addrstr = str(addr)
+        if addrstr.startswith("["):
+            addrstr = addrstr[1 : addrstr.index("]")]
+        return int(ipaddress.IPv6Address(addrstr))
+
+    @staticmethod
+    def add(node_id, domain, ipaddr, cidrmask, context, net_segment):
+        """
+        Add a Subnet to the index (replacing any previous entry for this node id)
+
+        :param node_id: int: Neo4j node id of the Subnet
+        :param domain: str: domain of the Subnet
+        :param ipaddr: str: base address of the Subnet (IPv6 form)
+        :param cidrmask: int: IPv6 CIDR mask of the Subnet (0-128)
+        :param context: str: context of the Subnet
+        :param net_segment: str: network segment of the Subnet - or None
+        :return: None
+        """
+        if node_id in SubnetIndex._by_id:
+            SubnetIndex.remove(node_id)
+        cidrmask = int(cidrmask)
+        prefix = SubnetIndex.ip_to_int(ipaddr)
+        trie = SubnetIndex._tries.get(domain)
+        if trie is None:
+            trie = [None, None, None]
+            SubnetIndex._tries[domain] = trie
+        tnode = trie
+        for bit in range(IPV6_BITS - 1, IPV6_BITS - 1 - cidrmask, -1):
+            branch = (prefix >> bit) & 1
+            if tnode[branch] is None:
+                tnode[branch] = [None, None, None]
+            tnode = tnode[branch]
+        entry = (node_id, context, net_segment)
+        if tnode[SubnetIndex.ENTRIES] is None:
+            tnode[SubnetIndex.ENTRIES] = []
+        tnode[SubnetIndex.ENTRIES].append(entry)
+        SubnetIndex._by_id[node_id] = (domain, prefix, cidrmask, entry)
+
+    @staticmethod
+    def remove(node_id):
+        """
+        Remove a Subnet from the index.
+        We don't bother to prune empty trie nodes - Subnets are rarely deleted.
+
+        :param node_id: int: Neo4j node id of the Subnet
+        :return: None
+        """
+        if not SubnetIndex._loaded:
+            SubnetIndex._deleted_ids.add(node_id)
+        if node_id not in SubnetIndex._by_id:
+            return
+        domain, prefix, cidrmask, entry = SubnetIndex._by_id.pop(node_id)
+        tnode = SubnetIndex._tries[domain]
+        for bit in range(IPV6_BITS - 1, IPV6_BITS - 1 - cidrmask, -1):
+            tnode = tnode[(prefix >> bit) & 1]
+        tnode[SubnetIndex.ENTRIES].remove(entry)
+
+    @staticmethod
+    def invalidate(_store=None):
+        """
+        Forget everything - we'll reload from the database on our next lookup.
+        Also used as our Store abort hook.
+
+        :param _store: Store: (unused) the Store whose transaction was aborted
+        :return: None
+        """
+        SubnetIndex._tries = {}
+        SubnetIndex._by_id = {}
+        SubnetIndex._deleted_ids = set()
+        SubnetIndex._loaded = False
+        SubnetIndex.stats["invalidations"] += 1
+
+    @staticmethod
+    def ensure_loaded(store):
+        """
+        Load all the Subnets in the database into the index - if we haven't already.
+        Subnets created or deleted in our current transaction were already reported
+        to us by our Store hooks, and are merged with what we find.
+
+        :param store: Store: the Store to load them from
+        :return: None
+        """
+        if SubnetIndex._loaded:
+            return
+        query = """MATCH (s:Class_Subnet)
+        RETURN ID(s) AS node_id, s.domain AS domain, s.ipaddr AS ipaddr, s.cidrmask AS cidrmask,
+               s.context AS context, s.net_segment AS net_segment"""
+        for row in store.load_cypher_query(query):
+            if row.node_id in SubnetIndex._by_id or row.node_id in SubnetIndex._deleted_ids:
+                continue
+            SubnetIndex.add(
+                row.node_id, row.domain, row.ipaddr, row.cidrmask, row.context, row.net_segment
+            )
+        SubnetIndex._deleted_ids = set()
+        SubnetIndex._loaded = True
+        SubnetIndex.stats["loads"] += 1
+
+    @staticmethod
+    def lookup(domain, ipaddr, contexts=None, net_segment=None):
+        """
+        Return the node ids of all the Subnets this IP address belongs on - longest prefix first.
+        This only looks at what is already in the index - see matching() for the usual API.
+
+        :param domain: str: domain to search - None means all domains
+        :param ipaddr: str, pyNetAddr or IPaddrNode: IP address to look up
+        :param contexts: [str]: contexts that interest us - or None for any context
+        :param net_segment: str: network segment that interests us - or None for any
+        :return: [int]: Subnet node ids
+        """
+        SubnetIndex.stats["lookups"] += 1
+        addr = SubnetIndex.ip_to_int(ipaddr)
+        if domain is None:
+            tries = SubnetIndex._tries.values()
+        else:
+            tries = [SubnetIndex._tries[domain]] if domain in SubnetIndex._tries else []
+        result = []
+        for trie in tries:
+            found = []
+            tnode = trie
+            bit = IPV6_BITS - 1
+            while tnode is not None:
+                entries = tnode[SubnetIndex.ENTRIES]
+                if entries:
+                    found.append(entries)
+                if bit < 0:
+                    break
+                tnode = tnode[(addr >> bit) & 1]
+                bit -= 1
+            for entries in reversed(found):
+                for node_id, context, segment in entries:
+                    if contexts is not None and context not in contexts:
+                        continue
+                    if net_segment is not None and segment != net_segment:
+                        continue
+                    result.append(node_id)
+        return result
+
+    @staticmethod
+    def matching(store, domain, ipaddr, contexts=None, net_segment=None):
+        """
+        Return the node ids of all the Subnets this IP address belongs on - longest prefix first.
+
+        :param store: Store: the Store to load the index from if need be
+        :param domain: str: domain to search - None means all domains
+        :param ipaddr: str, pyNetAddr or IPaddrNode: IP address to look up
+        :param contexts: [str]: contexts that interest us - or None for any context
+        :param net_segment: str: network segment that interests us - or None for any
+        :return: [int]: Subnet node ids
+        """
+        SubnetIndex.ensure_loaded(store)
+        return SubnetIndex.lookup(domain, ipaddr, contexts=contexts, net_segment=net_segment)
+
+    @staticmethod
+    def exact(store, domain, ipaddr, cidrmask, context=None, net_segment=None):
+        """
+        Return the node id of the Subnet with exactly this base address and mask
+
+        :param store: Store: the Store to load the index from if need be
+        :param domain: str: domain of the Subnet
+        :param ipaddr: str or pyNetAddr: base address of the Subnet (IPv6 form)
+        :param cidrmask: int: IPv6 CIDR mask of the Subnet
+        :param context: str: context of the Subnet - or None for any context
+        :param net_segment: str: network segment of the Subnet - or None for any
+        :return: int: node id - or None
+        """
+        SubnetIndex.ensure_loaded(store)
+        trie = SubnetIndex._tries.get(domain)
+        prefix = SubnetIndex.ip_to_int(ipaddr)
+        cidrmask = int(cidrmask)
+        tnode = trie
+        for bit in range(IPV6_BITS - 1, IPV6_BITS - 1 - cidrmask, -1):
+            if tnode is None:
+                return None
+            tnode = tnode[(prefix >> bit) & 1]
+        if tnode is None or not tnode[SubnetIndex.ENTRIES]:
+            return None
+        for node_id, entry_context, segment in tnode[SubnetIndex.ENTRIES]:
+            if context is not None and entry_context != context:
+                continue
+            if net_segment is not None and segment != net_segment:
+                continue
+            return node_id
+        return None
+
+    @staticmethod
+    def _on_create(_store, subnet):
+        "Store hook: a Subnet was just created"
+        SubnetIndex.add(
+            subnet.association.node_id,
+            subnet.domain,
+            subnet.ipaddr,
+            subnet.cidrmask,
+            subnet.context,
+            subnet.net_segment,
+        )
+
+    @staticmethod
+    def _on_delete(_store, _subnet, node_id):
+        "Store hook: a Subnet was just deleted"
+        SubnetIndex.remove(node_id)
+
+
+Store.register_node_hooks(
+    "Subnet",
+    on_create=SubnetIndex._on_create,
+    on_delete=SubnetIndex._on_delete,
+    on_abort=SubnetIndex.invalidate,
+)
@@ -37,6 +37,11 @@ from graphnodes import (
 from cmaconfig import ConfigFile
 from AssimCtypes import CONFIGNAME_TYPE
 from frameinfo import FrameTypes, FrameSetTypes
+from discoverycontext import DiscoveryContext
+from assimtrace import Trace
+from cypherprofile import CypherProfiler
+
+DISCOVERY_TRACE = Trace.category("discovery")
 
 
 @registergraphclass
@@ -94,7 +99,6 @@ class SystemNode(GraphNode):
 
     def logjson(self, origaddr, jsontext):
         """Process and save away JSON discovery data."""
-        print(f"Starting _logjson for {origaddr}")
         assert self.association.node_id is not None
         jsonobj = pyConfigContext(jsontext)
         if "instance" not in jsonobj or "data" not in jsonobj:
@@ -112,9 +116,10 @@ class SystemNode(GraphNode):
                 CMAdb.log.debug(
                     "Discovery type %s for endpoint %s is unchanged." % (dtype, self.designation)
                 )
+        if CMAdb.discovery_scheduler is not None:
+            CMAdb.discovery_scheduler.note_discovery(self, dtype, discoverychanged)
         self._process_json(origaddr, jsonobj, discoverychanged)
         self[dtype] = jsontext  # This is stored in separate nodes for performance
-        print(f"Ending _logjson for {origaddr}")
 
     def __iter__(self):
         """Iterate over our child JSON attribute names"""
@@ -246,25 +251,30 @@ class SystemNode(GraphNode):
 
         Our argument is a vector of pyConfigContext objects with values for
             'instance'  Name of this discovery instance
-            'interval'  How often to repeat this discovery action
+            'repeat'    How often to repeat this discovery action
             'timeout'   How long to wait before considering this discovery failed...
+        Anything missing comes from our agent parameters - so set 'repeat' to 0 for a
+        one-shot discovery. If we have a DiscoveryScheduler, it decides how often repeating
+        discoveries actually repeat.
         """
         # fs = pyFrameSet(FrameSetTypes.DODISCOVER)
         frames = []
+        scheduler = CMAdb.discovery_scheduler
         for arg in args:
-            agent_params = ConfigFile.agent_params(
+            agent_params = ConfigFile.agent_params_readonly(
                 CMAdb.config, "discovery", arg[CONFIGNAME_TYPE], self.designation
             )
-            for key in ("repeat", "warn" "timeout", "nice"):
-                if key in agent_params and key not in arg:
-                    arg[key] = agent_params[arg]
+            defaults = agent_params.get("parameters", {})  # That's where agent_params puts them
+            for key in ("repeat", "warn", "timeout", "nice"):
+                if key in defaults and key not in arg:
+                    arg[key] = defaults[key]
             instance = arg["instance"]
+            if scheduler is not None and "repeat" in arg:
+                arg["repeat"] = scheduler.interval_for(self, instance, int(arg["repeat"]), arg)
             frames.append({"frametype": FrameTypes.DISCNAME, "framevalue": instance})
-            if "repeat" in arg:
-                interval = int(arg["repeat"])
-                frames.append({"frametype": FrameTypes.DISCINTERVAL, "framevalue": int(interval)})
-            else:
-                interval = 0
+            interval = int(arg.get("repeat", 0))
+            if interval > 0:  # No DISCINTERVAL frame means run it once
+                frames.append({"frametype": FrameTypes.DISCINTERVAL, "framevalue": interval})
             frames.append({"frametype": FrameTypes.DISCJSON, "framevalue": str(arg)})
         self.send_frames(FrameSetTypes.DODISCOVER, frames)
 
@@ -273,23 +283,35 @@ class SystemNode(GraphNode):
         dtype = jsonobj["discovertype"]
         if CMAdb.debug:
             CMAdb.log.debug(f"Processing JSON for discovery type [{dtype}] from {origaddr}")
-            print(f"Processing JSON for discovery type [{dtype}] from {origaddr} "
-                  f"Changed? {discoverychanged}", file=stderr)
+        if DISCOVERY_TRACE.info:
+            DISCOVERY_TRACE.emit(
+                "Processing %s JSON from %s - changed? %s", dtype, origaddr, discoverychanged
+            )
         foundone = False
+        context = DiscoveryContext(self, self._store, dtype)
+        snapshot = None
         for prio in range(0, len(SystemNode._JSONprocessors)):
-            print(f'JSON PRIO[{prio}]')
             if dtype in SystemNode._JSONprocessors[prio]:
                 foundone = True
                 classes = SystemNode._JSONprocessors[prio][dtype]
-                print('PROC[%s][%s] = %s' % (prio, dtype, str(classes)), file=stderr)
                 for cls in classes:
-                    CMAdb.log.debug(f"Processing JSON for discovery type [{dtype}] with {cls}")
                     proc = cls(
-                        CMAdb.config, CMAdb.net_transaction, self._store, self._log, CMAdb.debug
+                        CMAdb.config,
+                        CMAdb.net_transaction,
+                        self._store,
+                        self._log,
+                        CMAdb.debug,
+                        context=context,
                     )
-                    print(f"PROCESSING JSON {dtype} from {origaddr} with {proc}", file=stderr)
-                    proc.processpkt(self, origaddr, jsonobj, discoverychanged)
-                    print(f"DONE PROCESSING JSON {dtype} from {origaddr} with {proc}", file=stderr)
+                    if DISCOVERY_TRACE.debug:
+                        DISCOVERY_TRACE.emit("Processing %s JSON with %s", dtype, cls.__name__)
+                    procjson = jsonobj
+                    if getattr(cls, "readonly_json", False):
+                        if snapshot is None:
+                            snapshot = jsonobj.snapshot()
+                        procjson = snapshot
+                    with CypherProfiler.calling(cls.__name__):
+                        proc.processpkt(self, origaddr, procjson, discoverychanged)
         if foundone:
             CMAdb.log.info(
                 "Processed %schanged %s JSON data from %s into graph."
@@ -300,7 +322,8 @@ class SystemNode(GraphNode):
                 "Stored %s JSON data from %s without processing." % (dtype, self.designation)
             )
 
-        CMAdb.log.debug(f"Finished Processing JSON for discovery type [{dtype}]")
+        if CMAdb.debug:
+            CMAdb.log.debug(f"Finished Processing JSON for discovery type [{dtype}]")
 
     @staticmethod
     def add_json_processor(clstoadd):
@@ -388,8 +411,8 @@ class SystemNode(GraphNode):
         nic = self.association.store.load_cypher_node(
             query, {"id": self.association.node_id, "ifname": ifname}
         )
-        if nic is None:
-            print(f"FAILING to find NIC ifname = {ifname} for {self}")
+        if nic is None and DISCOVERY_TRACE.info:
+            DISCOVERY_TRACE.emit("Failed to find NIC ifname = %s for %s", ifname, self)
         return nic
 
 
@@ -34,6 +34,7 @@ sys.path.append("/usr/local/lib/python2.7/dist-packages")
 import os, sys, tempfile, time, signal
 from assimevent import AssimEvent
 from assimeventobserver import ForkExecObserver
+from eventworkers import DelimitedReader, FrameReader, encode_frame, STREAM_MARKER
 
 DEBUG = False
 
@@ -64,6 +65,30 @@ def makescript(createdscriptname, outfile):
     os.chmod(createdscriptname, 0o0755)
 
 
+def makestreamscript(createdscriptname, outfile):
+    "Create a stream worker script - outputting to requested file"
+    script = """#!%s
+# %s
+import sys, struct, json
+with open("%s", "a") as outfile:
+    while True:
+        header = sys.stdin.buffer.read(4)
+        if len(header) < 4:
+            break
+        batch = json.loads(sys.stdin.buffer.read(struct.unpack(">I", header)[0]).decode("utf8"))
+        for event in batch:
+            outfile.write("%%s %%s %%s\\n" %% (event["eventtype"], event["nodetype"],
+                          json.dumps(event["event"], sort_keys=True, separators=(",", ":"))))
+        outfile.flush()
+        sys.stdout.buffer.write(struct.pack(">I", 2) + b"{}")
+        sys.stdout.buffer.flush()
+"""
+    f = open(createdscriptname, "w")
+    f.write(script % (sys.executable, STREAM_MARKER.decode("utf8"), outfile))
+    f.close()
+    os.chmod(createdscriptname, 0o0755)
+
+
 class ClientClass:
     def __init__(self):
         self.nodetype = "ClientClass"
@@ -252,3 +277,49 @@ ASSIM_sevenofnine=Annika
         os.unlink(execscript)
         os.unlink(pathname)
         os.rmdir(tmpdir)
+
+    def test_event_readers(self):
+        "Split NUL-terminated events and length-prefixed frames - however they're read"
+        reader = DelimitedReader(b"\0")
+        data = b"one\0two\0\0three\0four"
+        records = []
+        for j in range(len(data)):
+            records.extend(reader.feed(data[j : j + 1]))
+        self.assertEqual(records, [b"one", b"two", b"", b"three"])
+        self.assertEqual(reader.feed(b"\0"), [b"four"])
+        reader = FrameReader()
+        data = encode_frame(b"first") + encode_frame(b"") + encode_frame(b"third")
+        self.assertEqual(reader.feed(data[:7]), [])
+        self.assertEqual(reader.feed(data[7:]), [b"first", b"", b"third"])
+
+    def test_fork_exec_stream_event(self):
+        """Create a stream worker script and make sure it gets our events
+        in batches through its stdin
+        """
+        AssimEvent.enable_all_observers()
+        tmpdir = tempfile.mkdtemp(".d", "testexec_")
+        (fd, pathname) = tempfile.mkstemp(".out.txt")
+        execscript = os.path.join(tmpdir, "observer.py")
+        makestreamscript(execscript, pathname)
+        AssimEvent.observers = []
+        observer = ForkExecObserver(scriptdir=tmpdir)
+        dummyclient = ClientClass()
+        dummyclient.fred = "fred"
+        AssimEvent.registerobserver(observer)
+        AssimEvent(dummyclient, AssimEvent.CREATEOBJ)
+        AssimEvent(dummyclient, AssimEvent.OBJUP, extrainfo={"origaddr": "10.10.10.254"})
+        os.close(fd)
+        expectedcontent = (
+            'create ClientClass {"associatedobject":{"fred":"fred","nodetype":"ClientClass"},'
+            '"eventtype":0,"extrainfo":null}\n'
+            'up ClientClass {"associatedobject":{"fred":"fred","nodetype":"ClientClass"},'
+            '"eventtype":1,"extrainfo":{"origaddr":"10.10.10.254"}}\n'
+        )
+        TestAssimEvent.waitfor(pathname, expectedcontent)
+        f = open(pathname, "r")
+        content = f.read()
+        f.close()
+        self.assertEqual(content, expectedcontent)
+        os.unlink(execscript)
+        os.unlink(pathname)
+        os.rmdir(tmpdir)
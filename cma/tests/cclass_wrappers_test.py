@@ -875,6 +875,37 @@ class TestpyFrameSet(TestCase):
             self.assertEqual(strx, stry)
             self.assertEqual(TestpyFrameSet.cmpstring(x), TestpyFrameSet.cmpstring(y))
 
+    def test_decode_frames(self):
+        "decode_frames() should agree with iter() - and give us memoryviews of large values"
+        if DEBUG:
+            print("========================test_decode_frames(TestpyFrameSet)", file=stderr)
+        pyfs = pyFrameSet(801)
+        bigjson = '{"data": "%s"}' % ("x" * pyFrameSet.VIEW_THRESHOLD)
+        flist = (
+            pyAddrFrame(FrameTypes.IPADDR, (42, 42, 42, 42)),
+            pyIntFrame(FrameTypes.WALLCLOCK, 42),
+            pyCstringFrame(FrameTypes.HOSTNAME, "HhGttG"),
+            pyIntFrame(FrameTypes.CINTVAL, 3000000000000, intbytes=8),
+            pySeqnoFrame(FrameTypes.REQID, (42, 424242424242)),
+            pyCstringFrame(FrameTypes.JSDISCOVER, bigjson),
+        )
+        for frame in flist:
+            pyfs.append(frame)
+        pyfs.construct_packet(pySignFrame(1))
+        decoder = pyPacketDecoder()
+        fs0 = decoder.unpickle_packet(decoder.pickle_packet([pyfs]))[0]
+        decoded = fs0.decode_frames()
+        frames = list(fs0.iter())
+        self.assertEqual(len(decoded), len(frames))
+        self.assertEqual([f.frametype() for f in frames], [frametype for frametype, _ in decoded])
+        values = [value for _, value in decoded[1:-1]]  # Skip the signature and END frames
+        self.assertEqual(str(values[0]), str(flist[0].getnetaddr()))
+        self.assertEqual(values[1:], [42, "HhGttG", 3000000000000, (42, 424242424242), bigjson])
+        viewed = fs0.decode_frames(views=True)
+        self.assertEqual(viewed[3][1], "HhGttG")
+        self.assertTrue(isinstance(viewed[6][1], memoryview))
+        self.assertEqual(bytes(viewed[6][1]).decode("utf8"), bigjson)
+
 
 class TestpyConfigContext(TestCase):
     def test_constructor(self):
@@ -1162,6 +1193,36 @@ class TestpyConfigContext(TestCase):
         self.assertEqual(cc.deepget("a[-1]"), "f")
         self.assertEqual(cc.deepget("a[-3]"), "b")
 
+    def test_snapshot(self):
+        getstr = (
+            '{"a": ["b", {"c": {"d":0, "e":1.5}}, "f"], "g": {"h": true, "i": "j"},'
+            ' "kernel.sysrq": 176, "ip": "10.10.10.1", "ips": ["10.10.10.2"]}'
+        )
+        cc = pyConfigContext(init=getstr)
+        snap = cc.snapshot()
+        self.assertTrue(isinstance(snap, ConfigSnapshot))
+        self.assertTrue(snap.snapshot() is snap)
+        self.assertEqual(sorted(snap.keys()), sorted(cc.keys()))
+        self.assertEqual(len(snap), len(cc))
+        self.assertEqual(snap["a"][0], "b")
+        self.assertTrue(isinstance(snap["a"], tuple))
+        self.assertEqual(snap.deepget("a[1].c.d"), 0)
+        self.assertEqual(snap.deepget("a[1].c.e"), 1.5)
+        self.assertEqual(snap.deepget("a[-1]"), "f")
+        self.assertTrue(snap.deepget("a[3]") is None)
+        self.assertTrue(snap.deepget("a[1].c.x", None) is None)
+        self.assertEqual(snap.deepget("a[1].c.x", 42), 42)  # Cached misses honor 'alternative'
+        self.assertTrue(snap.deepget("g.h") is True)
+        self.assertTrue("i" in snap["g"])
+        self.assertEqual(str(snap["g"]), str(cc["g"]))
+        self.assertEqual(snap.get("kernel.sysrq"), 176)
+        self.assertTrue(isinstance(snap["ip"], pyNetAddr))
+        self.assertEqual(str(snap["ip"]), str(cc["ip"]))
+        self.assertEqual(snap["ips"], tuple(cc["ips"]))
+        self.assertRaises(TypeError, snap.__setitem__, "a", 1)
+        # Snapshots convert back into equivalent pyConfigContexts
+        self.assertEqual(str(pyConfigContext(snap)), str(cc))
+
 
 class TestpyNetIOudp(TestCase):
     def test_constructor(self):
@@ -30,6 +30,8 @@ import os
 import subprocess
 import re
 import optparse
+import json
+import tempfile
 from py2neo import Graph
 import inject
 
@@ -56,6 +58,7 @@ from dispatchtarget import (
 )
 from hbring import HbRing
 from droneinfo import Drone
+from systemnode import SystemNode
 from graphnodes import GraphNode, Subnet, IPaddrNode, NICNode
 from monitoring import MonitorAction, LSBMonitoringRule, MonitoringRule, OCFMonitoringRule
 from transaction import NetTransaction
@@ -64,7 +67,15 @@ from cmaconfig import ConfigFile
 from graphnodeexpression import ExpressionContext
 import assimglib as glib  # This is now our glib bindings...
 import discoverylistener
+from linkdiscovery import LinkDiscoveryListener
 from store import Store
+from discoverycontext import DiscoveryContext
+from subnetindex import SubnetIndex
+from scorerollup import ScoreRollups
+from assimtrace import Trace, TRACE_OFF
+from admission import TokenBucket, AdmissionController
+from discoveryscheduler import DiscoveryScheduler
+from warmstart import WarmStart
 
 stderr = sys.stderr
 
@@ -794,6 +805,15 @@ class TestCMABasic(TestCase):
         # As we change discovery...
         self.assertEqual(io.packetsread, 3)  # Did we read 3 packets?
         AUDITS().auditSETCONFIG(io.packetswritten[0], droneid, configinit)
+        # Initial discovery runs just once - so no DISCINTERVAL frames for it
+        discover = [
+            fs for _, fs in io.packetswritten if fs.get_framesettype() == FrameSetTypes.DODISCOVER
+        ]
+        self.assertEqual(len(discover), 1)
+        names = [f.getstr() for f in discover[0].iter() if f.frametype() == FrameTypes.DISCNAME]
+        self.assertTrue([name for name in names if name.startswith("_init_")])
+        intervals = [f for f in discover[0].iter() if f.frametype() == FrameTypes.DISCINTERVAL]
+        self.assertEqual(intervals, [])
         assimcli_check("query allips", 1)
         assimcli_check("query allservers", 1)
         assimcli_check("query findip %s" % str(droneip), 1)
@@ -1608,6 +1628,100 @@ class TestNetDevices(TestCase):
         assert subnet.subnet_label in store.labels(ipaddr1)
         assert Subnet.find_subnet_by_name(store, ipaddr1.subnet) is subnet
 
+    def test_subnet_index(self):
+        """
+        Longest-prefix-match lookups through our SubnetIndex
+        :return: None
+        """
+        CMAInjectables.set_config(ConfigFile().complete_config())
+        store = TestFoo.store
+        CMAinit(None, cleanoutdb=True, debug=DEBUG)
+        TestFoo.new_transaction()
+        wide = store.load_or_create(Subnet, domain="global", ipaddr="10.10.0.0/16")
+        narrow = store.load_or_create(Subnet, domain="global", ipaddr="10.10.10.0/24")
+        local = store.load_or_create(
+            Subnet, domain="global", ipaddr="10.10.10.0/24", context="host:virbr0"
+        )
+        found = list(Subnet.find_matching_subnets(store, "global", "10.10.10.20", None))
+        assert found[-1] is wide
+        assert set(found[:2]) == {narrow, local}
+        found = list(Subnet.find_matching_subnets(store, "global", "10.10.10.20", ["_GLOBAL_"]))
+        assert found == [narrow, wide]
+        assert list(Subnet.find_matching_subnets(store, "global", "10.11.0.1", None)) == []
+        assert list(Subnet.find_matching_subnets(store, "other", "10.10.10.20", None)) == []
+        assert Subnet.find_subnet(store, "10.10.10.0", 24, "global") is narrow
+        assert Subnet.find_subnet(store, "10.10.10.0", 24, "global", context=None) is not None
+        assert Subnet.find_subnet(store, "10.10.10.0", 23, "global") is None
+        store.delete(narrow)
+        found = list(Subnet.find_matching_subnets(store, "global", "10.10.10.20", ["_GLOBAL_"]))
+        assert found == [wide]
+        invalidations = SubnetIndex.stats["invalidations"]
+        store.commit()  # Committing doesn't throw our index away - only aborting does
+        TestFoo.new_transaction()
+        self.assertEqual(SubnetIndex.stats["invalidations"], invalidations)
+
+    def test_netconfig_rediscovery(self):
+        """
+        Rediscovering an unchanged network configuration should write nothing
+        :return: None
+        """
+        config = ConfigFile().complete_config()
+        CMAInjectables.set_config(config)
+        store = TestFoo.store
+        CMAinit(None, cleanoutdb=True, debug=DEBUG)
+        TestFoo.new_transaction()
+        drone = Drone.add(dronedesignation(1), "test", primary_ip_addr=str(droneipaddress(1)))
+        listener = discoverylistener.NetconfigDiscoveryListener(
+            config, None, store, CMAdb.log, DEBUG
+        )
+        netconfig = pyConfigContext(hostdiscoveryinfo(1))
+        listener.processpkt(drone, None, netconfig, True)
+        store.commit()
+        TestFoo.new_transaction()
+        self.assertEqual(len([ip for ip in drone.get_owned_ips()]), 3)
+        writes = store.stats["writes"]
+        listener.processpkt(drone, None, netconfig, True)
+        self.assertEqual(store.stats["writes"], writes)
+        for nic in store.load_related(drone, CMAconsts.REL_nicowner):
+            self.assertEqual(nic.association.dirty_attrs, set())
+        self.assertEqual(len([ip for ip in drone.get_owned_ips()]), 3)
+
+    def test_tcpdiscovery_endpoint_changes(self):
+        """
+        Comparing process endpoints between two tcpdiscovery packets
+        :return: None
+        """
+        changes = discoverylistener.TCPDiscoveryListener._endpoint_changes
+        old = {"listenaddrs": {"0.0.0.0:22": {}, "::1:631": {}}}
+        new = {"listenaddrs": {"0.0.0.0:22": {}, "10.10.10.5:80": {}}}
+        self.assertEqual(changes(new, old, "listenaddrs"), ([("10.10.10.5", 80)], [("::1", 631)]))
+        self.assertEqual(changes(new, new, "listenaddrs"), ([], []))
+        self.assertEqual(changes(new, {}, "clientaddrs"), ([], []))
+        self.assertEqual(changes({}, old, "listenaddrs"), ([], [("0.0.0.0", 22), ("::1", 631)]))
+
+    def test_discovery_context(self):
+        """
+        Listeners sharing a DiscoveryContext should load each view only once
+        :return: None
+        """
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return ["value"]
+
+        context = DiscoveryContext(None, None, "_test_context")
+        self.assertEqual(context.memo("view", loader), ["value"])
+        self.assertEqual(context.memo("view", loader), ["value"])
+        self.assertEqual(len(calls), 1)
+        context.forget("view", "unknown")
+        context.memo("view", loader)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(DiscoveryContext.stats["_test_context"], {"hits": 1, "misses": 2})
+        # A new packet means a new context - nothing is shared with the previous one
+        DiscoveryContext(None, None, "_test_context").memo("view", loader)
+        self.assertEqual(len(calls), 3)
+
     def test_scope_and_macaddr(self):
         """
         A test of MAC addresses (NICNodes) with scopes...
@@ -1629,6 +1743,538 @@ class TestNetDevices(TestCase):
         TestFoo.new_transaction()
 
 
+class TestLinkDiscovery(TestCase):
+    CHASSIS = "00-11-22-33-44-55"
+    PORT1 = "00-11-22-33-44-01"
+    PORT2 = "00-11-22-33-44-02"
+
+    @staticmethod
+    def _setup():
+        "Create a drone with its NICs - and a LinkDiscoveryListener for it"
+        config = ConfigFile().complete_config()
+        CMAInjectables.set_config(config)
+        store = TestFoo.store
+        CMAinit(None, cleanoutdb=True, debug=DEBUG)
+        TestFoo.new_transaction()
+        drone = Drone.add(dronedesignation(1), "test", primary_ip_addr=str(droneipaddress(1)))
+        netconfig = discoverylistener.NetconfigDiscoveryListener(
+            config, None, store, CMAdb.log, DEBUG
+        )
+        netconfig.processpkt(drone, None, pyConfigContext(hostdiscoveryinfo(1)), True)
+        store.commit()
+        TestFoo.new_transaction()
+        return drone, LinkDiscoveryListener(config, None, store, CMAdb.log, DEBUG)
+
+    @staticmethod
+    def _port(portid, ifname, sourcemac=None, description="port"):
+        "Return the link discovery data for one switch port"
+        port = {"PortId": portid, "ConnectsToInterface": ifname, "PortDescription": description}
+        if sourcemac is not None:
+            port["sourceMAC"] = sourcemac
+        return port
+
+    def _discover(self, listener, drone, ports, commit=True):
+        "Process link discovery about our switch's ports from this drone - and commit it"
+        for port in ports.values():
+            port["ConnectsToHost"] = drone.designation
+        discovery = {
+            "discovertype": "__LinkDiscovery",
+            "instance": "#SWITCH_eth0",
+            "host": drone.designation,
+            "data": {"ChassisId": self.CHASSIS, "ports": ports},
+        }
+        listener.processpkt(drone, None, pyConfigContext(json.dumps(discovery)), True)
+        if commit:
+            TestFoo.store.commit()
+            TestFoo.new_transaction()
+
+    @staticmethod
+    def _wiring(drone):
+        "Return {interface name: [MAC addresses of the switch ports wired to it]}"
+        store = TestFoo.store
+        result = {}
+        for nic in store.load_related(drone, CMAconsts.REL_nicowner):
+            ports = store.load_in_related(nic, CMAconsts.REL_wiredto)
+            result[nic.ifname] = sorted(port.macaddr for port in ports)
+        return result
+
+    def _switch_ports(self, drone):
+        "Return the switch's port NICs - by MAC address"
+        store = TestFoo.store
+        switch = store.load(SystemNode, domain=drone.domain, designation=self.CHASSIS)
+        return {nic.macaddr: nic for nic in store.load_related(switch, CMAconsts.REL_nicowner)}
+
+    def test_wiring_moves(self):
+        """
+        When a drone's NIC moves to another switch port, its old wiring goes away
+        :return: None
+        """
+        drone, listener = self._setup()
+        self._discover(listener, drone, {"1": self._port("Gi0/1", "eth0", self.PORT1)})
+        self.assertEqual(self._wiring(drone)["eth0"], [self.PORT1])
+        self._discover(listener, drone, {"2": self._port("Gi0/2", "eth0", self.PORT2)})
+        self.assertEqual(self._wiring(drone)["eth0"], [self.PORT2])
+        self.assertEqual(sorted(self._switch_ports(drone)), [self.PORT1, self.PORT2])
+
+    def test_port_attributes_change(self):
+        """
+        Changed port attributes update the existing port NIC
+        :return: None
+        """
+        drone, listener = self._setup()
+        self._discover(listener, drone, {"1": self._port("Gi0/1", "eth0", self.PORT1, "old")})
+        self._discover(listener, drone, {"1": self._port("Gi0/1", "eth0", self.PORT1, "new")})
+        ports = self._switch_ports(drone)
+        self.assertEqual(list(ports), [self.PORT1])
+        self.assertEqual(ports[self.PORT1].PortDescription, "new")
+        self.assertEqual(self._wiring(drone)["eth0"], [self.PORT1])
+
+    def test_unchanged_ports(self):
+        """
+        Rediscovering unchanged ports and wiring writes nothing
+        :return: None
+        """
+        drone, listener = self._setup()
+        store = TestFoo.store
+        self._discover(listener, drone, {"1": self._port("Gi0/1", "eth0", self.PORT1)})
+        writes = store.stats["writes"]
+        self._discover(listener, drone, {"1": self._port("Gi0/1", "eth0", self.PORT1)}, False)
+        self.assertEqual(store.stats["writes"], writes)
+        for nic in self._switch_ports(drone).values():
+            self.assertEqual(nic.association.dirty_attrs, set())
+        store.commit()
+        TestFoo.new_transaction()
+
+    def test_shared_chassis_mac(self):
+        """
+        Ports without their own MAC address share the chassis NIC - and none of the
+        NICs wired to it are mistaken for having moved
+        :return: None
+        """
+        drone, listener = self._setup()
+        ports = {"1": self._port("Gi0/1", "eth0"), "2": self._port("Gi0/2", "lo")}
+        self._discover(listener, drone, ports)
+        self.assertEqual(list(self._switch_ports(drone)), [self.CHASSIS])
+        ports = {"1": self._port("Gi0/1", "eth0"), "2": self._port("Gi0/2", "lo")}
+        self._discover(listener, drone, ports)
+        wiring = self._wiring(drone)
+        self.assertEqual((wiring["eth0"], wiring["lo"]), ([self.CHASSIS], [self.CHASSIS]))
+
+
+class TestScoreRollups(TestCase):
+    def test_score_rollups(self):
+        """
+        Incremental score rollups should agree with recomputing them from scratch
+        :return: None
+        """
+        CMAInjectables.set_config(ConfigFile().complete_config())
+        store = TestFoo.store
+        CMAinit(None, cleanoutdb=True, debug=DEBUG)
+        TestFoo.new_transaction()
+        old = {"security": {"rule1": 2.0, "rule2": 3.0}}
+        new = {"security": {"rule1": 2.0}, "networking": {"rule3": 1.0}}
+        ScoreRollups.apply(store, "global", "sshd", {}, old)
+        ScoreRollups.apply(store, "global", "sshd", {}, old)
+        ScoreRollups.apply(store, "global", "sshd", old, new)
+        store.commit()
+        TestFoo.new_transaction()
+        dtype_totals, rule_totals = ScoreRollups.totals(store)
+        self.assertEqual(
+            dtype_totals, {"global": {"security": {"sshd": 7.0}, "networking": {"sshd": 1.0}}}
+        )
+        self.assertEqual(rule_totals["global"]["security"]["sshd"], {"rule1": 4.0, "rule2": 3.0})
+        self.assertEqual(ScoreRollups.compare(store, dtype_totals, rule_totals), [])
+        dtype_totals["global"]["security"]["sshd"] = 4.0
+        del rule_totals["global"]["security"]["sshd"]["rule2"]
+        self.assertEqual(
+            ScoreRollups.compare(store, dtype_totals, rule_totals),
+            [
+                (("global", "security", "sshd"), 7.0, 4.0),
+                (("global", "security", "sshd", "rule2"), 3.0, 0.0),
+            ],
+        )
+        ScoreRollups.rebuild(store, dtype_totals, rule_totals)
+        store.commit()
+        TestFoo.new_transaction()
+        self.assertEqual(ScoreRollups.compare(store, dtype_totals, rule_totals), [])
+
+
+class TestTrace(TestCase):
+    def test_trace_points(self):
+        """
+        Trace points record only at or below their category's level,
+        and the ring buffer keeps the newest messages
+        :return: None
+        """
+        import io
+
+        category = Trace.category("test")
+        saved = list(Trace.ring), Trace.ring.maxlen
+        try:
+            Trace.set_ring_size(3)
+            Trace.ring.clear()
+            Trace.configure("test=info")
+            self.assertTrue(category.info)
+            self.assertFalse(category.debug)
+            Trace.configure("test")
+            self.assertTrue(category.debug)
+            self.assertFalse(category.verbose)
+            self.assertRaises(ValueError, Trace.configure, "test=loud")
+            for number in range(5):
+                if category.debug:
+                    category.emit("message %d", number)
+            if category.verbose:
+                category.emit("not recorded")
+            self.assertEqual(
+                [entry[2] for entry in Trace.ring], ["message 2", "message 3", "message 4"]
+            )
+            output = io.StringIO()
+            self.assertEqual(Trace.dump(output, clear=True), 3)
+            self.assertTrue("test: message 4" in output.getvalue())
+            self.assertEqual(len(Trace.ring), 0)
+        finally:
+            category.set_level(TRACE_OFF)
+            Trace.set_ring_size(saved[1])
+            Trace.ring.extend(saved[0])
+
+
+class FakeRulesStore(object):
+    "Just enough of a Store to return a best practice rule chain"
+
+    Row = collections.namedtuple("Row", ("head", "json"))
+
+    def __init__(self, head, texts):
+        self.rows = [FakeRulesStore.Row(head, text) for text in texts]
+
+    def load_cypher_query(self, querystr, params=None, maxcount=None, reader=False):
+        return self.rows
+
+
+class TestWarmStart(TestCase):
+    @staticmethod
+    def start_drones(count):
+        "Have 'count' drones send us their STARTUP packets"
+        fsin = []
+        for droneid in range(1, count + 1):
+            fs = pyFrameSet(FrameSetTypes.STARTUP)
+            fs.append(pyCstringFrame(FrameTypes.HOSTNAME, dronedesignation(droneid)))
+            fs.append(pyCstringFrame(FrameTypes.JSDISCOVER, hostdiscoveryinfo(droneid)))
+            fsin.append((droneipaddress(droneid), (fs,)))
+        io = IOTestIO(fsin)
+        CMAinit(io, cleanoutdb=True, debug=DEBUG)
+        disp = MessageDispatcher(
+            {FrameSetTypes.STARTUP: DispatchSTARTUP()}, encryption_required=False
+        )
+        config = pyConfigContext(init=geninitconfig(pyNetAddr((10, 10, 10, 5), 1984)))
+        CMAInjectables.set_config(config)
+        listener = PacketListener(config, disp, io=io, encryption_required=False)
+        io.mainloop = listener.mainloop
+        IOTestIO.mainloop = listener.mainloop
+        listener.listen()
+
+    def test_ring_order(self):
+        """
+        member_ids_ring_order() follows our ring's 'next' links all the way around
+        :return: None
+        """
+        self.start_drones(3)
+        ring = CMAdb.TheOneRing
+        order = ring.member_ids_ring_order()
+        self.assertEqual(len(order), 3)
+        query = "MATCH (a)-[:%s]->(b) RETURN ID(a) AS a, ID(b) AS b" % ring.ournexttype
+        successor = dict((row.a, row.b) for row in CMAdb.store.load_cypher_query(query))
+        for j, droneid in enumerate(order):
+            self.assertEqual(successor[droneid], order[(j + 1) % len(order)])
+
+    def test_snapshot_round_trip(self):
+        """
+        What we save in a snapshot comes back into our caches when we load it
+        :return: None
+        """
+        self.start_drones(3)
+        snapfd, filename = tempfile.mkstemp(suffix=".json")
+        os.close(snapfd)
+        warm = WarmStart(filename, store=CMAdb.store, ring=CMAdb.TheOneRing)
+        try:
+            self.assertTrue(warm.save(clean=True))
+            with open(filename) as snapfile:
+                snapshot = json.load(snapfile)
+            self.assertEqual(len(snapshot["drones"]), 3)
+            self.assertEqual(snapshot["ring_order"], CMAdb.TheOneRing.member_ids_ring_order())
+            node_ids = {drone["designation"]: drone["node_id"] for drone in snapshot["drones"]}
+            Drone._find_cache_unverified = {}
+            Drone.flush_find_cache()
+            self.assertTrue(warm.load())
+            self.assertEqual(warm.stats["loaded"]["members"], 3)
+            hits = Drone.find_cache_stats["hits"]
+            drone = Drone.find(dronedesignation(1))
+            self.assertEqual(Drone.find_cache_stats["hits"], hits + 1)
+            self.assertEqual(drone.association.node_id, node_ids[dronedesignation(1)])
+        finally:
+            os.unlink(filename)
+            Drone._find_cache_unverified = {}
+            Drone.flush_find_cache()
+
+    def test_warm_entry_moved_ip(self):
+        """
+        A warm-start find cache entry for an IP address which has since moved is rejected
+        :return: None
+        """
+        self.start_drones(2)
+        one = Drone.find(dronedesignation(1))
+        two = Drone.find(dronedesignation(2))
+        ipaddr = droneipaddress(1)
+        ipaddr.setport(0)
+        key = ("ip", str(one.domain), str(ipaddr.toIPv6()))
+        Drone._find_cache_unverified = {}
+        Drone.flush_find_cache()
+        try:
+            # Our snapshot says drone 2 had drone 1's address
+            Drone.warm_find_cache([(key, two.association.node_id, two.designation)])
+            stale = Drone.find_cache_stats["stale"]
+            self.assertTrue(Drone._find_cache_lookup(key) is None)
+            self.assertEqual(Drone.find_cache_stats["stale"], stale + 1)
+            found = Drone.find(droneipaddress(1), domain=one.domain)
+            self.assertEqual(found.association.node_id, one.association.node_id)
+        finally:
+            Drone._find_cache_unverified = {}
+            Drone.flush_find_cache()
+
+    def test_warm_merged_rules(self):
+        """
+        Warm-start merged rules are only reused while the rule chain is unchanged
+        :return: None
+        """
+        saved = (CMAdb.store, Drone._merged_rules_cache)
+        warmed = ['{"a": {"rule": "True", "category": "security"}}']
+        changed = ['{"a": {"rule": "False", "category": "security"}}']
+        association = collections.namedtuple("Association", ("node_id",))(1)
+        drone = collections.namedtuple("RulesDrone", ("association",))(association)
+        try:
+            Drone._merged_rules_cache = {}
+            self.assertEqual(Drone.warm_merged_rules([(77, warmed)]), 1)
+            cached = Drone._merged_rules_cache[77][1]
+            CMAdb.store = FakeRulesStore(77, warmed)
+            self.assertTrue(Drone.get_merged_bp_rules(drone, "proc_sys") is cached)
+            CMAdb.store = FakeRulesStore(77, changed)
+            merged = Drone.get_merged_bp_rules(drone, "proc_sys")
+            self.assertFalse(merged is cached)
+            self.assertEqual(merged["a"]["rule"], "False")
+            self.assertEqual(Drone._merged_rules_cache[77][0], changed)
+        finally:
+            CMAdb.store, Drone._merged_rules_cache = saved
+
+    def test_warm_find_cache(self):
+        """
+        Warm-start find cache entries survive transaction aborts until they're used
+        :return: None
+        """
+        Drone.flush_find_cache()
+        key = ("name", "global", "servidor", None)
+        try:
+            self.assertEqual(Drone.warm_find_cache([(key, 12345, "servidor")]), 1)
+            self.assertEqual(Drone.warm_find_cache([(key, 54321, "servidor")]), 0)
+            Drone.flush_find_cache()
+            self.assertEqual(Drone._find_cache[key], 12345)
+            self.assertEqual(Drone._find_cache_unverified[key], "servidor")
+            Drone.forget_cached(12345)
+            self.assertFalse(key in Drone._find_cache)
+            self.assertFalse(key in Drone._find_cache_unverified)
+        finally:
+            Drone._find_cache_unverified = {}
+            Drone.flush_find_cache()
+
+    def test_forget_cached_ips(self):
+        """
+        IP addresses moving to another Drone are forgotten - whichever Drone had them
+        :return: None
+        """
+        Drone.flush_find_cache()
+        moved = ("ip", "global", "::ffff:10.10.10.1")
+        kept = ("ip", "global", "::ffff:10.10.10.2")
+        name = ("name", "global", "servidor", None)
+        try:
+            Drone.warm_find_cache([(moved, 111, "servidor"), (name, 111, "servidor")])
+            Drone.warm_find_cache([(kept, 222, "cliente")])
+            Drone.forget_cached_ips(["::ffff:10.10.10.1"])
+            self.assertFalse(moved in Drone._find_cache)
+            self.assertFalse(moved in Drone._find_cache_unverified)
+            self.assertFalse("::ffff:10.10.10.1" in Drone._find_cache_ips)
+            self.assertEqual(Drone._find_cache_keys[111], {name})
+            self.assertEqual(Drone._find_cache[kept], 222)
+            self.assertEqual(Drone._find_cache_ips["::ffff:10.10.10.2"], {kept})
+        finally:
+            Drone._find_cache_unverified = {}
+            Drone.flush_find_cache()
+
+    def test_forget_deleted_drone(self):
+        """
+        Deleting a Drone forgets all its find cache entries - its node id may be reused
+        :return: None
+        """
+        Drone.flush_find_cache()
+        ipkey = ("ip", "global", "::ffff:10.10.10.1")
+        names = [("name", "global", "servidor", None), ("name", "global", "servidor", 1984)]
+        try:
+            Drone.warm_find_cache([(key, 111, "servidor") for key in [ipkey] + names])
+            self.assertEqual(Drone._find_cache_keys[111], set([ipkey] + names))
+            Drone._on_delete(None, None, 111)
+            self.assertEqual(Drone._find_cache, {})
+            self.assertEqual(Drone._find_cache_keys, {})
+            self.assertEqual(Drone._find_cache_ips, {})
+        finally:
+            Drone._find_cache_unverified = {}
+            Drone.flush_find_cache()
+
+    def test_merge_bp_rules(self):
+        """
+        Rules earlier in a best practice rule chain override the ones they're based on
+        :return: None
+        """
+        merged = Drone.merge_bp_rules(['{"a": {"rule": "new"}}', '{"a": {"rule": "old"}, "b": 2}'])
+        self.assertEqual(merged["a"]["rule"], "new")
+        self.assertEqual(merged["b"], 2)
+
+
+class TestAdmission(TestCase):
+    def test_token_bucket(self):
+        """
+        A token bucket allows 'burst' at once - then 'rate' per second
+        :return: None
+        """
+        bucket = TokenBucket(10, 2)
+        self.assertEqual(bucket.take(100.0), 0.0)
+        self.assertEqual(bucket.take(100.0), 0.0)
+        self.assertAlmostEqual(bucket.take(100.0), 0.1)
+        self.assertEqual(bucket.take(100.1), 0.0)
+
+    def test_startup_deferral(self):
+        """
+        STARTUPs over their limit are deferred - other FrameSets are admitted
+        :return: None
+        """
+        admission = AdmissionController(limits={"STARTUP": {"rate": 1, "burst": 1}})
+        addr = pyNetAddr("10.10.10.1", port=1984)
+        startup = pyFrameSet(FrameSetTypes.STARTUP)
+        ping = pyFrameSet(FrameSetTypes.PING)
+        self.assertEqual(admission.admit(addr, startup, now=10.0)[0], AdmissionController.ADMIT)
+        verdict, wait = admission.admit(addr, startup, now=10.0)
+        self.assertEqual(verdict, AdmissionController.DEFER)
+        self.assertEqual(wait, AdmissionController.STARTUP_RETRY)
+        self.assertEqual(admission.admit(addr, ping, now=10.0)[0], AdmissionController.ADMIT)
+        self.assertEqual(admission.admit(addr, startup, now=15.0)[0], AdmissionController.ADMIT)
+        self.assertRaises(ValueError, AdmissionController, {"NOSUCHTYPE": {"rate": 1}})
+
+    def test_death_batching(self):
+        """
+        Repeated death reports are merged, and deaths are collected into batches
+        :return: None
+        """
+        admission = AdmissionController(death_window_ms=200, death_merge_s=30)
+        dead = pyNetAddr("10.10.10.2", port=1984)
+        reporter = pyNetAddr("10.10.10.3", port=1984)
+        self.assertTrue(admission.report_death(dead, reporter, now=10.0))
+        mapped = pyNetAddr("::ffff:10.10.10.2", port=1984)
+        self.assertFalse(admission.report_death(mapped, reporter, now=10.1))
+        self.assertEqual(admission.pending_death_count(), 1)
+        self.assertEqual(admission.take_pending_deaths(now=10.2), [(dead, reporter)])
+        self.assertFalse(admission.report_death(dead, reporter, now=20.0))
+        self.assertTrue(admission.report_death(dead, reporter, now=50.0))
+        admission.forget_death(dead)
+        self.assertEqual(admission.pending_death_count(), 0)
+
+    def test_death_aborts(self):
+        """
+        Deaths only count once their transaction commits - failed batches are retried once
+        :return: None
+        """
+        admission = AdmissionController(death_window_ms=200, death_merge_s=30)
+        dead = pyNetAddr("10.10.10.2", port=1984)
+        reporter = pyNetAddr("10.10.10.3", port=1984)
+        self.assertTrue(admission.report_death(dead, reporter, now=10.0))
+        self.assertEqual(admission.take_pending_deaths(now=10.2), [(dead, reporter)])
+        admission.abort_deaths()
+        self.assertEqual(admission.take_pending_deaths(now=10.4), [(dead, reporter)])
+        admission.abort_deaths()  # Failed again - we give up on it
+        self.assertEqual(admission.pending_death_count(), 0)
+        self.assertTrue(admission.report_death(dead, reporter, now=11.0))
+        self.assertEqual(admission.take_pending_deaths(now=11.2), [(dead, reporter)])
+        admission.commit_deaths()
+        admission.abort_deaths()  # Nothing uncommitted left to undo
+        self.assertFalse(admission.report_death(dead, reporter, now=12.0))
+        immediate = AdmissionController(death_window_ms=0, death_merge_s=30)
+        self.assertTrue(immediate.report_death(dead, reporter, now=10.0))
+        immediate.abort_deaths()
+        self.assertTrue(immediate.report_death(dead, reporter, now=10.1))
+        immediate.commit_deaths()
+        self.assertFalse(immediate.report_death(dead, reporter, now=10.2))
+
+
+class FakeSystem(object):
+    "Just enough of a SystemNode for a DiscoveryScheduler"
+
+    def __init__(self, designation, domain="global"):
+        self.designation = designation
+        self.domain = domain
+        self.requests = []
+
+    def request_discovery(self, args):
+        self.requests.append(args)
+
+
+class TestDiscoveryScheduler(TestCase):
+    def test_backoff(self):
+        """
+        Quiet discoveries back off to max_interval - and speed up again when they change
+        :return: None
+        """
+        scheduler = DiscoveryScheduler(min_interval=30, max_interval=240, stable_after=2)
+        system = FakeSystem("servidor")
+        request = pyConfigContext(init='{"type": "proc_sys", "instance": "_auto_proc_sys"}')
+        self.assertEqual(scheduler.interval_for(system, "_auto_proc_sys", 60, request), 60)
+        scheduler.note_discovery(system, "_auto_proc_sys", False)  # Ran because we asked
+        scheduler.note_discovery(system, "_auto_proc_sys", False)
+        key = ("global", "servidor", "_auto_proc_sys")
+        self.assertEqual(scheduler.schedules[key]["interval"], 60)
+        for _ in range(10):
+            scheduler.note_discovery(system, "_auto_proc_sys", False)
+        self.assertEqual(scheduler.interval_for(system, "_auto_proc_sys", 60, request), 240)
+        scheduler.note_discovery(system, "_auto_proc_sys", True)
+        self.assertEqual(scheduler.schedules[key]["interval"], 120)
+        self.assertEqual(scheduler.pending_count(), 1)
+        self.assertEqual(scheduler.flush(), 1)
+        self.assertEqual(len(system.requests), 1)
+        self.assertEqual(system.requests[0][0]["instance"], "_auto_proc_sys")
+        self.assertEqual(scheduler.pending_count(), 0)
+
+    def test_domains(self):
+        """
+        Systems with the same name in different domains have their own schedules
+        :return: None
+        """
+        scheduler = DiscoveryScheduler(min_interval=30, max_interval=240, stable_after=1)
+        ours, theirs = FakeSystem("servidor"), FakeSystem("servidor", domain="other")
+        request = pyConfigContext(init='{"type": "proc_sys", "instance": "_auto_proc_sys"}')
+        for system in (ours, theirs):
+            scheduler.interval_for(system, "_auto_proc_sys", 60, request)
+            scheduler.note_discovery(system, "_auto_proc_sys", True)
+        self.assertEqual(scheduler.pending_count(), 2)
+        self.assertEqual(scheduler.flush(), 2)
+        self.assertEqual((len(ours.requests), len(theirs.requests)), (1, 1))
+
+    def test_one_shot(self):
+        """
+        Discoveries which don't repeat are left alone
+        :return: None
+        """
+        scheduler = DiscoveryScheduler()
+        system = FakeSystem("servidor")
+        request = pyConfigContext(init='{"type": "os", "instance": "_init_os"}')
+        self.assertEqual(scheduler.interval_for(system, "_init_os", 0, request), 0)
+        scheduler.note_discovery(system, "_init_os", False)
+        self.assertEqual(scheduler.pending_count(), 0)
+
+
 TestFoo.config_foo()
 
 if __name__ == "__main__":
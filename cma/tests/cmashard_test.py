@@ -0,0 +1,127 @@
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""Tests for sharding the CMA across worker processes"""
+from __future__ import print_function
+
+_suites = ["all", "cma"]
+import sys
+import json
+import socket
+import logging
+
+sys.path.extend(["..", "../cma"])
+from cmashard import ShardMap, CMAShard
+
+
+class TestCase(object):
+    def assertEqual(self, a, b):
+        assert a == b
+
+    def assertTrue(self, a):
+        assert a is True
+
+    def assertFalse(self, a):
+        assert a is False
+
+    def assertRaises(self, exception, function, *args, **kw):
+        try:
+            function(*args, **kw)
+            raise Exception("Did not raise exception %s: %s(%s)", exception, function, str(args))
+        except exception as e:
+            return True
+
+
+class TestShardMap(TestCase):
+    def test_split_addr(self):
+        self.assertEqual(ShardMap.split_addr("10.10.10.1:1984")[1], 1984)
+        self.assertEqual(ShardMap.split_addr("[::ffff:10.10.10.1]:1984")[1], 1984)
+        self.assertEqual(str(ShardMap.split_addr("[fe80::1]:1984")[0]), "fe80::1")
+        self.assertEqual(ShardMap.split_addr("10.10.10.1")[1], 0)
+
+    def test_shard_of(self):
+        shardmap = ShardMap(4)
+        self.assertEqual(
+            shardmap.shard_of("10.10.10.1:1984"), shardmap.shard_of("[::ffff:10.10.10.1]:1984")
+        )
+        for host in range(1, 255):
+            self.assertTrue(0 <= shardmap.shard_of("10.10.10.%d:1984" % host) < 4)
+        shards = set(shardmap.shard_of("10.10.10.%d:1984" % host) for host in range(1, 255))
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(shardmap.shard_of_name("switch-1"), shardmap.shard_of_name("switch-1"))
+        self.assertEqual(ShardMap(1).shard_of("10.10.10.1:1984"), 0)
+
+
+class StubDispatcher(object):
+    "Just enough of a MessageDispatcher for receiving shard messages"
+
+    def __init__(self):
+        self.transactions = []
+
+    def run_transaction(self, description, action, *args):
+        self.transactions.append(description)
+        action(*args)
+
+
+@CMAShard.handler("testop")
+def shard_testop(args):
+    "Our test operation"
+    TestCMAShard.received.append(args)
+
+
+class TestCMAShard(TestCase):
+    received = []
+
+    def test_receive_all(self):
+        sender, channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        channel.setblocking(False)
+        shard = CMAShard(ShardMap(2), 0, "/nonexistent", channel, None)
+        shard.dispatcher = StubDispatcher()
+        shard.log = logging.getLogger("cmashard_test")
+        for message in (
+            {"op": "testop", "from": 1, "args": {"x": 1}},
+            {"op": "nosuchop", "from": 1, "args": {}},
+            {"from": 1, "args": {}},
+        ):
+            sender.send(json.dumps(message).encode("utf-8"))
+        sender.send(b"not JSON")
+        shard.MAX_MESSAGE = 64
+        sender.send(json.dumps({"op": "testop", "from": 1, "args": {"x": "y" * 64}}).encode())
+        self.assertEqual(shard.receive_all(), 5)
+        self.assertEqual(TestCMAShard.received, [{"x": 1}])
+        self.assertEqual(shard.dispatcher.transactions, ["CMA shard testop from shard 1"])
+        self.assertEqual((shard.stats["unknown"], shard.stats["bad_messages"]), (1, 3))
+        sender.close()
+        channel.close()
+
+    def test_deferred(self):
+        shard = CMAShard(ShardMap(3), 0, "/nonexistent", None, None)
+        sent = []
+        shard.send = lambda index, operation, **args: sent.append((index, operation, args))
+        shard.defer_name("global", "testop", x=1)
+        shard.defer_broadcast("testop", y=2)
+        self.assertEqual(sent, [])
+        shard.send_deferred()
+        owner = ShardMap(3).shard_of_name("global")
+        self.assertEqual(
+            sent, [(owner, "testop", {"x": 1}), (1, "testop", {"y": 2}), (2, "testop", {"y": 2})]
+        )
+        shard.defer_name("global", "testop", x=3)
+        shard.drop_deferred()
+        shard.send_deferred()
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(shard.stats["dropped"], 1)
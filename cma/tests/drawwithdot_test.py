@@ -0,0 +1,115 @@
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""Tests for streaming DotGraph drawings"""
+from __future__ import print_function
+
+_suites = ["all", "cma"]
+import sys
+import collections
+
+sys.path.extend(["..", "../cma"])
+from drawwithdot import DotGraph, NodeView, SubgraphCache, construct_dot_formats
+
+
+class TestCase(object):
+    def assertEqual(self, a, b):
+        assert a == b
+
+    def assertTrue(self, a):
+        assert a is True
+
+    def assertFalse(self, a):
+        assert a is False
+
+    def assertRaises(self, exception, function, *args, **kw):
+        try:
+            function(*args, **kw)
+            raise Exception("Did not raise exception %s: %s(%s)", exception, function, str(args))
+        except exception as e:
+            return True
+
+
+class StubStore(object):
+    "Just enough of a Store to list relationship types"
+
+    Row = collections.namedtuple("Row", ("type",))
+
+    def __init__(self, reltypes):
+        self.reltypes = reltypes
+
+    def load_cypher_query(self, querystr, params=None, maxcount=None, reader=False):
+        return [StubStore.Row(reltype) for reltype in self.reltypes]
+
+
+class StubGraphStore(object):
+    "Just enough of a Store to draw two hosts whose Drones are related to each other"
+
+    Row = collections.namedtuple("Row", ("host", "id", "props", "type", "start_node", "end_node"))
+
+    def load_cypher_query(self, querystr, params=None, maxcount=None, reader=False):
+        row = StubGraphStore.Row
+        if querystr == DotGraph.DRONE_PAGE_QUERY % "":
+            if params["after"]:
+                return []
+            return [row(host, None, None, None, None, None) for host in ("h1", "h2")]
+        if "drone.designation AS host" in querystr:
+            return [
+                row("h1", 1, {"nodetype": "Drone"}, None, None, None),
+                row("h2", 2, {"nodetype": "Drone"}, None, None, None),
+            ]
+        return [row(None, 10, {}, "dependson", 1, 2)]
+
+
+class TestDotGraph(TestCase):
+    def test_node_view(self):
+        view = NodeView(None, 42, {"nodetype": "NICNode", "json": '{"mtu": 1500}'})
+        self.assertEqual(view["_node_id"], 42)
+        self.assertEqual(view.nodetype, "NICNode")
+        self.assertEqual(view.deepget("json.mtu"), 1500)
+        self.assertTrue("nodetype" in view)
+        self.assertFalse("os" in view)
+        self.assertRaises(KeyError, view.__getitem__, "os")
+
+    def test_subgraph_cache(self):
+        nodes = {1: {"nodetype": "Drone", "status": "up"}}
+        rels = [{"_id": 7, "type": "nicowner", "start_node": 1, "end_node": 2}]
+        fingerprint = DotGraph.fingerprint(nodes, rels)
+        cache = SubgraphCache()
+        self.assertTrue(cache.lookup("h1", fingerprint) is None)
+        cache.remember("h1", fingerprint, ([(1, "node_1\n")], []))
+        self.assertEqual(cache.lookup("h1", fingerprint), ([(1, "node_1\n")], []))
+        nodes[1]["status"] = "dead"
+        self.assertTrue(cache.lookup("h1", DotGraph.fingerprint(nodes, rels)) is None)
+        cache.prune(set())
+        self.assertEqual(cache.report(), {"hits": 1, "misses": 2, "hosts": 0})
+
+    def test_ring_partitions(self):
+        store = StubStore(["nicowner", "RingNext_The_One_Ring_0", "RingNext_The_One_Ring_1"])
+        dot = DotGraph(construct_dot_formats("monring"), store=store)
+        dot._add_ring_partitions()
+        self.assertEqual(
+            sorted(dot.formatdict["relationships"]),
+            ["RingNext_The_One_Ring", "RingNext_The_One_Ring_0", "RingNext_The_One_Ring_1"],
+        )
+
+    def test_cross_host_relationships(self):
+        formats = {"nodes": {"Drone": "%(id)s"}, "relationships": {"dependson": "%(from)s->%(to)s"}}
+        dot = DotGraph(formats, store=StubGraphStore(), pagesize=2)
+        lines = list(dot.render())
+        self.assertEqual(lines[1:-1], ["node_1\n", "node_2\n", "node_1->node_2\n"])
+        self.assertEqual(dot.stats["relationships"], 1)
@@ -0,0 +1,144 @@
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""Tests for ClientQuery result caching and our streaming query service"""
+from __future__ import print_function
+
+_suites = ["all", "cma"]
+import sys
+
+sys.path.extend(["..", "../cma"])
+from query import CypherExecutor, QueryResultCache
+from queryservice import StorePool, PooledStream, RateLimiter, CursorCodec, stream_query
+
+
+class TestCase(object):
+    def assertEqual(self, a, b):
+        assert a == b
+
+    def assertTrue(self, a):
+        assert a is True
+
+    def assertFalse(self, a):
+        assert a is False
+
+    def assertRaises(self, exception, function, *args, **kw):
+        try:
+            function(*args, **kw)
+            raise Exception("Did not raise exception %s: %s(%s)", exception, function, str(args))
+        except exception as e:
+            return True
+
+
+class TestQueryResultCache(TestCase):
+    def test_cypher_labels(self):
+        def labels(cypher):
+            return CypherExecutor(None, {"cypher": cypher}).labels()
+
+        self.assertEqual(labels("MATCH(drone:Class_Drone) RETURN drone"), ("Class_Drone",))
+        self.assertEqual(
+            labels("MATCH (n:Class_NICNode)<-[:nicowner]-(s:Class_SystemNode) RETURN n, s"),
+            ("Class_NICNode", "Class_SystemNode"),
+        )
+        self.assertEqual(
+            labels("MATCH (d:Class_Drone) MATCH (d)-[:r]->(d) RETURN d"), ("Class_Drone",)
+        )
+        self.assertEqual(labels("MATCH (d:Class_Drone)-[:hosting]->(s) RETURN d, s"), None)
+        self.assertEqual(labels("MATCH (d:Class_Drone)-->() RETURN d"), None)
+        self.assertEqual(labels("MATCH (n:Subnet_10_0_0_0) RETURN n"), None)
+        self.assertEqual(labels("START d=node:Drone('*:*') RETURN d"), None)
+
+    def test_cache(self):
+        cache = QueryResultCache(maxentries=2, maxbytes=10)
+        stamp = (("Class_Person", 1),)
+        self.assertEqual(cache.lookup("a", stamp), None)
+        self.assertEqual(list(cache.cache_results("a", stamp, iter(["x", "y"]))), ["x", "y"])
+        self.assertEqual(cache.lookup("a", stamp), ["x", "y"])
+        self.assertEqual(len(list(cache.cache_results("big", stamp, iter(["0123456789", "x"])))), 2)
+        self.assertEqual(cache.lookup("big", stamp), None)
+        self.assertEqual(cache.lookup("a", (("Class_Person", 2),)), None)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 3))
+        self.assertEqual((stats["stale"], stats["oversize"], stats["entries"]), (1, 1, 0))
+        self.assertEqual(stats["hitrate"], 0.25)
+
+    def test_paged_cache(self):
+        cache = QueryResultCache(maxentries=2, maxbytes=10)
+        stamp = (("Class_Person", 1),)
+        results = cache.cache_results("a", stamp, iter(["x", "y", "z"]))
+        self.assertEqual(next(results), "x")
+        results.close()  # Our consumer only wanted the first page
+        self.assertEqual(cache.lookup("a", stamp), ["x", "y", "z"])
+        results = cache.cache_results("big", stamp, iter(["x", "0123456789", "y"]))
+        self.assertEqual(next(results), "x")
+        results.close()
+        self.assertEqual(cache.lookup("big", stamp), None)
+
+
+class StubStore(object):
+    "Just enough of a read-only Store for our StorePool"
+
+    readonly = True
+
+
+class StubQuery(object):
+    "Just enough of a ClientQuery for testing our query service"
+
+    def __init__(self, queryname, metadata):
+        self.queryname = queryname
+        self.store = None
+
+    def bind_store(self, store):
+        self.store = store
+
+    def execute(self, executor_context, idsonly, expandjson, maxjson, elemsonly, **params):
+        if params:
+            raise ValueError("Excess parameters")
+        return ('{"row":%d}' % row for row in range(7))
+
+
+class TestQueryService(TestCase):
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=2, burst=2)
+        self.assertEqual([limiter.allow("a", now=100.0) for _ in range(3)], [0.0, 0.0, 0.5])
+        self.assertEqual(limiter.allow("a", now=100.5), 0.0)
+        self.assertEqual(limiter.allow("b", now=100.5), 0.0)
+        self.assertEqual(limiter.report(), {"allowed": 4, "limited": 1, "clients": 2})
+
+    def test_cursors(self):
+        codec = CursorCodec(b"secret")
+        cursor = codec.encode("allips", {"host": "fred"}, 10, 5)
+        self.assertEqual(codec.decode(cursor, "allips"), ({"host": "fred"}, 10, 5))
+        self.assertRaises(ValueError, codec.decode, cursor, "allservers")
+        self.assertRaises(ValueError, CursorCodec(b"other").decode, cursor, "allips")
+        self.assertRaises(ValueError, codec.decode, cursor[:-2], "allips")
+
+    def test_store_pool(self):
+        pool = StorePool(StubStore, StubQuery, 1, 0.05)
+        pooled = pool.acquire()
+        self.assertRaises(RuntimeError, pool.acquire)
+        query = pooled.query("q", "{}")
+        self.assertTrue(query.store is pooled.store)
+        self.assertRaises(ValueError, stream_query, query, {"extra": "1"})
+        body = PooledStream(pool, pooled, stream_query(query, {}, offset=2, limit=3))
+        self.assertEqual(list(body), ['{"row":2}\n', '{"row":3}\n', '{"row":4}\n'])
+        body.close()
+        body.close()
+        self.assertTrue(pool.acquire() is pooled)
+        self.assertTrue(pooled.query("q", "{}") is query)
+        report = pool.report()
+        self.assertEqual((report["created"], report["in_use"], report["timeouts"]), (1, 1, 1))
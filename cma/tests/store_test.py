@@ -31,6 +31,8 @@ sys.path.extend(["..", "../cma", "/usr/local/lib/python2.7/dist-packages"])
 import py2neo
 from py2neo import Graph, GraphError
 from store import Store
+from neopool import Neo4jRouter
+from cypherprofile import CypherProfiler, statement_shape
 from AssimCclasses import pyNetAddr, dump_c_objects
 from AssimCtypes import ADDR_FAMILY_802, proj_class_live_object_count, proj_class_dump_live_objects
 from graphnodes import GraphNode, registergraphclass, JSONMapNode
@@ -580,6 +582,150 @@ class TestSystemNode(TestCase):
         assert len(valset) == 0
 
 
+class StubGraph(object):
+    "Just enough of a py2neo.Graph for testing our connection pools"
+
+    def __init__(self, name):
+        self.name = name
+        self.statements = []
+
+    def run(self, querystr, params=None):
+        self.statements.append(querystr)
+        return None
+
+    def evaluate(self, querystr, params=None):
+        self.statements.append(querystr)
+        return self.name
+
+
+class TestNeo4jPool(TestCase):
+    def test_pool_routing(self):
+        primary, replica1, replica2 = StubGraph("primary"), StubGraph("r1"), StubGraph("r2")
+        router = Neo4jRouter(primary, [replica1, replica2], writer_size=2, reader_size=1)
+        writer = Store(primary, FooClass.log, pool=router.writer, reader_pool=router.reader)
+        self.assertEqual(writer._evaluate(writer.db, "RETURN 1"), "primary")
+        writer._run(writer.db, "MATCH (n) RETURN n", reader=True)
+        writer._run(writer.db, "MATCH (n) RETURN n", reader=True)
+        self.assertEqual(len(primary.statements), 1)
+        self.assertEqual((len(replica1.statements), len(replica2.statements)), (1, 1))
+        reader = Store(router.reader.graph, FooClass.log, readonly=True, pool=router.reader)
+        self.assertEqual(reader._evaluate(reader.db, "RETURN 1"), "r1")
+        self.assertEqual(router.reader.stats["checkouts"], 3)
+        self.assertEqual(router.writer.stats["checkouts"], 1)
+
+    def test_pool_waits(self):
+        pool = Neo4jRouter(StubGraph("primary"), reader_size=1, timeout=0.05).reader
+        graph = pool.acquire()
+        self.assertEqual(graph.name, "primary")
+        try:
+            pool.acquire()
+            raise AssertionError("acquire() did not time out")
+        except RuntimeError as oops:
+            message = str(oops)
+        self.assertTrue("reader pool" in message and "(1 of 1 slots in use)" in message)
+        self.assertEqual(pool.stats["timeouts"], 1)
+        pool.release()
+        with pool.connection() as graph:
+            self.assertEqual(graph.name, "primary")
+        self.assertEqual(pool.stats["checkouts"], 2)
+        self.assertRaises(RuntimeError, pool.release)
+
+    def test_cursor_keeps_slot(self):
+        graph = CursorGraph("primary")
+        pool = Neo4jRouter(graph, reader_size=1, timeout=0.05).reader
+        store = Store(graph, FooClass.log, readonly=True, pool=pool)
+        cursor = store._run(store.db, "MATCH (n) RETURN n", reader=True)
+        cursor.forward()
+        self.assertRaises(RuntimeError, pool.acquire)  # Still reading our rows
+        while cursor.forward():
+            pass
+        pool.acquire()
+        pool.release()
+        cursor = store._run(store.db, "MATCH (n) RETURN n", reader=True)
+        cursor.forward()
+        del cursor  # Stopped reading early
+        pool.acquire()
+        pool.release()
+
+
+class TestStoreEpochs(TestCase):
+    def test_epochs(self):
+        store = Store(StubGraph("primary"), FooClass.log)
+        drone = Store.epoch_stamp(("Class_aTestDrone",))
+        system = Store.epoch_stamp(("Class_aTestSystem",))
+        person = Store.epoch_stamp(("Class_Person",))
+        anything = Store.epoch_stamp()
+        store._touch(aTestDrone)
+        store.bump_epochs()
+        self.assertNotEqual(drone, Store.epoch_stamp(("Class_aTestDrone",)))
+        self.assertNotEqual(system, Store.epoch_stamp(("Class_aTestSystem",)))
+        self.assertEqual(person, Store.epoch_stamp(("Class_Person",)))
+        self.assertNotEqual(anything, Store.epoch_stamp())
+        anything = Store.epoch_stamp()
+        store.bump_epochs()  # Nothing touched - nothing changes
+        self.assertEqual(anything, Store.epoch_stamp())
+        store.touched_labels.add(None)  # Like update_cypher_query()
+        store.bump_epochs()
+        self.assertNotEqual(person, Store.epoch_stamp(("Class_Person",)))
+
+
+class StubCursor(object):
+    "Just enough of a py2neo.Cursor for testing our Cypher profiler"
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.current = None
+
+    def forward(self, amount=1):
+        if not self.rows:
+            return 0
+        self.current = self.rows.pop(0)
+        return 1
+
+
+class CursorGraph(StubGraph):
+    "A StubGraph whose statements return three rows"
+
+    def run(self, querystr, params=None):
+        StubGraph.run(self, querystr, params)
+        return StubCursor([(1,), (2,), (3,)])
+
+
+class TestCypherProfiler(TestCase):
+    def test_statement_shape(self):
+        self.assertEqual(
+            statement_shape("MATCH (Drone12) WHERE Drone12.designation = 'host\\'s'\n RETURN 42"),
+            "MATCH (Drone) WHERE Drone.designation = ? RETURN ?",
+        )
+        self.assertEqual(
+            statement_shape("MATCH (n) WHERE n.port IN [22, 80, -1.5e3] AND n.x = $x0"),
+            "MATCH (n) WHERE n.port IN [?] AND n.x = $x",
+        )
+
+    def test_profiler(self):
+        profiler = CypherProfiler(slow_ms=0)
+        store = Store(CursorGraph("primary"), FooClass.log, profiler=profiler)
+        with CypherProfiler.calling("STARTUP"):
+            with CypherProfiler.calling("TCPDiscoveryListener"):
+                for host in ("a", "b"):
+                    cursor = store._run(store.db, "MATCH (n) WHERE n.name = '%s' RETURN n" % host)
+                    while cursor.forward():
+                        pass
+            cursor = store._run(store.db, "MATCH (n) WHERE n.name = 'c' RETURN n")
+            cursor.forward()  # Stop reading early - recorded when the cursor goes away
+            del cursor
+        self.assertEqual(CypherProfiler.caller, None)
+        report = profiler.report()
+        self.assertEqual(report["statements"], 3)
+        self.assertEqual(len(report["shapes"]), 1)
+        shape = report["shapes"][0]
+        self.assertEqual(shape["shape"], "MATCH (n) WHERE n.name = ? RETURN n")
+        self.assertEqual(shape["rows"], 7)
+        self.assertEqual(shape["callers"], {"STARTUP/TCPDiscoveryListener": 2, "STARTUP": 1})
+        self.assertEqual(len(report["slow_log"]), 3)
+        self.assertEqual(store.stats["statements"], 3)
+
+
 # Other things that ought to have tests:
 #   node deletion
 #   Searching for nodes we just added (I forgot which ones work that way)
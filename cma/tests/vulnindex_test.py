@@ -0,0 +1,102 @@
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""Tests for our offline vulnerability index"""
+from __future__ import print_function
+
+_suites = ["all", "cma"]
+import sys
+
+sys.path.extend(["..", "../cma"])
+import os
+import tempfile
+from vulnindex import VulnerabilityIndex, VersionComparator, VulnerabilityCorrelator, DroneSoftware
+from parsemail import UbuntuAnnouncement
+
+
+class TestCase(object):
+    def assertEqual(self, a, b):
+        assert a == b
+
+    def assertTrue(self, a):
+        assert a is True
+
+    def assertFalse(self, a):
+        assert a is False
+
+    def assertRaises(self, exception, function, *args, **kw):
+        try:
+            function(*args, **kw)
+            raise Exception("Did not raise exception %s: %s(%s)", exception, function, str(args))
+        except exception as e:
+            return True
+
+
+USN_MBOX = """From security at ubuntu.com  Tue Mar 27 12:00:00 2018
+From: Ubuntu Security <security at ubuntu.com>
+Date: Tue, 27 Mar 2018 12:00:00 -0400
+Subject: [USN-3611-1] OpenSSL vulnerabilities
+
+Ubuntu Security Notice USN-3611-1
+Details:
+CVE-2018-0739 and CVE-2017-3738 were fixed.
+
+Update instructions:
+
+Ubuntu 16.04 LTS:
+  libssl1.0.0                     1.0.2g-1ubuntu4.11
+
+"""
+
+
+class TestVulnerabilityIndex(TestCase):
+    def test_versions(self):
+        comparator = VersionComparator()
+        self.assertEqual(comparator.compare("deb", "1.0.2g-1ubuntu4.10", "1.0.2g-1ubuntu4.11"), -1)
+        self.assertEqual(comparator.compare("deb", "1.0~rc1", "1.0"), -1)
+        self.assertEqual(comparator.compare("deb", "1:0.1", "2.0"), 1)
+        self.assertEqual(comparator.compare("deb", "1.0", "1.0-0"), 0)
+        self.assertEqual(comparator.compare("rpm", "1.0.2k-8.el7", "1.0.2k-12"), -1)
+        self.assertEqual(comparator.compare("rpm", "1.0.2k-12.el7_4", "1.0.2k-12"), 1)
+        self.assertEqual(comparator.compare("rpm", "1.0.2k-8.el7", "1.0.2k-12"), -1)
+        self.assertEqual(comparator.stats()["hits"], 1)
+
+    def test_correlate(self):
+        mboxdir = tempfile.mkdtemp()
+        with open(os.path.join(mboxdir, "2018-March.txt"), "w") as mbox:
+            mbox.write(USN_MBOX)
+        index = VulnerabilityIndex(":memory:")
+        self.assertEqual(index.ingest_directory(mboxdir, UbuntuAnnouncement), 2)
+        self.assertEqual(index.ingest_directory(mboxdir, UbuntuAnnouncement), 0)
+        packages = {
+            "old": {"deb": {"libssl1.0.0::amd64": "1.0.2g-1ubuntu4.10", "bash::amd64": "4.3"}},
+            "new": {"deb": {"libssl1.0.0::amd64": "1.0.2g-1ubuntu4.11"}},
+        }
+        drones = [DroneSoftware(name, "ubuntu", "16.04", "old") for name in ("a", "b")]
+        correlator = VulnerabilityCorrelator(index)
+        changes = list(correlator.correlate(drones, packages.get))
+        self.assertEqual(
+            [(c.change, c.designation, c.cve) for c in changes[:2]],
+            [("new", "a", "CVE-2017-3738"), ("new", "a", "CVE-2018-0739")],
+        )
+        self.assertEqual(len(changes), 4)
+        self.assertEqual(correlator.stats["packagesets"], 1)
+        self.assertEqual(list(correlator.correlate(drones, packages.get)), [])
+        drones[0] = DroneSoftware("a", "ubuntu", "16.04", "new")
+        changes = list(correlator.correlate(drones, packages.get))
+        self.assertEqual(set((c.change, c.designation) for c in changes), {("resolved", "a")})
+        self.assertEqual(len(list(correlator.findings())), 2)
@@ -0,0 +1,631 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100 fileencoding=utf-8
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Offline correlation of security announcements with the packages installed on our Drones.
+
+    VulnerabilityIndex      a persistent SQLite index of (distro, release, package, fixed version,
+                            advisory, CVE) - built from local mbox archives of announcements
+    VersionComparator       memoized rpm and deb version comparisons
+    DroneSoftwareLoader     reads every Drone's OS and package discovery in bulk
+    VulnerabilityCorrelator joins the index against the Drones' packages - yielding the
+                            findings which have changed since the last time it ran
+
+Each mbox archive is (re)read only when it changes, and each Drone is re-checked only when
+its packages change - or only against the fixes added since it was last checked when the
+index changes. Drones with identical package sets share a single check.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import sqlite3
+import optparse
+import functools
+import collections
+import inject
+from version_utils import rpm
+import parsemail
+
+DEFAULT_INDEX = "/var/lib/assimilation/vulnindex.sqlite"
+DroneSoftware = collections.namedtuple("DroneSoftware", "designation distro osrel pkghash")
+Finding = collections.namedtuple("Finding", "package installed fixed_version advisory cve")
+FindingChange = collections.namedtuple(
+    "FindingChange", "change designation package installed fixed_version advisory cve"
+)
+
+
+class VulnerabilityIndex(object):
+    """
+    A persistent SQLite index of which package versions fix which vulnerabilities.
+    Every change to the index gets a new generation number - each fix remembers the
+    generation that added it. When an mbox archive changes, its old fixes are retracted,
+    and we remember that generation too - so correlators know to start over.
+    """
+
+    # Which kind of packages each distribution uses
+    PACKAGE_TYPES = {
+        "centos": "rpm",
+        "redhat": "rpm",
+        "fedora": "rpm",
+        "ubuntu": "deb",
+        "debian": "deb",
+    }
+    CHUNK = 500  # Keeps us well under SQLite's limit on the number of parameters
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)""",
+        """CREATE TABLE IF NOT EXISTS mboxes
+           (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, generation INTEGER)""",
+        """CREATE TABLE IF NOT EXISTS fixes
+           (distro TEXT, osrel TEXT, package TEXT, fixed_version TEXT, advisory TEXT,
+            cve TEXT, epoch_time INTEGER, mbox TEXT, generation INTEGER)""",
+        """CREATE INDEX IF NOT EXISTS fixes_package ON fixes (distro, osrel, package)""",
+        """CREATE INDEX IF NOT EXISTS fixes_mbox ON fixes (mbox)""",
+    )
+
+    def __init__(self, pathname=DEFAULT_INDEX):
+        """
+        :param pathname: str: pathname of our SQLite database - created if need be
+        """
+        self.pathname = pathname
+        self.db = sqlite3.connect(pathname)
+        with self.db:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+
+    def _meta(self, name):
+        "Return the value of a metadata item - zero if it's never been set"
+        row = self.db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def _set_meta(self, name, value):
+        "Set the value of a metadata item"
+        self.db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+    @property
+    def generation(self):
+        "Generation of the most recent change to the index"
+        return self._meta("generation")
+
+    @property
+    def retracted(self):
+        "Generation of the most recent change which removed fixes from the index"
+        return self._meta("retracted")
+
+    @staticmethod
+    def release_key(distro, release):
+        """
+        Return the release an announcement or Drone belongs to for matching purposes.
+        RPM distributions (CentOS) issue fixes for a whole major release ("7" - not "7.4.1708").
+        Others (Ubuntu) issue them for exact releases ("16.04").
+
+        :param distro: str: distribution name (lower case)
+        :param release: str: release name or number
+        :return: str: release to match on
+        """
+        release = str(release).lower()
+        if VulnerabilityIndex.PACKAGE_TYPES.get(distro) == "rpm":
+            return release.split(".")[0]
+        return release
+
+    def ingest_directory(self, dirname, announcement_cls):
+        """
+        Add the fixes from every new or changed mbox archive under this directory to the index.
+        Archives are read a message at a time - they can be compressed or not.
+
+        :param dirname: str: directory containing mbox archives (any depth)
+        :param announcement_cls: class: parsemail.Announcement subclass to parse them with
+        :return: int: number of fixes added
+        """
+        changed = []
+        for dirpath, _dirnames, filenames in os.walk(dirname):
+            for filename in sorted(filenames):
+                pathname = os.path.join(dirpath, filename)
+                stat = os.stat(pathname)
+                row = self.db.execute(
+                    "SELECT mtime, size FROM mboxes WHERE path = ?", (pathname,)
+                ).fetchone()
+                if row is None or row != (stat.st_mtime, stat.st_size):
+                    changed.append((pathname, stat))
+        if not changed:
+            return 0
+        generation = self.generation + 1
+        added = 0
+        with self.db:
+            for pathname, stat in changed:
+                cursor = self.db.execute("DELETE FROM fixes WHERE mbox = ?", (pathname,))
+                if cursor.rowcount > 0:
+                    self._set_meta("retracted", generation)
+                cursor = self.db.executemany(
+                    """INSERT INTO fixes (distro, osrel, package, fixed_version, advisory, cve,
+                       epoch_time, mbox, generation) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    self._mbox_fixes(pathname, announcement_cls, generation),
+                )
+                added += max(cursor.rowcount, 0)
+                self.db.execute(
+                    "INSERT OR REPLACE INTO mboxes (path, mtime, size, generation)"
+                    " VALUES (?, ?, ?, ?)",
+                    (pathname, stat.st_mtime, stat.st_size, generation),
+                )
+            self._set_meta("generation", generation)
+        return added
+
+    def _mbox_fixes(self, pathname, announcement_cls, generation):
+        """
+        Generator yielding index rows for all the fixes in an mbox archive.
+        Announcements which don't mention a CVE are indexed under their own name.
+
+        :param pathname: str: pathname of the mbox archive
+        :param announcement_cls: class: parsemail.Announcement subclass to parse it with
+        :param generation: int: generation of the index these fixes belong to
+        :return: generator(tuple): rows for the 'fixes' table
+        """
+        for announcement in parsemail.parse_email_mbox_file(pathname, announcement_cls):
+            advisory = announcement.data["name"]
+            cves = announcement.cves() or [advisory]
+            epoch_time = announcement.data.get("epoch_time")
+            seen = set()
+            for distro, osrel, package, version in announcement.fixes():
+                distro = distro.lower()
+                fix = (distro, self.release_key(distro, osrel), package, version)
+                if fix in seen:  # Same fix for several architectures
+                    continue
+                seen.add(fix)
+                for cve in cves:
+                    yield fix + (advisory, cve, epoch_time, pathname, generation)
+
+    def fixes_for(self, distro, osrel, packages, since=0):
+        """
+        Generator yielding the fixes for any of these packages - in bulk
+
+        :param distro: str: distribution name (lower case)
+        :param osrel: str: release - as returned by release_key()
+        :param packages: iterable(str): package names
+        :param since: int: only return fixes added after this generation
+        :return: generator((str, str, str, str)): (package, fixed version, advisory, CVE)
+        """
+        names = sorted(packages)
+        for start in range(0, len(names), self.CHUNK):
+            chunk = names[start : start + self.CHUNK]
+            query = """SELECT package, fixed_version, advisory, cve FROM fixes
+                       WHERE distro = ? AND osrel = ? AND generation > ? AND package IN (%s)"""
+            for row in self.db.execute(
+                query % ", ".join("?" * len(chunk)), [distro, osrel, since] + chunk
+            ):
+                yield row
+
+    def close(self):
+        "Close our database"
+        self.db.close()
+
+
+class VersionComparator(object):
+    """
+    Memoized package version comparisons.
+    The same few versions of each package are installed all over the place, and get compared
+    against the same few fixed versions - so most comparisons are repeats.
+    version_utils only knows how to compare rpm versions - so we compare deb versions
+    ourselves - the way dpkg does.
+    """
+
+    def __init__(self, maxentries=65536):
+        """
+        :param maxentries: int: maximum number of comparisons to remember
+        """
+        self.compare = functools.lru_cache(maxsize=maxentries)(self._compare)
+
+    @staticmethod
+    def _compare(kind, version_a, version_b):
+        """
+        Compare two package versions
+
+        :param kind: str: kind of package - 'rpm' or 'deb'
+        :param version_a: str: a package version
+        :param version_b: str: another package version of the same kind
+        :return: int: 1 if version_a is newer, 0 if they're the same, -1 if version_b is newer
+        """
+        if kind == "rpm":
+            return rpm.compare_evrs(
+                VersionComparator.rpm_evr(version_a), VersionComparator.rpm_evr(version_b)
+            )
+        if kind == "deb":
+            return VersionComparator.deb_compare(version_a, version_b)
+        raise ValueError("Cannot compare versions of %s packages" % kind)
+
+    def stats(self):
+        """
+        Return our statistics
+
+        :return: {str: number}: hits, misses, hit rate and number of remembered comparisons
+        """
+        info = self.compare.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "hitrate": float(info.hits) / lookups if lookups else 0.0,
+            "entries": info.currsize,
+        }
+
+    @staticmethod
+    def rpm_evr(version):
+        """
+        Split an rpm version into (epoch, version, release)
+
+        :param version: str: [epoch:]version[-release]
+        :return: (int, str, str): (epoch, version, release)
+        """
+        epoch = 0
+        if ":" in version:
+            epoch, version = version.split(":", 1)
+            epoch = int(epoch)
+        version, _, release = version.partition("-")
+        return epoch, version, release
+
+    @staticmethod
+    def _deb_order(char):
+        "Return the sort order of a non-digit character in a deb version (end of string is 0)"
+        if char == "":
+            return 0
+        if char == "~":
+            return -1
+        if char.isalpha():
+            return ord(char)
+        return ord(char) + 256
+
+    @staticmethod
+    def _deb_compare_part(part_a, part_b):
+        """
+        Compare two upstream versions or two Debian revisions - the way dpkg's verrevcmp() does:
+        alternating non-digit strings (where '~' sorts before anything - even the end of the
+        string) and numbers.
+
+        :param part_a: str: upstream version or revision
+        :param part_b: str: another one
+        :return: int: <0, 0 or >0 - like cmp()
+        """
+        digits = "0123456789"
+        index_a = index_b = 0
+        len_a, len_b = len(part_a), len(part_b)
+        while index_a < len_a or index_b < len_b:
+            while (index_a < len_a and part_a[index_a] not in digits) or (
+                index_b < len_b and part_b[index_b] not in digits
+            ):
+                char_a = part_a[index_a] if index_a < len_a else ""
+                char_b = part_b[index_b] if index_b < len_b else ""
+                order_a = VersionComparator._deb_order("" if char_a in digits else char_a)
+                order_b = VersionComparator._deb_order("" if char_b in digits else char_b)
+                if order_a != order_b:
+                    return order_a - order_b
+                index_a += 1
+                index_b += 1
+            start_a = index_a
+            while index_a < len_a and part_a[index_a] in digits:
+                index_a += 1
+            start_b = index_b
+            while index_b < len_b and part_b[index_b] in digits:
+                index_b += 1
+            number_a = int(part_a[start_a:index_a] or "0")
+            number_b = int(part_b[start_b:index_b] or "0")
+            if number_a != number_b:
+                return number_a - number_b
+        return 0
+
+    @staticmethod
+    def deb_compare(version_a, version_b):
+        """
+        Compare two Debian package versions ([epoch:]upstream[-revision])
+
+        :param version_a: str: a deb package version
+        :param version_b: str: another deb package version
+        :return: int: 1 if version_a is newer, 0 if they're the same, -1 if version_b is newer
+        """
+        parts = []
+        for version in (version_a, version_b):
+            epoch = 0
+            if ":" in version:
+                epoch, version = version.split(":", 1)
+                epoch = int(epoch)
+            upstream, _, revision = version.rpartition("-") if "-" in version else (version, "", "")
+            parts.append((epoch, upstream, revision))
+        (epoch_a, upstream_a, revision_a), (epoch_b, upstream_b, revision_b) = parts
+        result = epoch_a - epoch_b
+        if result == 0:
+            result = VersionComparator._deb_compare_part(upstream_a, upstream_b)
+        if result == 0:
+            result = VersionComparator._deb_compare_part(revision_a, revision_b)
+        return (result > 0) - (result < 0)
+
+
+class DroneSoftwareLoader(object):
+    """
+    Reads the OS and package discovery of every Drone in one query.
+    Identical JSON is shared between Drones (it's stored by hash) - so we read and parse
+    each distinct OS and package set just once.
+    """
+
+    OS_NAMES = ("os", "_init_os")
+    PACKAGE_NAMES = ("packages", "_init_packages")
+    DRONE_SOFTWARE_QUERY = """
+        MATCH (drone:Class_Drone)-[rel:jsonattr]->(json:Class_JSONMapNode)
+        WHERE rel.jsonname IN $jsonnames
+        RETURN drone.designation AS designation, rel.jsonname AS jsonname,
+               json.jhash AS jhash, json.jsontype AS jsontype
+        """
+
+    @inject.params(persistentjson="PersistentJSON")
+    def __init__(self, store, persistentjson=None):
+        """
+        :param store: Store: Store to read Drones from
+        :param persistentjson: PersistentJSON: where our (big) JSON is kept
+        """
+        self.store = store
+        self.persistentjson = persistentjson
+        self._jsontypes = {}
+        self._osinfo = {}
+
+    def _json(self, jhash):
+        "Return the parsed JSON with this hash"
+        return json.loads(self.persistentjson.get(self._jsontypes[jhash], jhash))
+
+    def _release(self, jhash):
+        "Return the (distro, release) the OS discovery with this hash describes"
+        if jhash not in self._osinfo:
+            osdata = self._json(jhash).get("data", {})
+            distro = str(osdata.get("Distributor ID", "")).lower()
+            release = VulnerabilityIndex.release_key(distro, osdata.get("Release", ""))
+            self._osinfo[jhash] = (distro, release)
+        return self._osinfo[jhash]
+
+    @staticmethod
+    def _first(jsonattrs, names):
+        "Return the hash of the first of these JSON attributes we have - or None"
+        return next((jsonattrs[name] for name in names if name in jsonattrs), None)
+
+    def drones(self):
+        """
+        Generator yielding the software each Drone is running.
+        Drones we don't (yet) have both OS and package discovery for are left out.
+
+        :return: generator(DroneSoftware): each Drone's distro, release and package set hash
+        """
+        attrs = collections.defaultdict(dict)
+        for row in self.store.load_cypher_query(
+            self.DRONE_SOFTWARE_QUERY,
+            params={"jsonnames": list(self.OS_NAMES + self.PACKAGE_NAMES)},
+            reader=True,
+        ):
+            attrs[row.designation][row.jsonname] = row.jhash
+            self._jsontypes[row.jhash] = row.jsontype
+        for designation in sorted(attrs):
+            jsonattrs = attrs[designation]
+            oshash = self._first(jsonattrs, self.OS_NAMES)
+            pkghash = self._first(jsonattrs, self.PACKAGE_NAMES)
+            if oshash is None or pkghash is None:
+                continue
+            distro, release = self._release(oshash)
+            yield DroneSoftware(designation, distro, release, pkghash)
+
+    def packages(self, pkghash):
+        """
+        Return the packages in this package set
+
+        :param pkghash: str: hash of the package discovery JSON
+        :return: {str: {str: str}}: {package type: {package name::arch: version}}
+        """
+        return self._json(pkghash).get("data", {})
+
+
+class VulnerabilityCorrelator(object):
+    """
+    Joins a VulnerabilityIndex against the packages installed on our Drones, and remembers
+    the findings - so each run yields only what changed since the last one.
+    A Drone is checked against the whole index when its OS or packages change (or fixes were
+    retracted from the index) - otherwise only against fixes added since it was last checked.
+    """
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS drones (designation TEXT PRIMARY KEY, distro TEXT,
+           osrel TEXT, pkghash TEXT, generation INTEGER)""",
+        """CREATE TABLE IF NOT EXISTS findings (designation TEXT, package TEXT, installed TEXT,
+           fixed_version TEXT, advisory TEXT, cve TEXT,
+           PRIMARY KEY (designation, package, installed, fixed_version, advisory, cve))""",
+    )
+
+    def __init__(self, index, comparator=None):
+        """
+        :param index: VulnerabilityIndex: index to correlate against - we keep our state there
+        :param comparator: VersionComparator: how to compare versions
+        """
+        self.index = index
+        self.db = index.db
+        self.comparator = VersionComparator() if comparator is None else comparator
+        self.stats = {"drones": 0, "unchanged": 0, "full": 0, "incremental": 0, "packagesets": 0}
+        with self.db:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+
+    def correlate(self, drones, load_packages, complete=True):
+        """
+        Generator yielding changes in vulnerability findings - Drone by Drone.
+        Our state is committed when the generator is exhausted.
+
+        :param drones: iterable(DroneSoftware): Drones to check
+        :param load_packages: callable(str): returns {package type: {name: version}} for a hash
+        :param complete: bool: True if 'drones' are all our Drones - so vanished Drones'
+                               findings are resolved
+        :return: generator(FindingChange): each new ('new') and fixed ('resolved') finding
+        """
+        generation, retracted = self.index.generation, self.index.retracted
+        known = {
+            row[0]: tuple(row[1:])
+            for row in self.db.execute(
+                "SELECT designation, distro, osrel, pkghash, generation FROM drones"
+            )
+        }
+        groups = collections.defaultdict(list)
+        for drone in drones:
+            self.stats["drones"] += 1
+            software = (drone.distro, drone.osrel, drone.pkghash)
+            state = known.pop(drone.designation, None)
+            since = 0
+            if state is not None and state[:3] == software and state[3] >= retracted:
+                since = state[3]
+                if since >= generation:
+                    self.stats["unchanged"] += 1
+                    continue
+            self.stats["incremental" if since else "full"] += 1
+            groups[software + (since,)].append(drone.designation)
+        # Sorting groups by package set means we only need one package set at a time
+        packages = pkghash = None
+        for distro, osrel, grouphash, since in sorted(groups):
+            if grouphash != pkghash:
+                pkghash, packages = grouphash, load_packages(grouphash)
+                self.stats["packagesets"] += 1
+            findings = set(self._evaluate(distro, osrel, packages, since))
+            for designation in groups[(distro, osrel, grouphash, since)]:
+                for change in self._update(
+                    designation, (distro, osrel, grouphash), findings, since == 0, generation
+                ):
+                    yield change
+        if complete:
+            for designation in sorted(known):
+                for change in self._update(designation, None, set(), True, generation):
+                    yield change
+        self.db.commit()
+
+    def _evaluate(self, distro, osrel, packages, since):
+        """
+        Generator yielding the vulnerabilities in a package set
+
+        :param distro: str: distribution name (lower case)
+        :param osrel: str: release - as returned by VulnerabilityIndex.release_key()
+        :param packages: {str: {str: str}}: {package type: {name::arch: version}}
+        :param since: int: only check against fixes added after this index generation
+        :return: generator(Finding): the vulnerabilities found
+        """
+        kind = self.index.PACKAGE_TYPES.get(distro)
+        if kind is None:
+            return
+        installed = collections.defaultdict(list)
+        for package, version in packages.get(kind, {}).items():
+            installed[package.split("::", 1)[0]].append((package, version))
+        compare = self.comparator.compare
+        for name, fixed, advisory, cve in self.index.fixes_for(distro, osrel, installed, since):
+            for package, version in installed[name]:
+                if compare(kind, version, fixed) < 0:
+                    yield Finding(package, version, fixed, advisory, cve)
+
+    def _update(self, designation, software, findings, full, generation):
+        """
+        Record a Drone's findings - and yield how they changed
+
+        :param designation: str: the Drone's designation
+        :param software: (str, str, str): its (distro, release, package hash) - None if it's gone
+        :param findings: set(Finding): what we found
+        :param full: bool: True if 'findings' are all its findings - not just new ones
+        :param generation: int: index generation we checked it against
+        :return: generator(FindingChange): changes in its findings
+        """
+        old = set(
+            Finding(*row)
+            for row in self.db.execute(
+                """SELECT package, installed, fixed_version, advisory, cve FROM findings
+                   WHERE designation = ?""",
+                (designation,),
+            )
+        )
+        added = sorted(findings - old)
+        resolved = sorted(old - findings) if full else []
+        self.db.executemany(
+            "INSERT OR REPLACE INTO findings VALUES (?, ?, ?, ?, ?, ?)",
+            [(designation,) + finding for finding in added],
+        )
+        self.db.executemany(
+            """DELETE FROM findings WHERE designation = ? AND package = ? AND installed = ?
+               AND fixed_version = ? AND advisory = ? AND cve = ?""",
+            [(designation,) + finding for finding in resolved],
+        )
+        if software is None:
+            self.db.execute("DELETE FROM drones WHERE designation = ?", (designation,))
+        else:
+            self.db.execute(
+                "INSERT OR REPLACE INTO drones VALUES (?, ?, ?, ?, ?)",
+                (designation,) + software + (generation,),
+            )
+        for finding in added:
+            yield FindingChange("new", designation, *finding)
+        for finding in resolved:
+            yield FindingChange("resolved", designation, *finding)
+
+    def findings(self, designation=None):
+        """
+        Generator yielding our current findings
+
+        :param designation: str: only this Drone's findings - None means all of them
+        :return: generator((str, Finding)): (designation, finding)
+        """
+        query = "SELECT * FROM findings"
+        params = ()
+        if designation is not None:
+            query += " WHERE designation = ?"
+            params = (designation,)
+        for row in self.db.execute(query + " ORDER BY designation, package", params):
+            yield row[0], Finding(*row[1:])
+
+
+def main():
+    "Update the vulnerability index - and report changed findings as newline-delimited JSON"
+    parser = optparse.OptionParser(
+        prog="vulnindex",
+        description="Correlate security announcements with the packages on our Drones",
+    )
+    parser.add_option("--index", default=DEFAULT_INDEX, help="index database [%default]")
+    parser.add_option("--centos", action="append", default=[], help="CentOS mbox directory")
+    parser.add_option("--ubuntu", action="append", default=[], help="Ubuntu mbox directory")
+    parser.add_option(
+        "--correlate", action="store_true", default=False, help="check our Drones' packages"
+    )
+    opts = parser.parse_args()[0]
+
+    index = VulnerabilityIndex(opts.index)
+    for directories, announcement_cls in (
+        (opts.centos, parsemail.CentOSAnnouncement),
+        (opts.ubuntu, parsemail.UbuntuAnnouncement),
+    ):
+        for dirname in directories:
+            added = index.ingest_directory(dirname, announcement_cls)
+            print("Added %d fixes from %s" % (added, dirname), file=sys.stderr)
+    if opts.correlate:
+        # pylint: disable=C0415
+        from cmainit import CMAInjectables
+
+        CMAInjectables.default_cma_injection_configuration({"NEO4J_READONLY": True})
+        loader = DroneSoftwareLoader(inject.instance("Store"))
+        correlator = VulnerabilityCorrelator(index)
+        for change in correlator.correlate(loader.drones(), loader.packages):
+            print(json.dumps(change._asdict(), sort_keys=True))
+        print("Correlation: %s" % json.dumps(correlator.stats, sort_keys=True), file=sys.stderr)
+        stats = correlator.comparator.stats()
+        print("Comparisons: %s" % json.dumps(stats, sort_keys=True), file=sys.stderr)
+    index.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
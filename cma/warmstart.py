@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100
+#
+# This file is part of the Assimilation Project.
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+"""
+Warm-start snapshots - so a restarted CMA doesn't have to rediscover its state one drone at a time.
+
+After a CMA restart, every returning drone costs us a Drone.find(), a ring membership check,
+crypto identity setup and best practice rule merges - each one a trip to the database.
+With thousands of drones, the STARTUP storm takes a long time to settle.
+
+A warm-start snapshot is a JSON file holding what those lookups found last time:
+    - each Drone's node id, designation, domain, addresses, port and key id
+    - the node ids of the members of our ring, in ring order
+    - our merged best practice rule chains
+We write one periodically and when we shut down cleanly, and bulk-load it into our caches
+when we start up. Nothing in it is trusted blindly:
+    - Drone.find() checks each entry against Neo4j the first time it's used
+    - ring membership is only a hint about which joins are going to fail
+    - merged rules are only reused when the database has exactly the same rule chain
+A periodic snapshot can be a few minutes out of date - and an IP address could have moved
+to another drone in the meantime. So we only use its addresses (for find() and for crypto)
+if it was written when we shut down cleanly.
+"""
+from __future__ import print_function
+import os
+import json
+import time
+import signal
+import assimglib as glib
+from cmadb import CMAdb
+from consts import CMAconsts
+from droneinfo import Drone
+from AssimCclasses import pyNetAddr, pyCryptFrame
+
+
+class WarmStart(object):
+    """
+    Writes our warm-start snapshots, and loads them back into our caches when we start up.
+    """
+
+    VERSION = 1
+    DRONES_QUERY_txt = """MATCH (drone:Class_Drone)
+        OPTIONAL MATCH (drone)-[:%s]->()-[:%s]->(ip:Class_IPaddrNode)
+        RETURN ID(drone) AS node_id, drone.designation AS designation, drone.domain AS domain,
+            drone.primary_ip_addr AS primary_ip_addr, drone.port AS port,
+            drone.startaddr AS startaddr,
+            drone.key_id AS key_id, collect([ip.ipaddr, ip.domain]) AS ipaddrs"""
+
+    def __init__(self, filename, interval=0, store=None, ring=None):
+        """
+        :param filename: str: where to keep our snapshot
+        :param interval: int: how often (in seconds) to write a snapshot - 0 means only at exit
+        :param store: Store: where to get our data from
+        :param ring: HbRing: the ring whose membership we remember
+        """
+        self.filename = filename
+        self.interval = interval
+        self.store = store
+        self.ring = ring
+        self.timer = None
+        self.mainloop = None
+        self.wakeup_watch = None
+        self.stats = {"saves": 0, "save_errors": 0, "save_ms": 0, "loaded": None}
+
+    @staticmethod
+    def from_config(config, shard=None):
+        """
+        Construct a WarmStart from our configuration. Each worker of a sharded CMA
+        has a snapshot of its own.
+
+        :param config: pyConfigContext: our configuration
+        :param shard: CMAShard: our shard - if we're one worker of a sharded CMA
+        :return: WarmStart or None: None if snapshots are turned off
+        """
+        params = config.get("warm_start", {})
+        filename = params.get("file", "")
+        if not filename:
+            return None
+        if shard is not None:
+            base, ext = os.path.splitext(filename)
+            filename = "%s-%d%s" % (base, shard.index, ext)
+        return WarmStart(filename, params.get("interval", 0), CMAdb.store, CMAdb.TheOneRing)
+
+    def collect(self, clean=False):
+        """
+        Collect everything that goes into a snapshot.
+        Each worker of a sharded CMA only snapshots the drones it owns.
+
+        :param clean: bool: True if we're shutting down cleanly
+        :return: dict: our snapshot
+        """
+        query = WarmStart.DRONES_QUERY_txt % (CMAconsts.REL_nicowner, CMAconsts.REL_ipowner)
+        drones = []
+        for row in self.store.load_cypher_query(query, reader=True):
+            if not self._owned(row.startaddr):
+                continue
+            drones.append(
+                {
+                    "node_id": row.node_id,
+                    "designation": row.designation,
+                    "domain": row.domain,
+                    "primary_ip_addr": row.primary_ip_addr,
+                    "port": row.port,
+                    "key_id": row.key_id,
+                    "ipaddrs": [pair for pair in row.ipaddrs if pair[0] is not None],
+                }
+            )
+        return {
+            "version": WarmStart.VERSION,
+            "time": time.time(),
+            "clean": clean,
+            "ring": None if self.ring is None else self.ring.name,
+            "ring_order": [] if self.ring is None else self.ring.member_ids_ring_order(),
+            "drones": drones,
+            "bp_rules": Drone.merged_rules_cache_items(),
+        }
+
+    @staticmethod
+    def _owned(startaddr):
+        """
+        Return True if the drone which started up from this address is ours to snapshot
+
+        :param startaddr: str: the address its STARTUP came from (None if it never sent one)
+        :return: bool
+        """
+        if CMAdb.shard is None:
+            return True
+        if startaddr is None or startaddr == "None":  # It never started up
+            return False
+        return CMAdb.shard.owns(pyNetAddr(startaddr))
+
+    def save(self, clean=False):
+        """
+        Write a new snapshot. Problems get logged - never raised, since a missing snapshot
+        only makes our next startup slower.
+
+        :param clean: bool: True if we're shutting down cleanly
+        :return: bool: True if we wrote a snapshot
+        """
+        start = time.time()
+        # pylint: disable=W0703
+        try:
+            self._write(self.collect(clean=clean))
+        except Exception as oops:
+            self.stats["save_errors"] += 1
+            CMAdb.log.warning("Could not save warm-start snapshot %s: %s" % (self.filename, oops))
+            return False
+        self.stats["saves"] += 1
+        self.stats["save_ms"] = int((time.time() - start) * 1000)
+        return True
+
+    def _write(self, snapshot):
+        "Write this snapshot - atomically, so a crash never leaves half a snapshot behind"
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, "w") as snapfile:
+            json.dump(snapshot, snapfile)
+        os.replace(tmpname, self.filename)
+
+    def discard(self):
+        "Throw our snapshot away - because the database it describes has been erased"
+        try:
+            os.unlink(self.filename)
+        except FileNotFoundError:
+            pass
+
+    def load(self):
+        """
+        Bulk-load our snapshot into Drone.find()'s cache, our ring, the crypto layer,
+        and our merged best practice rules.
+
+        :return: bool: True if we loaded a snapshot
+        """
+        try:
+            with open(self.filename, "r") as snapfile:
+                snapshot = json.load(snapfile)
+        except FileNotFoundError:
+            CMAdb.log.info("No warm-start snapshot in %s" % self.filename)
+            return False
+        except (IOError, OSError, ValueError) as oops:
+            CMAdb.log.warning("Ignoring warm-start snapshot %s: %s" % (self.filename, oops))
+            return False
+        if snapshot.get("version") != WarmStart.VERSION:
+            CMAdb.log.warning(
+                "Ignoring warm-start snapshot %s: version %s is not %s"
+                % (self.filename, snapshot.get("version"), WarmStart.VERSION)
+            )
+            return False
+        clean = snapshot["clean"]
+        entries = []
+        for drone in snapshot["drones"]:
+            node_id = drone["node_id"]
+            designation = drone["designation"]
+            # find() may be asked for it with or without the port it uses
+            for port in set([None, drone["port"]]):
+                entries.append((("name", drone["domain"], designation, port), node_id, designation))
+            if clean:
+                for ipaddr, domain in drone["ipaddrs"]:
+                    entries.append((("ip", domain, ipaddr), node_id, designation))
+        found = Drone.warm_find_cache(entries)
+        keys = self._warm_crypto(snapshot["drones"], clean)
+        rules = Drone.warm_merged_rules(snapshot["bp_rules"])
+        members = 0
+        if self.ring is not None and snapshot["ring"] == self.ring.name:
+            self.ring.warm_start(snapshot["ring_order"])
+            members = len(snapshot["ring_order"])
+        self.stats["loaded"] = {
+            "age": int(time.time() - snapshot["time"]),
+            "clean": clean,
+            "find": found,
+            "keys": keys,
+            "members": members,
+            "rules": rules,
+        }
+        CMAdb.log.info("Warm start from %s: %s" % (self.filename, self.stats["loaded"]))
+        if clean:
+            # If we crash before our next snapshot, this one won't be up to date any more
+            snapshot["clean"] = False
+            try:
+                self._write(snapshot)
+            except (IOError, OSError) as oops:
+                CMAdb.log.warning("Could not rewrite %s: %s" % (self.filename, oops))
+        return True
+
+    @staticmethod
+    def _warm_crypto(drones, clean):
+        """
+        Associate our drones' identities (and if 'clean' their addresses) with their key ids -
+        the same thing Drone.set_crypto_identity() does for one drone at a time.
+
+        :param drones: [dict]: drones from our snapshot
+        :param clean: bool: True if we can trust the addresses in our snapshot
+        :return: int: number of key ids we set up
+        """
+        if CMAdb.store.readonly or not CMAdb.use_network:
+            return 0
+        count = 0
+        for drone in drones:
+            key_id = drone["key_id"]
+            if not key_id:
+                continue
+            try:
+                if clean and drone["primary_ip_addr"] not in (None, "None") and drone["port"]:
+                    destaddr = pyNetAddr(drone["primary_ip_addr"], port=drone["port"])
+                    pyCryptFrame.dest_set_key_id(destaddr, key_id)
+                pyCryptFrame.associate_identity(drone["designation"], key_id)
+            except ValueError as oops:
+                CMAdb.log.warning("Warm start: no key id for %s: %s" % (drone["designation"], oops))
+                continue
+            count += 1
+        return count
+
+    def start(self, mainloop):
+        """
+        Start writing periodic snapshots, and catch SIGTERM and SIGINT so we can write one
+        more when we're told to shut down. Our signal handler quits 'mainloop', which
+        lets our caller write that snapshot once it's finished with its current packet.
+
+        :param mainloop: glib.MainLoop: the mainloop to quit when we're told to shut down
+        :return: None
+        """
+        if self.interval > 0:
+            self.timer = glib.GMainTimeout(self.interval * 1000, WarmStart._timer_callback, self)
+        self.mainloop = mainloop
+        # Python signal handlers only run when Python code does - so we have the signal
+        # wake up the mainloop through a pipe.
+        readfd, writefd = os.pipe()
+        os.set_blocking(readfd, False)
+        os.set_blocking(writefd, False)
+        signal.set_wakeup_fd(writefd)
+        self.wakeup_watch = glib.IOWatch(
+            readfd, glib.IO_IN | glib.IO_PRI, WarmStart._wakeup_callback, readfd
+        )
+        signal.signal(signal.SIGTERM, self._shutdown_signal)
+        signal.signal(signal.SIGINT, self._shutdown_signal)
+
+    @staticmethod
+    def _timer_callback(warmstart):
+        "glib timer callback: write a periodic snapshot"
+        warmstart.save()
+        return True
+
+    @staticmethod
+    def _wakeup_callback(_source, _condition, readfd):
+        "glib I/O callback: our signal handler has already run - we just empty the pipe"
+        try:
+            while os.read(readfd, 512):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def _shutdown_signal(self, signum, _frame):
+        "Signal handler: stop our mainloop so we can shut down cleanly"
+        CMAdb.log.info("Received signal %d - shutting down." % signum)
+        self.mainloop.quit()
+
+    def summary(self):
+        "Return a string summarizing our snapshots"
+        return "%d saves (%d errors, last took %d ms), loaded: %s" % (
+            self.stats["saves"],
+            self.stats["save_errors"],
+            self.stats["save_ms"],
+            self.stats["loaded"],
+        )